@@ -23,6 +23,29 @@ cdef extern from *:
     void *realloc(void *, size_t)
     void free(void *)
     void memset(void *, int, size_t)
+    void memmove(void *, void *, size_t)
+    void memcpy(void *, void *, size_t)
+    void *memchr(void *, int, size_t)
+    int memcmp(void *, void *, size_t)
+
+cdef extern from "Python.h":
+    ctypedef struct PyObject:
+        pass
+    int PyObject_AsReadBuffer(object, void **, Py_ssize_t *) except -1
+    ctypedef struct Py_buffer:
+        void *buf
+        Py_ssize_t len
+    int PyBUF_SIMPLE
+    int PyObject_CheckBuffer(object)
+    int PyObject_GetBuffer(object, Py_buffer *, int) except -1
+    void PyBuffer_Release(Py_buffer *)
+    object PyString_FromStringAndSize(char *, Py_ssize_t)
+    char *PyString_AS_STRING(object)
+    Py_ssize_t PyString_GET_SIZE(object)
+    void Py_INCREF(PyObject *)
+    void Py_DECREF(PyObject *)
+
+import array
 
 
 ctypedef Py_ssize_t int_type
@@ -33,6 +56,14 @@ cdef int_type _singleton1, _singleton2
 _singleton1 = <int_type> 0;
 _singleton2 = <int_type> -1;
 
+# The header of IntSet.to_bytes(), followed by _HEADER_WORDS words of
+# (word size, kind, count, mask, has_singleton, dummies), and then the hash
+# table itself, so that from_buffer() can use it without rehashing.
+_MAGIC = 'MLIntSet'
+cdef enum:
+    _MAGIC_SIZE = 8
+    _HEADER_WORDS = 6
+
 
 cdef class IntSet:
     """Keep a set of integer objects.
@@ -45,6 +76,17 @@ cdef class IntSet:
     cdef Py_ssize_t _mask
     cdef int_type *_array
     cdef readonly int _has_singleton
+    # The number of entries of _array that are _singleton2, from discard()
+    cdef int _dummies
+    # When _array points into a buffer (see from_buffer), _buffer is the
+    # view of it that we hold, so that it can't be freed or resized under
+    # us. The array is copied before it is changed.
+    cdef Py_buffer *_buffer
+
+    # The array.array typecode of to_array()
+    _typecode = 'l'
+    # Stored by to_bytes, since IDSet hashes values differently
+    _kind = 0
 
     def __init__(self, values=None):
         self._count = 0
@@ -54,13 +96,19 @@ cdef class IntSet:
         # There are 2, the one which indicates no value, and the one that
         # indicates 'dummy', aka removed value
         self._has_singleton = 0
+        self._dummies = 0
         if values:
             for value in values:
                 self._add(value)
 
     def __dealloc__(self):
-        if self._array != NULL:
+        if self._buffer != NULL:
+            PyBuffer_Release(self._buffer)
+            free(self._buffer)
+            self._buffer = NULL
+        elif self._array != NULL:
             free(self._array)
+        self._array = NULL
 
     def __len__(self):
         return self._count
@@ -68,10 +116,164 @@ cdef class IntSet:
     def __sizeof__(self):
         # PyType *, RefCount, + known attributes
         my_size = sizeof(IntSet)
-        if self._array != NULL:
+        if self._array != NULL and self._buffer == NULL:
             my_size += (sizeof(int_type) * (self._mask + 1))
         return my_size
 
+    cdef int _own_array(self) except -1:
+        """Copy the array out of the buffer, so that it can be changed."""
+        cdef int_type *new_array
+        cdef size_t size
+
+        if self._buffer == NULL:
+            return 0
+        size = sizeof(int_type) * (self._mask + 1)
+        new_array = <int_type *>malloc(size)
+        if new_array == NULL:
+            raise MemoryError('Failed to allocate %d bytes' % (size,))
+        memcpy(new_array, self._array, size)
+        self._array = new_array
+        PyBuffer_Release(self._buffer)
+        free(self._buffer)
+        self._buffer = NULL
+        return 1
+
+    def to_bytes(self):
+        """Return the contents of the set as a string.
+
+        The hash table is stored as is, so from_buffer() can use it
+        directly. The format is specific to the word size and byte order of
+        this machine.
+        """
+        cdef int_type header[_HEADER_WORDS]
+        cdef Py_ssize_t table_size
+        cdef char *out
+
+        table_size = 0
+        if self._array != NULL:
+            table_size = sizeof(int_type) * (self._mask + 1)
+        header[0] = sizeof(int_type)
+        header[1] = self._kind
+        header[2] = self._count
+        header[3] = self._mask
+        header[4] = self._has_singleton
+        header[5] = self._dummies
+        result = PyString_FromStringAndSize(NULL, _MAGIC_SIZE
+            + sizeof(header) + table_size)
+        out = PyString_AS_STRING(result)
+        memcpy(out, PyString_AS_STRING(_MAGIC), _MAGIC_SIZE)
+        memcpy(out + _MAGIC_SIZE, header, sizeof(header))
+        if table_size:
+            memcpy(out + _MAGIC_SIZE + sizeof(header), self._array, table_size)
+        return result
+
+    @classmethod
+    def from_buffer(cls, buf, copy=True):
+        """Create a set from the output of to_bytes().
+
+        :param buf: A string, mmap or any other object supporting the
+            buffer interface.
+        :param copy: If False, and buf supports the new buffer interface
+            (eg a bytearray) with the table aligned to a word, the hash
+            table is used in place, so opening a large set costs nothing
+            until it is looked at. The set holds a view of buf until the
+            table is first changed, when it is copied. Other objects are
+            always copied, as nothing stops them from being freed under us
+            (eg closing an mmap).
+        """
+        cdef IntSet result
+        cdef Py_buffer view
+        cdef char *c_data
+        cdef Py_ssize_t length, table_size, num_singletons
+        cdef int_type header[_HEADER_WORDS]
+        cdef int got_view
+
+        got_view = 0
+        if not copy and PyObject_CheckBuffer(buf):
+            PyObject_GetBuffer(buf, &view, PyBUF_SIMPLE)
+            got_view = 1
+        else:
+            copy = True
+            PyObject_AsReadBuffer(buf, &view.buf, &view.len)
+        try:
+            c_data = <char *>view.buf
+            length = view.len
+            if (length < _MAGIC_SIZE + sizeof(header)
+                or memcmp(c_data, PyString_AS_STRING(_MAGIC),
+                          _MAGIC_SIZE) != 0):
+                raise ValueError('buffer does not contain an IntSet')
+            memcpy(header, c_data + _MAGIC_SIZE, sizeof(header))
+            if header[0] != sizeof(int_type):
+                raise ValueError('IntSet was written with %d byte words,'
+                                 ' not %d' % (header[0], sizeof(int_type)))
+            if header[1] != cls._kind:
+                raise ValueError('buffer contains a different kind of set'
+                                 ' than %s' % (cls.__name__,))
+            num_singletons = (header[4] & 0x01) + ((header[4] >> 1) & 0x01)
+            # A lookup only stops at an empty slot, so a table without one
+            # would loop forever
+            if (header[3] < 0 or header[3] & (header[3] + 1) != 0
+                or header[4] & ~0x03 or header[5] < 0
+                or header[2] < num_singletons
+                or (header[3] == 0 and header[2] + header[5]
+                                       != num_singletons)
+                or (header[3] > 0 and header[2] - num_singletons + header[5]
+                                      > header[3])):
+                raise ValueError('buffer contains an invalid IntSet header')
+            table_size = 0
+            if header[3] > 0:
+                table_size = sizeof(int_type) * (header[3] + 1)
+            if length != _MAGIC_SIZE + sizeof(header) + table_size:
+                raise ValueError('buffer has %d bytes, not %d'
+                    % (length, _MAGIC_SIZE + sizeof(header) + table_size))
+            c_data = c_data + _MAGIC_SIZE + sizeof(header)
+            if <size_t>c_data % sizeof(int_type) != 0:
+                # The table can't be read in place
+                copy = True
+            result = cls()
+            result._count = header[2]
+            result._mask = header[3]
+            result._has_singleton = header[4]
+            result._dummies = header[5]
+            if table_size == 0:
+                return result
+            if copy:
+                result._array = <int_type *>malloc(table_size)
+                if result._array == NULL:
+                    raise MemoryError('Failed to allocate %d bytes'
+                                      % (table_size,))
+                memcpy(result._array, c_data, table_size)
+                result._check_table()
+            else:
+                result._buffer = <Py_buffer *>malloc(sizeof(Py_buffer))
+                if result._buffer == NULL:
+                    raise MemoryError('Failed to allocate %d bytes'
+                                      % (sizeof(Py_buffer),))
+                result._buffer[0] = view
+                result._array = <int_type *>c_data
+                got_view = 0
+        finally:
+            if got_view:
+                PyBuffer_Release(&view)
+        return result
+
+    cdef int _check_table(self) except -1:
+        """Check that the table agrees with _count and _dummies."""
+        cdef Py_ssize_t i, count, dummies
+
+        count = (self._has_singleton & 0x01) + (self._has_singleton >> 1)
+        dummies = 0
+        for i from 0 <= i <= self._mask:
+            if self._array[i] == _singleton2:
+                dummies += 1
+            elif self._array[i] != _singleton1:
+                count += 1
+        if count != self._count or dummies != self._dummies:
+            raise ValueError('buffer contains %d values and %d dummies,'
+                             ' not %d and %d' % (count, dummies,
+                                                 self._count, self._dummies))
+        return 0
+
     def _peek_array(self):
         cdef Py_ssize_t i, size
         if self._array == NULL:
@@ -157,7 +359,12 @@ cdef class IntSet:
             self._array = <int_type*>malloc(sizeof(int_type) * 256)
             memset(self._array, _singleton1, sizeof(int_type) * 256)
             return 0
-        new_size = old_size * 2
+        if self._count * 4 > old_mask:
+            new_size = old_size * 2
+        else:
+            # Mostly discarded entries, just clean them out
+            new_size = old_size
+        self._dummies = 0
         # Replace 'in place', grow to a new array, and add items back in
         # Note that if it weren't for collisions, we could actually 'realloc()'
         # and insert backwards. Since expanding mask means something will only
@@ -195,7 +402,10 @@ cdef class IntSet:
             self._has_singleton = self._has_singleton | 0x02
             self._count = self._count + 1
             return 1
-        if self._array == NULL or self._count * 4 > self._mask:
+        if self._buffer != NULL:
+            self._own_array()
+        if (self._array == NULL
+            or (self._count + self._dummies) * 4 > self._mask):
             self._grow()
         entry = self._lookup(c_val)
         if entry[0] == c_val:
@@ -203,6 +413,8 @@ cdef class IntSet:
             return 0
         if entry[0] == _singleton1 or entry[0] == _singleton2:
             # No value stored at this location
+            if entry[0] == _singleton2:
+                self._dummies = self._dummies - 1
             entry[0] = c_val
             self._count = self._count + 1
             return 1
@@ -214,6 +426,188 @@ cdef class IntSet:
         """Add a new entry to the set."""
         self._add(val)
 
+    cdef int_type _from_object(self, val) except? -1:
+        return val
+
+    cdef object _to_object(self, int_type c_val):
+        return c_val
+
+    cdef int _discard(self, int_type c_val) except -1:
+        cdef int_type *entry
+        if c_val == _singleton1:
+            if not self._has_singleton & 0x01:
+                return 0
+            self._has_singleton = self._has_singleton & ~0x01
+            self._count = self._count - 1
+            return 1
+        elif c_val == _singleton2:
+            if not self._has_singleton & 0x02:
+                return 0
+            self._has_singleton = self._has_singleton & ~0x02
+            self._count = self._count - 1
+            return 1
+        if self._array == NULL:
+            return 0
+        entry = self._lookup(c_val)
+        if entry[0] != c_val:
+            return 0
+        if self._buffer != NULL:
+            self._own_array()
+            entry = self._lookup(c_val)
+        # Leave a dummy, so that lookups keep searching past this entry
+        entry[0] = _singleton2
+        self._count = self._count - 1
+        self._dummies = self._dummies + 1
+        return 1
+
+    def discard(self, val):
+        """Remove val from the set, if it is present."""
+        self._discard(self._from_object(val))
+
+    def remove(self, val):
+        """Remove val from the set, raising KeyError if it isn't present."""
+        if not self._discard(self._from_object(val)):
+            raise KeyError(val)
+
+    def __iter__(self):
+        return _IntSetIterator(self)
+
+    cdef int _update(self, IntSet other) except -1:
+        """Add all of the values of other."""
+        cdef Py_ssize_t i
+        cdef int_type val
+
+        if other._has_singleton & 0x01:
+            self._add(_singleton1)
+        if other._has_singleton & 0x02:
+            self._add(_singleton2)
+        if other._array == NULL:
+            return 0
+        for i from 0 <= i <= other._mask:
+            val = other._array[i]
+            if val != _singleton1 and val != _singleton2:
+                self._add(val)
+        return 0
+
+    cdef IntSet _as_same_type(self, other):
+        if isinstance(other, IntSet):
+            return other
+        return type(self)(other)
+
+    def update(self, values):
+        """Add all of the values of an iterable (or another IntSet)."""
+        if isinstance(values, IntSet):
+            self._update(values)
+        else:
+            for value in values:
+                self._add(self._from_object(value))
+
+    def update_from_buffer(self, buf):
+        """Add the values of a buffer of machine words.
+
+        eg an array.array('l') (or 'L' for an IDSet), or a string, which
+        avoids creating an integer object for every value.
+        """
+        cdef void *data
+        cdef Py_ssize_t length, i, count
+        cdef int_type *values
+
+        PyObject_AsReadBuffer(buf, &data, &length)
+        if length % sizeof(int_type) != 0:
+            raise ValueError('buffer length %d is not a multiple of %d'
+                             % (length, sizeof(int_type)))
+        values = <int_type *>data
+        count = length / sizeof(int_type)
+        for i from 0 <= i < count:
+            self._add(values[i])
+
+    def to_array(self):
+        """Return the values as an array.array, in no particular order."""
+        cdef Py_ssize_t i, count
+        cdef int_type *values
+        cdef int_type val
+
+        values = <int_type *>malloc(sizeof(int_type) * (self._count + 1))
+        if values == NULL:
+            raise MemoryError('Failed to allocate %d bytes'
+                              % (sizeof(int_type) * (self._count + 1),))
+        try:
+            count = 0
+            if self._has_singleton & 0x01:
+                values[count] = _singleton1
+                count = count + 1
+            if self._has_singleton & 0x02:
+                values[count] = _singleton2
+                count = count + 1
+            if self._array != NULL:
+                for i from 0 <= i <= self._mask:
+                    val = self._array[i]
+                    if val != _singleton1 and val != _singleton2:
+                        values[count] = val
+                        count = count + 1
+            result = array.array(self._typecode)
+            result.fromstring(PyString_FromStringAndSize(<char *>values,
+                sizeof(int_type) * count))
+        finally:
+            free(values)
+        return result
+
+    def union(self, other):
+        """Return a new set with the values of both sets."""
+        cdef IntSet result
+        result = type(self)()
+        result._update(self)
+        result._update(self._as_same_type(other))
+        return result
+
+    def intersection(self, other):
+        """Return a new set with the values that are in both sets."""
+        cdef IntSet result, c_other, smaller, larger
+        cdef Py_ssize_t i
+        cdef int_type val
+
+        c_other = self._as_same_type(other)
+        if c_other._count < self._count:
+            smaller = c_other
+            larger = self
+        else:
+            smaller = self
+            larger = c_other
+        result = type(self)()
+        if smaller._has_singleton & 0x01 and larger._has_singleton & 0x01:
+            result._add(_singleton1)
+        if smaller._has_singleton & 0x02 and larger._has_singleton & 0x02:
+            result._add(_singleton2)
+        if smaller._array == NULL:
+            return result
+        for i from 0 <= i <= smaller._mask:
+            val = smaller._array[i]
+            if (val != _singleton1 and val != _singleton2
+                and larger._contains(val)):
+                result._add(val)
+        return result
+
+    def difference(self, other):
+        """Return a new set with the values that are not in other."""
+        cdef IntSet result, c_other
+        cdef Py_ssize_t i
+        cdef int_type val
+
+        c_other = self._as_same_type(other)
+        result = type(self)()
+        if self._has_singleton & 0x01 and not c_other._has_singleton & 0x01:
+            result._add(_singleton1)
+        if self._has_singleton & 0x02 and not c_other._has_singleton & 0x02:
+            result._add(_singleton2)
+        if self._array == NULL:
+            return result
+        for i from 0 <= i <= self._mask:
+            val = self._array[i]
+            if (val != _singleton1 and val != _singleton2
+                and not c_other._contains(val)):
+                result._add(val)
+        return result
+
 
 cdef class IDSet(IntSet):
     """Track a set of object ids (addresses).
@@ -228,11 +622,24 @@ cdef class IDSet(IntSet):
     value overflow on 32-bits if the highest bit is set.
     """
 
+    _typecode = 'L'
+    _kind = 1
+
     def add(self, val):
         cdef unsigned long ul_val
         ul_val = val
         self._add(<int_type>(ul_val))
 
+    cdef int_type _from_object(self, val) except? -1:
+        cdef unsigned long ul_val
+        ul_val = val
+        return <int_type>ul_val
+
+    cdef object _to_object(self, int_type c_val):
+        if c_val >= 0:
+            return c_val
+        return <unsigned long>c_val
+
     def __contains__(self, val):
         cdef unsigned long ul_val
         ul_val = val
@@ -282,3 +689,679 @@ cdef class IDSet(IntSet):
                 freeslot = entry
             perturb = perturb >> 5 # PERTURB_SHIFT
 
+
+cdef class _IntSetIterator:
+    """Iterate the values of an IntSet."""
+
+    cdef IntSet intset
+    cdef Py_ssize_t initial_count
+    # -2 and -1 are the singletons, then the offsets in the array
+    cdef Py_ssize_t pos
+
+    def __init__(self, intset):
+        self.intset = intset
+        self.initial_count = self.intset._count
+        self.pos = -2
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef int_type val
+
+        if self.intset._count != self.initial_count:
+            raise RuntimeError('IntSet changed size during iteration')
+        if self.pos == -2:
+            self.pos = -1
+            if self.intset._has_singleton & 0x01:
+                return self.intset._to_object(_singleton1)
+        if self.pos == -1:
+            self.pos = 0
+            if self.intset._has_singleton & 0x02:
+                return self.intset._to_object(_singleton2)
+        if self.intset._array == NULL:
+            raise StopIteration
+        while self.pos <= self.intset._mask:
+            val = self.intset._array[self.pos]
+            self.pos = self.pos + 1
+            if val != _singleton1 and val != _singleton2:
+                return self.intset._to_object(val)
+        raise StopIteration
+
+
+# AddressSet stores address >> 3 split into the high bits, which select a
+# container, and the low 16 bits which are stored in the container. A
+# container is a sorted array of the low bits, until it has more than
+# _ARRAY_MAX members, and then it becomes a bitmap of all 65536 values.
+cdef enum:
+    _ARRAY_MAX = 4096
+    # A bitmap shrinks back into an array when it gets this small
+    _ARRAY_MIN = 2048
+    _BITMAP_WORDS = 1024
+
+
+ctypedef struct _Container:
+    unsigned long high
+    long count
+    # The number of entries allocated in values, 0 for a bitmap
+    long alloc
+    unsigned short *values
+    unsigned long long *bits
+
+
+cdef object _ulong_to_object(unsigned long val):
+    # Return an int rather than a long when we can
+    if <long>val >= 0:
+        return <long>val
+    return val
+
+
+cdef long _search_u16(unsigned short *values, long count, unsigned short low):
+    """Return the offset of low in values, or where it would be inserted."""
+    cdef long lo, hi, mid
+
+    lo = 0
+    hi = count
+    while lo < hi:
+        mid = (lo + hi) / 2
+        if values[mid] < low:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+cdef int _container_contains(_Container *c, unsigned short low):
+    cdef long offset
+
+    if c.bits != NULL:
+        return (c.bits[low >> 6] >> (low & 63)) & 1
+    offset = _search_u16(c.values, c.count, low)
+    return offset < c.count and c.values[offset] == low
+
+
+cdef int _container_to_bitmap(_Container *c) except -1:
+    cdef unsigned long long *bits
+    cdef long i
+
+    bits = <unsigned long long *>malloc(sizeof(unsigned long long)
+                                        * _BITMAP_WORDS)
+    if bits == NULL:
+        raise MemoryError('Failed to allocate %d bytes'
+                          % (sizeof(unsigned long long) * _BITMAP_WORDS,))
+    memset(bits, 0, sizeof(unsigned long long) * _BITMAP_WORDS)
+    for i from 0 <= i < c.count:
+        bits[c.values[i] >> 6] = (bits[c.values[i] >> 6]
+                                  | (<unsigned long long>1 << (c.values[i] & 63)))
+    free(c.values)
+    c.values = NULL
+    c.alloc = 0
+    c.bits = bits
+    return 0
+
+
+cdef int _container_to_array(_Container *c) except -1:
+    cdef unsigned short *values
+    cdef long i, count
+
+    values = <unsigned short *>malloc(sizeof(unsigned short) * c.count)
+    if values == NULL:
+        raise MemoryError('Failed to allocate %d bytes'
+                          % (sizeof(unsigned short) * c.count,))
+    count = 0
+    for i from 0 <= i < 65536:
+        if (c.bits[i >> 6] >> (i & 63)) & 1:
+            values[count] = i
+            count = count + 1
+    free(c.bits)
+    c.bits = NULL
+    c.values = values
+    c.alloc = c.count
+    return 0
+
+
+cdef int _container_add(_Container *c, unsigned short low) except -1:
+    """Add low to the container, returning 1 if it wasn't present."""
+    cdef long offset, new_alloc
+    cdef unsigned short *new_values
+
+    if c.bits != NULL:
+        if (c.bits[low >> 6] >> (low & 63)) & 1:
+            return 0
+        c.bits[low >> 6] = c.bits[low >> 6] | (<unsigned long long>1
+                                                << (low & 63))
+        c.count = c.count + 1
+        return 1
+    offset = _search_u16(c.values, c.count, low)
+    if offset < c.count and c.values[offset] == low:
+        return 0
+    if c.count >= _ARRAY_MAX:
+        _container_to_bitmap(c)
+        return _container_add(c, low)
+    if c.count == c.alloc:
+        new_alloc = c.alloc * 2
+        if new_alloc < 4:
+            new_alloc = 4
+        new_values = <unsigned short *>realloc(c.values,
+            sizeof(unsigned short) * new_alloc)
+        if new_values == NULL:
+            raise MemoryError('Failed to allocate %d bytes'
+                              % (sizeof(unsigned short) * new_alloc,))
+        c.values = new_values
+        c.alloc = new_alloc
+    memmove(c.values + offset + 1, c.values + offset,
+            sizeof(unsigned short) * (c.count - offset))
+    c.values[offset] = low
+    c.count = c.count + 1
+    return 1
+
+
+cdef int _container_discard(_Container *c, unsigned short low) except -1:
+    """Remove low from the container, returning 1 if it was present."""
+    cdef long offset
+
+    if c.bits != NULL:
+        if not (c.bits[low >> 6] >> (low & 63)) & 1:
+            return 0
+        c.bits[low >> 6] = c.bits[low >> 6] & ~(<unsigned long long>1
+                                                 << (low & 63))
+        c.count = c.count - 1
+        if c.count <= _ARRAY_MIN:
+            _container_to_array(c)
+        return 1
+    offset = _search_u16(c.values, c.count, low)
+    if offset >= c.count or c.values[offset] != low:
+        return 0
+    memmove(c.values + offset, c.values + offset + 1,
+            sizeof(unsigned short) * (c.count - offset - 1))
+    c.count = c.count - 1
+    return 1
+
+
+cdef class AddressSet:
+    """A compressed set of object addresses.
+
+    Addresses are aligned to (at least) 8 bytes, and objects are clustered
+    in pools and arenas. So rather than storing every address in a hash
+    table like IDSet, this stores address >> 3 in containers of 65536
+    consecutive values, each either a sorted array of 16-bit offsets or a
+    bitmap. Dense regions cost a bit per address, sparse ones 2 bytes.
+    Values which aren't 8-byte aligned are kept in a separate IDSet.
+
+    It has the same interface as IDSet, and iterates in sorted order, the
+    unaligned values merged in with the others.
+    """
+
+    cdef _Container *_containers
+    cdef long _num_containers
+    cdef long _alloc_containers
+    cdef Py_ssize_t _count
+    cdef IDSet _unaligned
+
+    _typecode = 'L'
+
+    def __init__(self, values=None):
+        self._unaligned = None
+        if values:
+            self.update(values)
+
+    def __dealloc__(self):
+        cdef long i
+
+        if self._containers != NULL:
+            for i from 0 <= i < self._num_containers:
+                free(self._containers[i].values)
+                free(self._containers[i].bits)
+            free(self._containers)
+            self._containers = NULL
+
+    def __len__(self):
+        if self._unaligned is not None:
+            return self._count + self._unaligned._count
+        return self._count
+
+    def __sizeof__(self):
+        cdef long i
+
+        my_size = sizeof(AddressSet)
+        my_size += sizeof(_Container) * self._alloc_containers
+        for i from 0 <= i < self._num_containers:
+            if self._containers[i].bits != NULL:
+                my_size += sizeof(unsigned long long) * _BITMAP_WORDS
+            else:
+                my_size += sizeof(unsigned short) * self._containers[i].alloc
+        if self._unaligned is not None:
+            my_size += self._unaligned.__sizeof__()
+        return my_size
+
+    cdef long _find_container(self, unsigned long high):
+        """Return the offset of the container for high, or where it goes."""
+        cdef long lo, hi, mid
+
+        lo = 0
+        hi = self._num_containers
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self._containers[mid].high < high:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    cdef _Container *_get_container(self, unsigned long high):
+        cdef long offset
+
+        offset = self._find_container(high)
+        if (offset < self._num_containers
+            and self._containers[offset].high == high):
+            return self._containers + offset
+        return NULL
+
+    cdef _Container *_new_container(self, unsigned long high) except NULL:
+        cdef long offset, new_alloc
+        cdef _Container *new_containers
+
+        offset = self._find_container(high)
+        if self._num_containers == self._alloc_containers:
+            new_alloc = self._alloc_containers * 2
+            if new_alloc < 4:
+                new_alloc = 4
+            new_containers = <_Container *>realloc(self._containers,
+                sizeof(_Container) * new_alloc)
+            if new_containers == NULL:
+                raise MemoryError('Failed to allocate %d bytes'
+                                  % (sizeof(_Container) * new_alloc,))
+            self._containers = new_containers
+            self._alloc_containers = new_alloc
+        memmove(self._containers + offset + 1, self._containers + offset,
+                sizeof(_Container) * (self._num_containers - offset))
+        self._num_containers = self._num_containers + 1
+        memset(self._containers + offset, 0, sizeof(_Container))
+        self._containers[offset].high = high
+        return self._containers + offset
+
+    cdef int _add(self, unsigned long val) except -1:
+        cdef _Container *c
+        cdef unsigned long key
+
+        if val & 7:
+            if self._unaligned is None:
+                self._unaligned = IDSet()
+            return self._unaligned._add(<int_type>val)
+        key = val >> 3
+        c = self._get_container(key >> 16)
+        if c == NULL:
+            c = self._new_container(key >> 16)
+        if _container_add(c, key & 0xFFFF):
+            self._count = self._count + 1
+            return 1
+        return 0
+
+    cdef int _contains(self, unsigned long val) except -1:
+        cdef _Container *c
+        cdef unsigned long key
+
+        if val & 7:
+            if self._unaligned is None:
+                return 0
+            return self._unaligned._contains(<int_type>val)
+        key = val >> 3
+        c = self._get_container(key >> 16)
+        if c == NULL:
+            return 0
+        return _container_contains(c, key & 0xFFFF)
+
+    cdef int _discard(self, unsigned long val) except -1:
+        cdef _Container *c
+        cdef long offset
+        cdef unsigned long key
+
+        if val & 7:
+            if self._unaligned is None:
+                return 0
+            return self._unaligned._discard(<int_type>val)
+        key = val >> 3
+        offset = self._find_container(key >> 16)
+        if (offset >= self._num_containers
+            or self._containers[offset].high != key >> 16):
+            return 0
+        c = self._containers + offset
+        if not _container_discard(c, key & 0xFFFF):
+            return 0
+        self._count = self._count - 1
+        if c.count == 0:
+            free(c.values)
+            free(c.bits)
+            memmove(self._containers + offset, self._containers + offset + 1,
+                    sizeof(_Container) * (self._num_containers - offset - 1))
+            self._num_containers = self._num_containers - 1
+        return 1
+
+    def add(self, val):
+        """Add a new entry to the set."""
+        cdef unsigned long ul_val
+        ul_val = val
+        self._add(ul_val)
+
+    def __contains__(self, val):
+        cdef unsigned long ul_val
+        ul_val = val
+        return bool(self._contains(ul_val))
+
+    def discard(self, val):
+        """Remove val from the set, if it is present."""
+        cdef unsigned long ul_val
+        ul_val = val
+        self._discard(ul_val)
+
+    def remove(self, val):
+        """Remove val from the set, raising KeyError if it isn't present."""
+        cdef unsigned long ul_val
+        ul_val = val
+        if not self._discard(ul_val):
+            raise KeyError(val)
+
+    def __iter__(self):
+        return _AddressSetIterator(self)
+
+    cdef int _update(self, AddressSet other) except -1:
+        cdef long i, j
+        cdef _Container *c
+        cdef unsigned long base
+
+        for i from 0 <= i < other._num_containers:
+            c = other._containers + i
+            base = c.high << 16
+            if c.bits != NULL:
+                for j from 0 <= j < 65536:
+                    if (c.bits[j >> 6] >> (j & 63)) & 1:
+                        self._add((base | j) << 3)
+            else:
+                for j from 0 <= j < c.count:
+                    self._add((base | c.values[j]) << 3)
+        if other._unaligned is not None:
+            if self._unaligned is None:
+                self._unaligned = IDSet()
+            self._unaligned._update(other._unaligned)
+        return 0
+
+    cdef AddressSet _as_address_set(self, other):
+        if isinstance(other, AddressSet):
+            return other
+        return AddressSet(other)
+
+    def update(self, values):
+        """Add all of the values of an iterable (or another AddressSet)."""
+        cdef unsigned long ul_val
+
+        if isinstance(values, AddressSet):
+            self._update(values)
+        else:
+            for value in values:
+                ul_val = value
+                self._add(ul_val)
+
+    def update_from_buffer(self, buf):
+        """Add the values of a buffer of unsigned longs (eg array('L'))."""
+        cdef void *data
+        cdef Py_ssize_t length, i, count
+        cdef unsigned long *values
+
+        PyObject_AsReadBuffer(buf, &data, &length)
+        if length % sizeof(unsigned long) != 0:
+            raise ValueError('buffer length %d is not a multiple of %d'
+                             % (length, sizeof(unsigned long)))
+        values = <unsigned long *>data
+        count = length / sizeof(unsigned long)
+        for i from 0 <= i < count:
+            self._add(values[i])
+
+    def to_array(self):
+        """Return the values as an array.array('L'), sorted."""
+        cdef long i, j, count, num_unaligned
+        cdef _Container *c
+        cdef unsigned long base, val
+        cdef unsigned long *values
+
+        if self._unaligned is None:
+            unaligned = []
+        else:
+            unaligned = _sorted_unaligned(self._unaligned)
+        num_unaligned = len(unaligned)
+        values = <unsigned long *>malloc(sizeof(unsigned long)
+            * (self._count + num_unaligned + 1))
+        if values == NULL:
+            raise MemoryError('Failed to allocate %d bytes'
+                              % (sizeof(unsigned long)
+                                 * (self._count + num_unaligned + 1),))
+        try:
+            count = 0
+            for i from 0 <= i < self._num_containers:
+                c = self._containers + i
+                base = c.high << 16
+                if c.bits != NULL:
+                    for j from 0 <= j < 65536:
+                        if (c.bits[j >> 6] >> (j & 63)) & 1:
+                            values[count] = (base | j) << 3
+                            count = count + 1
+                else:
+                    for j from 0 <= j < c.count:
+                        values[count] = (base | c.values[j]) << 3
+                        count = count + 1
+            # Merge in the unaligned values, filling from the end
+            i = count - 1
+            j = num_unaligned - 1
+            count = count + num_unaligned
+            while j >= 0:
+                val = unaligned[j]
+                if i >= 0 and values[i] > val:
+                    values[i + j + 1] = values[i]
+                    i = i - 1
+                else:
+                    values[i + j + 1] = val
+                    j = j - 1
+            result = array.array('L')
+            result.fromstring(PyString_FromStringAndSize(<char *>values,
+                sizeof(unsigned long) * count))
+        finally:
+            free(values)
+        return result
+
+    def union(self, other):
+        """Return a new set with the values of both sets."""
+        cdef AddressSet result
+        result = AddressSet()
+        result._update(self)
+        result._update(self._as_address_set(other))
+        return result
+
+    cdef AddressSet _filter(self, AddressSet other, int keep_common):
+        """Return the values of self which are (not) in other."""
+        cdef AddressSet result
+        cdef long i, j
+        cdef _Container *c, *other_c
+        cdef unsigned long base
+
+        result = AddressSet()
+        for i from 0 <= i < self._num_containers:
+            c = self._containers + i
+            other_c = other._get_container(c.high)
+            if other_c == NULL and keep_common:
+                continue
+            base = c.high << 16
+            if c.bits != NULL:
+                for j from 0 <= j < 65536:
+                    if not (c.bits[j >> 6] >> (j & 63)) & 1:
+                        continue
+                    if ((other_c != NULL and _container_contains(other_c, j))
+                        == keep_common):
+                        result._add((base | j) << 3)
+            else:
+                for j from 0 <= j < c.count:
+                    if ((other_c != NULL
+                         and _container_contains(other_c, c.values[j]))
+                        == keep_common):
+                        result._add((base | c.values[j]) << 3)
+        if self._unaligned is not None:
+            if other._unaligned is None:
+                other_unaligned = IDSet()
+            else:
+                other_unaligned = other._unaligned
+            if keep_common:
+                result._unaligned = self._unaligned.intersection(
+                    other_unaligned)
+            else:
+                result._unaligned = self._unaligned.difference(
+                    other_unaligned)
+        return result
+
+    def intersection(self, other):
+        """Return a new set with the values that are in both sets."""
+        return self._filter(self._as_address_set(other), 1)
+
+    def difference(self, other):
+        """Return a new set with the values that are not in other."""
+        return self._filter(self._as_address_set(other), 0)
+
+
+cdef object _sorted_unaligned(IDSet unaligned):
+    """Return the values of an IDSet as unsigned longs, sorted."""
+    cdef int_type value
+
+    result = []
+    for obj in unaligned:
+        value = obj
+        result.append(_ulong_to_object(<unsigned long>value))
+    result.sort()
+    return result
+
+
+cdef class _AddressSetIterator:
+    """Iterate the values of an AddressSet, merging the two sorted streams.
+
+    The aligned values come from the containers, and the unaligned ones
+    from a sorted copy of the IDSet.
+    """
+
+    cdef AddressSet addresses
+    cdef Py_ssize_t initial_count
+    cdef long container
+    # The offset in the values of an array container, or the bit of a bitmap
+    cdef long pos
+    # The next aligned value, if has_aligned
+    cdef unsigned long aligned
+    cdef int has_aligned
+    cdef object unaligned
+    cdef Py_ssize_t unaligned_pos
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.initial_count = len(self.addresses)
+        self.container = 0
+        self.pos = 0
+        if self.addresses._unaligned is None:
+            self.unaligned = []
+        else:
+            self.unaligned = _sorted_unaligned(self.addresses._unaligned)
+        self.unaligned_pos = 0
+        self._next_aligned()
+
+    cdef int _next_aligned(self) except -1:
+        """Find the next aligned value, setting has_aligned if there is one."""
+        cdef _Container *c
+
+        while self.container < self.addresses._num_containers:
+            c = self.addresses._containers + self.container
+            if c.bits != NULL:
+                while self.pos < 65536:
+                    self.pos = self.pos + 1
+                    if (c.bits[(self.pos - 1) >> 6]
+                        >> ((self.pos - 1) & 63)) & 1:
+                        self.aligned = ((c.high << 16) | (self.pos - 1)) << 3
+                        self.has_aligned = 1
+                        return 0
+            elif self.pos < c.count:
+                self.pos = self.pos + 1
+                self.aligned = ((c.high << 16) | c.values[self.pos - 1]) << 3
+                self.has_aligned = 1
+                return 0
+            self.container = self.container + 1
+            self.pos = 0
+        self.has_aligned = 0
+        return 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef unsigned long val
+
+        if len(self.addresses) != self.initial_count:
+            raise RuntimeError('AddressSet changed size during iteration')
+        if self.unaligned_pos < len(self.unaligned):
+            val = self.unaligned[self.unaligned_pos]
+            if not self.has_aligned or val < self.aligned:
+                self.unaligned_pos = self.unaligned_pos + 1
+                return _ulong_to_object(val)
+        if not self.has_aligned:
+            raise StopIteration
+        val = self.aligned
+        self._next_aligned()
+        return _ulong_to_object(val)
+
+
+cdef char *_address_prefix
+_address_prefix = '{"address": '
+cdef enum:
+    _ADDRESS_PREFIX_LEN = 12
+
+
+def filter_new_lines(AddressSet seen, block):
+    """Keep the lines of a dump for objects that haven't been seen before.
+
+    This is the inner loop of strip_duplicates, it parses the leading
+    '{"address": N' of every line without a regex or creating objects.
+
+    :param seen: The addresses of the lines kept so far, updated with the
+        new ones.
+    :param block: A string of complete lines. Lines that don't start with
+        an address (such as the '[' and ']' around a json list) are dropped.
+    :return: (new_block, num_lines, num_kept)
+    """
+    cdef char *start, *end, *line_end, *pos, *out
+    cdef Py_ssize_t length, num_lines, num_kept, line_len
+    cdef unsigned long address
+    cdef int has_digits
+
+    length = PyString_GET_SIZE(block)
+    start = PyString_AS_STRING(block)
+    end = start + length
+    result = PyString_FromStringAndSize(NULL, length)
+    out = PyString_AS_STRING(result)
+    num_lines = num_kept = 0
+    while start < end:
+        line_end = <char *>memchr(start, c'\n', end - start)
+        if line_end == NULL:
+            line_end = end
+        else:
+            line_end = line_end + 1
+        line_len = line_end - start
+        num_lines = num_lines + 1
+        if (line_len > _ADDRESS_PREFIX_LEN
+            and memcmp(start, _address_prefix, _ADDRESS_PREFIX_LEN) == 0):
+            address = 0
+            has_digits = 0
+            pos = start + _ADDRESS_PREFIX_LEN
+            while pos < line_end and pos[0] >= c'0' and pos[0] <= c'9':
+                address = address * 10 + (pos[0] - c'0')
+                has_digits = 1
+                pos = pos + 1
+            if has_digits and seen._add(address):
+                memcpy(out, start, line_len)
+                out = out + line_len
+                num_kept = num_kept + 1
+        start = line_end
+    length = out - PyString_AS_STRING(result)
+    if length < PyString_GET_SIZE(result):
+        result = result[:length]
+    return result, num_lines, num_kept
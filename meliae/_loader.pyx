@@ -20,14 +20,25 @@ cdef extern from "Python.h":
         pass
     PyObject *Py_None
     void *PyMem_Malloc(size_t)
+    void *PyMem_Realloc(void *, size_t)
     void PyMem_Free(void *)
 
     ctypedef int (*visitproc)(PyObject *, void *)
     ctypedef int (*traverseproc)(PyObject *, visitproc, void *)
+    ctypedef struct PyTypeObject
+    ctypedef PyObject *(*allocfunc)(PyTypeObject *, Py_ssize_t)
+    ctypedef void (*freefunc)(void *)
     ctypedef struct PyTypeObject:
         # hashfunc tp_hash
         # richcmpfunc tp_richcompare
         traverseproc tp_traverse
+        allocfunc tp_alloc
+        freefunc tp_free
+        Py_ssize_t tp_basicsize
+
+    PyObject *PyObject_INIT(PyObject *, PyTypeObject *)
+    unsigned long PyInt_AsUnsignedLongMask(PyObject *) except? -1
+    void PyObject_GC_Track(void *)
 
     long PyObject_Hash(PyObject *) except -1
 
@@ -43,13 +54,30 @@ cdef extern from "Python.h":
     void Py_DECREF(PyObject*)
     object PyTuple_New(Py_ssize_t)
     object PyTuple_SET_ITEM(object, Py_ssize_t, object)
+    void PyTuple_SET_ITEM_ptr "PyTuple_SET_ITEM" (object, Py_ssize_t,
+                                                  PyObject *)
     int PyObject_RichCompareBool(PyObject *, PyObject *, int) except -1
     int Py_EQ
     void memset(void *, int, size_t)
+    int memcmp(void *, void *, size_t)
+    void *memcpy(void *, void *, size_t)
+    int PyString_CheckExact(object)
+    char *PyString_AS_STRING(object)
+    Py_ssize_t PyString_GET_SIZE(object)
+    object PyString_FromStringAndSize(char *, Py_ssize_t)
+    int PyObject_AsWriteBuffer(object, void **, Py_ssize_t *) except -1
 
     # void fprintf(void *, char *, ...)
     # void *stderr
 
+cdef extern from "stdlib.h":
+    void qsort(void *, size_t, size_t, int (*)(void *, void *))
+
+cdef extern from "math.h":
+    double log(double)
+    float HUGE_VALF
+
+import array
 import gc
 from meliae import warn
 
@@ -173,6 +201,606 @@ cdef object _format_list(RefList *ref_list):
     return ''.join(ref_str)
 
 
+cdef int _compare_ulong(void *a, void *b):
+    if (<unsigned long *>a)[0] < (<unsigned long *>b)[0]:
+        return -1
+    if (<unsigned long *>a)[0] > (<unsigned long *>b)[0]:
+        return 1
+    return 0
+
+
+ctypedef struct _AddressOffset:
+    unsigned long address
+    unsigned long offset
+
+
+cdef int _compare_address_offset(void *a, void *b):
+    cdef _AddressOffset *x, *y
+
+    x = <_AddressOffset *>a
+    y = <_AddressOffset *>b
+    if x.address != y.address:
+        if x.address < y.address:
+            return -1
+        return 1
+    if x.offset < y.offset:
+        return -1
+    if x.offset > y.offset:
+        return 1
+    return 0
+
+
+cdef int _in_sorted(unsigned long *values, long count, unsigned long value):
+    """Binary search for value in the sorted values."""
+    cdef long low, high, mid
+
+    low = 0
+    high = count
+    while low < high:
+        mid = (low + high) / 2
+        if values[mid] < value:
+            low = mid + 1
+        else:
+            high = mid
+    return low < count and values[low] == value
+
+
+cdef long *_new_long_array(long count) except NULL:
+    """Allocate an array of 'count' longs, raising MemoryError on failure."""
+    cdef long *arr
+
+    if count < 1:
+        count = 1
+    arr = <long *>PyMem_Malloc(sizeof(long) * count)
+    if arr == NULL:
+        raise MemoryError('Failed to allocate %d bytes'
+                          % (sizeof(long) * count,))
+    return arr
+
+
+cdef long _dom_eval(long v, long *ancestor, long *label, long *semi,
+                    long *stack):
+    """The 'eval' step of Lengauer-Tarjan, with path compression.
+
+    The textbook version of 'compress' is recursive, which would overflow the C
+    stack on long reference chains, so we walk up the ancestors first, and then
+    compress the path back down.
+    """
+    cdef long u, a, top
+
+    if ancestor[v] == -1:
+        return v
+    top = 0
+    u = v
+    while ancestor[ancestor[u]] != -1:
+        stack[top] = u
+        top += 1
+        u = ancestor[u]
+    while top > 0:
+        top -= 1
+        u = stack[top]
+        a = ancestor[u]
+        if semi[label[a]] < semi[label[u]]:
+            label[u] = label[a]
+        ancestor[u] = ancestor[a]
+    return label[v]
+
+
+cdef inline unsigned long long _mix64(unsigned long long x):
+    """The splitmix64 finalizer, a cheap and well distributed integer hash."""
+    x = x + <unsigned long long>0x9E3779B97F4A7C15ULL
+    x = (x ^ (x >> 30)) * <unsigned long long>0xBF58476D1CE4E5B9ULL
+    x = (x ^ (x >> 27)) * <unsigned long long>0x94D049BB133111EBULL
+    return x ^ (x >> 31)
+
+
+# The graph algorithms below work on the objects of a collection as table
+# slots. sizes[i] is the size of the object in slot i, or -1 for an empty
+# slot, and its references to other objects in the collection are the slots
+# succ[starts[i]:starts[i+1]]. MemObjectCollection builds these arrays from
+# its table, and disk.DiskMemObjectCollection from its file, through
+# graph_dominators and graph_reachable_sizes.
+
+cdef int _graph_dominators(long n_slots, long *starts, long *succ,
+                           long *sizes, long *idom_out,
+                           unsigned long *retained_out) except -1:
+    """Compute the immediate dominator and retained size of every object.
+
+    See MemObjectCollection.compute_dominators.
+
+    :param idom_out: Set to the slot of the immediate dominator of each
+        object, or -1 if only the synthetic root dominates it.
+    :param retained_out: Set to the retained size of each object.
+    """
+    cdef long n_verts, n_preds, i, j, v, w, u, p, t, top
+    cdef long *vnum, *vslot, *dfs_parent, *cursor
+    cdef long *stack, *pred_starts, *preds, *semi, *idom, *label
+    cdef long *bucket_head, *bucket_next
+    cdef unsigned long *retained
+
+    n_verts = 1
+    for i from 0 <= i < n_slots:
+        if sizes[i] >= 0:
+            n_verts += 1
+    vnum = vslot = dfs_parent = cursor = NULL
+    stack = pred_starts = preds = semi = idom = label = NULL
+    bucket_head = bucket_next = NULL
+    retained = NULL
+    try:
+        # vnum maps table offsets to vertex numbers. -1 is an object
+        # without parents, -2 one that has them, but both are unvisited.
+        vnum = _new_long_array(n_slots)
+        for i from 0 <= i < n_slots:
+            vnum[i] = -1
+        for i from 0 <= i < starts[n_slots]:
+            vnum[succ[i]] = -2
+        # Number the vertices in depth-first order, vertex 0 is the root.
+        # The first pass starts from objects without parents, the second
+        # picks up cycles which are not referenced from anywhere else.
+        vslot = _new_long_array(n_verts)
+        dfs_parent = _new_long_array(n_verts)
+        cursor = _new_long_array(n_verts)
+        stack = _new_long_array(n_verts)
+        vslot[0] = -1
+        dfs_parent[0] = -1
+        n_verts = 1
+        for j from 0 <= j < 2:
+            for i from 0 <= i < n_slots:
+                if sizes[i] < 0:
+                    continue
+                if vnum[i] != -1 and (j == 0 or vnum[i] >= 0):
+                    continue
+                vnum[i] = n_verts
+                vslot[n_verts] = i
+                dfs_parent[n_verts] = 0
+                cursor[n_verts] = starts[i]
+                stack[0] = n_verts
+                top = 1
+                n_verts += 1
+                while top > 0:
+                    v = stack[top - 1]
+                    if cursor[v] >= starts[vslot[v] + 1]:
+                        top -= 1
+                        continue
+                    t = succ[cursor[v]]
+                    cursor[v] += 1
+                    if vnum[t] >= 0:
+                        continue
+                    vnum[t] = n_verts
+                    vslot[n_verts] = t
+                    dfs_parent[n_verts] = v
+                    cursor[n_verts] = starts[t]
+                    stack[top] = n_verts
+                    top += 1
+                    n_verts += 1
+        # Collect the predecessors of each vertex, including the edges
+        # from the synthetic root.
+        pred_starts = _new_long_array(n_verts + 1)
+        memset(pred_starts, 0, sizeof(long) * (n_verts + 1))
+        for v from 1 <= v < n_verts:
+            if dfs_parent[v] == 0:
+                pred_starts[v + 1] += 1
+            for i from starts[vslot[v]] <= i < starts[vslot[v] + 1]:
+                pred_starts[vnum[succ[i]] + 1] += 1
+        for v from 0 <= v < n_verts:
+            pred_starts[v + 1] += pred_starts[v]
+        n_preds = pred_starts[n_verts]
+        preds = _new_long_array(n_preds)
+        # cursor is reused as the fill position for each vertex
+        for v from 0 <= v < n_verts:
+            cursor[v] = pred_starts[v]
+        for v from 1 <= v < n_verts:
+            if dfs_parent[v] == 0:
+                preds[cursor[v]] = 0
+                cursor[v] += 1
+            for i from starts[vslot[v]] <= i < starts[vslot[v] + 1]:
+                w = vnum[succ[i]]
+                preds[cursor[w]] = v
+                cursor[w] += 1
+        PyMem_Free(vnum)
+        vnum = NULL
+        # Lengauer-Tarjan, cursor is reused as the 'ancestor' forest
+        semi = _new_long_array(n_verts)
+        idom = _new_long_array(n_verts)
+        label = _new_long_array(n_verts)
+        bucket_head = _new_long_array(n_verts)
+        bucket_next = _new_long_array(n_verts)
+        for v from 0 <= v < n_verts:
+            semi[v] = v
+            label[v] = v
+            idom[v] = 0
+            cursor[v] = -1
+            bucket_head[v] = -1
+        for w from n_verts - 1 >= w > 0:
+            for i from pred_starts[w] <= i < pred_starts[w + 1]:
+                u = _dom_eval(preds[i], cursor, label, semi, stack)
+                if semi[u] < semi[w]:
+                    semi[w] = semi[u]
+            bucket_next[w] = bucket_head[semi[w]]
+            bucket_head[semi[w]] = w
+            p = dfs_parent[w]
+            cursor[w] = p
+            v = bucket_head[p]
+            while v != -1:
+                u = _dom_eval(v, cursor, label, semi, stack)
+                if semi[u] < semi[v]:
+                    idom[v] = u
+                else:
+                    idom[v] = p
+                v = bucket_next[v]
+            bucket_head[p] = -1
+        for w from 1 <= w < n_verts:
+            if idom[w] != semi[w]:
+                idom[w] = idom[idom[w]]
+        # A dominator always has a lower number than the objects it
+        # dominates, so walking backwards accumulates the retained size.
+        retained = <unsigned long *>_new_long_array(n_verts)
+        for v from 1 <= v < n_verts:
+            retained[v] = sizes[vslot[v]]
+        for w from n_verts - 1 >= w > 0:
+            if idom[w] != 0:
+                retained[idom[w]] += retained[w]
+        for i from 0 <= i < n_slots:
+            idom_out[i] = -1
+            retained_out[i] = 0
+        for v from 1 <= v < n_verts:
+            retained_out[vslot[v]] = retained[v]
+            if idom[v] != 0:
+                idom_out[vslot[v]] = vslot[idom[v]]
+    finally:
+        PyMem_Free(vnum)
+        PyMem_Free(vslot)
+        PyMem_Free(dfs_parent)
+        PyMem_Free(cursor)
+        PyMem_Free(stack)
+        PyMem_Free(pred_starts)
+        PyMem_Free(preds)
+        PyMem_Free(semi)
+        PyMem_Free(idom)
+        PyMem_Free(label)
+        PyMem_Free(bucket_head)
+        PyMem_Free(bucket_next)
+        PyMem_Free(retained)
+    return 0
+
+
+cdef long _graph_strongly_connected(long n_slots, long *starts, long *succ,
+                                    long *sizes, long *comp) except -1:
+    """Find the strongly connected components of the object graph.
+
+    This is Tarjan's algorithm, with an explicit stack rather than
+    recursion. Components are numbered in the order they are completed,
+    so every component only refers to components with a lower number.
+
+    :param comp: An array (one entry per table slot) which will be set to
+        the component number of each object.
+    :return: The number of components found
+    """
+    cdef long i, v, w, counter, n_comps, top, s_top, n_active
+    cdef long *index, *low, *cursor, *call_stack, *scc_stack
+
+    n_active = 0
+    for i from 0 <= i < n_slots:
+        if sizes[i] >= 0:
+            n_active += 1
+    index = low = cursor = call_stack = scc_stack = NULL
+    try:
+        index = _new_long_array(n_slots)
+        low = _new_long_array(n_slots)
+        cursor = _new_long_array(n_slots)
+        call_stack = _new_long_array(n_active)
+        scc_stack = _new_long_array(n_active)
+        for i from 0 <= i < n_slots:
+            index[i] = -1
+            comp[i] = -1
+        counter = n_comps = s_top = 0
+        for i from 0 <= i < n_slots:
+            if sizes[i] < 0 or index[i] != -1:
+                continue
+            index[i] = low[i] = counter
+            counter += 1
+            cursor[i] = starts[i]
+            scc_stack[s_top] = i
+            s_top += 1
+            call_stack[0] = i
+            top = 1
+            while top > 0:
+                v = call_stack[top - 1]
+                if cursor[v] < starts[v + 1]:
+                    w = succ[cursor[v]]
+                    cursor[v] += 1
+                    if index[w] == -1:
+                        index[w] = low[w] = counter
+                        counter += 1
+                        cursor[w] = starts[w]
+                        scc_stack[s_top] = w
+                        s_top += 1
+                        call_stack[top] = w
+                        top += 1
+                    elif comp[w] == -1 and index[w] < low[v]:
+                        # w is still on the scc stack
+                        low[v] = index[w]
+                    continue
+                top -= 1
+                if low[v] == index[v]:
+                    while True:
+                        s_top -= 1
+                        w = scc_stack[s_top]
+                        comp[w] = n_comps
+                        if w == v:
+                            break
+                    n_comps += 1
+                if top > 0 and low[v] < low[call_stack[top - 1]]:
+                    low[call_stack[top - 1]] = low[v]
+    finally:
+        PyMem_Free(index)
+        PyMem_Free(low)
+        PyMem_Free(cursor)
+        PyMem_Free(call_stack)
+        PyMem_Free(scc_stack)
+    return n_comps
+
+
+cdef long _graph_reachable_sizes(long n_slots, long *starts, long *succ,
+                                 long *sizes, unsigned long *hashes,
+                                 int approximate, long n_regs,
+                                 unsigned long *reach_out) except -1:
+    """Compute the size of everything reachable from each object.
+
+    See MemObjectCollection.compute_reachable_sizes.
+
+    :param hashes: The hash of the address of each object, only used (and
+        only needed) when approximate is set.
+    :param reach_out: Set to the reachable size of each object.
+    :return: The number of strongly connected components
+    """
+    cdef long n_comps, n_edges, i, j, k, c, x, top, n_active
+    cdef long *comp, *mstart, *members, *cstart, *csucc
+    cdef long *indeg, *seen, *stack, *pending, *sketch_slot, *free_slots
+    cdef long n_free, n_sketches, slot
+    cdef unsigned long *comp_size, *reach
+    cdef unsigned long total
+    cdef unsigned long long h
+    cdef char *is_tree
+    cdef float *sketch, *regs, *other, *new_sketch
+    cdef double e, reg_sum
+
+    comp = mstart = members = cstart = csucc = NULL
+    indeg = seen = stack = pending = sketch_slot = free_slots = NULL
+    comp_size = reach = NULL
+    is_tree = NULL
+    sketch = NULL
+    try:
+        comp = _new_long_array(n_slots)
+        n_comps = _graph_strongly_connected(n_slots, starts, succ, sizes,
+                                            comp)
+        # Group the objects by component
+        n_active = 0
+        for i from 0 <= i < n_slots:
+            if comp[i] >= 0:
+                n_active += 1
+        mstart = _new_long_array(n_comps + 1)
+        members = _new_long_array(n_active)
+        comp_size = <unsigned long *>_new_long_array(n_comps)
+        memset(mstart, 0, sizeof(long) * (n_comps + 1))
+        memset(comp_size, 0, sizeof(long) * n_comps)
+        for i from 0 <= i < n_slots:
+            if comp[i] >= 0:
+                mstart[comp[i] + 1] += 1
+                comp_size[comp[i]] += sizes[i]
+        for c from 0 <= c < n_comps:
+            mstart[c + 1] += mstart[c]
+        for i from 0 <= i < n_slots:
+            if comp[i] >= 0:
+                members[mstart[comp[i]]] = i
+                mstart[comp[i]] += 1
+        for c from n_comps >= c > 0:
+            mstart[c] = mstart[c - 1]
+        mstart[0] = 0
+        # The condensed graph, without duplicate edges
+        cstart = _new_long_array(n_comps + 1)
+        csucc = _new_long_array(starts[n_slots])
+        indeg = _new_long_array(n_comps)
+        seen = _new_long_array(n_comps)
+        for c from 0 <= c < n_comps:
+            indeg[c] = 0
+            seen[c] = -1
+        n_edges = 0
+        for c from 0 <= c < n_comps:
+            cstart[c] = n_edges
+            seen[c] = c
+            for j from mstart[c] <= j < mstart[c + 1]:
+                i = members[j]
+                for k from starts[i] <= k < starts[i + 1]:
+                    x = comp[succ[k]]
+                    if seen[x] != c:
+                        seen[x] = c
+                        csucc[n_edges] = x
+                        n_edges += 1
+                        indeg[x] += 1
+        cstart[n_comps] = n_edges
+        # Successors always have a lower number, so walking upwards
+        # means they are done before they are needed.
+        reach = <unsigned long *>_new_long_array(n_comps)
+        is_tree = <char *>PyMem_Malloc(n_comps + 1)
+        stack = _new_long_array(n_edges + 1)
+        if is_tree == NULL:
+            raise MemoryError('Failed to allocate %d bytes'
+                              % (n_comps + 1,))
+        if approximate:
+            # The sketches are kept in a pool of slots. A component's
+            # slot goes back on the free list once all the components
+            # that refer to it (pending) have merged it.
+            pending = _new_long_array(n_comps)
+            sketch_slot = _new_long_array(n_comps)
+            free_slots = _new_long_array(n_comps)
+            memcpy(pending, indeg, sizeof(long) * n_comps)
+            n_free = 0
+            n_sketches = 64
+            sketch = <float *>PyMem_Malloc(
+                sizeof(float) * n_regs * n_sketches)
+            if sketch == NULL:
+                raise MemoryError('Failed to allocate %d bytes'
+                    % (sizeof(float) * n_regs * n_sketches,))
+            slot = 0
+        for c from 0 <= c < n_comps:
+            seen[c] = -1
+        for c from 0 <= c < n_comps:
+            is_tree[c] = 1
+            total = comp_size[c]
+            for k from cstart[c] <= k < cstart[c + 1]:
+                x = csucc[k]
+                if indeg[x] != 1 or not is_tree[x]:
+                    is_tree[c] = 0
+                total += reach[x]
+            if approximate:
+                # Each object of size w contributes an exponentially
+                # distributed value with rate w to every register. The
+                # minimum over a set of objects is then exponential
+                # with a rate of the sum of their sizes.
+                if n_free > 0:
+                    n_free -= 1
+                    sketch_slot[c] = free_slots[n_free]
+                else:
+                    if slot == n_sketches:
+                        n_sketches = n_sketches * 2
+                        new_sketch = <float *>PyMem_Realloc(sketch,
+                            sizeof(float) * n_regs * n_sketches)
+                        if new_sketch == NULL:
+                            raise MemoryError('Failed to allocate %d bytes'
+                                % (sizeof(float) * n_regs * n_sketches,))
+                        sketch = new_sketch
+                    sketch_slot[c] = slot
+                    slot += 1
+                regs = sketch + (sketch_slot[c] * n_regs)
+                for k from 0 <= k < n_regs:
+                    regs[k] = HUGE_VALF
+                for j from mstart[c] <= j < mstart[c + 1]:
+                    i = members[j]
+                    if sizes[i] <= 0:
+                        continue
+                    h = hashes[i]
+                    for k from 0 <= k < n_regs:
+                        h = _mix64(h + k)
+                        e = -log(((h >> 11) + 1.0) / 9007199254740992.0)
+                        e = e / sizes[i]
+                        if e < regs[k]:
+                            regs[k] = <float>e
+                for j from cstart[c] <= j < cstart[c + 1]:
+                    x = csucc[j]
+                    other = sketch + (sketch_slot[x] * n_regs)
+                    for k from 0 <= k < n_regs:
+                        if other[k] < regs[k]:
+                            regs[k] = other[k]
+                    pending[x] -= 1
+                    if pending[x] == 0:
+                        free_slots[n_free] = sketch_slot[x]
+                        n_free += 1
+                if pending[c] == 0:
+                    # Nothing refers to c, so nothing will merge it
+                    free_slots[n_free] = sketch_slot[c]
+                    n_free += 1
+            if is_tree[c]:
+                reach[c] = total
+                continue
+            if approximate:
+                reg_sum = 0
+                for k from 0 <= k < n_regs:
+                    reg_sum = reg_sum + regs[k]
+                if reg_sum >= HUGE_VALF:
+                    reach[c] = comp_size[c]
+                else:
+                    reach[c] = <unsigned long>((n_regs - 1) / reg_sum)
+                continue
+            # Walk everything reachable, using seen[] stamped with c
+            total = comp_size[c]
+            seen[c] = c
+            top = 0
+            for k from cstart[c] <= k < cstart[c + 1]:
+                stack[top] = csucc[k]
+                top += 1
+            while top > 0:
+                top -= 1
+                x = stack[top]
+                if seen[x] == c:
+                    continue
+                seen[x] = c
+                if is_tree[x]:
+                    total += reach[x]
+                    continue
+                total += comp_size[x]
+                for k from cstart[x] <= k < cstart[x + 1]:
+                    if seen[csucc[k]] != c:
+                        stack[top] = csucc[k]
+                        top += 1
+            reach[c] = total
+        for i from 0 <= i < n_slots:
+            if comp[i] >= 0:
+                reach_out[i] = reach[comp[i]]
+            else:
+                reach_out[i] = 0
+    finally:
+        PyMem_Free(comp)
+        PyMem_Free(mstart)
+        PyMem_Free(members)
+        PyMem_Free(cstart)
+        PyMem_Free(csucc)
+        PyMem_Free(indeg)
+        PyMem_Free(seen)
+        PyMem_Free(stack)
+        PyMem_Free(comp_size)
+        PyMem_Free(reach)
+        PyMem_Free(is_tree)
+        PyMem_Free(pending)
+        PyMem_Free(sketch_slot)
+        PyMem_Free(free_slots)
+        PyMem_Free(sketch)
+    return n_comps
+
+
+cdef struct _MemObject
+
+
+ctypedef struct _TypeList:
+    # The slot of the first object with a given type_str, or -1. The rest are
+    # linked through MemObjectCollection._type_next
+    long head
+    long count
+
+
+ctypedef struct _LineTypeTotals:
+    # Like _TypeTotals, but when we don't have a _MemObject to point to
+    long count
+    unsigned long total_size
+    double sq_sum
+    long max_size
+    unsigned long long max_address
+
+
+ctypedef struct _TypeTotals:
+    # Running totals for one type_str, see summarize_by_type
+    long count
+    unsigned long total_size
+    # The squares can overflow a 64-bit integer for a large heap, and they are
+    # only used to compute the standard deviation
+    double sq_sum
+    long max_size
+    unsigned long long max_address
+    _MemObject *max_obj
+
+
+cdef inline int _is_new_max(long count, long size, unsigned long long address,
+                            long max_size, unsigned long long max_address):
+    """Should the object counted as number 'count' become the type's max?
+
+    The largest object wins, and the lowest address breaks ties, so that
+    summarize_lines and summarize_by_type agree no matter what order they
+    see the objects in.
+    """
+    return (count == 1 or size > max_size
+            or (size == max_size and address < max_address))
+
+
 cdef struct _MemObject:
     # """The raw C structure, used to minimize memory allocation size."""
     PyObject *address
@@ -188,13 +816,33 @@ cdef struct _MemObject:
     #       a pointer
     # PyObject *name
     RefList *parent_list
+    # The number of distinct parents, this can be larger than
+    # parent_list.size if the parent list was capped by max_parents
+    long total_parents
     unsigned long total_size
+    # The refcnt, immediate dominator and type index are rarely used, so they
+    # are kept in arrays on the side, see MemObjectCollection._refcnts
     # This is an uncounted ref to a _MemObjectProxy. _MemObjectProxy also has a
     # reference to this object, so when it disappears it can set the reference
     # to NULL.
     PyObject *proxy
 
 
+cdef long _pack_refcnt(refcnt, gc_tracked) except? -2:
+    """Pack a dumped refcnt, with the low bit set if gc_tracked.
+
+    :return: -1 if the dump didn't record the refcnt.
+    """
+    cdef long packed
+
+    if refcnt is None:
+        return -1
+    packed = <long>refcnt << 1
+    if gc_tracked:
+        packed |= 1
+    return packed
+
+
 cdef _MemObject *_new_mem_object(address, type_str, size, children,
                              value, name, parent_list, total_size) except NULL:
     cdef _MemObject *new_entry
@@ -225,6 +873,8 @@ cdef _MemObject *_new_mem_object(address, type_str, size, children,
         new_entry.value = <PyObject *>name
     Py_INCREF(new_entry.value)
     new_entry.parent_list = _list_to_ref_list(parent_list)
+    if new_entry.parent_list != NULL:
+        new_entry.total_parents = new_entry.parent_list.size
     new_entry.total_size = total_size
     return new_entry
 
@@ -253,6 +903,108 @@ cdef int _free_mem_object(_MemObject *cur) except -1:
     return 1
 
 
+ctypedef struct _EdgeRule:
+    # What prune_edges removes from the objects of one type. slots and
+    # sideways are sorted, and may be NULL
+    long *slots
+    long num_slots
+    unsigned long *sideways
+    long num_sideways
+
+
+cdef long _prune_ref_list(_MemObject *cur, _EdgeRule *rule,
+                          unsigned long *into, long num_into,
+                          int *add_null) except -1:
+    """Move the references of cur selected by rule to the end of its list.
+
+    The references that are kept stay in order at the start of
+    cur.child_list, the list itself isn't changed in size until
+    _finish_pruned_ref_list.
+
+    :param add_null: Set to 1 if a removed reference is to be replaced by
+        the null object.
+    :return: The number of references kept.
+    """
+    cdef long j, num_kept, next_slot
+    cdef unsigned long address
+    cdef int dropped
+    cdef PyObject *ref
+
+    add_null[0] = 0
+    if cur.child_list == NULL:
+        return 0
+    num_kept = 0
+    next_slot = 0
+    for j from 0 <= j < cur.child_list.size:
+        ref = cur.child_list.refs[j]
+        dropped = 0
+        while next_slot < rule.num_slots and rule.slots[next_slot] < j:
+            next_slot += 1
+        if next_slot < rule.num_slots and rule.slots[next_slot] == j:
+            dropped = add_null[0] = 1
+        elif num_into > 0 or rule.num_sideways > 0:
+            address = PyInt_AsUnsignedLongMask(ref)
+            if num_into > 0 and _in_sorted(into, num_into, address):
+                dropped = add_null[0] = 1
+            elif (rule.num_sideways > 0
+                  and _in_sorted(rule.sideways, rule.num_sideways, address)):
+                dropped = 1
+        if not dropped:
+            # Everything between num_kept and j has been dropped
+            cur.child_list.refs[j] = cur.child_list.refs[num_kept]
+            cur.child_list.refs[num_kept] = ref
+            num_kept += 1
+    return num_kept
+
+
+cdef int _finish_pruned_ref_list(_MemObject *cur, long num_kept, int add_null,
+                                 object null_ref) except -1:
+    """Release the references that _prune_ref_list moved past num_kept."""
+    cdef long j, new_size
+    cdef RefList *new_list
+
+    for j from num_kept <= j < cur.child_list.size:
+        Py_DECREF(cur.child_list.refs[j])
+    new_size = num_kept
+    if add_null:
+        # We dropped at least one reference, so there is room
+        cur.child_list.refs[new_size] = <PyObject *>null_ref
+        Py_INCREF(cur.child_list.refs[new_size])
+        new_size += 1
+    cur.child_list.size = new_size
+    if new_size == 0:
+        PyMem_Free(cur.child_list)
+        cur.child_list = NULL
+    else:
+        new_list = <RefList *>PyMem_Realloc(cur.child_list,
+            sizeof(RefList) + sizeof(PyObject *) * new_size)
+        if new_list != NULL:
+            cur.child_list = new_list
+    return 1
+
+
+cdef int _same_address(PyObject *a, PyObject *b) except -1:
+    if a == b:
+        return 1
+    return PyObject_RichCompareBool(a, b, Py_EQ)
+
+
+cdef int _has_ref(RefList *ref_list, long start, long end,
+                  PyObject *ref) except -1:
+    """Is ref in ref_list.refs[start:end]?"""
+    cdef long j
+
+    for j from start <= j < end:
+        if _same_address(ref_list.refs[j], ref):
+            return 1
+    return 0
+
+
+cdef int _is_type(_MemObject *obj, object type_str) except -1:
+    """Is obj.type_str equal to type_str?"""
+    return _same_address(obj.type_str, <PyObject *>type_str)
+
+
 cdef _MemObject *_dummy
 _dummy = <_MemObject*>(-1)
 
@@ -263,7 +1015,7 @@ cdef class _MemObjectProxy
 
 def _MemObjectProxy_from_args(address, type_str, size, children=(), length=0,
                               value=None, name=None, parent_list=(),
-                              total_size=0):
+                              total_size=0, refcnt=None, gc_tracked=None):
     """Create a standalone _MemObjectProxy instance.
 
     Note that things like '__getitem__' won't work, as they query the
@@ -277,10 +1029,24 @@ def _MemObjectProxy_from_args(address, type_str, size, children=(), length=0,
     proxy = _MemObjectProxy(None)
     proxy._obj = new_entry
     proxy._managed_obj = new_entry
+    proxy._refcnt = _pack_refcnt(refcnt, gc_tracked)
     new_entry.proxy = <PyObject *>proxy
     return proxy
 
 
+cdef long _proxy_refcnt(_MemObjectProxy proxy) except? -2:
+    """The packed refcnt of the object behind proxy, see _pack_refcnt."""
+    cdef MemObjectCollection collection
+
+    if proxy.collection is None or proxy._managed_obj != NULL:
+        return proxy._refcnt
+    collection = proxy.collection
+    if collection._refcnts == NULL:
+        return -1
+    return collection._refcnts[
+        collection._child_slot_index(proxy._obj.address)]
+
+
 cdef class _MemObjectProxy:
     """The standard interface for understanding memory consumption.
 
@@ -313,11 +1079,14 @@ cdef class _MemObjectProxy:
     cdef _MemObject *_obj
     # If not NULL, this will be freed when this object is deallocated
     cdef _MemObject *_managed_obj
+    # The packed refcnt, once the object isn't part of a collection
+    cdef long _refcnt
 
     def __init__(self, collection):
         self.collection = collection
         self._obj = NULL
         self._managed_obj = NULL
+        self._refcnt = -1
 
     def __dealloc__(self):
         if self._obj != NULL:
@@ -354,6 +1123,12 @@ cdef class _MemObjectProxy:
 
         def __set__(self, value):
             cdef PyObject *ptr
+            if self.collection is not None and self._managed_obj == NULL:
+                # Still part of the collection, so keep its index up to date
+                self.collection._set_type_str(
+                    self.collection._child_slot_index(self._obj.address),
+                    value)
+                return
             ptr = <PyObject *>value
             Py_INCREF(ptr)
             Py_DECREF(self._obj.type_str)
@@ -422,8 +1197,14 @@ cdef class _MemObjectProxy:
             return _ref_list_to_list(self._obj.child_list)
 
         def __set__(self, value):
+            old_children = None
+            if (self.collection is not None and self._managed_obj == NULL
+                and self.collection._maintain_parents):
+                old_children = _ref_list_to_list(self._obj.child_list)
             _free_ref_list(self._obj.child_list)
             self._obj.child_list = _list_to_ref_list(value)
+            if old_children is not None:
+                self.collection._children_changed(self._obj, old_children)
 
     property ref_list:
         """The list of objects referenced by this object.
@@ -466,6 +1247,10 @@ cdef class _MemObjectProxy:
         def __set__(self, value):
             _free_ref_list(self._obj.parent_list)
             self._obj.parent_list = _list_to_ref_list(value)
+            if self._obj.parent_list == NULL:
+                self._obj.total_parents = 0
+            else:
+                self._obj.total_parents = self._obj.parent_list.size
 
     property num_referrers:
         """The length of the parents list."""
@@ -483,6 +1268,63 @@ cdef class _MemObjectProxy:
                 return 0
             return self._obj.parent_list.size
 
+    property total_parents:
+        """The number of distinct parents of this object.
+
+        This can be larger than num_parents if compute_parents() capped the
+        parents list.
+        """
+        def __get__(self):
+            return self._obj.total_parents
+
+    property refcnt:
+        """The reference count of the object when it was dumped.
+
+        None if the dump didn't record reference counts.
+        """
+        def __get__(self):
+            cdef long refcnt
+
+            refcnt = _proxy_refcnt(self)
+            if refcnt < 0:
+                return None
+            return refcnt >> 1
+
+    property gc_tracked:
+        """Was the object tracked by the garbage collector when dumped?
+
+        Objects that aren't can only be found by following references, so
+        a leak of one is invisible to gc.get_objects(). None if the dump
+        didn't record it.
+        """
+        def __get__(self):
+            cdef long refcnt
+
+            refcnt = _proxy_refcnt(self)
+            if refcnt < 0:
+                return None
+            return bool(refcnt & 1)
+
+    property immediate_dominator:
+        """The address of the object that immediately dominates this one.
+
+        Every path from the roots to this object goes through the dominator,
+        so if the dominator was freed, this object would be freed as well.
+        None if only the (synthetic) root dominates this object, if
+        compute_dominators() has not been run, or if the object was removed
+        from its collection.
+        """
+        def __get__(self):
+            cdef long idx
+
+            if (self.collection is None or self._managed_obj != NULL
+                or self.collection._dominators == NULL):
+                return None
+            idx = self.collection._child_slot_index(self._obj.address)
+            if self.collection._dominators[idx] == NULL:
+                return None
+            return <object>self.collection._dominators[idx]
+
     def __getitem__(self, offset):
         cdef long off
 
@@ -586,8 +1428,14 @@ cdef class _MemObjectProxy:
                 value = '"value": "%s", ' % self.value
         else:
             value = ''
-        return '{"address": %d, "type": "%s", "size": %d, %s"refs": [%s]}' % (
-            self.address, self.type_str, self.size, value, ', '.join(refs))
+        if _proxy_refcnt(self) >= 0:
+            refcnt = ', "refcnt": %d, "gc": %s' % (
+                self.refcnt, self.gc_tracked and 'true' or 'false')
+        else:
+            refcnt = ''
+        return ('{"address": %d, "type": "%s", "size": %d, %s"refs": [%s]%s}'
+                % (self.address, self.type_str, self.size, value,
+                   ', '.join(refs), refcnt))
 
     def refs_as_dict(self):
         """Expand the ref list considering it to be a 'dict' structure.
@@ -671,29 +1519,450 @@ def _all_sort_key(proxy_obj):
     return (proxy_obj.size, len(proxy_obj), proxy_obj.num_parents)
 
 
+def _total_size_sort_key(proxy_obj):
+    return (proxy_obj.total_size, proxy_obj.size)
+
+
+cdef int _parse_number(char **pos, char *end,
+                       unsigned long long *result) except -1:
+    """Parse the decimal digits at pos, moving pos past them.
+
+    :return: 1 if there were any digits, else 0
+    """
+    cdef char *cur
+
+    cur = pos[0]
+    result[0] = 0
+    while cur < end and c'0' <= cur[0] <= c'9':
+        result[0] = result[0] * 10 + (cur[0] - c'0')
+        cur += 1
+    if cur == pos[0]:
+        return 0
+    pos[0] = cur
+    return 1
+
+
+cdef int _parse_type_and_size(char *line, Py_ssize_t length,
+                              unsigned long long *address, char **type_start,
+                              Py_ssize_t *type_len,
+                              unsigned long long *size) except -1:
+    """Parse the start of a line written by the scanner.
+
+    Lines look like '{"address": 1234, "type": "str", "size": 25, ...'.
+
+    :return: 1 if the line was parsed, 0 if it was in some other form.
+    """
+    cdef char *pos, *end
+
+    pos = line
+    end = line + length
+    if length < 12 or memcmp(pos, '{"address": ', 12) != 0:
+        return 0
+    pos += 12
+    if not _parse_number(&pos, end, address):
+        return 0
+    if end - pos < 11 or memcmp(pos, ', "type": "', 11) != 0:
+        return 0
+    pos += 11
+    type_start[0] = pos
+    while pos < end and pos[0] != c'"':
+        pos += 1
+    type_len[0] = pos - type_start[0]
+    if end - pos < 11 or memcmp(pos, '", "size": ', 11) != 0:
+        return 0
+    pos += 11
+    if not _parse_number(&pos, end, size):
+        return 0
+    return 1
+
+
+def summarize_lines(lines, fallback=None, seen=None):
+    """Aggregate the count and size of each type in the lines of a dump.
+
+    Only the address, type and size at the start of each line are parsed,
+    and nothing is kept per object, so this runs in constant memory (apart
+    from seen).
+
+    :param lines: An iterable of lines, as written by the scanner.
+    :param fallback: Lines that aren't in the format the scanner writes are
+        passed to fallback(line), which should return (address, type_str,
+        size). If None, such lines raise ValueError.
+    :param seen: If not None, a set of addresses (such as an AddressSet).
+        Lines for addresses already in it are skipped, and the others are
+        added to it, so objects dumped more than once are only counted once.
+    :return: A list of (type_str, count, total_size, sq_sum, max_size,
+        max_address) like MemObjectCollection.summarize_by_type.
+    """
+    cdef _LineTypeTotals *totals, *new_totals, *cur_totals
+    cdef long idx, n_types, n_alloc
+    cdef unsigned long long address, size
+    cdef char *type_start, *last_type
+    cdef Py_ssize_t type_len, last_type_len
+    cdef PyObject *tmp
+
+    type_index = {}
+    n_types = 0
+    n_alloc = 64
+    totals = <_LineTypeTotals *>PyMem_Malloc(sizeof(_LineTypeTotals) * n_alloc)
+    if totals == NULL:
+        raise MemoryError('Failed to allocate %d bytes'
+                          % (sizeof(_LineTypeTotals) * n_alloc,))
+    # We keep the last type_str object around, and compare its content to
+    # the new line, rather than creating a string for every line
+    last_type_str = None
+    last_type = NULL
+    last_type_len = -1
+    idx = -1
+    try:
+        for line in lines:
+            if (PyString_CheckExact(line)
+                and _parse_type_and_size(PyString_AS_STRING(line),
+                                         PyString_GET_SIZE(line), &address,
+                                         &type_start, &type_len, &size)):
+                if (type_len != last_type_len
+                    or memcmp(type_start, last_type, type_len) != 0):
+                    last_type_str = PyString_FromStringAndSize(type_start,
+                                                               type_len)
+                    last_type = PyString_AS_STRING(last_type_str)
+                    last_type_len = type_len
+                    idx = -1
+            elif line in ('[\n', ']\n', '[', ']', '\n'):
+                continue
+            elif fallback is None:
+                raise ValueError('Failed to parse line: %r' % (line,))
+            else:
+                py_address, last_type_str, py_size = fallback(line)
+                address = py_address
+                size = py_size
+                last_type = PyString_AS_STRING(last_type_str)
+                last_type_len = PyString_GET_SIZE(last_type_str)
+                idx = -1
+            if seen is not None:
+                if address in seen:
+                    continue
+                seen.add(address)
+            if idx == -1:
+                tmp = PyDict_GetItem(type_index, last_type_str)
+                if tmp != NULL:
+                    idx = <object>tmp
+                else:
+                    if n_types == n_alloc:
+                        new_totals = <_LineTypeTotals *>PyMem_Realloc(totals,
+                            sizeof(_LineTypeTotals) * n_alloc * 2)
+                        if new_totals == NULL:
+                            raise MemoryError('Failed to allocate %d bytes'
+                                % (sizeof(_LineTypeTotals) * n_alloc * 2,))
+                        totals = new_totals
+                        n_alloc = n_alloc * 2
+                    idx = n_types
+                    n_types += 1
+                    memset(totals + idx, 0, sizeof(_LineTypeTotals))
+                    type_index[last_type_str] = idx
+            cur_totals = totals + idx
+            cur_totals.count += 1
+            cur_totals.total_size += size
+            cur_totals.sq_sum += (<double>size) * size
+            if _is_new_max(cur_totals.count, size, address,
+                           cur_totals.max_size, cur_totals.max_address):
+                cur_totals.max_size = size
+                cur_totals.max_address = address
+        result = [None] * n_types
+        for type_str, idx in type_index.iteritems():
+            cur_totals = totals + idx
+            result[idx] = (type_str, cur_totals.count, cur_totals.total_size,
+                           cur_totals.sq_sum, cur_totals.max_size,
+                           cur_totals.max_address)
+    finally:
+        PyMem_Free(totals)
+    return result
+
+
+cdef class _TypeAndSizeIterator:
+    """Iterate the (address, type_str, size) of the lines of a dump.
+
+    See iter_type_and_size.
+    """
+
+    cdef object lines
+    cdef object fallback
+    # The type_str of the last line, reused while the type doesn't change
+    cdef object last_type_str
+
+    def __init__(self, lines, fallback=None):
+        self.lines = iter(lines)
+        self.fallback = fallback
+        self.last_type_str = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef unsigned long long address, size
+        cdef char *type_start
+        cdef Py_ssize_t type_len
+
+        while True:
+            line = next(self.lines)
+            if (PyString_CheckExact(line)
+                and _parse_type_and_size(PyString_AS_STRING(line),
+                                         PyString_GET_SIZE(line), &address,
+                                         &type_start, &type_len, &size)):
+                if (self.last_type_str is None
+                    or type_len != PyString_GET_SIZE(self.last_type_str)
+                    or memcmp(type_start,
+                              PyString_AS_STRING(self.last_type_str),
+                              type_len) != 0):
+                    self.last_type_str = PyString_FromStringAndSize(
+                        type_start, type_len)
+                return (address, self.last_type_str, size)
+            if line in ('[\n', ']\n', '[', ']', '\n'):
+                continue
+            if self.fallback is None:
+                raise ValueError('Failed to parse line: %r' % (line,))
+            return self.fallback(line)
+
+
+def iter_type_and_size(lines, fallback=None):
+    """Iterate the (address, type_str, size) of every object in a dump.
+
+    Only the start of each line is parsed, as in summarize_lines, and no
+    more than one line is held at a time.
+
+    :param lines: An iterable of lines, as written by the scanner.
+    :param fallback: Called as fallback(line) for lines that aren't in the
+        format the scanner writes, see summarize_lines. If None, such lines
+        raise ValueError.
+    """
+    return _TypeAndSizeIterator(lines, fallback)
+
+
+def sort_by_address(addresses, offsets):
+    """Sort parallel arrays of addresses and offsets by address, in place.
+
+    Where an address is repeated only its lowest offset is kept, and the
+    arrays are truncated to the remaining entries. This takes 16 bytes per
+    entry on top of the arrays, rather than the objects a python sort
+    needs.
+
+    :param addresses: An array.array('L').
+    :param offsets: An array.array('L') of the same length.
+    :return: The number of distinct addresses.
+    """
+    cdef unsigned long *c_addresses, *c_offsets
+    cdef _AddressOffset *pairs
+    cdef Py_ssize_t length, offsets_length, i, num
+
+    PyObject_AsWriteBuffer(addresses, <void **>&c_addresses, &length)
+    PyObject_AsWriteBuffer(offsets, <void **>&c_offsets, &offsets_length)
+    if (addresses.itemsize != sizeof(unsigned long)
+        or offsets.itemsize != sizeof(unsigned long)):
+        raise TypeError('addresses and offsets must be arrays of'
+                        ' unsigned long')
+    if length != offsets_length:
+        raise ValueError('%d addresses but %d offsets'
+                         % (len(addresses), len(offsets)))
+    length = length / sizeof(unsigned long)
+    if length == 0:
+        return 0
+    pairs = <_AddressOffset *>PyMem_Malloc(sizeof(_AddressOffset) * length)
+    if pairs == NULL:
+        raise MemoryError('Failed to allocate %d bytes'
+                          % (sizeof(_AddressOffset) * length,))
+    try:
+        for i from 0 <= i < length:
+            pairs[i].address = c_addresses[i]
+            pairs[i].offset = c_offsets[i]
+        qsort(pairs, length, sizeof(_AddressOffset), _compare_address_offset)
+        num = 0
+        for i from 0 <= i < length:
+            if num > 0 and pairs[i].address == c_addresses[num - 1]:
+                continue
+            c_addresses[num] = pairs[i].address
+            c_offsets[num] = pairs[i].offset
+            num += 1
+    finally:
+        PyMem_Free(pairs)
+    del addresses[num:]
+    del offsets[num:]
+    return num
+
+
+cdef int _long_buffer(values, Py_ssize_t count, name,
+                      long **out) except -1:
+    """Point out at the contents of an array.array('l') of count items."""
+    cdef void *buf
+    cdef Py_ssize_t length
+
+    PyObject_AsWriteBuffer(values, &buf, &length)
+    if (values.itemsize != sizeof(long)
+        or length != count * <Py_ssize_t>sizeof(long)):
+        raise ValueError('%s must be an array of %d longs' % (name, count))
+    out[0] = <long *>buf
+    return 0
+
+
+cdef int _graph_buffers(starts, succ, sizes, long **c_starts, long **c_succ,
+                        long **c_sizes) except -1:
+    """Check the arrays describing a graph, and get their contents.
+
+    The algorithms trust the arrays, so bad input would crash rather than
+    raise.
+    """
+    cdef long n_slots, i
+
+    n_slots = len(sizes)
+    _long_buffer(sizes, n_slots, 'sizes', c_sizes)
+    _long_buffer(starts, n_slots + 1, 'starts', c_starts)
+    _long_buffer(succ, len(succ), 'succ', c_succ)
+    if c_starts[0][0] != 0 or c_starts[0][n_slots] != len(succ):
+        raise ValueError('starts must run from 0 to len(succ)')
+    for i from 0 <= i < n_slots:
+        if c_starts[0][i] > c_starts[0][i + 1]:
+            raise ValueError('starts must not decrease')
+        if c_sizes[0][i] < 0 and c_starts[0][i] != c_starts[0][i + 1]:
+            raise ValueError('empty slot %d has references' % (i,))
+    for i from 0 <= i < len(succ):
+        if (c_succ[0][i] < 0 or c_succ[0][i] >= n_slots
+            or c_sizes[0][c_succ[0][i]] < 0):
+            raise ValueError('reference %d is not to an object' % (i,))
+    return 0
+
+
+def graph_dominators(starts, succ, sizes):
+    """Compute the dominator tree of a graph of objects in table slots.
+
+    This is MemObjectCollection.compute_dominators for collections that
+    don't keep their objects in memory, such as disk.DiskMemObjectCollection.
+    Only these arrays (a few words per object and one per reference) are.
+
+    :param starts: An array.array('l') of len(sizes) + 1 items. The
+        references of the object in slot i are succ[starts[i]:starts[i+1]].
+    :param succ: An array.array('l') of the slots that are referenced.
+    :param sizes: An array.array('l') of the size of the object in each
+        slot, or -1 for an empty slot.
+    :return: (idom, retained) arrays, with the slot of the immediate
+        dominator of each object (-1 if none), and its retained size.
+    """
+    cdef long *c_starts, *c_succ, *c_sizes, *c_idom, *c_retained
+    cdef long n_slots
+
+    _graph_buffers(starts, succ, sizes, &c_starts, &c_succ, &c_sizes)
+    n_slots = len(sizes)
+    idom = array.array('l', [0]) * n_slots
+    retained = array.array('L', [0]) * n_slots
+    if n_slots > 0:
+        _long_buffer(idom, n_slots, 'idom', &c_idom)
+        _long_buffer(retained, n_slots, 'retained', &c_retained)
+        _graph_dominators(n_slots, c_starts, c_succ, c_sizes, c_idom,
+                          <unsigned long *>c_retained)
+    return idom, retained
+
+
+def graph_reachable_sizes(starts, succ, sizes, hashes=None,
+                          approximate=False, num_registers=64):
+    """Compute the reachable size of every object in a graph.
+
+    This is MemObjectCollection.compute_reachable_sizes for collections
+    that don't keep their objects in memory, see graph_dominators.
+
+    :param hashes: For approximate, an array.array('l') of the hash of the
+        address of each object.
+    :return: (number of strongly connected components, an array of the
+        reachable size of each object)
+    """
+    cdef long *c_starts, *c_succ, *c_sizes, *c_hashes, *c_reach
+    cdef long n_slots, n_comps
+
+    _graph_buffers(starts, succ, sizes, &c_starts, &c_succ, &c_sizes)
+    n_slots = len(sizes)
+    c_hashes = NULL
+    if approximate:
+        if num_registers < 2:
+            raise ValueError('num_registers must be at least 2, not %d'
+                             % (num_registers,))
+        if hashes is None:
+            raise ValueError('approximate needs the hashes')
+        _long_buffer(hashes, n_slots, 'hashes', &c_hashes)
+    reach = array.array('L', [0]) * n_slots
+    if n_slots == 0:
+        return 0, reach
+    _long_buffer(reach, n_slots, 'reach', &c_reach)
+    n_comps = _graph_reachable_sizes(n_slots, c_starts, c_succ, c_sizes,
+                                     <unsigned long *>c_hashes, approximate,
+                                     num_registers,
+                                     <unsigned long *>c_reach)
+    return n_comps, reach
+
+
 cdef class MemObjectCollection:
     """Track a bunch of _MemObject instances."""
 
     cdef readonly int _table_mask  # N slots = table_mask + 1
     cdef readonly int _active      # How many slots have real data
     cdef readonly int _filled      # How many slots have real or dummy
+    cdef int _maintain_parents
     cdef _MemObject** _table       # _MemObjects are stored inline
+    # Maps type_str => offset in _type_lists. This is not an 'object' member,
+    # so that we don't have to participate in gc. It only references strings
+    # and ints, so it can never be part of a reference cycle.
+    cdef PyObject *_type_index
+    cdef _TypeList *_type_lists    # Objects of each type, as linked lists
+    cdef long _num_types
+    cdef long _alloc_types
+    # Fields that most objects never need are kept in arrays indexed by table
+    # slot, which are only allocated once something uses them, and are
+    # moved along by _resize(). Empty and dummy slots hold -1 or NULL.
+    cdef long *_refcnts            # The packed refcnt, see _pack_refcnt
+    cdef PyObject **_dominators    # The immediate dominator's address
+    # The per-type linked lists of slots, built by _ensure_type_lists()
+    cdef long *_type_prev
+    cdef long *_type_next
+    # The max_parents of the last compute_parents(), see maintain_parents
+    cdef long _max_parents
 
     def __init__(self):
+        self._max_parents = -1
         self._table_mask = 1024 - 1
         self._table = <_MemObject**>PyMem_Malloc(sizeof(_MemObject*)*1024)
         memset(self._table, 0, sizeof(_MemObject*)*1024)
+        type_index = {}
+        self._type_index = <PyObject *>type_index
+        Py_INCREF(self._type_index)
 
     def __len__(self):
         return self._active
 
+    property maintain_parents:
+        """Keep the parents up to date when references change.
+
+        When this is True, assigning to obj.children, add() and deleting an
+        object update the parents of the objects they reference, rather than
+        leaving them stale until the next compute_parents(). So the parents
+        should be up to date when this is turned on. The max_parents of the
+        last compute_parents() is respected, and total_parents is kept
+        accurate. The parents of a newly added object are just the
+        parent_list it was added with.
+        """
+        def __get__(self):
+            return bool(self._maintain_parents)
+
+        def __set__(self, value):
+            self._maintain_parents = bool(value)
+
     def __sizeof__(self):
         cdef int i
         cdef _MemObject *cur
         cdef long my_size
         my_size = (sizeof(MemObjectCollection)
             + (sizeof(_MemObject**) * (self._table_mask + 1))
-            + (sizeof(_MemObject) * self._active))
+            + (sizeof(_MemObject) * self._active)
+            + (sizeof(_TypeList) * self._alloc_types))
+        if self._refcnts != NULL:
+            my_size += sizeof(long) * (self._table_mask + 1)
+        if self._dominators != NULL:
+            my_size += sizeof(PyObject *) * (self._table_mask + 1)
+        if self._type_next != NULL:
+            my_size += 2 * sizeof(long) * (self._table_mask + 1)
         for i from 0 <= i <= self._table_mask:
             cur = self._table[i]
             if cur != NULL and cur != _dummy:
@@ -797,6 +2066,7 @@ cdef class MemObjectCollection:
     def __delitem__(self, at):
         cdef _MemObject **slot
         cdef _MemObjectProxy proxy
+        cdef long idx
 
         if isinstance(at, _MemObjectProxy):
             address = at.address
@@ -806,29 +2076,58 @@ cdef class MemObjectCollection:
         slot = self._lookup(address)
         if slot[0] == NULL or slot[0] == _dummy:
             raise KeyError('address %s not present' % (at,))
+        idx = slot - self._table
+        if self._maintain_parents:
+            self._children_changed(slot[0], _ref_list_to_list(
+                slot[0].child_list), ())
+        self._type_unlink(idx)
         if slot[0].proxy != NULL:
             # Have the proxy take over the memory lifetime. At the same time,
             # we break the reference cycle, so that the proxy will get cleaned
             # up properly
             proxy = <object>slot[0].proxy
             proxy._managed_obj = proxy._obj
+            if self._refcnts != NULL:
+                proxy._refcnt = self._refcnts[idx]
         else:
             # Without a proxy, we just nuke the object
             self._clear_slot(slot)
+        self._clear_extra(idx)
         slot[0] = _dummy
         self._active -= 1
         # TODO: Shrink
 
+    cdef int _clear_extra(self, long idx) except -1:
+        """Reset the side array entries of a slot that is being emptied."""
+        if self._refcnts != NULL:
+            self._refcnts[idx] = -1
+        if self._dominators != NULL:
+            Py_XDECREF(self._dominators[idx])
+            self._dominators[idx] = NULL
+        return 0
+
+    cdef long *_new_slot_array(self) except NULL:
+        """Allocate a side array with a -1 for every slot in the table."""
+        cdef long *arr
+        cdef long i
+
+        arr = _new_long_array(self._table_mask + 1)
+        for i from 0 <= i <= self._table_mask:
+            arr[i] = -1
+        return arr
+
     #def __setitem__(self, address, value):
     #    """moc[address] = value"""
     #    pass
 
-    cdef int _insert_clean(self, _MemObject *entry) except -1:
+    cdef long _insert_clean(self, _MemObject *entry) except -1:
         """Copy _MemObject into the table.
 
         We know that this _MemObject is unique, and we know that self._table
         contains no _dummy entries. So we can do the lookup cheaply, without
         any equality checks, etc.
+
+        :return: The slot the entry was put in.
         """
         cdef long the_hash
         cdef size_t i, n_lookup, mask
@@ -844,7 +2143,7 @@ cdef class MemObjectCollection:
                 slot[0] = entry
                 self._filled += 1
                 self._active += 1
-                return 1
+                return slot - self._table
             i = i + 1 + n_lookup
         raise RuntimeError('could not find a free slot after %d lookups'
                            % (n_lookup,))
@@ -853,13 +2152,17 @@ cdef class MemObjectCollection:
         """Resize the internal table.
 
         We will be big enough to hold at least 'min_active' entries. We will
-        create a copy of all data, leaving out dummy entries.
+        create a copy of all data, leaving out dummy entries. The side arrays
+        are copied as well, following their objects to the new slots.
 
         :return: The new table size.
         """
-        cdef int new_size, remaining
+        cdef int new_size
+        cdef long i, n_old, offset
         cdef size_t n_bytes
-        cdef _MemObject **old_table, **old_slot, **new_table
+        cdef long *remap, *refcnts, *type_prev, *type_next
+        cdef PyObject **dominators
+        cdef _MemObject **old_table, **new_table
 
         new_size = 1024
         while new_size <= min_active and new_size > 0:
@@ -867,43 +2170,104 @@ cdef class MemObjectCollection:
         if new_size <= 0:
             raise MemoryError('table size too large for %d entries'
                               % (min_active,))
-        n_bytes = sizeof(_MemObject*)*new_size
-        new_table = <_MemObject**>PyMem_Malloc(n_bytes)
-        if new_table == NULL:
-            raise MemoryError('Failed to allocate %d bytes' % (n_bytes,))
-        memset(new_table, 0, n_bytes)
-        old_slot = old_table = self._table
+        n_old = self._table_mask + 1
+        new_table = dominators = NULL
+        remap = refcnts = type_prev = type_next = NULL
+        try:
+            n_bytes = sizeof(_MemObject*)*new_size
+            new_table = <_MemObject**>PyMem_Malloc(n_bytes)
+            if new_table == NULL:
+                raise MemoryError('Failed to allocate %d bytes' % (n_bytes,))
+            memset(new_table, 0, n_bytes)
+            remap = _new_long_array(n_old)
+            if self._refcnts != NULL:
+                refcnts = _new_long_array(new_size)
+            if self._dominators != NULL:
+                n_bytes = sizeof(PyObject*)*new_size
+                dominators = <PyObject **>PyMem_Malloc(n_bytes)
+                if dominators == NULL:
+                    raise MemoryError('Failed to allocate %d bytes'
+                                      % (n_bytes,))
+                memset(dominators, 0, n_bytes)
+            if self._type_next != NULL:
+                type_prev = _new_long_array(new_size)
+                type_next = _new_long_array(new_size)
+        except:
+            PyMem_Free(new_table)
+            PyMem_Free(remap)
+            PyMem_Free(refcnts)
+            PyMem_Free(dominators)
+            PyMem_Free(type_prev)
+            PyMem_Free(type_next)
+            raise
+        old_table = self._table
         self._table = new_table
         self._table_mask = new_size - 1
-        remaining = self._active
         self._filled = 0
         self._active = 0
 
-        while remaining > 0:
-            if old_slot[0] == NULL:
-                pass # empty
-            elif old_slot[0] == _dummy:
-                pass # dummy
+        for i from 0 <= i < n_old:
+            if old_table[i] == NULL or old_table[i] == _dummy:
+                remap[i] = -1
             else:
-                remaining -= 1
-                self._insert_clean(old_slot[0])
-            old_slot += 1
+                remap[i] = self._insert_clean(old_table[i])
         # Moving everything over is refcount neutral, so we just free the old
         # table
         PyMem_Free(old_table)
+        if refcnts != NULL:
+            for i from 0 <= i < new_size:
+                refcnts[i] = -1
+            for i from 0 <= i < n_old:
+                if remap[i] >= 0:
+                    refcnts[remap[i]] = self._refcnts[i]
+            PyMem_Free(self._refcnts)
+            self._refcnts = refcnts
+        if dominators != NULL:
+            for i from 0 <= i < n_old:
+                if remap[i] >= 0:
+                    dominators[remap[i]] = self._dominators[i]
+            PyMem_Free(self._dominators)
+            self._dominators = dominators
+        if type_next != NULL:
+            for i from 0 <= i < new_size:
+                type_prev[i] = type_next[i] = -1
+            for i from 0 <= i < n_old:
+                if remap[i] < 0:
+                    continue
+                if self._type_prev[i] >= 0:
+                    type_prev[remap[i]] = remap[self._type_prev[i]]
+                if self._type_next[i] >= 0:
+                    type_next[remap[i]] = remap[self._type_next[i]]
+            for offset from 0 <= offset < self._num_types:
+                if self._type_lists[offset].head >= 0:
+                    self._type_lists[offset].head = remap[
+                        self._type_lists[offset].head]
+            PyMem_Free(self._type_prev)
+            PyMem_Free(self._type_next)
+            self._type_prev = type_prev
+            self._type_next = type_next
+        PyMem_Free(remap)
         return new_size
 
     def add(self, address, type_str, size, children=(), length=0,
-            value=None, name=None, parent_list=(), total_size=0):
+            value=None, name=None, parent_list=(), total_size=0,
+            refcnt=None, gc_tracked=None):
         """Add a new MemObject to this collection."""
         cdef _MemObject **slot, *new_entry
         cdef _MemObjectProxy proxy
+        cdef long idx, packed
 
         slot = self._lookup(address)
         if slot[0] != NULL and slot[0] != _dummy:
             # We are overwriting an existing entry, for now, fail
             # Probably all we have to do is clear the slot first, then continue
             assert False, "We don't support overwrite yet."
+        packed = _pack_refcnt(refcnt, gc_tracked)
+        if packed >= 0 and self._refcnts == NULL:
+            self._refcnts = self._new_slot_array()
+        if self._type_next != NULL:
+            # Create the type list now, so linking the entry can't fail
+            self._type_offset(type_str, 1)
         # TODO: These are fairy small and more subject to churn, maybe we
         #       should be using PyObj_Malloc instead...
         new_entry = _new_mem_object(address, type_str, size, children,
@@ -913,19 +2277,1250 @@ cdef class MemObjectCollection:
             self._filled += 1
         self._active += 1
         slot[0] = new_entry
+        idx = slot - self._table
+        if self._refcnts != NULL:
+            self._refcnts[idx] = packed
+        self._type_link(idx)
+        if self._maintain_parents:
+            self._children_changed(new_entry, ())
         if self._filled * 3 > (self._table_mask + 1) * 2:
             # We need to grow
             self._resize(self._active * 2)
         proxy = self._proxy_for(address, new_entry)
         return proxy
 
+    cdef long _type_offset(self, type_str, int create) except -2:
+        """Find the offset of type_str in _type_lists.
+
+        :param create: If True, add a new (empty) list when type_str hasn't
+            been seen before, otherwise return -1.
+        """
+        cdef PyObject *tmp
+        cdef _TypeList *new_lists
+        cdef long offset, n_alloc
+
+        tmp = PyDict_GetItem(<object>self._type_index, type_str)
+        if tmp != NULL:
+            return <object>tmp
+        if not create:
+            return -1
+        if self._num_types == self._alloc_types:
+            n_alloc = self._alloc_types * 2
+            if n_alloc == 0:
+                n_alloc = 16
+            new_lists = <_TypeList *>PyMem_Realloc(self._type_lists,
+                                                   sizeof(_TypeList) * n_alloc)
+            if new_lists == NULL:
+                raise MemoryError('Failed to allocate %d bytes'
+                                  % (sizeof(_TypeList) * n_alloc,))
+            self._type_lists = new_lists
+            self._alloc_types = n_alloc
+        offset = self._num_types
+        self._type_lists[offset].head = -1
+        self._type_lists[offset].count = 0
+        PyDict_SetItem(<object>self._type_index, type_str, offset)
+        self._num_types += 1
+        return offset
+
+    cdef int _ensure_type_lists(self) except -1:
+        """Build the lists of objects of each type, if they don't exist yet.
+
+        Loading a dump never looks objects up by type, so the lists are only
+        built when something first does, and kept up to date from then on.
+        """
+        cdef long i, offset
+
+        if self._type_next != NULL:
+            return 0
+        for offset from 0 <= offset < self._num_types:
+            self._type_lists[offset].head = -1
+            self._type_lists[offset].count = 0
+        self._type_prev = self._new_slot_array()
+        try:
+            self._type_next = self._new_slot_array()
+            for i from 0 <= i <= self._table_mask:
+                if self._table[i] != NULL and self._table[i] != _dummy:
+                    self._type_link(i)
+        except:
+            PyMem_Free(self._type_prev)
+            PyMem_Free(self._type_next)
+            self._type_prev = self._type_next = NULL
+            raise
+        return 0
+
+    cdef int _type_link(self, long idx) except -1:
+        """Add the object in slot idx to the list of its type_str."""
+        cdef _TypeList *type_list
+
+        if self._type_next == NULL:
+            return 0
+        type_list = self._type_lists + self._type_offset(
+            <object>self._table[idx].type_str, 1)
+        self._type_prev[idx] = -1
+        self._type_next[idx] = type_list.head
+        if type_list.head >= 0:
+            self._type_prev[type_list.head] = idx
+        type_list.head = idx
+        type_list.count += 1
+        return 0
+
+    cdef int _type_unlink(self, long idx) except -1:
+        """Remove the object in slot idx from the list of its type_str."""
+        cdef _TypeList *type_list
+        cdef long offset
+
+        if self._type_next == NULL:
+            return 0
+        offset = self._type_offset(<object>self._table[idx].type_str, 0)
+        if offset < 0:
+            raise RuntimeError('type %r is not in the type index'
+                               % (<object>self._table[idx].type_str,))
+        type_list = self._type_lists + offset
+        if self._type_prev[idx] < 0:
+            type_list.head = self._type_next[idx]
+        else:
+            self._type_next[self._type_prev[idx]] = self._type_next[idx]
+        if self._type_next[idx] >= 0:
+            self._type_prev[self._type_next[idx]] = self._type_prev[idx]
+        self._type_prev[idx] = self._type_next[idx] = -1
+        type_list.count -= 1
+        return 0
+
+    cdef int _set_type_str(self, long idx, type_str) except -1:
+        """Change the type_str of an object, keeping the index up to date."""
+        cdef PyObject *ptr
+        cdef _MemObject *entry
+
+        entry = self._table[idx]
+        self._type_unlink(idx)
+        ptr = <PyObject *>type_str
+        Py_INCREF(ptr)
+        Py_DECREF(entry.type_str)
+        entry.type_str = ptr
+        self._type_link(idx)
+        return 0
+
+    def type_strs(self):
+        """Return a list of all the types that have objects."""
+        cdef long offset
+
+        self._ensure_type_lists()
+        result = []
+        for type_str, offset in (<object>self._type_index).iteritems():
+            if self._type_lists[offset].count > 0:
+                result.append(type_str)
+        return result
+
+    def count_type(self, type_str):
+        """Return how many objects have the given type."""
+        cdef long offset
+
+        self._ensure_type_lists()
+        offset = self._type_offset(type_str, 0)
+        if offset < 0:
+            return 0
+        return self._type_lists[offset].count
+
+    def addresses_of_type(self, type_str):
+        """Return the addresses of all objects with the given type.
+
+        This uses the type index, so it is proportional to the number of
+        matching objects, not to the size of the collection.
+        """
+        cdef long offset, i, idx
+        cdef _MemObject *cur
+
+        self._ensure_type_lists()
+        offset = self._type_offset(type_str, 0)
+        if offset < 0:
+            return []
+        result = PyList_New(self._type_lists[offset].count)
+        idx = self._type_lists[offset].head
+        i = 0
+        while idx >= 0:
+            cur = self._table[idx]
+            address = <object>cur.address
+            # SET_ITEM steals a reference
+            Py_INCREF(cur.address)
+            PyList_SET_ITEM(result, i, address)
+            i += 1
+            idx = self._type_next[idx]
+        return result
+
+    def values_of_type(self, type_str):
+        """Return the objects with the given type, see addresses_of_type."""
+        cdef long offset, idx
+        cdef _MemObject *cur
+
+        self._ensure_type_lists()
+        offset = self._type_offset(type_str, 0)
+        if offset < 0:
+            return []
+        result = []
+        idx = self._type_lists[offset].head
+        while idx >= 0:
+            cur = self._table[idx]
+            result.append(self._proxy_for(<object>cur.address, cur))
+            idx = self._type_next[idx]
+        return result
+
+    cdef long _child_slot_index(self, PyObject *address) except -2:
+        """Return the table offset holding address, or -1 if not present."""
+        cdef _MemObject **slot
+
+        slot = self._lookup(<object>address)
+        if slot[0] == NULL or slot[0] == _dummy:
+            return -1
+        return slot - self._table
+
+    def compute_parents(self, max_parents=-1):
+        """For each object, figure out who is referencing it.
+
+        This is done with two passes over the children. The first counts how
+        many references point to each object, which lets us allocate a single
+        array for all parent pointers and fill it in the second pass. Because
+        we walk one object's children at a time, a repeated reference from
+        the same parent always lands next to the previous one, so duplicates
+        are filtered out as we go.
+
+        :param max_parents: If >= 0, only keep this many parents for each
+            object. total_parents still records how many distinct parents
+            were found.
+        """
+        cdef long i, j, idx, n_slots, n_refs, num, offset, c_max_parents
+        cdef long *counts, *starts
+        cdef PyObject **parents
+        cdef _MemObject *cur
+        cdef RefList *ref_list
+
+        c_max_parents = max_parents
+        self._max_parents = c_max_parents
+        n_slots = self._table_mask + 1
+        counts = <long *>PyMem_Malloc(sizeof(long) * n_slots)
+        starts = <long *>PyMem_Malloc(sizeof(long) * n_slots)
+        parents = NULL
+        try:
+            if counts == NULL or starts == NULL:
+                raise MemoryError('Failed to allocate %d bytes'
+                                  % (2 * sizeof(long) * n_slots,))
+            memset(counts, 0, sizeof(long) * n_slots)
+            # First pass, count the references into each object
+            n_refs = 0
+            for i from 0 <= i < n_slots:
+                cur = self._table[i]
+                if cur == NULL or cur == _dummy or cur.child_list == NULL:
+                    continue
+                for j from 0 <= j < cur.child_list.size:
+                    idx = self._child_slot_index(cur.child_list.refs[j])
+                    if idx >= 0:
+                        counts[idx] += 1
+                        n_refs += 1
+            # Each object gets a contiguous section of the parents array
+            offset = 0
+            for i from 0 <= i < n_slots:
+                starts[i] = offset
+                offset += counts[i]
+                counts[i] = 0
+            if n_refs > 0:
+                parents = <PyObject **>PyMem_Malloc(sizeof(PyObject*) * n_refs)
+                if parents == NULL:
+                    raise MemoryError('Failed to allocate %d bytes'
+                                      % (sizeof(PyObject*) * n_refs,))
+            # Second pass, fill in the parents, skipping repeated references
+            for i from 0 <= i < n_slots:
+                cur = self._table[i]
+                if cur == NULL or cur == _dummy or cur.child_list == NULL:
+                    continue
+                for j from 0 <= j < cur.child_list.size:
+                    idx = self._child_slot_index(cur.child_list.refs[j])
+                    if idx < 0:
+                        continue
+                    offset = starts[idx] + counts[idx]
+                    if counts[idx] > 0 and parents[offset - 1] == cur.address:
+                        continue
+                    parents[offset] = cur.address
+                    counts[idx] += 1
+            # Finally, copy each section into the object's parent_list
+            for i from 0 <= i < n_slots:
+                cur = self._table[i]
+                if cur == NULL or cur == _dummy:
+                    continue
+                _free_ref_list(cur.parent_list)
+                cur.parent_list = NULL
+                num = counts[i]
+                cur.total_parents = num
+                if c_max_parents >= 0 and num > c_max_parents:
+                    num = c_max_parents
+                if num == 0:
+                    continue
+                ref_list = <RefList *>PyMem_Malloc(sizeof(RefList)
+                                                   + sizeof(PyObject*) * num)
+                if ref_list == NULL:
+                    raise MemoryError('Failed to allocate %d bytes'
+                        % (sizeof(RefList) + sizeof(PyObject*) * num,))
+                ref_list.size = num
+                for j from 0 <= j < num:
+                    ref_list.refs[j] = parents[starts[i] + j]
+                    Py_INCREF(ref_list.refs[j])
+                cur.parent_list = ref_list
+        finally:
+            PyMem_Free(counts)
+            PyMem_Free(starts)
+            if parents != NULL:
+                PyMem_Free(parents)
+
+    def compute_external_refs(self, min_refs=1):
+        """Find the references to objects that the dump can't account for.
+
+        The dump records each object's reference count. Counting every
+        reference from the children of the objects in this collection
+        (repeats included, as each one holds a reference) and subtracting it
+        leaves the references held from elsewhere: objects that weren't
+        dumped, C globals and extension module state, or leaked references.
+        Objects without a tp_traverse, such as code objects, are dumped
+        without their references, so what they refer to is counted here
+        too.
+
+        This needs a dump written with refcounts=True, and is only
+        meaningful before edges are removed by prune_edges() or
+        remove_expensive_references().
+
+        :param min_refs: Only return objects with at least this many
+            external references.
+        :return: [(num_external, proxy)] with the most external references
+            first. Objects without a recorded refcnt are skipped.
+        """
+        cdef long i, j, idx, n_slots, c_min_refs, num
+        cdef long *counts
+        cdef _MemObject *cur
+
+        if self._refcnts == NULL:
+            return []
+        c_min_refs = min_refs
+        n_slots = self._table_mask + 1
+        counts = _new_long_array(n_slots)
+        found = []
+        try:
+            memset(counts, 0, sizeof(long) * n_slots)
+            for i from 0 <= i < n_slots:
+                cur = self._table[i]
+                if cur == NULL or cur == _dummy or cur.child_list == NULL:
+                    continue
+                for j from 0 <= j < cur.child_list.size:
+                    idx = self._child_slot_index(cur.child_list.refs[j])
+                    if idx >= 0:
+                        counts[idx] += 1
+            for i from 0 <= i < n_slots:
+                cur = self._table[i]
+                if cur == NULL or cur == _dummy or self._refcnts[i] < 0:
+                    continue
+                num = (self._refcnts[i] >> 1) - counts[i]
+                if num >= c_min_refs:
+                    found.append((num, <object>cur.address))
+        finally:
+            PyMem_Free(counts)
+        found.sort(reverse=True)
+        return [(num, self[address]) for num, address in found]
+
+    cdef _MemObject *_ref_object(self, PyObject *address) except? NULL:
+        """Return the object at address, or NULL if it is not present."""
+        cdef long idx
+
+        idx = self._child_slot_index(address)
+        if idx < 0:
+            return NULL
+        return self._table[idx]
+
+    cdef int _replace_parent(self, _MemObject *child, PyObject *old,
+                             PyObject *new) except -1:
+        """Change the parent 'old' of child into 'new'.
+
+        If new is already a parent of child, old is just removed.
+        """
+        cdef long j, old_idx
+        cdef int found_new
+        cdef RefList *parent_list
+
+        parent_list = child.parent_list
+        if parent_list == NULL:
+            return 0
+        old_idx = -1
+        found_new = 0
+        for j from 0 <= j < parent_list.size:
+            if old_idx < 0 and _same_address(parent_list.refs[j], old):
+                old_idx = j
+            elif _same_address(parent_list.refs[j], new):
+                found_new = 1
+        if old_idx < 0:
+            return 0
+        Py_DECREF(parent_list.refs[old_idx])
+        if not found_new:
+            parent_list.refs[old_idx] = new
+            Py_INCREF(new)
+            return 1
+        for j from old_idx < j < parent_list.size:
+            parent_list.refs[j - 1] = parent_list.refs[j]
+        parent_list.size -= 1
+        child.total_parents -= 1
+        if parent_list.size == 0:
+            PyMem_Free(parent_list)
+            child.parent_list = NULL
+        return 1
+
+    cdef int _add_parent(self, PyObject *address, PyObject *parent) except -1:
+        """Record that parent now references the object at address."""
+        cdef long j, num
+        cdef _MemObject *child
+        cdef RefList *new_list
+
+        child = self._ref_object(address)
+        if child == NULL:
+            return 0
+        num = 0
+        if child.parent_list != NULL:
+            num = child.parent_list.size
+            for j from 0 <= j < num:
+                if _same_address(child.parent_list.refs[j], parent):
+                    return 0
+        child.total_parents += 1
+        if self._max_parents >= 0 and num >= self._max_parents:
+            return 1
+        new_list = <RefList *>PyMem_Realloc(child.parent_list,
+            sizeof(RefList) + sizeof(PyObject*) * (num + 1))
+        if new_list == NULL:
+            raise MemoryError('Failed to allocate %d bytes'
+                % (sizeof(RefList) + sizeof(PyObject*) * (num + 1),))
+        new_list.size = num + 1
+        new_list.refs[num] = parent
+        Py_INCREF(parent)
+        child.parent_list = new_list
+        return 1
+
+    cdef int _remove_parent(self, PyObject *address,
+                            PyObject *parent) except -1:
+        """Record that parent no longer references the object at address.
+
+        parent must have referenced it. If the parent_list was cut off by
+        max_parents and parent isn't in it, it was one of the parents that
+        were only counted in total_parents.
+        """
+        cdef long j, idx
+        cdef _MemObject *child
+        cdef RefList *parent_list
+
+        child = self._ref_object(address)
+        if child == NULL:
+            return 0
+        parent_list = child.parent_list
+        idx = -1
+        if parent_list != NULL:
+            for j from 0 <= j < parent_list.size:
+                if _same_address(parent_list.refs[j], parent):
+                    idx = j
+                    break
+        if idx < 0:
+            if parent_list != NULL and child.total_parents > parent_list.size:
+                # parent was one of the ones cut off by max_parents
+                child.total_parents -= 1
+            elif parent_list == NULL and child.total_parents > 0:
+                child.total_parents -= 1
+            return 0
+        Py_DECREF(parent_list.refs[idx])
+        for j from idx < j < parent_list.size:
+            parent_list.refs[j - 1] = parent_list.refs[j]
+        parent_list.size -= 1
+        child.total_parents -= 1
+        if parent_list.size == 0:
+            PyMem_Free(parent_list)
+            child.parent_list = NULL
+        return 1
+
+    cdef int _children_changed(self, _MemObject *cur, old_children,
+                               new_children=None) except -1:
+        """Update the parents of the objects cur used to and now references.
+
+        :param new_children: The new children, by default cur.child_list.
+        """
+        if new_children is None:
+            new_children = _ref_list_to_list(cur.child_list)
+        old = set(old_children)
+        new = set(new_children)
+        for address in old:
+            if address not in new:
+                self._remove_parent(<PyObject *>address, cur.address)
+        for address in new:
+            if address not in old:
+                self._add_parent(<PyObject *>address, cur.address)
+        return 1
+
+    cdef int _pruned_children_changed(self, _MemObject *cur, long num_kept,
+                                      int add_null, null_ref) except -1:
+        """Update the parents for the references _prune_ref_list removed.
+
+        The removed references are after num_kept in cur.child_list. cur is
+        only removed from the parents of a child that it no longer
+        references at all.
+        """
+        cdef long j
+        cdef RefList *ref_list
+
+        ref_list = cur.child_list
+        for j from num_kept <= j < ref_list.size:
+            if (_has_ref(ref_list, 0, num_kept, ref_list.refs[j])
+                or _has_ref(ref_list, num_kept, j, ref_list.refs[j])):
+                # Still referenced, or a repeat we have already handled
+                continue
+            self._remove_parent(ref_list.refs[j], cur.address)
+        if add_null and not _has_ref(ref_list, 0, num_kept,
+                                     <PyObject *>null_ref):
+            self._add_parent(<PyObject *>null_ref, cur.address)
+        return 1
+
+    cdef int _collapse_into(self, _MemObject *cur, _MemObject *dict_obj,
+                            _MemObject *type_obj, int update_parents,
+                            int dict_collapsed) except -1:
+        """Replace the references of cur with those of dict_obj.
+
+        :param type_obj: If not NULL, cur keeps a reference to it.
+        :param dict_collapsed: dict_obj was already collapsed into another
+            object, so it was already replaced in the parents of its
+            contents.
+        """
+        cdef long j, num, num_refs
+        cdef RefList *new_list
+        cdef _MemObject *child
+
+        num = 0
+        if dict_obj.child_list != NULL:
+            num = dict_obj.child_list.size
+        num_refs = num
+        if type_obj != NULL:
+            num_refs += 1
+        new_list = NULL
+        if num_refs > 0:
+            new_list = <RefList *>PyMem_Malloc(sizeof(RefList)
+                                               + sizeof(PyObject*) * num_refs)
+            if new_list == NULL:
+                raise MemoryError('Failed to allocate %d bytes'
+                    % (sizeof(RefList) + sizeof(PyObject*) * num_refs,))
+            new_list.size = num_refs
+            for j from 0 <= j < num:
+                new_list.refs[j] = dict_obj.child_list.refs[j]
+                Py_INCREF(new_list.refs[j])
+                if (not update_parents
+                    or _has_ref(dict_obj.child_list, 0, j, new_list.refs[j])):
+                    continue
+                child = self._ref_object(new_list.refs[j])
+                if child == NULL:
+                    continue
+                if _has_ref(cur.child_list, 0, cur.child_list.size,
+                            new_list.refs[j]):
+                    # cur was already counted as a parent
+                    if not dict_collapsed:
+                        self._remove_parent(new_list.refs[j],
+                                            dict_obj.address)
+                elif dict_collapsed:
+                    self._add_parent(new_list.refs[j], cur.address)
+                else:
+                    self._replace_parent(child, dict_obj.address,
+                                         cur.address)
+            if type_obj != NULL:
+                new_list.refs[num] = type_obj.address
+                Py_INCREF(type_obj.address)
+        _free_ref_list(cur.child_list)
+        cur.child_list = new_list
+        cur.size += dict_obj.size
+        cur.total_size = 0
+        return 1
+
+    def collapse_instance_dicts(self, skip_types=(), update_parents=False):
+        """Move the contents of __dict__ objects into their owners.
+
+        This is the native version of ObjManager.collapse_instance_dicts.
+        Modules referencing only a dict, new-style instances referencing a
+        dict and their type, and old-style instances referencing their
+        classobj and a dict are collapsed. Old-style instances also get the
+        name of their class as their type_str. The dicts are removed from
+        the collection.
+
+        :param skip_types: Types that are never instances, their objects are
+            not looked at.
+        :param update_parents: If True, the parents of the contents of each
+            dict are patched to refer to its owner, rather than having to
+            call compute_parents() again.
+        :return: The number of objects that were collapsed.
+        """
+        cdef long offset, num_collapsed, idx
+        cdef int c_update_parents
+        cdef _MemObject *cur, *dict_obj, *type_obj, *ref_1, *ref_2
+
+        c_update_parents = update_parents or self._maintain_parents
+        num_collapsed = 0
+        to_remove = set()
+        to_rename = []
+        self._ensure_type_lists()
+        for type_str, offset in (<object>self._type_index).items():
+            if type_str == 'dict' or type_str in skip_types:
+                continue
+            idx = self._type_lists[offset].head
+            while idx >= 0:
+                cur = self._table[idx]
+                dict_obj = type_obj = NULL
+                if cur.child_list == NULL:
+                    pass
+                elif cur.child_list.size == 1 and type_str == 'module':
+                    ref_1 = self._ref_object(cur.child_list.refs[0])
+                    if ref_1 != NULL and _is_type(ref_1, 'dict'):
+                        dict_obj = ref_1
+                elif cur.child_list.size == 2:
+                    ref_1 = self._ref_object(cur.child_list.refs[0])
+                    ref_2 = self._ref_object(cur.child_list.refs[1])
+                    if ref_1 == NULL or ref_2 == NULL:
+                        pass
+                    elif _is_type(ref_1, 'dict') and _is_type(ref_2, 'type'):
+                        # This is a new-style class
+                        dict_obj = ref_1
+                        type_obj = ref_2
+                    elif (type_str == 'instance'
+                          and _is_type(ref_1, 'classobj')
+                          and _is_type(ref_2, 'dict')):
+                        # This is an old-style class
+                        type_obj = ref_1
+                        dict_obj = ref_2
+                if dict_obj != NULL:
+                    self._collapse_into(cur, dict_obj, type_obj,
+                        c_update_parents,
+                        <object>dict_obj.address in to_remove)
+                    to_remove.add(<object>dict_obj.address)
+                    if (type_str == 'instance'
+                        and type_obj.value != NULL
+                        and <object>type_obj.value is not None):
+                        to_rename.append((<object>cur.address,
+                                          <object>type_obj.value))
+                    num_collapsed += 1
+                idx = self._type_next[idx]
+        # Changing the type_str moves the object to another type list, so
+        # we wait until we are done walking them
+        for address, type_str in to_rename:
+            self._set_type_str(self._child_slot_index(<PyObject *>address),
+                               type_str)
+        # The parents of the dicts' contents were already patched
+        maintain_parents = self._maintain_parents
+        self._maintain_parents = 0
+        try:
+            for address in to_remove:
+                del self[address]
+        finally:
+            self._maintain_parents = maintain_parents
+        return num_collapsed
+
+    cdef int _build_graph(self, long **starts_out, long **succ_out,
+                          long **sizes_out) except -1:
+        """Describe the objects as a graph of table offsets.
+
+        The children of self._table[i] end up as
+        succ[starts[i]:starts[i+1]], and its size as sizes[i] (-1 for an
+        empty slot), see _graph_dominators. References to objects that are
+        not in the collection are dropped. The caller must PyMem_Free all
+        three arrays.
+        """
+        cdef long i, j, idx, n_slots, n_refs
+        cdef long *starts, *succ, *sizes
+        cdef _MemObject *cur
+
+        n_slots = self._table_mask + 1
+        n_refs = 0
+        for i from 0 <= i < n_slots:
+            cur = self._table[i]
+            if cur != NULL and cur != _dummy and cur.child_list != NULL:
+                n_refs += cur.child_list.size
+        starts = succ = NULL
+        sizes = _new_long_array(n_slots)
+        try:
+            starts = _new_long_array(n_slots + 1)
+            succ = _new_long_array(n_refs)
+        except:
+            PyMem_Free(sizes)
+            PyMem_Free(starts)
+            raise
+        n_refs = 0
+        for i from 0 <= i < n_slots:
+            starts[i] = n_refs
+            cur = self._table[i]
+            if cur == NULL or cur == _dummy:
+                sizes[i] = -1
+                continue
+            sizes[i] = cur.size
+            if cur.child_list == NULL:
+                continue
+            for j from 0 <= j < cur.child_list.size:
+                idx = self._child_slot_index(cur.child_list.refs[j])
+                if idx >= 0:
+                    succ[n_refs] = idx
+                    n_refs += 1
+        starts[n_slots] = n_refs
+        starts_out[0] = starts
+        succ_out[0] = succ
+        sizes_out[0] = sizes
+        return 0
+
+    def compute_dominators(self):
+        """Compute the dominator tree, and the retained size of every object.
+
+        X dominates Y if every path from the roots to Y goes through X, so if
+        X was freed, Y would be freed with it. We add a synthetic root which
+        refers to every object without parents, and to one object of each
+        cycle that can't be reached any other way. The tree is computed with
+        the Lengauer-Tarjan algorithm, in a single pass over the graph.
+
+        Afterwards .total_size is the retained size of each object (its own
+        size plus the size of everything it dominates), and
+        .immediate_dominator is the address of its immediate dominator.
+        """
+        cdef long n_slots, i
+        cdef long *starts, *succ, *sizes, *idom
+        cdef unsigned long *retained
+
+        n_slots = self._table_mask + 1
+        starts = succ = sizes = idom = NULL
+        retained = NULL
+        try:
+            self._build_graph(&starts, &succ, &sizes)
+            idom = _new_long_array(n_slots)
+            retained = <unsigned long *>_new_long_array(n_slots)
+            _graph_dominators(n_slots, starts, succ, sizes, idom, retained)
+            if self._dominators == NULL:
+                self._dominators = <PyObject **>PyMem_Malloc(
+                    sizeof(PyObject *) * n_slots)
+                if self._dominators == NULL:
+                    raise MemoryError('Failed to allocate %d bytes'
+                                      % (sizeof(PyObject *) * n_slots,))
+                memset(self._dominators, 0, sizeof(PyObject *) * n_slots)
+            for i from 0 <= i < n_slots:
+                if sizes[i] < 0:
+                    continue
+                self._table[i].total_size = retained[i]
+                Py_XDECREF(self._dominators[i])
+                self._dominators[i] = NULL
+                if idom[i] >= 0:
+                    self._dominators[i] = self._table[idom[i]].address
+                    Py_INCREF(self._dominators[i])
+        finally:
+            PyMem_Free(starts)
+            PyMem_Free(succ)
+            PyMem_Free(sizes)
+            PyMem_Free(idom)
+            PyMem_Free(retained)
+
+    def compute_reachable_sizes(self, approximate=False, num_registers=64):
+        """Set total_size of every object to the size of everything it reaches.
+
+        This gives the same result as calling compute_total_size() on every
+        object, but in one pass. The graph is condensed into its strongly
+        connected components (all members of a cycle reach the same objects),
+        and the sizes are then computed from the sinks upwards, sharing the
+        results between components.
+
+        A component whose successors are only referenced by it (a tree) just
+        sums their sizes. Other components walk the objects they reach, but
+        stop at any tree component, since nothing inside it can be reached
+        any other way.
+
+        The walks are what make the exact version slow on some graphs: each
+        shared component walks everything below it that isn't a tree, so
+        the time is O(components * edges) in the worst case. A long chain of
+        objects that each also refer to one big shared structure is such a
+        case. Use approximate=True for graphs like that.
+
+        :param approximate: If True, rather than walking shared components,
+            each component keeps a sketch of num_registers floats, merged
+            from its successors. This is the weighted version of
+            HyperLogLog, and gives an error of about 1/sqrt(num_registers)
+            for components that aren't trees, but runs in linear time. A
+            sketch is freed as soon as every component referring to it has
+            merged it, so only the sketches on the frontier of the walk are
+            kept at once.
+        :param num_registers: The number of registers in each sketch.
+        :return: The number of strongly connected components
+        """
+        cdef long n_slots, n_comps, i
+        cdef long *starts, *succ, *sizes
+        cdef unsigned long *hashes, *reach
+
+        n_slots = self._table_mask + 1
+        if approximate and num_registers < 2:
+            raise ValueError('num_registers must be at least 2, not %d'
+                             % (num_registers,))
+        starts = succ = sizes = NULL
+        hashes = reach = NULL
+        try:
+            self._build_graph(&starts, &succ, &sizes)
+            if approximate:
+                hashes = <unsigned long *>_new_long_array(n_slots)
+                for i from 0 <= i < n_slots:
+                    if sizes[i] >= 0:
+                        hashes[i] = PyObject_Hash(self._table[i].address)
+            reach = <unsigned long *>_new_long_array(n_slots)
+            n_comps = _graph_reachable_sizes(n_slots, starts, succ, sizes,
+                                             hashes, approximate,
+                                             num_registers, reach)
+            for i from 0 <= i < n_slots:
+                if sizes[i] >= 0:
+                    self._table[i].total_size = reach[i]
+        finally:
+            PyMem_Free(starts)
+            PyMem_Free(succ)
+            PyMem_Free(sizes)
+            PyMem_Free(hashes)
+            PyMem_Free(reach)
+        return n_comps
+
+    def largest_total_size(self, count=20):
+        """Return the objects with the largest total_size, largest first.
+
+        This keeps a small heap of the best entries while scanning the table,
+        so proxies are only created for the objects that are returned.
+        """
+        cdef long i, n, pos, child, c_count, tmp
+        cdef long *heap
+        cdef _MemObject *cur
+
+        c_count = count
+        if c_count <= 0:
+            return []
+        heap = _new_long_array(c_count)
+        n = 0
+        try:
+            for i from 0 <= i <= self._table_mask:
+                cur = self._table[i]
+                if cur == NULL or cur == _dummy:
+                    continue
+                if n < c_count:
+                    # Sift up
+                    pos = n
+                    n += 1
+                    while pos > 0:
+                        tmp = (pos - 1) / 2
+                        if (self._table[heap[tmp]].total_size
+                            <= cur.total_size):
+                            break
+                        heap[pos] = heap[tmp]
+                        pos = tmp
+                    heap[pos] = i
+                    continue
+                if cur.total_size <= self._table[heap[0]].total_size:
+                    continue
+                # Replace the smallest entry, and sift down
+                pos = 0
+                while True:
+                    child = 2 * pos + 1
+                    if child >= n:
+                        break
+                    if (child + 1 < n
+                        and self._table[heap[child + 1]].total_size
+                            < self._table[heap[child]].total_size):
+                        child += 1
+                    if self._table[heap[child]].total_size >= cur.total_size:
+                        break
+                    heap[pos] = heap[child]
+                    pos = child
+                heap[pos] = i
+            result = []
+            for pos from 0 <= pos < n:
+                cur = self._table[heap[pos]]
+                result.append(self._proxy_for(<object>cur.address, cur))
+        finally:
+            PyMem_Free(heap)
+        result.sort(key=_total_size_sort_key, reverse=True)
+        return result
+
+    def path_to_root(self, address, k=3, skip_types=('type', 'frame')):
+        """Find the shortest paths that keep an object alive.
+
+        This does a breadth first search over the parent lists, starting at
+        address, until k roots have been found. A root is an object without
+        any parents, or a module. Objects of skip_types are never walked
+        through, since they tend to reference everything (see
+        remove_expensive_references). compute_parents needs to have been
+        called first.
+
+        :param address: The address of the object to start from.
+        :param k: The number of paths to return. Each path ends at a
+            different root.
+        :param skip_types: Don't look for paths through these types.
+        :return: A list of paths, shortest first. Each path is a list of
+            addresses starting with address, and ending with a root.
+        """
+        cdef long start, slot, parent_slot, pos, i
+        cdef _MemObject *cur
+
+        start = self._child_slot_index(<PyObject *>address)
+        if start == -1:
+            raise KeyError('address %s not present' % (address,))
+        skip_types = frozenset(skip_types)
+        # Maps a slot to the slot we reached it from
+        came_from = {start: -1}
+        queue = [start]
+        roots = []
+        pos = 0
+        while pos < len(queue) and len(roots) < k:
+            slot = queue[pos]
+            pos += 1
+            cur = self._table[slot]
+            if (cur.parent_list == NULL or cur.parent_list.size == 0
+                or <object>cur.type_str == 'module'):
+                roots.append(slot)
+                continue
+            for i from 0 <= i < cur.parent_list.size:
+                parent_slot = self._child_slot_index(cur.parent_list.refs[i])
+                if parent_slot == -1 or parent_slot in came_from:
+                    continue
+                if <object>self._table[parent_slot].type_str in skip_types:
+                    continue
+                came_from[parent_slot] = slot
+                queue.append(parent_slot)
+        paths = []
+        for slot in roots:
+            path = []
+            while slot != -1:
+                path.append(<object>self._table[slot].address)
+                slot = came_from[slot]
+            path.reverse()
+            paths.append(path)
+        return paths
+
+    cdef unsigned long *_sorted_addresses_of_types(self, type_strs,
+                                                   long *count) except NULL:
+        """Return a sorted array of the addresses of objects of type_strs.
+
+        The caller must PyMem_Free the result.
+        """
+        cdef long offset, num, idx
+        cdef unsigned long *addresses
+
+        self._ensure_type_lists()
+        offsets = []
+        num = 0
+        for type_str in type_strs:
+            offset = self._type_offset(type_str, 0)
+            if offset >= 0:
+                offsets.append(offset)
+                num += self._type_lists[offset].count
+        addresses = <unsigned long *>PyMem_Malloc(
+            sizeof(unsigned long) * (num + 1))
+        if addresses == NULL:
+            raise MemoryError('Failed to allocate %d bytes'
+                              % (sizeof(unsigned long) * (num + 1),))
+        num = 0
+        for offset in offsets:
+            idx = self._type_lists[offset].head
+            while idx >= 0:
+                addresses[num] = PyInt_AsUnsignedLongMask(
+                    self._table[idx].address)
+                num += 1
+                idx = self._type_next[idx]
+        qsort(addresses, num, sizeof(unsigned long), _compare_ulong)
+        count[0] = num
+        return addresses
+
+    def prune_edges(self, into_types=(), slots=None, sideways_types=()):
+        """Remove references according to rules about their types.
+
+        The rules are compiled into a table with one entry for every type in
+        the type index, and the objects are then filtered a type at a time,
+        with the reference lists edited in place. References removed by the
+        first two rules are replaced by a single reference to the null
+        object at address 0 (see ObjManager.remove_expensive_references).
+
+        :param into_types: Remove all references to objects of these types,
+            from objects whose type has no slots or sideways rule.
+        :param slots: A dict mapping type_str to the (traverse) positions in
+            the reference lists of those objects that should be removed.
+        :param sideways_types: Remove the references from objects of these
+            types to other objects of the same type.
+        :return: The number of objects that were changed.
+        """
+        cdef _EdgeRule *rules
+        cdef unsigned long *into, *type_into
+        cdef long num_into, type_num_into, offset, i, num_changed, num_kept
+        cdef long idx
+        cdef int add_null
+        cdef _MemObject *cur
+        cdef object null_ref
+
+        if slots is None:
+            slots = {}
+        self._ensure_type_lists()
+        into = NULL
+        num_changed = 0
+        rules = <_EdgeRule *>PyMem_Malloc(sizeof(_EdgeRule)
+                                          * (self._num_types + 1))
+        if rules == NULL:
+            raise MemoryError('Failed to allocate %d bytes'
+                              % (sizeof(_EdgeRule) * (self._num_types + 1),))
+        memset(rules, 0, sizeof(_EdgeRule) * (self._num_types + 1))
+        try:
+            into = self._sorted_addresses_of_types(into_types, &num_into)
+            for type_str, type_slots in slots.iteritems():
+                offset = self._type_offset(type_str, 0)
+                if offset < 0:
+                    continue
+                type_slots = sorted(set(type_slots))
+                rules[offset].slots = <long *>PyMem_Malloc(
+                    sizeof(long) * (len(type_slots) + 1))
+                if rules[offset].slots == NULL:
+                    raise MemoryError('Failed to allocate %d bytes'
+                        % (sizeof(long) * (len(type_slots) + 1),))
+                for i from 0 <= i < len(type_slots):
+                    rules[offset].slots[i] = type_slots[i]
+                rules[offset].num_slots = len(type_slots)
+            for type_str in sideways_types:
+                offset = self._type_offset(type_str, 0)
+                if offset < 0 or rules[offset].sideways != NULL:
+                    continue
+                rules[offset].sideways = self._sorted_addresses_of_types(
+                    (type_str,), &rules[offset].num_sideways)
+            null_ref = 0
+            for offset from 0 <= offset < self._num_types:
+                # Types with their own rules don't lose references by the
+                # type of what they refer to, see EdgeRules
+                if (rules[offset].slots != NULL
+                    or rules[offset].sideways != NULL):
+                    type_into = NULL
+                    type_num_into = 0
+                else:
+                    type_into = into
+                    type_num_into = num_into
+                idx = self._type_lists[offset].head
+                while idx >= 0:
+                    cur = self._table[idx]
+                    num_kept = _prune_ref_list(cur, rules + offset, type_into,
+                                               type_num_into, &add_null)
+                    if (cur.child_list != NULL
+                        and num_kept < cur.child_list.size):
+                        num_changed += 1
+                        if self._maintain_parents:
+                            self._pruned_children_changed(cur, num_kept,
+                                                          add_null, null_ref)
+                        _finish_pruned_ref_list(cur, num_kept, add_null,
+                                                null_ref)
+                    idx = self._type_next[idx]
+        finally:
+            for offset from 0 <= offset < self._num_types:
+                PyMem_Free(rules[offset].slots)
+                PyMem_Free(rules[offset].sideways)
+            PyMem_Free(rules)
+            PyMem_Free(into)
+        return num_changed
+
+    def remove_expensive_references(self):
+        """Filter out references that are mere housekeeping links.
+
+        This is the native version of loader.remove_expensive_references,
+        and gives the same result. References to modules, frames and types
+        are replaced by a single reference to the null object at address 0,
+        the func_globals and func_module references of functions are removed
+        (also adding a null reference), and _LRUNode objects lose their
+        references to other _LRUNodes. Functions and _LRUNodes keep their
+        other references, even to modules or types. See prune_edges.
+
+        :return: The number of objects that were changed.
+        """
+        return self.prune_edges(('module', 'frame', 'type'),
+                                {'function': (1, 2)}, ('_LRUNode',))
+
+    def find_duplicate_values(self, type_strs=('str', 'unicode', 'int'),
+                              max_samples=5):
+        """Find objects of the given types which have equal values.
+
+        This is done in two passes. The first only counts the hashes of the
+        values into a small table of saturating counters (one byte for every
+        candidate object). The second pass only looks at the objects whose
+        hash bucket was hit more than once, and groups them by their actual
+        value. So the memory used is proportional to the number of
+        duplicates, rather than to the number of distinct values.
+
+        Objects are grouped by (type_str, size, value), since dumps only
+        record the start of long strings.
+
+        :param type_strs: The types of objects to look at.
+        :param max_samples: The number of addresses of copies, and of the
+            objects which refer to them (if parents have been computed), to
+            report for each value.
+        :return: A list of (type_str, value, size, count, addresses, holders)
+            for every value with more than one copy.
+        """
+        cdef long offset, num_candidates, num_buckets, bucket, i, idx
+        cdef unsigned char *counters
+        cdef _MemObject *cur
+        cdef long value_hash
+
+        self._ensure_type_lists()
+        offsets = []
+        num_candidates = 0
+        for type_str in type_strs:
+            offset = self._type_offset(type_str, 0)
+            if offset < 0 or self._type_lists[offset].count == 0:
+                continue
+            offsets.append(offset)
+            num_candidates += self._type_lists[offset].count
+        num_buckets = 1024
+        while num_buckets < num_candidates * 2:
+            num_buckets = num_buckets * 2
+        counters = <unsigned char *>PyMem_Malloc(num_buckets)
+        if counters == NULL:
+            raise MemoryError('Failed to allocate %d bytes' % (num_buckets,))
+        memset(counters, 0, num_buckets)
+        groups = {}
+        try:
+            for offset in offsets:
+                idx = self._type_lists[offset].head
+                while idx >= 0:
+                    cur = self._table[idx]
+                    if cur.value != NULL and cur.value != Py_None:
+                        value_hash = PyObject_Hash(cur.value)
+                        bucket = (<long>_mix64(<unsigned long long>value_hash
+                                               ^ <unsigned long long>cur.size)
+                                  & (num_buckets - 1))
+                        if counters[bucket] < 2:
+                            counters[bucket] += 1
+                    idx = self._type_next[idx]
+            for offset in offsets:
+                idx = self._type_lists[offset].head
+                while idx >= 0:
+                    cur = self._table[idx]
+                    if cur.value != NULL and cur.value != Py_None:
+                        value_hash = PyObject_Hash(cur.value)
+                        bucket = (<long>_mix64(<unsigned long long>value_hash
+                                               ^ <unsigned long long>cur.size)
+                                  & (num_buckets - 1))
+                        if counters[bucket] > 1:
+                            key = (<object>cur.type_str, cur.size,
+                                   <object>cur.value)
+                            group = groups.get(key)
+                            if group is None:
+                                # count, addresses, holders
+                                group = [0, [], []]
+                                groups[key] = group
+                            group[0] += 1
+                            if len(group[1]) < max_samples:
+                                group[1].append(<object>cur.address)
+                            holders = group[2]
+                            if (cur.parent_list != NULL
+                                and len(holders) < max_samples):
+                                for i from 0 <= i < cur.parent_list.size:
+                                    if len(holders) >= max_samples:
+                                        break
+                                    holder = <object>cur.parent_list.refs[i]
+                                    if holder not in holders:
+                                        holders.append(holder)
+                    idx = self._type_next[idx]
+        finally:
+            PyMem_Free(counters)
+        result = []
+        for key, group in groups.iteritems():
+            if group[0] < 2:
+                # A collision in the first pass
+                continue
+            result.append((key[0], key[2], key[1], group[0], group[1],
+                           group[2]))
+        return result
+
+    def summarize_by_type(self):
+        """Aggregate the count and size of the objects of each type.
+
+        This works directly on the table, so no proxies are created.
+
+        :return: A list of (type_str, count, total_size, sq_sum, max_size,
+            max_address) tuples, one for each type. sq_sum is the sum of the
+            squares of the sizes, as a float.
+        """
+        cdef long i, idx, n_types, n_alloc
+        cdef unsigned long long address
+        cdef _TypeTotals *totals, *new_totals, *cur_totals
+        cdef PyObject *last_type, *tmp
+        cdef _MemObject *cur
+
+        type_index = {}
+        n_types = 0
+        n_alloc = 64
+        totals = <_TypeTotals *>PyMem_Malloc(sizeof(_TypeTotals) * n_alloc)
+        if totals == NULL:
+            raise MemoryError('Failed to allocate %d bytes'
+                              % (sizeof(_TypeTotals) * n_alloc,))
+        try:
+            last_type = NULL
+            idx = -1
+            for i from 0 <= i <= self._table_mask:
+                cur = self._table[i]
+                if cur == NULL or cur == _dummy:
+                    continue
+                if cur.type_str != last_type:
+                    # type_str is usually interned, but we fall back to the
+                    # dict when the pointer doesn't match the last object
+                    tmp = PyDict_GetItem_ptr(type_index, cur.type_str)
+                    if tmp != NULL:
+                        idx = <object>tmp
+                    else:
+                        if n_types == n_alloc:
+                            new_totals = <_TypeTotals *>PyMem_Realloc(totals,
+                                sizeof(_TypeTotals) * n_alloc * 2)
+                            if new_totals == NULL:
+                                raise MemoryError('Failed to allocate %d'
+                                    ' bytes'
+                                    % (sizeof(_TypeTotals) * n_alloc * 2,))
+                            totals = new_totals
+                            n_alloc = n_alloc * 2
+                        idx = n_types
+                        n_types += 1
+                        memset(totals + idx, 0, sizeof(_TypeTotals))
+                        type_index[<object>cur.type_str] = idx
+                    last_type = cur.type_str
+                cur_totals = totals + idx
+                cur_totals.count += 1
+                cur_totals.total_size += cur.size
+                cur_totals.sq_sum += (<double>cur.size) * cur.size
+                address = PyInt_AsUnsignedLongMask(cur.address)
+                if _is_new_max(cur_totals.count, cur.size, address,
+                               cur_totals.max_size, cur_totals.max_address):
+                    cur_totals.max_size = cur.size
+                    cur_totals.max_address = address
+                    cur_totals.max_obj = cur
+            result = [None] * n_types
+            for type_str, idx in type_index.iteritems():
+                cur_totals = totals + idx
+                if cur_totals.max_obj == NULL:
+                    max_address = None
+                else:
+                    max_address = <object>cur_totals.max_obj.address
+                result[idx] = (type_str, cur_totals.count,
+                               cur_totals.total_size, cur_totals.sq_sum,
+                               cur_totals.max_size, max_address)
+        finally:
+            PyMem_Free(totals)
+        return result
+
     def __dealloc__(self):
         cdef long i
 
         for i from 0 <= i < self._table_mask:
             self._clear_slot(self._table + i)
+        if self._dominators != NULL:
+            for i from 0 <= i <= self._table_mask:
+                Py_XDECREF(self._dominators[i])
+        PyMem_Free(self._dominators)
+        self._dominators = NULL
+        PyMem_Free(self._refcnts)
+        self._refcnts = NULL
+        PyMem_Free(self._type_prev)
+        PyMem_Free(self._type_next)
+        self._type_prev = self._type_next = NULL
         PyMem_Free(self._table)
         self._table = NULL
+        PyMem_Free(self._type_lists)
+        self._type_lists = NULL
+        Py_XDECREF(self._type_index)
+        self._type_index = NULL
 
     def __iter__(self):
         return self.iterkeys()
@@ -989,6 +3584,31 @@ cdef class MemObjectCollection:
         """Return an iterable of values stored in this map."""
         return _MOCValueIterator(self)
 
+    def iter_raw(self, fields=('address', 'type_str', 'size'),
+                 batch_size=None):
+        """Iterate the fields of every object, without creating proxies.
+
+        :param fields: The names of the fields to return, any of 'address',
+            'type_str', 'size', 'value', 'total_size', 'num_children',
+            'num_parents' and 'total_parents'.
+        :param batch_size: If None, yield a tuple of the fields for every
+            object. Otherwise yield a tuple with an array.array('L') for each
+            field, holding the values of up to batch_size objects. Only
+            numeric fields can be batched.
+        """
+        return _MOCRawIterator(self, fields, batch_size)
+
+    def iter_edges(self, batch_size=65536):
+        """Iterate all references, without creating proxies.
+
+        References to objects which are not in the collection are included.
+
+        :param batch_size: The maximum number of references in each batch.
+        :return: An iterator of (parents, children) pairs of
+            array.array('L'), so parents[i] refers to children[i].
+        """
+        return _MOCEdgeIterator(self, batch_size)
+
     def values(self):
         # This returns a list, but that is 'close enough' for what we need
         cdef long i
@@ -1043,6 +3663,244 @@ cdef class _MOCValueIterator:
         return self.collection._proxy_for(<object>cur.address, cur)
 
 
+# The fields that iter_raw can return
+cdef enum _RawField:
+    _RAW_ADDRESS
+    _RAW_TYPE_STR
+    _RAW_SIZE
+    _RAW_VALUE
+    _RAW_TOTAL_SIZE
+    _RAW_NUM_CHILDREN
+    _RAW_NUM_PARENTS
+    _RAW_TOTAL_PARENTS
+
+
+_raw_fields = {
+    'address': _RAW_ADDRESS,
+    'type_str': _RAW_TYPE_STR,
+    'size': _RAW_SIZE,
+    'value': _RAW_VALUE,
+    'total_size': _RAW_TOTAL_SIZE,
+    'num_children': _RAW_NUM_CHILDREN,
+    'num_parents': _RAW_NUM_PARENTS,
+    'total_parents': _RAW_TOTAL_PARENTS,
+    }
+
+
+cdef object _raw_field(_MemObject *cur, int field):
+    if field == _RAW_ADDRESS:
+        return <object>cur.address
+    elif field == _RAW_TYPE_STR:
+        return <object>cur.type_str
+    elif field == _RAW_SIZE:
+        return cur.size
+    elif field == _RAW_VALUE:
+        return <object>cur.value
+    elif field == _RAW_TOTAL_SIZE:
+        return cur.total_size
+    elif field == _RAW_NUM_CHILDREN:
+        if cur.child_list == NULL:
+            return 0
+        return cur.child_list.size
+    elif field == _RAW_NUM_PARENTS:
+        if cur.parent_list == NULL:
+            return 0
+        return cur.parent_list.size
+    elif field == _RAW_TOTAL_PARENTS:
+        return cur.total_parents
+    raise ValueError('unknown field %d' % (field,))
+
+
+cdef unsigned long _raw_numeric_field(_MemObject *cur, int field) except? 0:
+    if field == _RAW_ADDRESS:
+        return <object>cur.address
+    elif field == _RAW_SIZE:
+        return cur.size
+    elif field == _RAW_TOTAL_SIZE:
+        return cur.total_size
+    elif field == _RAW_NUM_CHILDREN:
+        if cur.child_list == NULL:
+            return 0
+        return cur.child_list.size
+    elif field == _RAW_NUM_PARENTS:
+        if cur.parent_list == NULL:
+            return 0
+        return cur.parent_list.size
+    elif field == _RAW_TOTAL_PARENTS:
+        return cur.total_parents
+    raise ValueError('field %d is not numeric' % (field,))
+
+
+cdef object _ulong_array(unsigned long *values, long count):
+    """Copy count values into a new array.array('L')."""
+    result = array.array('L')
+    result.fromstring(PyString_FromStringAndSize(<char *>values,
+                                                 sizeof(unsigned long) * count))
+    return result
+
+
+cdef class _MOCRawIterator:
+    """Iterate the fields of the objects in a MOC, see iter_raw."""
+
+    cdef MemObjectCollection collection
+    cdef int initial_active
+    cdef long table_pos
+    cdef int *fields
+    cdef int num_fields
+    cdef long batch_size
+    cdef unsigned long *buffer
+
+    def __init__(self, collection, fields, batch_size=None):
+        cdef int i
+
+        self.collection = collection
+        self.initial_active = self.collection._active
+        self.table_pos = 0
+        self.num_fields = len(fields)
+        self.fields = <int *>PyMem_Malloc(sizeof(int) * (self.num_fields + 1))
+        if self.fields == NULL:
+            raise MemoryError('Failed to allocate %d bytes'
+                              % (sizeof(int) * (self.num_fields + 1),))
+        for i from 0 <= i < self.num_fields:
+            try:
+                self.fields[i] = _raw_fields[fields[i]]
+            except KeyError:
+                raise ValueError('unknown field %r' % (fields[i],))
+            if (batch_size is not None
+                and self.fields[i] in (_RAW_TYPE_STR, _RAW_VALUE)):
+                raise ValueError('field %r cannot be batched' % (fields[i],))
+        if batch_size is None:
+            self.batch_size = 0
+        else:
+            self.batch_size = batch_size
+            if self.batch_size < 1:
+                raise ValueError('batch_size must be positive, not %d'
+                                 % (self.batch_size,))
+            self.buffer = <unsigned long *>PyMem_Malloc(sizeof(unsigned long)
+                * (self.batch_size * self.num_fields + 1))
+            if self.buffer == NULL:
+                raise MemoryError('Failed to allocate %d bytes'
+                    % (sizeof(unsigned long)
+                       * self.batch_size * self.num_fields,))
+
+    def __dealloc__(self):
+        PyMem_Free(self.fields)
+        PyMem_Free(self.buffer)
+
+    def __iter__(self):
+        return self
+
+    cdef _MemObject *_next_object(self) except? NULL:
+        cdef _MemObject *cur
+
+        if self.collection._active != self.initial_active:
+            raise RuntimeError('MemObjectCollection changed size during'
+                               ' iteration')
+        while self.table_pos <= self.collection._table_mask:
+            cur = self.collection._table[self.table_pos]
+            self.table_pos += 1
+            if cur != NULL and cur != _dummy:
+                return cur
+        return NULL
+
+    def __next__(self):
+        cdef _MemObject *cur
+        cdef long count
+        cdef int i
+
+        if self.batch_size == 0:
+            cur = self._next_object()
+            if cur == NULL:
+                raise StopIteration()
+            result = PyTuple_New(self.num_fields)
+            for i from 0 <= i < self.num_fields:
+                value = _raw_field(cur, self.fields[i])
+                # SET_ITEM steals a reference
+                Py_INCREF(<PyObject *>value)
+                PyTuple_SET_ITEM_ptr(result, i, <PyObject *>value)
+            return result
+        count = 0
+        while count < self.batch_size:
+            cur = self._next_object()
+            if cur == NULL:
+                break
+            for i from 0 <= i < self.num_fields:
+                self.buffer[i * self.batch_size + count] = _raw_numeric_field(
+                    cur, self.fields[i])
+            count += 1
+        if count == 0:
+            raise StopIteration()
+        result = []
+        for i from 0 <= i < self.num_fields:
+            result.append(_ulong_array(self.buffer + i * self.batch_size,
+                                       count))
+        return tuple(result)
+
+
+cdef class _MOCEdgeIterator:
+    """Iterate the references between objects in a MOC, see iter_edges."""
+
+    cdef MemObjectCollection collection
+    cdef int initial_active
+    cdef long table_pos
+    cdef long child_pos
+    cdef long batch_size
+    cdef unsigned long *parents
+    cdef unsigned long *children
+
+    def __init__(self, collection, batch_size):
+        self.collection = collection
+        self.initial_active = self.collection._active
+        self.table_pos = 0
+        self.child_pos = 0
+        self.batch_size = batch_size
+        if self.batch_size < 1:
+            raise ValueError('batch_size must be positive, not %d'
+                             % (self.batch_size,))
+        self.parents = <unsigned long *>PyMem_Malloc(
+            sizeof(unsigned long) * self.batch_size * 2)
+        if self.parents == NULL:
+            raise MemoryError('Failed to allocate %d bytes'
+                % (sizeof(unsigned long) * self.batch_size * 2,))
+        self.children = self.parents + self.batch_size
+
+    def __dealloc__(self):
+        PyMem_Free(self.parents)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        cdef _MemObject *cur
+        cdef long count
+        cdef unsigned long address
+
+        if self.collection._active != self.initial_active:
+            raise RuntimeError('MemObjectCollection changed size during'
+                               ' iteration')
+        count = 0
+        while (count < self.batch_size
+               and self.table_pos <= self.collection._table_mask):
+            cur = self.collection._table[self.table_pos]
+            if (cur == NULL or cur == _dummy or cur.child_list == NULL
+                or self.child_pos >= cur.child_list.size):
+                self.table_pos += 1
+                self.child_pos = 0
+                continue
+            address = <object>cur.address
+            while (count < self.batch_size
+                   and self.child_pos < cur.child_list.size):
+                self.parents[count] = address
+                self.children[count] = <object>cur.child_list.refs[
+                    self.child_pos]
+                self.child_pos += 1
+                count += 1
+        if count == 0:
+            raise StopIteration()
+        return (_ulong_array(self.parents, count),
+                _ulong_array(self.children, count))
+
+
 cdef class _MOPReferencedIterator:
     """Iterate over all the children referenced from this object."""
 
@@ -1058,9 +3916,9 @@ cdef class _MOPReferencedIterator:
         c_proxy = proxy
         self.collection = c_proxy.collection
         if excluding is not None:
-            self.seen_addresses = _intset.IDSet(excluding)
+            self.seen_addresses = _intset.AddressSet(excluding)
         else:
-            self.seen_addresses = _intset.IDSet()
+            self.seen_addresses = _intset.AddressSet()
         self.pending_addresses = [c_proxy.address]
         self.pending_offset = 0
 
@@ -1170,6 +4028,91 @@ cdef int _MemObjectProxy_traverse(_MemObjectProxy self, visitproc visit,
 (<PyTypeObject*>_MemObjectProxy).tp_traverse = <traverseproc>_MemObjectProxy_traverse
 
 
+# Walking a collection creates and destroys a proxy for every object. So we
+# keep the memory of recently freed proxies around, and hand it out again
+# when a new proxy is created, which skips the allocator and gc accounting.
+# tp_alloc and tp_free are only called with the GIL held, so the list needs
+# no lock of its own.
+cdef PyObject **_proxy_free_list
+cdef long _proxy_free_list_size
+cdef long _proxy_free_list_count
+cdef allocfunc _proxy_orig_alloc
+cdef freefunc _proxy_orig_free
+_proxy_free_list = NULL
+_proxy_free_list_size = 0
+_proxy_free_list_count = 0
+
+
+cdef PyObject *_MemObjectProxy_alloc(PyTypeObject *t, Py_ssize_t nitems):
+    """tp_alloc for _MemObjectProxy, reusing memory from the free list."""
+    global _proxy_free_list_count
+    cdef PyObject *obj
+
+    if (_proxy_free_list_count == 0 or nitems != 0
+        or t != <PyTypeObject*>_MemObjectProxy):
+        return _proxy_orig_alloc(t, nitems)
+    _proxy_free_list_count -= 1
+    obj = _proxy_free_list[_proxy_free_list_count]
+    # Same as PyType_GenericAlloc
+    memset(obj, 0, t.tp_basicsize)
+    PyObject_INIT(obj, t)
+    PyObject_GC_Track(obj)
+    return obj
+
+
+cdef void _MemObjectProxy_free(void *obj):
+    """tp_free for _MemObjectProxy, putting the memory on the free list.
+
+    tp_dealloc has already untracked the object from gc.
+    """
+    global _proxy_free_list_count
+
+    if _proxy_free_list_count < _proxy_free_list_size:
+        _proxy_free_list[_proxy_free_list_count] = <PyObject *>obj
+        _proxy_free_list_count += 1
+    else:
+        _proxy_orig_free(obj)
+
+
+def set_proxy_free_list_size(size):
+    """Set how many freed proxies are kept around for reuse.
+
+    :param size: The maximum number of proxies to keep, 0 disables it.
+    :return: The previous maximum.
+    """
+    global _proxy_free_list, _proxy_free_list_size, _proxy_free_list_count
+    cdef long c_size
+    cdef PyObject **new_list
+
+    c_size = size
+    if c_size < 0:
+        raise ValueError('size must not be negative, not %d' % (c_size,))
+    old_size = _proxy_free_list_size
+    while _proxy_free_list_count > c_size:
+        _proxy_free_list_count -= 1
+        _proxy_orig_free(_proxy_free_list[_proxy_free_list_count])
+    new_list = <PyObject **>PyMem_Realloc(_proxy_free_list,
+                                          sizeof(PyObject *) * (c_size + 1))
+    if new_list == NULL:
+        raise MemoryError('Failed to allocate %d bytes'
+                          % (sizeof(PyObject *) * (c_size + 1),))
+    _proxy_free_list = new_list
+    _proxy_free_list_size = c_size
+    return old_size
+
+
+def _proxy_free_list_length():
+    """The number of proxies currently waiting to be reused (for tests)."""
+    return _proxy_free_list_count
+
+
+_proxy_orig_alloc = (<PyTypeObject*>_MemObjectProxy).tp_alloc
+_proxy_orig_free = (<PyTypeObject*>_MemObjectProxy).tp_free
+(<PyTypeObject*>_MemObjectProxy).tp_alloc = <allocfunc>_MemObjectProxy_alloc
+(<PyTypeObject*>_MemObjectProxy).tp_free = <freefunc>_MemObjectProxy_free
+set_proxy_free_list_size(1000)
+
+
 cdef int MemObjectCollection_traverse(MemObjectCollection self,
                                       visitproc visit, void *arg) except -1:
     """Implement a correct tp_traverse because we use hidden members.
@@ -1189,5 +4132,9 @@ cdef int MemObjectCollection_traverse(MemObjectCollection self,
             ret = _MemObject_traverse(cur, visit, arg)
             if ret:
                 break
+        if self._dominators != NULL and self._dominators[i] != NULL:
+            ret = visit(self._dominators[i], arg)
+            if ret:
+                break
     return ret
 (<PyTypeObject*>MemObjectCollection).tp_traverse = <traverseproc>MemObjectCollection_traverse
@@ -37,9 +37,21 @@ cdef extern from "_scanner_core.h":
     ctypedef void (*write_callback)(void *callee_data, const_pchar bytes,
                    size_t len)
 
+    ctypedef struct seen_objects:
+        void *table
+        void *bloom
+        size_t mask
+        size_t count
+        Py_ssize_t min_refcount
+    int _seen_objects_init(seen_objects *seen, size_t bloom_bytes) except -1
+    void _seen_objects_clear(seen_objects *seen)
+    int _seen_objects_add(seen_objects *seen, object c_obj)
+    int _seen_objects_contains(seen_objects *seen, object c_obj)
+
     void _clear_last_dumped()
     void _dump_object_info(write_callback write, void *callee_data,
-                           object c_obj, object nodump, int recurse)
+                           object c_obj, object nodump, seen_objects *seen,
+                           int refcounts, Py_ssize_t refs_held, int recurse)
     object _get_referents(object c_obj)
     object _get_special_case_dict()
 
@@ -76,8 +88,77 @@ cdef void _callable_callback(void *callee_data, char *bytes, size_t len):
     callable(s)
 
 
+cdef class SeenObjects:
+    """The objects that dump_object_info has already written.
+
+    Passing the same SeenObjects to every dump_object_info call means each
+    object is written once, even when it is referenced (and so dumped as a
+    child) from many places.
+
+    By default this is an exact set of the objects, costing 12-24 bytes per
+    object. It holds a reference to each of them until it is freed, so
+    that no new object can take the address of one that was dumped (the
+    refcnt written for them leaves that reference out). With bloom_size,
+    it is instead a Bloom filter of that many bytes. That never grows, but
+    once it fills up it will think some new objects have already been
+    dumped, and they are missing from the dump. About 10 bits per object
+    keeps that under 1%. A Bloom filter only knows addresses, so it is
+    only right while the dumped objects stay alive: an object allocated
+    where a dumped one was freed is taken as already dumped.
+
+    With min_refcount, only objects with more references than that are
+    tracked, and the rest are dumped every time they are found. The few
+    objects that are shared very widely (common strings, small ints, types)
+    are then only written once, for very little memory.
+    """
+
+    cdef seen_objects _seen
+
+    def __init__(self, bloom_size=None, min_refcount=0):
+        if bloom_size is None:
+            bloom_size = 0
+        elif bloom_size <= 0:
+            raise ValueError('bloom_size must be positive, not %d'
+                             % (bloom_size,))
+        _seen_objects_clear(&self._seen)
+        _seen_objects_init(&self._seen, bloom_size)
+        self._seen.min_refcount = min_refcount
+
+    property min_refcount:
+        def __get__(self):
+            return self._seen.min_refcount
+
+    def __dealloc__(self):
+        _seen_objects_clear(&self._seen)
+
+    property is_bloom:
+        def __get__(self):
+            return self._seen.bloom != NULL
+
+    def __len__(self):
+        # For a Bloom filter, this is the number of objects that were
+        # considered new
+        return self._seen.count
+
+    def __contains__(self, obj):
+        return bool(_seen_objects_contains(&self._seen, obj))
+
+    def add(self, obj):
+        """Mark obj as dumped, return True if it wasn't already."""
+        return bool(_seen_objects_add(&self._seen, obj))
+
+    def __sizeof__(self):
+        my_size = sizeof(SeenObjects)
+        if self._seen.bloom != NULL:
+            my_size += (self._seen.mask + 1) / 8
+        elif self._seen.table != NULL:
+            my_size += sizeof(void *) * (self._seen.mask + 1)
+        return my_size
+
+
 def dump_object_info(object out, object obj, object nodump=None,
-                     int recurse_depth=1):
+                     int recurse_depth=1, SeenObjects seen=None,
+                     int refcounts=False, Py_ssize_t refs_held=0):
     """Dump the object information to the given output.
 
     :param out: Either a File object, or a callable.
@@ -92,17 +173,30 @@ def dump_object_info(object out, object obj, object nodump=None,
        1 to dump the object and immediate neighbors that would not otherwise be
        referenced (such as strings).
        2 dump everything we find and continue recursing
+    :param seen: A SeenObjects, objects in it are not written again, and
+        the written objects are added to it.
+    :param refcounts: If True, also write the "refcnt" of every object, and
+        whether it is tracked by the garbage collector as "gc".
+    :param refs_held: The number of references to obj held just to dump it
+        (such as the caller's variable), which are not counted in its
+        "refcnt". The argument passed to this function isn't counted either.
     """
     cdef FILE *fp_out
+    cdef seen_objects *c_seen
 
+    c_seen = NULL
+    if seen is not None:
+        c_seen = &seen._seen
+    # The arguments of this call hold one reference to obj
+    refs_held = refs_held + 1
     fp_out = PyFile_AsFile(out)
     if fp_out != NULL:
         _dump_object_info(<write_callback>_file_io_callback, fp_out, obj,
-                          nodump, recurse_depth)
+                          nodump, c_seen, refcounts, refs_held, recurse_depth)
         fflush(fp_out)
     else:
         _dump_object_info(<write_callback>_callable_callback, <void *>out, obj,
-                          nodump, recurse_depth)
+                          nodump, c_seen, refcounts, refs_held, recurse_depth)
     _clear_last_dumped()
 
 
@@ -50,6 +50,13 @@ struct ref_info {
     void *data;
     int first;
     PyObject *nodump;
+    seen_objects *seen;
+    int refcounts;
+    /* The object passed to _dump_object_info, and the references to it that
+     * the caller holds, which are left out of its refcnt.
+     */
+    PyObject *top;
+    Py_ssize_t refs_held;
 };
 
 void _dump_object_to_ref_info(struct ref_info *info, PyObject *c_obj,
@@ -345,6 +352,12 @@ _dump_if_no_traverse(PyObject *c_obj, void *val)
          * if it does [not] have a tp_traverse function.
          */
         _dump_object_to_ref_info(info, c_obj, 1);
+    } else if (info->refcounts && !_PyObject_GC_IS_TRACKED(c_obj)) {
+        /* Tuples and dicts of atomic objects stop being tracked, so they
+         * aren't in gc.get_objects() either. Without them, what they
+         * reference would look like it is referenced from outside the dump.
+         */
+        _dump_object_to_ref_info(info, c_obj, 1);
     }
     return 0;
 }
@@ -438,9 +451,184 @@ _dump_unicode(struct ref_info *info, PyObject *c_obj)
 }
 
 
+/* The number of bits set in the Bloom filter for each object */
+#define BLOOM_HASHES 4
+/* The smallest exact table */
+#define SEEN_MIN_SIZE 1024
+
+static inline size_t
+_seen_hash(PyObject *c_obj)
+{
+    unsigned long long h;
+
+    /* Objects are at least 8-byte aligned, so the low bits carry nothing.
+     * Multiply by 2^64 / phi to spread the rest over the word.
+     */
+    h = ((unsigned long long)(size_t)c_obj >> 3) * 0x9E3779B97F4A7C15ULL;
+    return (size_t)(h ^ (h >> 32));
+}
+
+int
+_seen_objects_init(seen_objects *seen, size_t bloom_bytes)
+{
+    size_t num_bits;
+
+    seen->table = NULL;
+    seen->bloom = NULL;
+    seen->mask = 0;
+    seen->count = 0;
+    seen->min_refcount = 0;
+    if (bloom_bytes == 0) {
+        return 0;
+    }
+    /* Use a power of 2 number of bits, so we can mask rather than divide */
+    num_bits = 64;
+    while (num_bits < bloom_bytes * 8) {
+        num_bits <<= 1;
+    }
+    seen->bloom = (unsigned char *)calloc(num_bits / 8, 1);
+    if (seen->bloom == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    seen->mask = num_bits - 1;
+    return 0;
+}
+
+void
+_seen_objects_clear(seen_objects *seen)
+{
+    size_t i;
+
+    if (seen->table != NULL) {
+        for (i = 0; i <= seen->mask; ++i) {
+            Py_XDECREF(seen->table[i]);
+        }
+    }
+    free(seen->table);
+    free(seen->bloom);
+    seen->table = NULL;
+    seen->bloom = NULL;
+    seen->mask = 0;
+    seen->count = 0;
+}
+
+static PyObject **
+_seen_lookup(PyObject **table, size_t mask, PyObject *c_obj)
+{
+    size_t offset, step;
+
+    offset = _seen_hash(c_obj);
+    step = 0;
+    /* Triangular probing visits every slot of a power of 2 table */
+    while (table[offset & mask] != NULL && table[offset & mask] != c_obj) {
+        step++;
+        offset += step;
+    }
+    return &table[offset & mask];
+}
+
+static int
+_seen_grow(seen_objects *seen)
+{
+    PyObject **new_table;
+    size_t new_size, i;
+
+    if (seen->table == NULL) {
+        new_size = SEEN_MIN_SIZE;
+    } else {
+        new_size = (seen->mask + 1) * 2;
+    }
+    new_table = (PyObject **)calloc(new_size, sizeof(PyObject *));
+    if (new_table == NULL) {
+        return -1;
+    }
+    if (seen->table != NULL) {
+        for (i = 0; i <= seen->mask; ++i) {
+            if (seen->table[i] != NULL) {
+                *_seen_lookup(new_table, new_size - 1, seen->table[i])
+                    = seen->table[i];
+            }
+        }
+        free(seen->table);
+    }
+    seen->table = new_table;
+    seen->mask = new_size - 1;
+    return 0;
+}
+
+int
+_seen_objects_add(seen_objects *seen, PyObject *c_obj)
+{
+    PyObject **slot;
+    size_t h, step, bit;
+    int i, is_new;
+
+    if (seen->bloom != NULL) {
+        /* Double hashing gives the BLOOM_HASHES bits */
+        h = _seen_hash(c_obj);
+        step = (h >> 17) | 1;
+        is_new = 0;
+        for (i = 0; i < BLOOM_HASHES; ++i) {
+            bit = (h + i * step) & seen->mask;
+            if (!(seen->bloom[bit >> 3] & (1 << (bit & 7)))) {
+                seen->bloom[bit >> 3] |= (1 << (bit & 7));
+                is_new = 1;
+            }
+        }
+        seen->count += is_new;
+        return is_new;
+    }
+    if (seen->table == NULL || (seen->count + 1) * 3 > seen->mask * 2) {
+        if (_seen_grow(seen) == -1) {
+            /* Out of memory, so dump the object again rather than fail */
+            if (seen->table == NULL) {
+                return 1;
+            }
+        }
+    }
+    slot = _seen_lookup(seen->table, seen->mask, c_obj);
+    if (*slot != NULL) {
+        return 0;
+    }
+    if ((seen->count + 1) > seen->mask) {
+        /* Full, and couldn't grow */
+        return 1;
+    }
+    /* Keep the object alive, so no other object can get its address */
+    Py_INCREF(c_obj);
+    *slot = c_obj;
+    seen->count++;
+    return 1;
+}
+
+int
+_seen_objects_contains(seen_objects *seen, PyObject *c_obj)
+{
+    size_t h, step, bit;
+    int i;
+
+    if (seen->bloom != NULL) {
+        h = _seen_hash(c_obj);
+        step = (h >> 17) | 1;
+        for (i = 0; i < BLOOM_HASHES; ++i) {
+            bit = (h + i * step) & seen->mask;
+            if (!(seen->bloom[bit >> 3] & (1 << (bit & 7)))) {
+                return 0;
+            }
+        }
+        return 1;
+    }
+    if (seen->table == NULL) {
+        return 0;
+    }
+    return *_seen_lookup(seen->table, seen->mask, c_obj) != NULL;
+}
+
 void 
 _dump_object_info(write_callback write, void *callee_data,
-                  PyObject *c_obj, PyObject *nodump, int recurse)
+                  PyObject *c_obj, PyObject *nodump, seen_objects *seen,
+                  int refcounts, Py_ssize_t refs_held, int recurse)
 {
     struct ref_info info;
 
@@ -448,6 +636,10 @@ _dump_object_info(write_callback write, void *callee_data,
     info.data = callee_data;
     info.first = 1;
     info.nodump = nodump;
+    info.seen = seen;
+    info.refcounts = refcounts;
+    info.top = c_obj;
+    info.refs_held = refs_held;
     if (nodump != NULL) {
         Py_INCREF(nodump);
     }
@@ -457,12 +649,29 @@ _dump_object_info(write_callback write, void *callee_data,
     }
 }
 
+static int
+_traverse_static_type(PyObject *c_obj, visitproc visit, void *arg)
+{
+    PyTypeObject *type;
+
+    /* What type_traverse visits, without its assertion that the type is a
+     * heap type.
+     */
+    type = (PyTypeObject *)c_obj;
+    Py_VISIT(type->tp_dict);
+    Py_VISIT(type->tp_cache);
+    Py_VISIT(type->tp_mro);
+    Py_VISIT(type->tp_bases);
+    Py_VISIT((PyObject *)type->tp_base);
+    return 0;
+}
+
 void
 _dump_object_to_ref_info(struct ref_info *info, PyObject *c_obj, int recurse)
 {
-    Py_ssize_t size;
+    Py_ssize_t size, refcnt;
     int retval;
-    int do_traverse;
+    traverseproc traverse;
     char *name;
 
     if (info->nodump != NULL && 
@@ -491,6 +700,12 @@ _dump_object_to_ref_info(struct ref_info *info, PyObject *c_obj, int recurse)
         /* We just dumped this object, no need to do it again. */
         return;
     }
+    if (info->seen != NULL && c_obj->ob_refcnt > info->seen->min_refcount
+        && !_seen_objects_add(info->seen, c_obj))
+    {
+        /* Dumped by an earlier call */
+        return;
+    }
     _last_dumped = c_obj;
     size = _size_of(c_obj);
     _write_to_ref_info(info, "{\"address\": %lu, \"type\": ",
@@ -551,33 +766,57 @@ _dump_object_to_ref_info(struct ref_info *info, PyObject *c_obj, int recurse)
         }
     }
     _write_static_to_info(info, ", \"refs\": [");
-    do_traverse = 1;
-    if (Py_TYPE(c_obj)->tp_traverse == NULL
-        || (Py_TYPE(c_obj)->tp_traverse == PyType_Type.tp_traverse
-            && !PyType_HasFeature((PyTypeObject*)c_obj, Py_TPFLAGS_HEAPTYPE)))
+    traverse = Py_TYPE(c_obj)->tp_traverse;
+    if (traverse == PyType_Type.tp_traverse
+        && !PyType_HasFeature((PyTypeObject*)c_obj, Py_TPFLAGS_HEAPTYPE))
     {
-        /* Obviously we don't traverse if there is no traverse function. But
-         * also, if this is a 'Type' (class definition), then
+        /* If this is a 'Type' (class definition), then
          * PyTypeObject.tp_traverse has an assertion about whether this type is
          * a HEAPTYPE. In debug builds, this can trip and cause failures, even
          * though it doesn't seem to hurt anything.
          *  See: https://bugs.launchpad.net/bugs/586122
+         * With refcounts, the references of built-in types are still needed,
+         * or their tp_dict etc look like they are referenced from outside
+         * the dump, so we visit the same members ourselves.
          */
-        do_traverse = 0;
+        if (info->refcounts) {
+            traverse = _traverse_static_type;
+        } else {
+            traverse = NULL;
+        }
     }
-    if (do_traverse) {
+    if (traverse != NULL) {
         info->first = 1;
-        Py_TYPE(c_obj)->tp_traverse(c_obj, _dump_reference, info);
+        traverse(c_obj, _dump_reference, info);
+    }
+    if (info->refcounts) {
+        refcnt = c_obj->ob_refcnt;
+        if (c_obj == info->top) {
+            refcnt -= info->refs_held;
+        }
+        if (info->seen != NULL && info->seen->table != NULL
+            && _seen_objects_contains(info->seen, c_obj))
+        {
+            /* The reference the exact set holds */
+            refcnt -= 1;
+        }
+        _write_to_ref_info(info, "], \"refcnt\": " SSIZET_FMT, refcnt);
+        if (PyObject_IS_GC(c_obj) && _PyObject_GC_IS_TRACKED(c_obj)) {
+            _write_static_to_info(info, ", \"gc\": true}\n");
+        } else {
+            _write_static_to_info(info, ", \"gc\": false}\n");
+        }
+    } else {
+        _write_static_to_info(info, "]}\n");
     }
-    _write_static_to_info(info, "]}\n");
-    if (do_traverse && recurse != 0) {
+    if (traverse != NULL && recurse != 0) {
         if (recurse == 2) { /* Always dump one layer deeper */
-            Py_TYPE(c_obj)->tp_traverse(c_obj, _dump_child, info);
+            traverse(c_obj, _dump_child, info);
         } else if (recurse == 1) {
             /* strings and such aren't in gc.get_objects, so we need to dump
              * them when they are referenced.
              */
-            Py_TYPE(c_obj)->tp_traverse(c_obj, _dump_if_no_traverse, info);
+            traverse(c_obj, _dump_if_no_traverse, info);
         }
     }
 }
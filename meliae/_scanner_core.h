@@ -41,11 +41,60 @@ extern Py_ssize_t _size_of(PyObject *c_obj);
  */
 typedef void (*write_callback)(void *data, const char *bytes, size_t len);
 
+/**
+ * The objects that have already been dumped.
+ *
+ * This is either an exact hash set of objects, or when bloom is not NULL a
+ * Bloom filter, which uses a fixed amount of memory but can think an object
+ * has been dumped when it has not. The exact set holds a reference to each
+ * object, so their addresses can't be reused by new objects. The Bloom
+ * filter can't, so it is only right while the dumped objects stay alive.
+ */
+typedef struct {
+    PyObject **table;
+    unsigned char *bloom;
+    size_t mask; /* The size of the table, or the bits of bloom, minus 1 */
+    size_t count;
+    /* Only objects with more references than this are tracked */
+    Py_ssize_t min_refcount;
+} seen_objects;
+
+/**
+ * Set up an empty seen_objects.
+ *
+ * If bloom_bytes is not 0, use a Bloom filter of (at least) that many bytes.
+ * Return -1 and set a MemoryError if the filter can't be allocated.
+ */
+extern int _seen_objects_init(seen_objects *seen, size_t bloom_bytes);
+
+/**
+ * Release the objects and free the memory of a seen_objects.
+ */
+extern void _seen_objects_clear(seen_objects *seen);
+
+/**
+ * Add an object, return 1 if it was new and 0 if it had been seen.
+ */
+extern int _seen_objects_add(seen_objects *seen, PyObject *c_obj);
+
+/**
+ * Return 1 if the object has been seen, else 0.
+ */
+extern int _seen_objects_contains(seen_objects *seen, PyObject *c_obj);
+
 /**
  * Write the information about this object to the file.
+ *
+ * If seen is not NULL, objects in it are skipped, and the dumped objects are
+ * added to it.
+ * If refcounts is not 0, write the ob_refcnt of each object, and whether it
+ * is tracked by the garbage collector. refs_held is subtracted from the
+ * refcnt of c_obj itself, for the references the caller holds.
  */
 extern void _dump_object_info(write_callback write, void *callee_data,
-                              PyObject *c_obj, PyObject *nodump, int recurse);
+                              PyObject *c_obj, PyObject *nodump,
+                              seen_objects *seen, int refcounts,
+                              Py_ssize_t refs_held, int recurse);
 
 /**
  * Clear out what the last object we dumped was.
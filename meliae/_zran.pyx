@@ -0,0 +1,274 @@
+# Copyright (C) 2011 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Random access into gzip files.
+
+This follows zran.c from the zlib examples. While decompressing the whole
+file once, we remember the state of inflate at block boundaries every so
+often: the position in the compressed file (down to the bit) and the last
+32KiB of output. Decompression can then start again from any of these
+checkpoints, rather than from the start of the file.
+"""
+
+cdef extern from *:
+    ctypedef unsigned long size_t
+    void memset(void *, int, size_t)
+    void memcpy(void *, void *, size_t)
+
+cdef extern from "Python.h":
+    object PyString_FromStringAndSize(char *, Py_ssize_t)
+    char *PyString_AS_STRING(object)
+    Py_ssize_t PyString_GET_SIZE(object)
+
+cdef extern from "zlib.h":
+    ctypedef struct z_stream:
+        unsigned char *next_in
+        unsigned int avail_in
+        unsigned char *next_out
+        unsigned int avail_out
+        char *msg
+        int data_type
+    int inflateInit2(z_stream *, int)
+    int inflate(z_stream *, int)
+    int inflateEnd(z_stream *)
+    int inflateReset(z_stream *)
+    int inflateReset2(z_stream *, int)
+    int inflatePrime(z_stream *, int, int)
+    int inflateSetDictionary(z_stream *, unsigned char *, unsigned int)
+    int Z_OK, Z_STREAM_END, Z_NEED_DICT, Z_DATA_ERROR, Z_MEM_ERROR
+    int Z_NO_FLUSH, Z_BLOCK
+
+
+cdef enum:
+    # The most that deflate can refer back to
+    WINSIZE = 32768
+    # The number of compressed bytes read at a time
+    CHUNK = 65536
+    # inflateInit2 windowBits for a gzip header, and for raw deflate
+    GZIP_WBITS = 31
+    RAW_WBITS = -15
+    # The size of the crc32 and length after each gzip member
+    GZIP_TRAILER = 8
+
+
+cdef class _Input:
+    """Feed a z_stream from a file object, CHUNK bytes at a time."""
+
+    cdef object _source
+    cdef object _data
+
+    def __init__(self, source):
+        self._source = source
+        self._data = None
+
+    cdef int fill(self, z_stream *strm) except -1:
+        """Read more input if strm has used it all.
+
+        :return: 0 at the end of the file, else 1
+        """
+        if strm.avail_in != 0:
+            return 1
+        self._data = self._source.read(CHUNK)
+        strm.next_in = <unsigned char *>PyString_AS_STRING(self._data)
+        strm.avail_in = PyString_GET_SIZE(self._data)
+        return strm.avail_in != 0
+
+    cdef int next_member(self, z_stream *strm, int skip) except -1:
+        """Move to the start of the next gzip member.
+
+        :param skip: The number of bytes after the end of the deflate
+            stream, before the next member.
+        :return: 1 if there is another member, 0 at the end of the file or
+            at the zero padding that gzip allows after the last member.
+        """
+        while skip > 0:
+            if not self.fill(strm):
+                return 0
+            if strm.avail_in > <unsigned int>skip:
+                strm.next_in += skip
+                strm.avail_in -= skip
+                break
+            skip -= strm.avail_in
+            strm.avail_in = 0
+        if not self.fill(strm):
+            return 0
+        return strm.next_in[0] != 0
+
+
+cdef int _check(int ret, z_stream *strm) except -1:
+    if ret == Z_MEM_ERROR:
+        raise MemoryError('zlib failed to allocate memory')
+    if ret == Z_NEED_DICT or ret == Z_DATA_ERROR:
+        if strm.msg != NULL:
+            raise ValueError('Invalid compressed data: %s' % (strm.msg,))
+        raise ValueError('Invalid compressed data')
+    if ret < 0:
+        raise ValueError('zlib error %d' % (ret,))
+    return 0
+
+
+def build_checkpoints(source, long long span=1048576, on_data=None):
+    """Decompress a gzip file, and return checkpoints to restart from.
+
+    :param source: A file object of the gzip file, opened in binary mode
+        and positioned at the start.
+    :param span: The minimum number of uncompressed bytes between
+        checkpoints. Each checkpoint costs 32KiB, so this trades memory
+        for how much has to be decompressed to reach an offset.
+    :param on_data: If not None, called with each piece of the uncompressed
+        data in order, so that it can be looked at in the same pass.
+    :return: (uncompressed_size, [(uncompressed_offset, compressed_offset,
+        bits, window)]) The checkpoints are in order. bits is the number of
+        bits of the byte before compressed_offset that belong to the
+        next block, and window is the 32KiB of output before the checkpoint.
+    """
+    cdef z_stream strm
+    cdef _Input input
+    cdef unsigned char window[WINSIZE]
+    cdef long long total_in, total_out, last
+    cdef unsigned int left, avail
+    cdef int ret
+
+    checkpoints = []
+    input = _Input(source)
+    memset(&strm, 0, sizeof(z_stream))
+    memset(window, 0, WINSIZE)
+    _check(inflateInit2(&strm, GZIP_WBITS), &strm)
+    try:
+        total_in = total_out = last = 0
+        strm.next_out = window
+        strm.avail_out = WINSIZE
+        while True:
+            if not input.fill(&strm):
+                raise ValueError('gzip file is truncated')
+            if strm.avail_out == 0:
+                strm.next_out = window
+                strm.avail_out = WINSIZE
+            # Count the input and output used by this call
+            total_in += strm.avail_in
+            total_out += strm.avail_out
+            avail = strm.avail_out
+            # Z_BLOCK returns at the end of every deflate block
+            ret = inflate(&strm, Z_BLOCK)
+            total_in -= strm.avail_in
+            total_out -= strm.avail_out
+            _check(ret, &strm)
+            if on_data is not None and strm.avail_out < avail:
+                on_data(PyString_FromStringAndSize(
+                    <char *>strm.next_out - (avail - strm.avail_out),
+                    avail - strm.avail_out))
+            if ret == Z_STREAM_END:
+                # gzip has already read the trailer of this member
+                if not input.next_member(&strm, 0):
+                    break
+                _check(inflateReset(&strm), &strm)
+                continue
+            # bit 7 is set at the end of a block, and bit 6 at the end of
+            # the last block of a member, where nothing can start.
+            if ((strm.data_type & 128) and not (strm.data_type & 64)
+                and (total_out == 0 or total_out - last > span)):
+                # The window is a circular buffer ending at next_out
+                left = strm.avail_out
+                window_str = PyString_FromStringAndSize(NULL, WINSIZE)
+                if left:
+                    memcpy(PyString_AS_STRING(window_str),
+                           window + WINSIZE - left, left)
+                if left < WINSIZE:
+                    memcpy(PyString_AS_STRING(window_str) + left,
+                           window, WINSIZE - left)
+                checkpoints.append((total_out, total_in,
+                                    strm.data_type & 7, window_str))
+                last = total_out
+    finally:
+        inflateEnd(&strm)
+    return total_out, checkpoints
+
+
+def extract(source, checkpoint, long long offset, Py_ssize_t length):
+    """Decompress part of a gzip file, starting from a checkpoint.
+
+    :param source: A seekable file object of the gzip file.
+    :param checkpoint: One of the checkpoints from build_checkpoints, at or
+        before offset.
+    :param offset: The uncompressed offset to start reading from.
+    :param length: The number of bytes to return. Fewer are returned at the
+        end of the file.
+    :return: A string of the uncompressed bytes.
+    """
+    cdef z_stream strm
+    cdef _Input input
+    cdef unsigned char discard[WINSIZE]
+    cdef char *out
+    cdef long long skip
+    cdef Py_ssize_t produced
+    cdef unsigned int avail
+    cdef int ret, bits, trailer
+
+    start_out, start_in, bits, window = checkpoint
+    skip = offset - start_out
+    if skip < 0:
+        raise ValueError('checkpoint at %d is after offset %d'
+                         % (start_out, offset))
+    if length <= 0:
+        return ''
+    if PyString_GET_SIZE(window) != WINSIZE:
+        raise ValueError('checkpoint window must be %d bytes' % (WINSIZE,))
+    result = PyString_FromStringAndSize(NULL, length)
+    out = PyString_AS_STRING(result)
+    produced = 0
+    trailer = GZIP_TRAILER
+    input = _Input(source)
+    memset(&strm, 0, sizeof(z_stream))
+    _check(inflateInit2(&strm, RAW_WBITS), &strm)
+    try:
+        if bits:
+            source.seek(start_in - 1)
+            ret = ord(source.read(1))
+            _check(inflatePrime(&strm, bits, ret >> (8 - bits)), &strm)
+        else:
+            source.seek(start_in)
+        _check(inflateSetDictionary(&strm,
+                    <unsigned char *>PyString_AS_STRING(window), WINSIZE),
+               &strm)
+        while produced < length:
+            if skip > 0:
+                strm.next_out = discard
+                if skip > WINSIZE:
+                    strm.avail_out = WINSIZE
+                else:
+                    strm.avail_out = <unsigned int>skip
+            else:
+                strm.next_out = <unsigned char *>(out + produced)
+                strm.avail_out = length - produced
+            avail = strm.avail_out
+            if not input.fill(&strm):
+                break
+            ret = inflate(&strm, Z_NO_FLUSH)
+            _check(ret, &strm)
+            if skip > 0:
+                skip -= avail - strm.avail_out
+            else:
+                produced += avail - strm.avail_out
+            if ret == Z_STREAM_END:
+                # Raw inflate stops before the trailer of the first member,
+                # after that we read the gzip headers and trailers.
+                if not input.next_member(&strm, trailer):
+                    break
+                _check(inflateReset2(&strm, GZIP_WBITS), &strm)
+                trailer = 0
+    finally:
+        inflateEnd(&strm)
+    if produced < length:
+        return result[:produced]
+    return result
@@ -0,0 +1,1242 @@
+# Copyright (C) 2009, 2010 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A MemObjectCollection that keeps its objects on disk.
+
+For dumps that don't fit in memory, DiskMemObjectCollection stores the
+objects in a memory mapped hash table, and their reference lists and values
+in append-only heap files, all in a scratch directory. The operating system
+page cache decides what actually stays in memory. Replacing a list or value
+leaves the old copy in its heap, so the heaps are compacted after the bulk
+operations that rewrite them.
+
+Only the type names (and a count of objects for each type) are kept in
+memory. The analyses that ObjManager relies on (compute_parents,
+summarize_by_type, get_all, collapse_instance_dicts, etc) walk the table
+sequentially wherever possible. compute_dominators and
+compute_reachable_sizes need the whole graph at once, so they read it into
+arrays of table slots (a word for each slot and each reference, rather than
+the objects themselves) and run the same code as _loader.MemObjectCollection.
+"""
+
+import array
+import heapq
+import marshal
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import weakref
+
+from meliae import (
+    _intset,
+    _loader,
+    )
+
+
+# flags, has dominator, type index, address, size, total_size, children
+# offset, number of children, parents offset, number of parents, total
+# parents, value offset, value length, refcnt (see _pack_refcnt in _loader),
+# dominator address
+_record = struct.Struct('<BB2xIQqQqqqqqqqqQ')
+_record_size = _record.size
+_flags = struct.Struct('<B')
+_address = struct.Struct('<8xQ')
+_ref = struct.Struct('<Q')
+# (child home slot, child address, parent address), see compute_parents
+_edge = struct.Struct('<QQQ')
+
+_EMPTY = 0
+_USED = 1
+_DUMMY = 2
+
+(_FLAGS, _HAS_DOMINATOR, _TYPE, _ADDRESS, _SIZE, _TOTAL_SIZE, _CHILDREN,
+ _NUM_CHILDREN, _PARENTS, _NUM_PARENTS, _TOTAL_PARENTS, _VALUE, _VALUE_LEN,
+ _REFCNT, _DOMINATOR) = range(15)
+
+
+class _ScratchDirectory(object):
+    """Remove a temporary directory, when closed or garbage collected.
+
+    This doesn't reference the collection using the directory, so it is
+    still collected (and the directory removed) when the collection was
+    part of a reference cycle.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def remove(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    __del__ = remove
+
+
+class _RefHeap(object):
+    """An append-only file of lists of addresses."""
+
+    def __init__(self, filename):
+        self._file = open(filename, 'w+b')
+        self._count = 0
+
+    def append(self, addresses):
+        """Store a list of addresses.
+
+        :return: The offset of the list in the heap.
+        """
+        offset = self._count
+        if addresses:
+            self._file.seek(offset * _ref.size)
+            self._file.write(struct.pack('<%dQ' % len(addresses), *addresses))
+            self._count += len(addresses)
+        return offset
+
+    def get(self, offset, count):
+        if count == 0:
+            return []
+        self._file.seek(offset * _ref.size)
+        return list(struct.unpack('<%dQ' % count,
+                                  self._file.read(count * _ref.size)))
+
+    def close(self):
+        self._file.close()
+
+
+class _ValueHeap(object):
+    """An append-only file of marshalled values."""
+
+    def __init__(self, filename):
+        self._file = open(filename, 'w+b')
+        self._size = 0
+
+    def append(self, value):
+        """Store value, returning (offset, length). None is not stored."""
+        if value is None:
+            return 0, -1
+        return self.append_raw(marshal.dumps(value))
+
+    def append_raw(self, content):
+        """Store an already marshalled value, returning (offset, length)."""
+        offset = self._size
+        self._file.seek(offset)
+        self._file.write(content)
+        self._size += len(content)
+        return offset, len(content)
+
+    def get(self, offset, length):
+        if length < 0:
+            return None
+        return marshal.loads(self.get_raw(offset, length))
+
+    def get_raw(self, offset, length):
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def close(self):
+        self._file.close()
+
+
+def _field_property(name, doc):
+    def getter(self):
+        return self._get(name)
+    def setter(self, value):
+        self._set(name, value)
+    return property(getter, setter, doc=doc)
+
+
+class _DiskObjectProxy(object):
+    """The interface to an object stored in a DiskMemObjectCollection.
+
+    This has the same attributes as _loader._MemObjectProxy. The data is
+    always read from (and written to) the collection, unless the object
+    has been removed from it, in which case the proxy keeps a copy.
+    """
+
+    __slots__ = ('collection', 'address', '_detached', '__weakref__')
+
+    def __init__(self, collection, address):
+        self.collection = collection
+        self.address = address
+        self._detached = None
+
+    def _get(self, name):
+        if self._detached is not None:
+            return self._detached[name]
+        return self.collection._get_field(self.address, name)
+
+    def _set(self, name, value):
+        if self._detached is not None:
+            self._detached[name] = value
+        else:
+            self.collection._set_field(self.address, name, value)
+
+    type_str = _field_property('type_str', 'The type of this object.')
+    size = _field_property('size', 'The number of bytes of this object.')
+    value = _field_property('value', 'The value of str/int/etc objects.')
+    total_size = _field_property('total_size',
+        'The number of bytes of this and all referenced objects.')
+    children = _field_property('children',
+        'The list of objects referenced by this object.')
+    parents = _field_property('parents',
+        'The list of objects that reference this object.')
+
+    @property
+    def num_parents(self):
+        """The length of the parents list."""
+        return len(self.parents)
+
+    @property
+    def total_parents(self):
+        """The number of distinct parents of this object.
+
+        This can be larger than num_parents if compute_parents() capped the
+        parents list.
+        """
+        return self._get('total_parents')
+
+    @property
+    def refcnt(self):
+        """The reference count of the object when it was dumped, or None."""
+        return self._get('refcnt')
+
+    @property
+    def gc_tracked(self):
+        """Was the object tracked by the garbage collector, or None."""
+        return self._get('gc_tracked')
+
+    @property
+    def immediate_dominator(self):
+        """The address of the object that immediately dominates this one.
+
+        None if only the (synthetic) root dominates this object, if
+        compute_dominators() has not been run, or if the object was removed
+        from its collection.
+        """
+        if self._detached is not None:
+            return None
+        return self.collection._get_field(self.address, 'immediate_dominator')
+
+    def __len__(self):
+        if self._detached is not None:
+            return len(self._detached['children'])
+        return self.collection._get_field(self.address, 'num_children')
+
+    def _intern_from_cache(self, cache):
+        # Addresses and type strings are not python objects on disk
+        pass
+
+    def __getitem__(self, offset):
+        children = self.children
+        if not children:
+            raise IndexError('%s has no references' % (self,))
+        if offset >= len(children):
+            raise IndexError('%s has only %d (not %d) references'
+                             % (self, len(children), offset+1))
+        if offset < 0:
+            offset = len(children) + offset
+        if offset < 0:
+            raise IndexError('ref index %s out of range' % (offset,))
+        return self.collection[children[offset]]
+
+    @property
+    def c(self):
+        """The list of children objects as objects (not references)."""
+        return [self.collection[address] for address in self.children]
+
+    @property
+    def p(self):
+        """The list of parent objects as objects (not references)."""
+        return [self.collection[address] for address in self.parents]
+
+    def __repr__(self):
+        num_children = len(self)
+        if num_children == 0:
+            refs = ''
+        else:
+            refs = ' %drefs' % (num_children,)
+        num_parents = self.num_parents
+        if num_parents == 0:
+            parent_str = ''
+        else:
+            parent_str = ' %dpar' % (num_parents,)
+        value = self.value
+        if value is None:
+            val = ''
+        else:
+            val = ' %r' % (value,)
+        total_size = self.total_size
+        if total_size == 0:
+            total_size_str = ''
+        else:
+            total_size = float(total_size)
+            order = 'B'
+            for next_order in 'KMG':
+                if total_size > 800.0:
+                    total_size = total_size / 1024.0
+                    order = next_order
+            total_size_str = ' %.1f%stot' % (total_size, order)
+        return '%s(%d %dB%s%s%s%s)' % (
+            self.type_str, self.address, self.size,
+            refs, parent_str, val, total_size_str)
+
+    def refs_as_dict(self):
+        """Expand the ref list considering it to be a 'dict' structure.
+
+        See _loader._MemObjectProxy.refs_as_dict
+        """
+        as_dict = {}
+        children = self.children
+        if len(children) % 2 == 1 and self.type_str not in ('dict', 'module'):
+            children = children[:-1]
+        for idx in xrange(0, len(children), 2):
+            key = self.collection[children[idx]]
+            val = self.collection[children[idx+1]]
+            if key.value is not None:
+                key = key.value
+            if val.type_str == 'bool':
+                val = (val.value == 'True')
+            elif val.type_str in ('int', 'long', 'str', 'unicode', 'float',
+                                  ) and val.value is not None:
+                val = val.value
+            elif val.type_str == 'NoneType':
+                val = None
+            as_dict[key] = val
+        return as_dict
+
+    def iter_recursive_refs(self, excluding=None):
+        """Find all objects referenced from this one (including self).
+
+        See _loader._MemObjectProxy.iter_recursive_refs
+        """
+        if excluding is not None:
+            seen = _intset.AddressSet(excluding)
+        else:
+            seen = _intset.AddressSet()
+        pending = [self.address]
+        while pending:
+            address = pending.pop()
+            if address in seen:
+                continue
+            seen.add(address)
+            obj = self.collection.get(address)
+            if obj is None:
+                continue
+            for child in obj.children:
+                if child not in seen:
+                    pending.append(child)
+            yield obj
+
+    def compute_total_size(self, excluding=None):
+        """Compute the number of bytes of this and all referenced objects."""
+        total_size = 0
+        for item in self.iter_recursive_refs(excluding=excluding):
+            total_size += item.size
+        self.total_size = total_size
+        return total_size
+
+    def all(self, type_str, excluding=None):
+        """Retrieve a list of all the referenced items matching type_str."""
+        all = [item for item in self.iter_recursive_refs(excluding=excluding)
+               if item.type_str == type_str]
+        all.sort(key=lambda x: (x.size, len(x), x.num_parents), reverse=True)
+        return all
+
+
+class DiskMemObjectCollection(object):
+    """Track a large number of objects, keeping them on disk.
+
+    This has the same interface as _loader.MemObjectCollection, for the parts
+    that ObjManager uses.
+    """
+
+    def __init__(self, path=None, initial_size=1024, run_size=1<<20):
+        """Create a new collection.
+
+        :param path: The directory to keep the files in. If None, a
+            temporary directory is used, and removed by close() or when the
+            collection is garbage collected.
+        :param initial_size: The initial number of slots in the table, must be
+            a power of 2.
+        :param run_size: The number of references compute_parents sorts in
+            memory at a time.
+        """
+        if path is None:
+            path = tempfile.mkdtemp(prefix='meliae-')
+            self._scratch = _ScratchDirectory(path)
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._scratch = None
+        self._path = path
+        self._run_size = run_size
+        self._type_strs = []
+        self._type_index = {}
+        self._type_counts = []
+        self._active = 0
+        self._filled = 0
+        self._proxies = weakref.WeakValueDictionary()
+        self._refs = _RefHeap(os.path.join(path, 'refs'))
+        self._values = _ValueHeap(os.path.join(path, 'values'))
+        self._table_file, self._table = self._new_table('table', initial_size)
+        self._mask = initial_size - 1
+
+    def _new_table(self, name, num_slots):
+        f = open(os.path.join(self._path, name), 'w+b')
+        f.truncate(num_slots * _record_size)
+        return f, mmap.mmap(f.fileno(), num_slots * _record_size)
+
+    def close(self):
+        """Release the files used by this collection."""
+        if self._table is None:
+            return
+        self._table.close()
+        self._table_file.close()
+        self._table = None
+        self._refs.close()
+        self._values.close()
+        if self._scratch is not None:
+            self._scratch.remove()
+
+    def compact(self):
+        """Rewrite the reference and value heaps without unused space.
+
+        The heaps are append-only, so replacing the children, parents or
+        value of an object leaves the old copy behind. The live data is
+        copied to new files in table order, which also puts the lists of
+        neighbouring slots next to each other.
+        """
+        refs = _RefHeap(os.path.join(self._path, 'refs.new'))
+        values = _ValueHeap(os.path.join(self._path, 'values.new'))
+        for slot, record in self._iter_slots():
+            record = list(record)
+            record[_CHILDREN] = refs.append(
+                self._refs.get(record[_CHILDREN], record[_NUM_CHILDREN]))
+            record[_PARENTS] = refs.append(
+                self._refs.get(record[_PARENTS], record[_NUM_PARENTS]))
+            if record[_VALUE_LEN] >= 0:
+                record[_VALUE], record[_VALUE_LEN] = values.append_raw(
+                    self._values.get_raw(record[_VALUE], record[_VALUE_LEN]))
+            self._write(slot, record)
+        self._refs.close()
+        self._values.close()
+        os.rename(os.path.join(self._path, 'refs.new'),
+                  os.path.join(self._path, 'refs'))
+        os.rename(os.path.join(self._path, 'values.new'),
+                  os.path.join(self._path, 'values'))
+        self._refs = refs
+        self._values = values
+
+    def _maybe_compact(self):
+        """Compact the heaps if more than half of either is unused."""
+        live_refs = live_values = 0
+        for slot, record in self._iter_slots():
+            live_refs += record[_NUM_CHILDREN] + record[_NUM_PARENTS]
+            if record[_VALUE_LEN] > 0:
+                live_values += record[_VALUE_LEN]
+        if (self._refs._count > 2 * live_refs + 4096
+            or self._values._size > 2 * live_values + 65536):
+            self.compact()
+
+    def _home(self, address, mask):
+        # Addresses are aligned, so shift away the low bits, and use the high
+        # bits of a multiplicative hash.
+        return ((((address >> 3) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF)
+                >> 32) & mask
+
+    def _find(self, address):
+        """Find the slot for address.
+
+        We use linear probing, so collisions stay within the same pages.
+
+        :return: (slot, found)
+        """
+        table = self._table
+        mask = self._mask
+        slot = self._home(address, mask)
+        free_slot = -1
+        while True:
+            offset = slot * _record_size
+            flags = _flags.unpack_from(table, offset)[0]
+            if flags == _EMPTY:
+                if free_slot == -1:
+                    free_slot = slot
+                return free_slot, False
+            if flags == _DUMMY:
+                if free_slot == -1:
+                    free_slot = slot
+            elif _address.unpack_from(table, offset)[0] == address:
+                return slot, True
+            slot = (slot + 1) & mask
+
+    def _read(self, slot):
+        return list(_record.unpack_from(self._table, slot * _record_size))
+
+    def _write(self, slot, record):
+        _record.pack_into(self._table, slot * _record_size, *record)
+
+    def _slot_for(self, address):
+        slot, found = self._find(address)
+        if not found:
+            raise KeyError('address %s not present' % (address,))
+        return slot
+
+    def _resize(self, num_slots):
+        """Move all the objects into a new table of num_slots slots."""
+        new_file, new_table = self._new_table('table.new', num_slots)
+        new_mask = num_slots - 1
+        table = self._table
+        for slot in xrange(self._mask + 1):
+            offset = slot * _record_size
+            if _flags.unpack_from(table, offset)[0] != _USED:
+                continue
+            address = _address.unpack_from(table, offset)[0]
+            new_slot = self._home(address, new_mask)
+            while _flags.unpack_from(new_table, new_slot * _record_size)[0]:
+                new_slot = (new_slot + 1) & new_mask
+            new_offset = new_slot * _record_size
+            new_table[new_offset:new_offset + _record_size] = \
+                table[offset:offset + _record_size]
+        table.close()
+        self._table_file.close()
+        os.rename(os.path.join(self._path, 'table.new'),
+                  os.path.join(self._path, 'table'))
+        self._table_file = new_file
+        self._table = new_table
+        self._mask = new_mask
+        self._filled = self._active
+
+    def _type_offset(self, type_str):
+        try:
+            return self._type_index[type_str]
+        except KeyError:
+            offset = len(self._type_strs)
+            self._type_strs.append(type_str)
+            self._type_counts.append(0)
+            self._type_index[type_str] = offset
+            return offset
+
+    def _get_field(self, address, name):
+        record = self._read(self._slot_for(address))
+        if name == 'type_str':
+            return self._type_strs[record[_TYPE]]
+        elif name == 'size':
+            return record[_SIZE]
+        elif name == 'value':
+            return self._values.get(record[_VALUE], record[_VALUE_LEN])
+        elif name == 'total_size':
+            return record[_TOTAL_SIZE]
+        elif name == 'children':
+            return self._refs.get(record[_CHILDREN], record[_NUM_CHILDREN])
+        elif name == 'num_children':
+            return record[_NUM_CHILDREN]
+        elif name == 'parents':
+            return self._refs.get(record[_PARENTS], record[_NUM_PARENTS])
+        elif name == 'total_parents':
+            return record[_TOTAL_PARENTS]
+        elif name == 'refcnt':
+            if record[_REFCNT] < 0:
+                return None
+            return record[_REFCNT] >> 1
+        elif name == 'gc_tracked':
+            if record[_REFCNT] < 0:
+                return None
+            return bool(record[_REFCNT] & 1)
+        elif name == 'immediate_dominator':
+            if not record[_HAS_DOMINATOR]:
+                return None
+            return record[_DOMINATOR]
+        raise AttributeError(name)
+
+    def _set_field(self, address, name, value):
+        slot = self._slot_for(address)
+        record = self._read(slot)
+        if name == 'type_str':
+            self._type_counts[record[_TYPE]] -= 1
+            record[_TYPE] = self._type_offset(value)
+            self._type_counts[record[_TYPE]] += 1
+        elif name == 'size':
+            record[_SIZE] = value
+        elif name == 'value':
+            record[_VALUE], record[_VALUE_LEN] = self._values.append(value)
+        elif name == 'total_size':
+            record[_TOTAL_SIZE] = value
+        elif name == 'children':
+            value = list(value)
+            record[_CHILDREN] = self._refs.append(value)
+            record[_NUM_CHILDREN] = len(value)
+        elif name == 'parents':
+            value = list(value)
+            record[_PARENTS] = self._refs.append(value)
+            record[_NUM_PARENTS] = record[_TOTAL_PARENTS] = len(value)
+        else:
+            raise AttributeError(name)
+        self._write(slot, record)
+
+    def _proxy_for(self, address):
+        proxy = self._proxies.get(address)
+        if proxy is None:
+            proxy = _DiskObjectProxy(self, address)
+            self._proxies[address] = proxy
+        return proxy
+
+    def __len__(self):
+        return self._active
+
+    def __contains__(self, address):
+        return self._find(address)[1]
+
+    def __getitem__(self, at):
+        if isinstance(at, _DiskObjectProxy):
+            at = at.address
+        self._slot_for(at)
+        return self._proxy_for(at)
+
+    def get(self, at, default=None):
+        try:
+            return self[at]
+        except KeyError:
+            return default
+
+    def __delitem__(self, at):
+        if isinstance(at, _DiskObjectProxy):
+            at = at.address
+        slot = self._slot_for(at)
+        proxy = self._proxies.get(at)
+        if proxy is not None:
+            # The proxy outlives the object in the collection, so give it a
+            # copy of the data
+            detached = {}
+            for name in ('type_str', 'size', 'value', 'total_size',
+                         'children', 'parents', 'total_parents', 'refcnt',
+                         'gc_tracked'):
+                detached[name] = self._get_field(at, name)
+            proxy._detached = detached
+            del self._proxies[at]
+        record = self._read(slot)
+        self._type_counts[record[_TYPE]] -= 1
+        _flags.pack_into(self._table, slot * _record_size, _DUMMY)
+        self._active -= 1
+
+    def add(self, address, type_str, size, children=(), length=0,
+            value=None, name=None, parent_list=(), total_size=0,
+            refcnt=None, gc_tracked=None):
+        """Add a new object to this collection."""
+        if value is not None and name is not None:
+            raise RuntimeError("We currently only support one of value or name"
+                               " per object.")
+        if value is None:
+            value = name
+        if (self._filled + 1) * 3 >= (self._mask + 1) * 2:
+            num_slots = self._mask + 1
+            while (self._active + 1) * 3 >= num_slots:
+                num_slots *= 2
+            self._resize(num_slots)
+        slot, found = self._find(address)
+        assert not found, "We don't support overwrite yet."
+        if _flags.unpack_from(self._table, slot * _record_size)[0] == _EMPTY:
+            self._filled += 1
+        children = list(children)
+        parent_list = list(parent_list)
+        type_offset = self._type_offset(type_str)
+        value_offset, value_len = self._values.append(value)
+        if refcnt is None:
+            refcnt = -1
+        else:
+            refcnt = refcnt << 1 | bool(gc_tracked)
+        self._write(slot, [_USED, 0, type_offset, address, size, total_size,
+                           self._refs.append(children), len(children),
+                           self._refs.append(parent_list), len(parent_list),
+                           len(parent_list), value_offset, value_len, refcnt,
+                           0])
+        self._type_counts[type_offset] += 1
+        self._active += 1
+        return self._proxy_for(address)
+
+    def _iter_slots(self):
+        """Iterate the (slot, record) of every object, in table order."""
+        table = self._table
+        for slot in xrange(self._mask + 1):
+            if _flags.unpack_from(table, slot * _record_size)[0] == _USED:
+                yield slot, _record.unpack_from(table, slot * _record_size)
+
+    def iterkeys(self):
+        for slot, record in self._iter_slots():
+            yield record[_ADDRESS]
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def itervalues(self):
+        for slot, record in self._iter_slots():
+            yield self._proxy_for(record[_ADDRESS])
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for slot, record in self._iter_slots():
+            address = record[_ADDRESS]
+            yield address, self._proxy_for(address)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iter_raw(self, fields=('address', 'type_str', 'size'),
+                 batch_size=None):
+        """Iterate the fields of every object, without creating proxies.
+
+        See _loader.MemObjectCollection.iter_raw
+        """
+        getters = []
+        for field in fields:
+            if field == 'address':
+                getter = lambda r: r[_ADDRESS]
+            elif field == 'type_str':
+                getter = lambda r: self._type_strs[r[_TYPE]]
+            elif field == 'size':
+                getter = lambda r: r[_SIZE]
+            elif field == 'value':
+                getter = lambda r: self._values.get(r[_VALUE], r[_VALUE_LEN])
+            elif field == 'total_size':
+                getter = lambda r: r[_TOTAL_SIZE]
+            elif field == 'num_children':
+                getter = lambda r: r[_NUM_CHILDREN]
+            elif field == 'num_parents':
+                getter = lambda r: r[_NUM_PARENTS]
+            elif field == 'total_parents':
+                getter = lambda r: r[_TOTAL_PARENTS]
+            else:
+                raise ValueError('unknown field %r' % (field,))
+            if batch_size is not None and field in ('type_str', 'value'):
+                raise ValueError('field %r cannot be batched' % (field,))
+            getters.append(getter)
+        if batch_size is None:
+            for slot, record in self._iter_slots():
+                yield tuple([getter(record) for getter in getters])
+            return
+        batch = [array.array('L') for getter in getters]
+        for slot, record in self._iter_slots():
+            for getter, values in zip(getters, batch):
+                values.append(getter(record))
+            if len(batch[0]) >= batch_size:
+                yield tuple(batch)
+                batch = [array.array('L') for getter in getters]
+        if batch and len(batch[0]):
+            yield tuple(batch)
+
+    def iter_edges(self, batch_size=65536):
+        """Iterate all references, without creating proxies.
+
+        See _loader.MemObjectCollection.iter_edges
+        """
+        parents = array.array('L')
+        children = array.array('L')
+        for slot, record in self._iter_slots():
+            refs = self._refs.get(record[_CHILDREN], record[_NUM_CHILDREN])
+            while refs:
+                room = batch_size - len(children)
+                children.extend(refs[:room])
+                parents.extend([record[_ADDRESS]] * len(refs[:room]))
+                refs = refs[room:]
+                if len(children) >= batch_size:
+                    yield parents, children
+                    parents = array.array('L')
+                    children = array.array('L')
+        if children:
+            yield parents, children
+
+    def type_strs(self):
+        """Return a list of all the types that have objects."""
+        return [type_str for type_str, count
+                in zip(self._type_strs, self._type_counts) if count > 0]
+
+    def count_type(self, type_str):
+        """Return how many objects have the given type."""
+        offset = self._type_index.get(type_str)
+        if offset is None:
+            return 0
+        return self._type_counts[offset]
+
+    def addresses_of_type(self, type_str):
+        """Return the addresses of all objects with the given type."""
+        offset = self._type_index.get(type_str)
+        if offset is None or self._type_counts[offset] == 0:
+            return []
+        return [record[_ADDRESS] for slot, record in self._iter_slots()
+                if record[_TYPE] == offset]
+
+    def values_of_type(self, type_str):
+        """Return the objects with the given type."""
+        return [self._proxy_for(address)
+                for address in self.addresses_of_type(type_str)]
+
+    def summarize_by_type(self):
+        """Aggregate the count and size of the objects of each type.
+
+        See _loader.MemObjectCollection.summarize_by_type
+        """
+        totals = {}
+        for slot, record in self._iter_slots():
+            size = record[_SIZE]
+            type_totals = totals.get(record[_TYPE])
+            if type_totals is None:
+                totals[record[_TYPE]] = [1, size, float(size) * size, size,
+                                         record[_ADDRESS]]
+                continue
+            type_totals[0] += 1
+            type_totals[1] += size
+            type_totals[2] += float(size) * size
+            # The same rule as _loader._is_new_max
+            if (size > type_totals[3]
+                or (size == type_totals[3]
+                    and record[_ADDRESS] < type_totals[4])):
+                type_totals[3] = size
+                type_totals[4] = record[_ADDRESS]
+        return [(self._type_strs[offset],) + tuple(type_totals)
+                for offset, type_totals in totals.iteritems()]
+
+    def prune_edges(self, into_types=(), slots=None, sideways_types=()):
+        """Remove references according to rules about their types.
+
+        See _loader.MemObjectCollection.prune_edges
+
+        :return: The number of objects that were changed.
+        """
+        into = _intset.IDSet()
+        for type_str in into_types:
+            for address in self.addresses_of_type(type_str):
+                into.add(address)
+        type_slots = {}
+        if slots:
+            for type_str, drop in slots.iteritems():
+                if type_str in self._type_index:
+                    type_slots[self._type_index[type_str]] = frozenset(drop)
+        sideways = {}
+        for type_str in sideways_types:
+            if type_str in self._type_index:
+                sideways[self._type_index[type_str]] = _intset.IDSet(
+                    self.addresses_of_type(type_str))
+        no_slots = frozenset()
+        no_sideways = _intset.IDSet()
+        no_into = _intset.IDSet()
+        num_changed = 0
+        for slot, record in self._iter_slots():
+            if record[_NUM_CHILDREN] == 0:
+                continue
+            refs = self._refs.get(record[_CHILDREN], record[_NUM_CHILDREN])
+            drop = type_slots.get(record[_TYPE], no_slots)
+            same_type = sideways.get(record[_TYPE], no_sideways)
+            # Types with their own rules don't lose references by the type
+            # of what they refer to, see loader.EdgeRules
+            if record[_TYPE] in type_slots or record[_TYPE] in sideways:
+                type_into = no_into
+            else:
+                type_into = into
+            new_refs = []
+            add_null = False
+            for idx, ref in enumerate(refs):
+                if idx in drop or ref in type_into:
+                    add_null = True
+                elif ref not in same_type:
+                    new_refs.append(ref)
+            if len(new_refs) == len(refs):
+                continue
+            if add_null:
+                new_refs.append(0)
+            num_changed += 1
+            record = list(record)
+            record[_CHILDREN] = self._refs.append(new_refs)
+            record[_NUM_CHILDREN] = len(new_refs)
+            self._write(slot, record)
+        if num_changed:
+            self._maybe_compact()
+        return num_changed
+
+    def remove_expensive_references(self):
+        """Filter out references that are mere housekeeping links.
+
+        See _loader.MemObjectCollection.remove_expensive_references
+
+        :return: The number of objects that were changed.
+        """
+        return self.prune_edges(('module', 'frame', 'type'),
+                                {'function': (1, 2)}, ('_LRUNode',))
+
+    def collapse_instance_dicts(self, skip_types=(), update_parents=False):
+        """Move the contents of __dict__ objects into their owners.
+
+        See _loader.MemObjectCollection.collapse_instance_dicts
+
+        :return: The number of objects that were collapsed.
+        """
+        candidates = []
+        for type_str in self.type_strs():
+            if type_str == 'dict' or type_str in skip_types:
+                continue
+            candidates.extend(self.addresses_of_type(type_str))
+        collapsed = 0
+        to_remove = set()
+        for address in candidates:
+            obj = self._proxy_for(address)
+            children = obj.children
+            dict_obj = type_obj = None
+            if len(children) == 1 and obj.type_str == 'module':
+                dict_obj = self.get(children[0])
+                if dict_obj is None or dict_obj.type_str != 'dict':
+                    continue
+            elif len(children) == 2:
+                obj_1 = self.get(children[0])
+                obj_2 = self.get(children[1])
+                if obj_1 is None or obj_2 is None:
+                    continue
+                if obj_1.type_str == 'dict' and obj_2.type_str == 'type':
+                    dict_obj, type_obj = obj_1, obj_2
+                elif (obj.type_str == 'instance'
+                      and obj_1.type_str == 'classobj'
+                      and obj_2.type_str == 'dict'):
+                    type_obj, dict_obj = obj_1, obj_2
+                else:
+                    continue
+            else:
+                continue
+            collapsed += 1
+            new_refs = list(dict_obj.children)
+            if update_parents:
+                for child in set(new_refs):
+                    if child in self:
+                        self._replace_parent(child, dict_obj.address, address)
+            if type_obj is not None:
+                new_refs.append(type_obj.address)
+            obj.children = new_refs
+            obj.size = obj.size + dict_obj.size
+            obj.total_size = 0
+            if obj.type_str == 'instance' and type_obj.value is not None:
+                obj.type_str = type_obj.value
+            to_remove.add(dict_obj.address)
+        for address in to_remove:
+            del self[address]
+        if collapsed:
+            self._maybe_compact()
+        return collapsed
+
+    def _replace_parent(self, address, old, new):
+        slot = self._slot_for(address)
+        record = self._read(slot)
+        parents = self._refs.get(record[_PARENTS], record[_NUM_PARENTS])
+        if old not in parents:
+            return
+        if new in parents:
+            parents.remove(old)
+            record[_TOTAL_PARENTS] -= 1
+        else:
+            parents[parents.index(old)] = new
+        record[_PARENTS] = self._refs.append(parents)
+        record[_NUM_PARENTS] = len(parents)
+        self._write(slot, record)
+
+    def _write_run(self, edges, runs):
+        edges.sort()
+        f = tempfile.TemporaryFile(prefix='meliae-', dir=self._path)
+        for edge in edges:
+            f.write(_edge.pack(*edge))
+        f.seek(0)
+        runs.append(f)
+
+    def _iter_run(self, f):
+        while True:
+            content = f.read(_edge.size * 1024)
+            if not content:
+                break
+            for pos in xrange(0, len(content), _edge.size):
+                yield _edge.unpack_from(content, pos)
+
+    def compute_parents(self, max_parents=-1):
+        """For each object, figure out who is referencing it.
+
+        This is an external sort. All references are collected as (child,
+        parent) pairs in runs of at most run_size, which are sorted and
+        written to disk. The runs are then merged, so all the parents of a
+        child arrive together. Pairs are sorted by the home slot of the
+        child, which means we also update the table in (mostly) sequential
+        order.
+
+        :param max_parents: If >= 0, only keep this many parents for each
+            object. total_parents still records how many distinct parents
+            were found.
+        """
+        mask = self._mask
+        runs = []
+        edges = []
+        for slot, record in self._iter_slots():
+            # Forget the old parents
+            if record[_NUM_PARENTS] or record[_TOTAL_PARENTS]:
+                record = list(record)
+                record[_PARENTS] = record[_NUM_PARENTS] = 0
+                record[_TOTAL_PARENTS] = 0
+                self._write(slot, record)
+            if record[_NUM_CHILDREN] == 0:
+                continue
+            parent = record[_ADDRESS]
+            for child in self._refs.get(record[_CHILDREN],
+                                        record[_NUM_CHILDREN]):
+                edges.append((self._home(child, mask), child, parent))
+            if len(edges) >= self._run_size:
+                self._write_run(edges, runs)
+                edges = []
+        try:
+            if edges:
+                self._write_run(edges, runs)
+                del edges
+            last_child = None
+            parents = []
+            for home, child, parent in heapq.merge(
+                    *[self._iter_run(f) for f in runs]):
+                if child != last_child:
+                    if parents:
+                        self._set_parents(last_child, parents, max_parents)
+                    last_child = child
+                    parents = []
+                if parents and parents[-1] == parent:
+                    # Referenced more than once from the same parent
+                    continue
+                parents.append(parent)
+            if parents:
+                self._set_parents(last_child, parents, max_parents)
+        finally:
+            for f in runs:
+                f.close()
+        self._maybe_compact()
+
+    def compute_external_refs(self, min_refs=1):
+        """Find the references to objects that the dump can't account for.
+
+        See _loader.MemObjectCollection.compute_external_refs
+        """
+        # One count per slot, rather than a dict of every address
+        counts = array.array('l', [0]) * (self._mask + 1)
+        for parents, children in self.iter_edges():
+            for child in children:
+                slot, found = self._find(child)
+                if found:
+                    counts[slot] += 1
+        found = []
+        for slot, record in self._iter_slots():
+            if record[_REFCNT] < 0:
+                continue
+            num = (record[_REFCNT] >> 1) - counts[slot]
+            if num >= min_refs:
+                found.append((num, record[_ADDRESS]))
+        found.sort(reverse=True)
+        return [(num, self._proxy_for(address)) for num, address in found]
+
+    def _build_graph(self):
+        """Read the references between objects into arrays of table slots.
+
+        :return: (starts, succ, sizes) as used by _loader.graph_dominators.
+            References to objects that are not in the collection are
+            dropped.
+        """
+        num_slots = self._mask + 1
+        starts = array.array('l', [0]) * (num_slots + 1)
+        sizes = array.array('l', [-1]) * num_slots
+        succ = array.array('l')
+        for slot, record in self._iter_slots():
+            sizes[slot] = record[_SIZE]
+            for child in self._refs.get(record[_CHILDREN],
+                                        record[_NUM_CHILDREN]):
+                child_slot, found = self._find(child)
+                if found:
+                    succ.append(child_slot)
+            starts[slot + 1] = len(succ)
+        # Empty slots end where the previous object ended
+        for slot in xrange(num_slots):
+            if starts[slot + 1] < starts[slot]:
+                starts[slot + 1] = starts[slot]
+        return starts, succ, sizes
+
+    def compute_dominators(self):
+        """Compute the dominator tree, and the retained size of every object.
+
+        See _loader.MemObjectCollection.compute_dominators. The graph is read
+        into memory as arrays of slots (see _build_graph), and the results
+        are written back in a sequential pass over the table.
+        """
+        starts, succ, sizes = self._build_graph()
+        idom, retained = _loader.graph_dominators(starts, succ, sizes)
+        del starts, succ, sizes
+        table = self._table
+        for slot, record in self._iter_slots():
+            record = list(record)
+            record[_TOTAL_SIZE] = retained[slot]
+            if idom[slot] >= 0:
+                record[_HAS_DOMINATOR] = 1
+                record[_DOMINATOR] = _address.unpack_from(
+                    table, idom[slot] * _record_size)[0]
+            else:
+                record[_HAS_DOMINATOR] = record[_DOMINATOR] = 0
+            self._write(slot, record)
+
+    def compute_reachable_sizes(self, approximate=False, num_registers=64):
+        """Set total_size of every object to the size of everything it reaches.
+
+        See _loader.MemObjectCollection.compute_reachable_sizes, and
+        compute_dominators for how the graph is read.
+
+        :return: The number of strongly connected components.
+        """
+        starts, succ, sizes = self._build_graph()
+        hashes = None
+        if approximate:
+            # The same hashes as the objects in memory, so both give the same
+            # estimates
+            hashes = array.array('l', [0]) * (self._mask + 1)
+            for slot, record in self._iter_slots():
+                hashes[slot] = hash(record[_ADDRESS])
+        num_components, reach = _loader.graph_reachable_sizes(
+            starts, succ, sizes, hashes, approximate, num_registers)
+        del starts, succ, sizes, hashes
+        for slot, record in self._iter_slots():
+            if record[_TOTAL_SIZE] != reach[slot]:
+                record = list(record)
+                record[_TOTAL_SIZE] = reach[slot]
+                self._write(slot, record)
+        return num_components
+
+    def largest_total_size(self, count=20):
+        """Return the objects with the largest total_size, largest first."""
+        largest = heapq.nlargest(count,
+            ((record[_TOTAL_SIZE], record[_ADDRESS])
+             for slot, record in self._iter_slots()))
+        return [self._proxy_for(address) for total_size, address in largest]
+
+    def find_duplicate_values(self, type_strs=('str', 'unicode', 'int'),
+                              max_samples=5):
+        """Find objects of the given types which have equal values.
+
+        See _loader.MemObjectCollection.find_duplicate_values. The same two
+        passes are made over the table, so only the duplicated values are
+        held in memory.
+        """
+        offsets = frozenset([self._type_index[type_str]
+                             for type_str in type_strs
+                             if type_str in self._type_index])
+        num_candidates = 0
+        for offset in offsets:
+            num_candidates += self._type_counts[offset]
+        num_buckets = 1024
+        while num_buckets < num_candidates * 2:
+            num_buckets *= 2
+        counters = bytearray(num_buckets)
+        for slot, record in self._iter_slots():
+            if record[_TYPE] not in offsets or record[_VALUE_LEN] < 0:
+                continue
+            value = self._values.get(record[_VALUE], record[_VALUE_LEN])
+            bucket = hash((value, record[_SIZE])) & (num_buckets - 1)
+            if counters[bucket] < 2:
+                counters[bucket] += 1
+        groups = {}
+        for slot, record in self._iter_slots():
+            if record[_TYPE] not in offsets or record[_VALUE_LEN] < 0:
+                continue
+            value = self._values.get(record[_VALUE], record[_VALUE_LEN])
+            bucket = hash((value, record[_SIZE])) & (num_buckets - 1)
+            if counters[bucket] < 2:
+                continue
+            key = (record[_TYPE], record[_SIZE], value)
+            group = groups.get(key)
+            if group is None:
+                # count, addresses, holders
+                group = [0, [], []]
+                groups[key] = group
+            group[0] += 1
+            if len(group[1]) < max_samples:
+                group[1].append(record[_ADDRESS])
+            holders = group[2]
+            if len(holders) < max_samples and record[_NUM_PARENTS]:
+                for holder in self._refs.get(record[_PARENTS],
+                                             record[_NUM_PARENTS]):
+                    if len(holders) >= max_samples:
+                        break
+                    if holder not in holders:
+                        holders.append(holder)
+        result = []
+        for key, group in groups.iteritems():
+            if group[0] < 2:
+                # A collision in the first pass
+                continue
+            result.append((self._type_strs[key[0]], key[2], key[1], group[0],
+                           group[1], group[2]))
+        return result
+
+    def path_to_root(self, address, k=3, skip_types=('type', 'frame')):
+        """Find the shortest paths that keep an object alive.
+
+        See _loader.MemObjectCollection.path_to_root. Only the objects on
+        the frontier of the search are read from the table.
+        """
+        start = self._slot_for(address)
+        skip = frozenset([self._type_index[type_str]
+                          for type_str in skip_types
+                          if type_str in self._type_index])
+        module = self._type_index.get('module')
+        # Maps a slot to the slot we reached it from
+        came_from = {start: -1}
+        queue = [start]
+        roots = []
+        pos = 0
+        while pos < len(queue) and len(roots) < k:
+            slot = queue[pos]
+            pos += 1
+            record = self._read(slot)
+            if record[_NUM_PARENTS] == 0 or record[_TYPE] == module:
+                roots.append(slot)
+                continue
+            for parent in self._refs.get(record[_PARENTS],
+                                         record[_NUM_PARENTS]):
+                parent_slot, found = self._find(parent)
+                if not found or parent_slot in came_from:
+                    continue
+                if self._read(parent_slot)[_TYPE] in skip:
+                    continue
+                came_from[parent_slot] = slot
+                queue.append(parent_slot)
+        table = self._table
+        paths = []
+        for slot in roots:
+            path = []
+            while slot != -1:
+                path.append(_address.unpack_from(table,
+                                                 slot * _record_size)[0])
+                slot = came_from[slot]
+            path.reverse()
+            paths.append(path)
+        return paths
+
+    def _set_parents(self, address, parents, max_parents):
+        slot, found = self._find(address)
+        if not found:
+            # A reference to something that isn't in the dump
+            return
+        record = self._read(slot)
+        record[_TOTAL_PARENTS] = len(parents)
+        if max_parents >= 0:
+            parents = parents[:max_parents]
+        record[_PARENTS] = self._refs.append(parents)
+        record[_NUM_PARENTS] = len(parents)
+        self._write(slot, record)
@@ -14,99 +14,416 @@
 
 """Work with files on disk."""
 
-import errno
-import gzip
+import bisect
+import bz2
+import os
+import Queue
+import struct
+import threading
+import zlib
 try:
-    import multiprocessing
+    import lzma
 except ImportError:
-    multiprocessing = None
-import subprocess
-import sys
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 
-def open_file(filename):
-    """Open a file which might be a regular file or a gzip.
-    
-    :return: An iterator of lines, and a cleanup function.
+# The leading bytes of each compressed format we can read
+_magic_to_format = [
+    ('\x1f\x8b', 'gzip'),
+    ('BZh', 'bz2'),
+    ('\xfd7zXZ\x00', 'xz'),
+    ]
+_MAX_MAGIC = max([len(magic) for magic, _ in _magic_to_format])
+_extension_to_format = [
+    ('.gz', 'gzip'),
+    ('.bz2', 'bz2'),
+    ('.xz', 'xz'),
+    ]
+
+# The number of compressed bytes read at a time
+_COMPRESSED_BLOCK_SIZE = 1024 * 1024
+# The number of decompressed blocks that can be waiting for the reader
+_MAX_QUEUED_BLOCKS = 8
+
+
+def sniff_format(source):
+    """Guess the compression of a file from its first bytes.
+
+    :param source: A file opened in binary mode, it is left at the start.
+    :return: 'gzip', 'bz2', 'xz' or None for an uncompressed file.
     """
-    source = open(filename, 'rb')
-    gzip_source = gzip.GzipFile(mode='rb', fileobj=source)
+    start = source.read(_MAX_MAGIC)
+    source.seek(0)
+    for magic, format in _magic_to_format:
+        if start.startswith(magic):
+            return format
+    return None
+
+
+def format_for_filename(filename):
+    """Guess the compression to write from the extension of filename."""
+    for ext, format in _extension_to_format:
+        if filename.endswith(ext):
+            return format
+    return None
+
+
+def _make_decompressor(format):
+    if format == 'gzip':
+        # 16 tells zlib to expect a gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif format == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif format == 'xz':
+        if lzma is None:
+            raise RuntimeError('Reading xz files needs the lzma module'
+                               ' (backports.lzma on python 2)')
+        return lzma.LZMADecompressor()
+    raise ValueError('Unknown compression format: %r' % (format,))
+
+
+def _make_compressor(format):
+    if format == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif format == 'bz2':
+        return bz2.BZ2Compressor()
+    elif format == 'xz':
+        if lzma is None:
+            raise RuntimeError('Writing xz files needs the lzma module'
+                               ' (backports.lzma on python 2)')
+        return lzma.LZMACompressor()
+    raise ValueError('Unknown compression format: %r' % (format,))
+
+
+def _stream_ended(decompressor):
+    """Has decompressor reached the end of its stream?"""
+    eof = getattr(decompressor, 'eof', None)
+    if eof is not None:
+        return eof
+    if decompressor.unused_data:
+        return True
+    # zlib and bz2 on python 2 don't say, but once they have reached the end
+    # they don't take any more data
     try:
-        line = gzip_source.readline()
-    except KeyboardInterrupt:
-        raise
-    except:
-        # probably not a gzip file
-        source.seek(0)
-        return source, None
-    else:
-        # We don't need these anymore, so close them out in case the rest of
-        # the code raises an exception.
-        gzip_source.close()
-        source.close()
-        # a gzip file
-        # preference - a gzip subprocess
-        if sys.platform == 'win32':
-            close_fds = False # not supported
+        decompressor.decompress('\x00')
+    except EOFError:
+        return True
+    except (zlib.error, IOError):
+        return False
+    return bool(decompressor.unused_data)
+
+
+def iter_line_blocks(blocks):
+    """Rejoin blocks of data so that each ends at the end of a line.
+
+    Only the last block may end without a newline.
+    """
+    partial = ''
+    for block in blocks:
+        end = block.rfind('\n') + 1
+        if end == 0:
+            partial += block
+            continue
+        if partial:
+            yield partial + block[:end]
         else:
-            close_fds = True
+            yield block[:end]
+        partial = block[end:]
+    if partial:
+        yield partial
+
+
+def _iter_lines_from_blocks(blocks):
+    """Split a sequence of strings into lines, like iterating a file."""
+    partial = ''
+    for block in blocks:
+        lines = block.split('\n')
+        lines[0] = partial + lines[0]
+        partial = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if partial:
+        yield partial
+
+
+class DecompressingReader(object):
+    """Iterate the lines of a gzip, bz2 or xz file.
+
+    The file is decompressed in large blocks by a background thread (zlib,
+    bz2 and lzma all release the GIL while they work), so it overlaps with
+    parsing the lines, without a subprocess and a pipe in between.
+    Concatenated streams (eg from 'pigz' or 'pbzip2') are read as one.
+    """
+
+    def __init__(self, filename, format=None,
+                 block_size=_COMPRESSED_BLOCK_SIZE):
+        self._source = open(filename, 'rb')
+        if format is None:
+            format = sniff_format(self._source)
+        # Check the format before starting the thread
+        _make_decompressor(format)
+        self.format = format
+        self.compressed_size = os.fstat(self._source.fileno()).st_size
+        self._block_size = block_size
+        self._compressed_read = 0
+        self._blocks = Queue.Queue(_MAX_QUEUED_BLOCKS)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._decompress)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def tell_compressed(self):
+        """The number of compressed bytes decompressed so far."""
+        return self._compressed_read
+
+    def _put(self, item):
+        # Time out regularly, so that close() can stop us while the reader
+        # isn't taking blocks.
+        while not self._stopped:
+            try:
+                self._blocks.put(item, timeout=0.1)
+            except Queue.Full:
+                continue
+            return True
+        return False
+
+    def _decompress(self):
         try:
-            process = subprocess.Popen(['gzip', '-d', '-c', filename],
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE, close_fds=close_fds)
-        except OSError, e:
-            if e.errno == errno.ENOENT:
-                # failing that, use another python process
-                return _open_mprocess(filename)
-        # make reading from stdin, or writting errors cause immediate aborts
-        process.stdin.close()
-        process.stderr.close()
-        terminate = getattr(process, 'terminate', None)
-        # terminate is a py2.6 thing
-        if terminate is not None:
-            def terminate_or_pass():
-                # It seems that on windows, sometimes terminate() can raise 
-                # WindowsError: [Error 5] Access is denied
-                # My guess is that the process has actually completed, and is
-                # no longer running.
-                try:
-                    return terminate()
-                except OSError, e:
-                    sys.stderr.write('Ignoring failure to terminate process:'
-                                     ' %s\n' % (e,))
-                # We *could* check if process.poll() returns that the
-                # process has already exited, etc.
-            return process.stdout, terminate_or_pass
-        else:
-            # We would like to use process.wait() but that can cause a deadlock
-            # if the child is still writing.
-            # The other alternative is process.communicate, but we closed
-            # stderr, and communicate wants to read from it. (We get:
-            #  ValueError: I/O operation on closed file
-            # if we try it here. Also, for large files, this may be many GB
-            # worth of data.
-            # So for now, live with the deadlock...
-            return process.stdout, process.wait
-
-
-def _stream_file(filename, child):
-    gzip_source = gzip.GzipFile(filename, 'rb')
-    for line in gzip_source:
-        child.send(line)
-    child.send(None)
-
-
-def _open_mprocess(filename):
-    if multiprocessing is None:
-        # can't multiprocess, use inprocess gzip.
-        return gzip.GzipFile(filename, mode='rb'), None
-    parent, child = multiprocessing.Pipe(False)
-    process = multiprocessing.Process(target=_stream_file, args=(filename, child))
-    process.start()
-    def iter_pipe():
+            decompressor = _make_decompressor(self.format)
+            # Whether decompressor has been given data, and may not have
+            # reached the end of its stream yet
+            in_stream = False
+            while not self._stopped:
+                data = self._source.read(self._block_size)
+                if not data:
+                    break
+                self._compressed_read += len(data)
+                while data:
+                    if not in_stream:
+                        # Between streams, skip the zero padding that gzip
+                        # and xz allow, however many blocks it spans
+                        data = data.lstrip('\x00')
+                        if not data:
+                            break
+                        in_stream = True
+                    try:
+                        block = decompressor.decompress(data)
+                    except EOFError:
+                        # The last stream ended exactly at the end of a block
+                        decompressor = _make_decompressor(self.format)
+                        in_stream = False
+                        continue
+                    data = ''
+                    if block and not self._put((block, None)):
+                        return
+                    unused = getattr(decompressor, 'unused_data', '')
+                    if unused:
+                        # The start of another stream, or padding
+                        decompressor = _make_decompressor(self.format)
+                        in_stream = False
+                        data = unused
+            if self._stopped:
+                return
+            if in_stream and not _stream_ended(decompressor):
+                raise EOFError('Compressed file ended before the end of'
+                               ' the stream')
+            self._put(('', None))
+        except Exception, e:
+            self._put((None, e))
+
+    def iter_blocks(self):
+        """Iterate the decompressed data, in blocks of any size."""
         while True:
-            line = parent.recv()
-            if line is None:
+            block, error = self._blocks.get()
+            if error is not None:
+                raise error
+            if not block:
                 break
-            yield line
-    return iter_pipe(), process.join
+            yield block
+
+    def __iter__(self):
+        return _iter_lines_from_blocks(self.iter_blocks())
+
+    def close(self):
+        self._stopped = True
+        self._thread.join()
+        self._source.close()
+
+
+class CompressingWriter(object):
+    """Write a gzip, bz2 or xz file, compressing on a background thread.
+
+    This is the counterpart of DecompressingReader, for writing large
+    blocks at a time.
+    """
+
+    def __init__(self, filename, format=None):
+        if format is None:
+            format = format_for_filename(filename)
+        self._compressor = _make_compressor(format)
+        self.format = format
+        self._out = open(filename, 'wb')
+        self._blocks = Queue.Queue(_MAX_QUEUED_BLOCKS)
+        self._error = None
+        self._thread = threading.Thread(target=self._compress)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _compress(self):
+        try:
+            while True:
+                block = self._blocks.get()
+                if block is None:
+                    break
+                self._out.write(self._compressor.compress(block))
+            self._out.write(self._compressor.flush())
+        except Exception, e:
+            self._error = e
+            # Keep taking blocks, so that write() doesn't block forever
+            while self._blocks.get() is not None:
+                pass
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        if data:
+            self._blocks.put(data)
+
+    def close(self):
+        """Finish compressing, and close the file."""
+        if self._thread is None:
+            return
+        self._blocks.put(None)
+        self._thread.join()
+        self._thread = None
+        self._out.close()
+        if self._error is not None:
+            raise self._error
+
+
+# The default number of uncompressed bytes between GzipIndex checkpoints
+_INDEX_SPAN = 1024 * 1024
+
+
+class GzipIndex(object):
+    """Read from any offset of a gzip file, without decompressing all of it.
+
+    The index is a list of checkpoints from meliae._zran, one every 'span'
+    uncompressed bytes. Reading decompresses from the checkpoint before the
+    offset, so on average span/2 bytes.
+    """
+
+    _magic = 'MLGzIdx1'
+    # compressed size, uncompressed size, number of checkpoints
+    _header = struct.Struct('<8sQQQ')
+    # uncompressed offset, compressed offset, bits, length of the window
+    _checkpoint = struct.Struct('<QQBI')
+
+    def __init__(self, filename, uncompressed_size, checkpoints):
+        self.filename = filename
+        self.uncompressed_size = uncompressed_size
+        self._checkpoints = checkpoints
+        self._offsets = [cp[0] for cp in checkpoints]
+        self._source = None
+
+    @classmethod
+    def build(cls, filename, span=_INDEX_SPAN, on_data=None):
+        """Decompress filename once, and index it.
+
+        :param on_data: Called with each piece of the uncompressed data, see
+            _zran.build_checkpoints.
+        """
+        from meliae import _zran
+        source = open(filename, 'rb')
+        try:
+            size, checkpoints = _zran.build_checkpoints(source, span, on_data)
+        finally:
+            source.close()
+        return cls(filename, size, checkpoints)
+
+    def __len__(self):
+        return len(self._checkpoints)
+
+    def write(self, out):
+        """Write the index to the file object out.
+
+        The windows are compressed, as they usually are mostly text.
+        """
+        out.write(self._header.pack(self._magic,
+                                    os.path.getsize(self.filename),
+                                    self.uncompressed_size,
+                                    len(self._checkpoints)))
+        for offset, compressed_offset, bits, window in self._checkpoints:
+            window = zlib.compress(window)
+            out.write(self._checkpoint.pack(offset, compressed_offset, bits,
+                                            len(window)))
+            out.write(window)
+
+    @classmethod
+    def read_from(cls, filename, source):
+        """Read an index for filename, as written by write().
+
+        :raises ValueError: If this is not an index, or filename has a
+            different size than when it was indexed.
+        """
+        magic, compressed_size, size, count = cls._header.unpack(
+            source.read(cls._header.size))
+        if magic != cls._magic:
+            raise ValueError('not a gzip index')
+        if compressed_size != os.path.getsize(filename):
+            raise ValueError('%s has changed since it was indexed'
+                             % (filename,))
+        checkpoints = []
+        for i in xrange(count):
+            offset, compressed_offset, bits, length = cls._checkpoint.unpack(
+                source.read(cls._checkpoint.size))
+            window = zlib.decompress(source.read(length))
+            checkpoints.append((offset, compressed_offset, bits, window))
+        return cls(filename, size, checkpoints)
+
+    def read(self, offset, length):
+        """Return length bytes of the uncompressed file, starting at offset."""
+        from meliae import _zran
+        if offset < 0 or offset >= self.uncompressed_size or length <= 0:
+            return ''
+        idx = bisect.bisect_right(self._offsets, offset) - 1
+        if self._source is None:
+            self._source = open(self.filename, 'rb')
+        return _zran.extract(self._source, self._checkpoints[idx], offset,
+                             length)
+
+    def read_line(self, offset, guess=4096):
+        """Return the line that starts at offset, including the newline."""
+        content = self.read(offset, guess)
+        while '\n' not in content and len(content) == guess:
+            guess *= 4
+            content = self.read(offset, guess)
+        end = content.find('\n')
+        if end == -1:
+            return content
+        return content[:end + 1]
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+
+def open_file(filename):
+    """Open a file which might be a regular file or compressed.
+
+    gzip, bz2 and xz files are recognised by their first bytes, and
+    decompressed with DecompressingReader.
+
+    :return: An iterator of lines, and a cleanup function.
+    """
+    source = open(filename, 'rb')
+    format = sniff_format(source)
+    if format is None:
+        return source, None
+    source.close()
+    reader = DecompressingReader(filename, format)
+    return reader, reader.close
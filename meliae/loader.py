@@ -17,10 +17,13 @@
 Currently requires simplejson to parse.
 """
 
-import gc
+import array
+import bisect
+import heapq
 import math
 import os
 import re
+import struct
 import sys
 import time
 
@@ -52,12 +55,29 @@ _object_re = re.compile(
     r'(, "len": (?P<len>\d+))?'
     r'(, "value": (?P<valuequote>"?)(?P<value>.*)(?P=valuequote))?'
     r', "refs": \[(?P<refs>[^]]*)\]'
+    r'(, "refcnt": (?P<refcnt>\d+), "gc": (?P<gc>true|false))?'
     r'\}')
 
 _refs_re = re.compile(
     r'(?P<ref>\d+)'
     )
 
+# The lines DumpIndex finds, in blocks of many lines
+_line_address_re = re.compile(
+    r'^\{"address": (\d+), "type": "[^"]*", "size": \d+', re.MULTILINE)
+
+
+def _refcnt_kwargs(refcnt, gc):
+    """The extra arguments for a line with "refcnt" and "gc".
+
+    Only dumps written with refcounts=True have them, so factories that
+    don't know about them keep working for every other dump.
+    """
+    if refcnt is None:
+        return {}
+    return {'refcnt': int(refcnt),
+            'gc_tracked': gc in (True, 'true')}
+
 
 def _from_json(cls, line, temp_cache=None):
     val = simplejson.loads(line)
@@ -70,7 +90,8 @@ def _from_json(cls, line, temp_cache=None):
               children=val['refs'],
               length=val.get('len', None),
               value=val.get('value', None),
-              name=val.get('name', None))
+              name=val.get('name', None),
+              **_refcnt_kwargs(val.get('refcnt', None), val.get('gc', None)))
     if (obj.type_str == 'str'):
         if type(obj.value) is unicode:
             obj.value = obj.value.encode('latin-1')
@@ -84,8 +105,8 @@ def _from_line(cls, line, temp_cache=None):
     if not m:
         raise RuntimeError('Failed to parse line: %r' % (line,))
     (address, type_str, size, name, length, value,
-     refs) = m.group('address', 'type', 'size', 'name', 'len',
-                     'value', 'refs')
+     refs, refcnt, gc) = m.group('address', 'type', 'size', 'name', 'len',
+                                 'value', 'refs', 'refcnt', 'gc')
     assert '\\' not in type_str
     if name is not None:
         assert '\\' not in name
@@ -103,7 +124,8 @@ def _from_line(cls, line, temp_cache=None):
               children=refs,
               length=length,
               value=value,
-              name=name)
+              name=name,
+              **_refcnt_kwargs(refcnt, gc))
     if (obj.type_str == 'str'):
         if type(obj.value) is unicode:
             obj.value = obj.value.encode('latin-1')
@@ -163,6 +185,23 @@ class _ObjSummary(object):
         self.total_count += 1
         self.total_size += memobj.size
 
+    def _add_type_totals(self, type_str, count, total_size, sq_sum, max_size,
+                         max_address):
+        """Add the aggregate of many objects of the same type at once."""
+        try:
+            type_summary = self.type_summaries[type_str]
+        except KeyError:
+            type_summary = _TypeSummary(type_str)
+            self.type_summaries[type_str] = type_summary
+        type_summary.count += count
+        type_summary.total_size += total_size
+        type_summary.sq_sum += sq_sum
+        if max_size > type_summary.max_size:
+            type_summary.max_size = max_size
+            type_summary.max_address = max_address
+        self.total_count += count
+        self.total_size += total_size
+
     def __repr__(self):
         if self.summaries is None:
             self.by_size()
@@ -198,13 +237,196 @@ class _ObjSummary(object):
         self.summaries = summaries
 
 
+class _DuplicateValue(object):
+    """Objects of the same type that all hold the same value."""
+
+    def __init__(self, type_str, value, size, count, addresses, holders):
+        self.type_str = type_str
+        self.value = value
+        self.size = size
+        self.count = count
+        self.addresses = addresses
+        self.holders = holders
+
+    @property
+    def wasted_size(self):
+        """The bytes that would be saved by sharing a single copy."""
+        return (self.count - 1) * self.size
+
+    def __repr__(self):
+        value = repr(self.value)
+        if len(value) > 40:
+            value = value[:37] + '...'
+        return '%s %s: %d copies, %d bytes wasted' % (
+            self.type_str, value, self.count, self.wasted_size)
+
+
+class _TypeDelta(object):
+    """How the objects of a given type changed between two dumps."""
+
+    def __init__(self, type_str):
+        self.type_str = type_str
+        self.old_count = 0
+        self.old_size = 0
+        self.new_count = 0
+        self.new_size = 0
+        # Objects in the new dump that weren't in the old one
+        self.added_count = 0
+        self.added_size = 0
+
+    @property
+    def count_delta(self):
+        return self.new_count - self.old_count
+
+    @property
+    def size_delta(self):
+        return self.new_size - self.old_size
+
+    def __repr__(self):
+        return '%s: %+d objects, %+d bytes, %d new objects (%d bytes)' % (
+            self.type_str, self.count_delta, self.size_delta,
+            self.added_count, self.added_size)
+
+
+class _DumpDiff(object):
+    """The differences between two dumps, see diff()."""
+
+    def __init__(self):
+        self.type_deltas = {}
+        self.old_count = 0
+        self.old_size = 0
+        self.new_count = 0
+        self.new_size = 0
+        # (size, address, type_str) of the largest objects which are only
+        # in the new dump
+        self.largest_added = []
+
+    def _get_delta(self, type_str):
+        try:
+            return self.type_deltas[type_str]
+        except KeyError:
+            delta = _TypeDelta(type_str)
+            self.type_deltas[type_str] = delta
+            return delta
+
+    def top_growers(self, count=20):
+        """Return the _TypeDeltas which grew the most, by size."""
+        deltas = sorted(self.type_deltas.itervalues(),
+                        key=lambda x: (x.size_delta, x.count_delta),
+                        reverse=True)
+        return [delta for delta in deltas[:count] if delta.size_delta > 0]
+
+    def __repr__(self):
+        out = [
+            'Old %d objects, %d bytes; New %d objects, %d bytes (%+d bytes)'
+            % (self.old_count, self.old_size, self.new_count, self.new_size,
+               self.new_size - self.old_size),
+            '   Count     Size  New Count   New Size Kind',
+            ]
+        for delta in self.top_growers():
+            out.append('%+8d%+9d%11d%11d %s'
+                       % (delta.count_delta, delta.size_delta,
+                          delta.added_count, delta.added_size,
+                          delta.type_str))
+        return '\n'.join(out)
+
+
+class EdgeRules(object):
+    """Rules for which references to remove from a dump.
+
+    References that are mere housekeeping links (a module's __dict__, a
+    registry of every instance, the sideways links of a cache) make
+    everything reachable from everything else. EdgeRules describes them by
+    the types of the objects involved, so they can be removed by the
+    collection in a single pass, see ObjManager.prune_edges.
+
+    Objects of a type with slots or sideways rules only have those rules
+    applied, drop_into doesn't remove any of their references. That is what
+    the streaming remove_expensive_references() does for functions and
+    _LRUNodes.
+    """
+
+    def __init__(self):
+        self.into_types = set()
+        self.slots = {}
+        self.sideways_types = set()
+
+    def drop_into(self, *type_strs):
+        """Remove all references to objects of these types.
+
+        The removed references are replaced by a reference to the null
+        object.
+        """
+        self.into_types.update(type_strs)
+        return self
+
+    def drop_slots(self, type_str, *slots):
+        """Remove references from type_str objects at these positions.
+
+        The positions are the order in which tp_traverse visits the
+        references, eg 1 is func_globals for a function. The removed
+        references are replaced by a reference to the null object.
+        """
+        self.slots.setdefault(type_str, set()).update(slots)
+        return self
+
+    def drop_sideways(self, *type_strs):
+        """Remove references between objects of the same type.
+
+        eg the prev/next links of a linked list.
+        """
+        self.sideways_types.update(type_strs)
+        return self
+
+    def copy(self):
+        rules = EdgeRules()
+        rules.into_types.update(self.into_types)
+        for type_str, slots in self.slots.iteritems():
+            rules.drop_slots(type_str, *slots)
+        rules.sideways_types.update(self.sideways_types)
+        return rules
+
+    def apply(self, objs):
+        """Remove the references from a MemObjectCollection.
+
+        :return: The number of objects that were changed.
+        """
+        return objs.prune_edges(tuple(self.into_types),
+                                dict((type_str, tuple(slots))
+                                     for type_str, slots
+                                     in self.slots.iteritems()),
+                                tuple(self.sideways_types))
+
+
+def expensive_reference_rules():
+    """The EdgeRules used by ObjManager.remove_expensive_references.
+
+    References to modules, frames and types, the func_globals and
+    func_module of functions, and the sideways references of _LRUNodes.
+    Add to these to also remove the references to your own hub objects.
+    """
+    # XXX: This is probably not a guaranteed order, but currently
+    #       func_traverse returns:
+    #   func_code, func_globals, func_module, func_defaults,
+    #   func_doc, func_name, func_dict, func_closure
+    return EdgeRules().drop_into('module', 'frame', 'type').drop_slots(
+        'function', 1, 2).drop_sideways('_LRUNode')
+
+
+# Types whose objects are never checked by collapse_instance_dicts
+_not_instance_types = ('str', 'dict', 'tuple', 'list', 'type', 'function',
+                       'wrapper_descriptor', 'code', 'classobj', 'int',
+                       'weakref')
+
+
 class ObjManager(object):
     """Manage the collection of MemObjects.
 
     This is the interface for doing queries, etc.
     """
 
-    def __init__(self, objs, show_progress=True, max_parents=None):
+    def __init__(self, objs, show_progress=True, max_parents=None,
+                 maintain_parents=False):
         """Create a new ObjManager
 
         :param show_progress: If True, as content is loading, write progress
@@ -213,16 +435,42 @@ class ObjManager(object):
             parents tracked to a fixed number, since knowing there are 50k
             references is only informative, you won't actually track into them.
             If 0 we will not compute parents, if < 0 we will show all parents.
+        :param maintain_parents: If True, once the parents are computed, a
+            collection in memory keeps them up to date as references change
+            (see MemObjectCollection.maintain_parents), rather than
+            prune_edges() computing them again. This costs time on every
+            change, so only use it when editing references by hand.
         """
         self.objs = objs
         self.show_progress = show_progress
         self.max_parents = max_parents
         if self.max_parents is None:
             self.max_parents = 100
+        self.maintain_parents = maintain_parents
+        # Whether the parents of the objects are up to date, so that they
+        # can be maintained rather than recomputed
+        self._parents_computed = False
 
     def __getitem__(self, address):
         return self.objs[address]
 
+    def close(self):
+        """Release the files of a collection kept on disk.
+
+        Collections in memory have nothing to release. An ObjManager can
+        also be used as a context manager, which closes it at the end.
+        """
+        close = getattr(self.objs, 'close', None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
     def compute_referrers(self):
         """Deprecated, use compute_parents instead."""
         warn.deprecated('.compute_referrers is deprecated.'
@@ -233,100 +481,18 @@ class ObjManager(object):
         """For each object, figure out who is referencing it."""
         if self.max_parents == 0:
             return
-        parents = {}
-        get_refs = parents.get
-        total = len(self.objs)
-        tlast = timer()-20
-        enabled = gc.isenabled()
-        if enabled:
-            # We create a *lot* of temporary objects here, which are all
-            # cleaned up perfectly by refcounting, so disable gc for this loop.
-            gc.disable()
-        try:
-            for idx, obj in enumerate(self.objs.itervalues()):
-                if self.show_progress and idx & 0x3f == 0:
-                    tnow = timer()
-                    if tnow - tlast > 0.1:
-                        tlast = tnow
-                        sys.stderr.write('compute parents %8d / %8d        \r'
-                                         % (idx, total))
-                address = obj.address
-                for ref in obj.children:
-                    refs = get_refs(ref, None)
-                    # This is ugly, so it should be explained.
-                    # To save memory pressure, parents will point to one of 4
-                    # types.
-                    #   1) A simple integer, representing a single referrer
-                    #      this saves the allocation of a separate structure
-                    #      entirely
-                    #   2) A tuple, slightly more efficient than a list, but
-                    #      requires creating a new tuple to 'add' an entry.
-                    #   3) A list, as before, for things with lots of
-                    #      parents, we use a regular list to let it grow.
-                    #   4) None, no references from this object
-                    t = type(refs)
-                    if refs is None:
-                        refs = address
-                    elif t in (int, long):
-                        refs = (refs, address)
-                    elif t is tuple:
-                        if len(refs) >= 5:
-                            refs = list(refs)
-                            refs.append(address)
-                        else:
-                            refs = refs + (address,)
-                    elif t is list:
-                        # if we are close to the maximum number of entries, put
-                        # it through a set() to make sure we get all the
-                        # duplicates
-                        if (self.max_parents > 0):
-                            if (len(refs) >= self.max_parents):
-                                # Our list has been filled, all done
-                                continue
-                            elif (len(refs) == self.max_parents - 1):
-                                # We are one step away from being full. We put
-                                # the content into a set() so that we are sure
-                                # any duplicates will get filtered out, leaving
-                                # space for the new ref.
-                                refs.append(address)
-                                refs[:] = set(refs)
-                                continue
-                        refs.append(address)
-                        # We don't need to set it, because we modify-in-place
-                        continue
-                    else:
-                        raise TypeError('unknown refs type: %s\n' % (t,))
-                    parents[ref] = refs
-            if self.show_progress:
-                sys.stderr.write('compute parents %8d / %8d        \r'
-                                 % (idx, total))
-            for idx, obj in enumerate(self.objs.itervalues()):
-                if self.show_progress and idx & 0x3f == 0:
-                    tnow = timer()
-                    if tnow - tlast > 0.1:
-                        tlast = tnow
-                        sys.stderr.write('set parents %8d / %8d        \r'
-                                         % (idx, total))
-                try:
-                    refs = parents.pop(obj.address)
-                except KeyError:
-                    obj.parents = ()
-                else:
-                    if refs is None:
-                        obj.parents = ()
-                    elif type(refs) in (int, long):
-                        obj.parents = (refs,)
-                    else:
-                        # We use a set() to remove duplicate parents
-                        obj.parents = set(refs)
-        finally:
-            if enabled:
-                gc.enable()
+        tstart = timer()
+        self.objs.compute_parents(self.max_parents)
+        self._parents_computed = True
+        if self.maintain_parents and hasattr(self.objs, 'maintain_parents'):
+            # Keep them up to date from now on, rather than recomputing
+            # them after prune_edges
+            self.objs.maintain_parents = True
         if self.show_progress:
-            sys.stderr.write('set parents %8d / %8d        \n'
-                             % (idx, total))
+            sys.stderr.write('set parents %8d in %.1fs\n'
+                             % (len(self.objs), timer() - tstart))
 
-    def remove_expensive_references(self):
+    def remove_expensive_references(self, rules=None):
         """Filter out references that are mere houskeeping links.
 
         module.__dict__ tends to reference lots of other modules, which in turn
@@ -337,20 +503,138 @@ class ObjManager(object):
 
         We filter out any reference to modules, frames, types, function globals
         pointers & LRU sideways references.
+
+        :param rules: An EdgeRules to use instead of
+            expensive_reference_rules().
         """
-        source = lambda:self.objs.itervalues()
-        total_objs = len(self.objs)
+        if rules is None:
+            rules = expensive_reference_rules()
+        self.prune_edges(rules)
+
+    def prune_edges(self, rules):
+        """Remove the references selected by an EdgeRules.
+
+        If the parents were computed, they are computed again afterwards,
+        unless the collection maintains them (see maintain_parents).
+
+        :return: The number of objects that were changed.
+        """
+        tstart = timer()
         # Add the 'null' object
-        self.objs.add(0, '<ex-reference>', 0, [])
-        for changed, obj in remove_expensive_references(source, total_objs,
-                                                        self.show_progress):
-            continue
+        if 0 not in self.objs:
+            self.objs.add(0, '<ex-reference>', 0, [])
+        num_changed = rules.apply(self.objs)
+        if self.show_progress:
+            sys.stderr.write('pruned references of %d objs in %.1fs\n'
+                             % (num_changed, timer() - tstart))
+        if (num_changed and self._parents_computed
+            and not getattr(self.objs, 'maintain_parents', False)):
+            self.compute_parents()
+        return num_changed
+
+    def path_to_root(self, address, k=3):
+        """Find why an object is still alive.
+
+        This walks the parents of the object (breadth first) until it finds
+        k objects without parents, or modules. Types and frames are not
+        walked through, since they end up referencing everything. This needs
+        the parents to have been computed, which load() does by default.
+
+        :param address: The address of the object to explain.
+        :param k: The number of paths to return, each to a different root.
+        :return: A list of paths, shortest first. Each path is a list of
+            objects, starting with the one at address and ending at a root.
+        """
+        paths = self.objs.path_to_root(address, k)
+        return [[self.objs[addr] for addr in path] for path in paths]
+
+    def find_duplicate_values(self, type_strs=('str', 'unicode', 'int'),
+                              max_samples=5):
+        """Find values that are held by more than one object.
+
+        Equal strings that were never interned (dict keys loaded from JSON,
+        values read from a database, etc) can waste a lot of memory. See
+        MemObjectCollection.find_duplicate_values for details.
+
+        :param type_strs: The types of objects to compare.
+        :param max_samples: How many copies, and objects referring to them
+            (when parents have been computed), to report for each value.
+        :return: A list of _DuplicateValue, the most wasteful first.
+        """
+        tstart = timer()
+        duplicates = [_DuplicateValue(*info) for info in
+                      self.objs.find_duplicate_values(type_strs, max_samples)]
+        duplicates.sort(key=lambda x: (x.wasted_size, x.count), reverse=True)
+        if self.show_progress:
+            sys.stderr.write('found %d duplicated values in %.1fs\n'
+                             % (len(duplicates), timer() - tstart))
+        return duplicates
+
+    def compute_external_refs(self, min_refs=1):
+        """Find objects kept alive by references the dump can't see.
+
+        This needs a dump written by scanner.dump_gc_objects(refcounts=True).
+        An object's refcnt, less the references from the other objects in
+        the dump, is the number of references held from C: extension
+        modules, interpreter state, or leaks. See
+        MemObjectCollection.compute_external_refs. Call this before
+        remove_expensive_references(), which drops edges.
+
+        :param min_refs: Only return objects with at least this many
+            external references.
+        :return: [(num_external, obj)] with the most external references
+            first.
+        """
+        tstart = timer()
+        external = self.objs.compute_external_refs(min_refs)
+        if self.show_progress:
+            sys.stderr.write('found %d objects with external references'
+                             ' in %.1fs\n'
+                             % (len(external), timer() - tstart))
+        return external
+
+    def compute_dominators(self):
+        """Compute the retained size of every object.
+
+        This finds the immediate dominator of every object (see
+        MemObjectCollection.compute_dominators) and sets .total_size to the
+        number of bytes that would be freed if that object went away. Unlike
+        compute_total_size, shared objects are only counted once, by the
+        object which actually keeps them alive.
+        """
+        tstart = timer()
+        self.objs.compute_dominators()
+        if self.show_progress:
+            sys.stderr.write('computed dominators of %8d objects in %.1fs\n'
+                             % (len(self.objs), timer() - tstart))
 
     def compute_total_size(self, obj):
         """Sum the size of all referenced objects (recursively)."""
         obj.total_size = sum(c.size for c in obj.iter_recursive_refs())
         return obj
 
+    def compute_all_total_sizes(self, top=20, approximate=False):
+        """Compute total_size for every object in a single pass.
+
+        This is the bulk version of compute_total_size, see
+        MemObjectCollection.compute_reachable_sizes for details.
+
+        :param top: The number of objects to return.
+        :param approximate: Estimate the size reachable from objects in
+            shared parts of the graph, rather than counting it exactly. Useful
+            for very large dumps.
+        :return: The 'top' objects with the largest total_size, largest first
+        """
+        tstart = timer()
+        num_components = self.objs.compute_reachable_sizes(
+            approximate=approximate)
+        if self.show_progress:
+            sys.stderr.write('computed total sizes of %8d objects'
+                             ' (%d components) in %.1fs\n'
+                             % (len(self.objs), num_components,
+                                timer() - tstart))
+        return self.objs.largest_total_size(top)
+
     def summarize(self, obj=None, excluding=None):
         """Summarize the objects referenced from this one.
 
@@ -362,16 +646,17 @@ class ObjManager(object):
         """
         summary = _ObjSummary()
         if obj is None:
-            objs = self.objs.itervalues()
-        else:
-            objs = obj.iter_recursive_refs(excluding=excluding)
-        for obj in objs:
+            # Aggregating the whole collection is done without proxies
+            for type_totals in self.objs.summarize_by_type():
+                summary._add_type_totals(*type_totals)
+            return summary
+        for obj in obj.iter_recursive_refs(excluding=excluding):
             summary._add(obj)
         return summary
 
     def get_all(self, type_str):
         """Return all objects that match a given type."""
-        all = [o for o in self.objs.itervalues() if o.type_str == type_str]
+        all = self.objs.values_of_type(type_str)
         all.sort(key=lambda x:(x.size, len(x), x.num_parents),
                  reverse=True)
         return all
@@ -392,69 +677,15 @@ class ObjManager(object):
         # The instances I'm focusing on have a custom type name, and every
         # instance has 2 pointers. The first is to __dict__, and the second is
         # to the 'type' object whose name matches the type of the instance.
-        # Also __dict__ has only 1 referrer, and that is *this* object
-
-        # TODO: Handle old style classes. They seem to have type 'instanceobj',
-        #       and reference a 'classobj' with the actual type name
-        collapsed = 0
-        total = len(self.objs)
-        tlast = timer()-20
-        to_be_removed = set()
-        for item_idx, obj in enumerate(self.objs.itervalues()):
-            if obj.type_str in ('str', 'dict', 'tuple', 'list', 'type',
-                                'function', 'wrapper_descriptor',
-                                'code', 'classobj', 'int',
-                                'weakref'):
-                continue
-            if self.show_progress and item_idx & 0x3f:
-                tnow = timer()
-                if tnow - tlast > 0.1:
-                    tlast = tnow
-                    sys.stderr.write('checked %8d / %8d collapsed %8d    \r'
-                                     % (item_idx, total, collapsed))
-            if obj.type_str == 'module' and len(obj) == 1:
-                (dict_obj,) = obj
-                if dict_obj.type_str != 'dict':
-                    continue
-                extra_refs = []
-            else:
-                if len(obj) != 2:
-                    continue
-                obj_1, obj_2 = obj
-                if obj_1.type_str == 'dict' and obj_2.type_str == 'type':
-                    # This is a new-style class
-                    dict_obj = obj_1
-                    type_obj = obj_2
-                elif (obj.type_str == 'instance'
-                      and obj_1.type_str == 'classobj'
-                      and obj_2.type_str == 'dict'):
-                    # This is an old-style class
-                    type_obj = obj_1
-                    dict_obj = obj_2
-                else:
-                    continue
-                extra_refs = [type_obj.address]
-            collapsed += 1
-            # We found an instance \o/
-            new_refs = list(dict_obj.children)
-            new_refs.extend(extra_refs)
-            obj.children = new_refs
-            obj.size = obj.size + dict_obj.size
-            obj.total_size = 0
-            if obj.type_str == 'instance':
-                obj.type_str = type_obj.value
-            # Now that all the data has been moved into the instance, we
-            # will want to remove the dict from the collection.  We'll do the
-            # actual deletion later, since we are using iteritems for this
-            # loop.
-            to_be_removed.add(dict_obj.address)
-        # Now we can do the actual deletion.
-        for address in to_be_removed:
-            del self.objs[address]
+        # Old style instances have type 'instance', and reference a 'classobj'
+        # with the actual type name, and then their __dict__.
+        tstart = timer()
+        collapsed = self.objs.collapse_instance_dicts(_not_instance_types,
+            update_parents=self._parents_computed)
         if self.show_progress:
-            sys.stderr.write('checked %8d / %8d collapsed %8d    \n'
-                             % (item_idx, total, collapsed))
-        if collapsed:
+            sys.stderr.write('collapsed %8d instance dicts in %.1fs\n'
+                             % (collapsed, timer() - tstart))
+        if collapsed and not self._parents_computed:
             self.compute_parents()
         return collapsed
 
@@ -489,9 +720,9 @@ class ObjManager(object):
 
         This is a dict that only contains strings that point to themselves.
         """
-        for o in self.objs.itervalues():
+        for o in self.objs.values_of_type('dict'):
             o_len = len(o)
-            if o.type_str != 'dict' or o_len == 0 or o.num_parents > 0:
+            if o_len == 0 or o.num_parents > 0:
                 # Must be a non-empty dict
                 continue
             # We avoid calling o.children so that we don't have to create
@@ -508,7 +739,8 @@ class ObjManager(object):
 
 
 def load(source, using_json=None, show_prog=True, collapse=True,
-         max_parents=None):
+         max_parents=None, on_disk=None, edge_rules=None,
+         maintain_parents=False):
     """Load objects from the given source.
 
     :param source: If this is a string, we will open it as a file and read all
@@ -523,6 +755,16 @@ def load(source, using_json=None, show_prog=True, collapse=True,
     :param show_prog: If True, display the progress as we read in data
     :param collapse: If True, run collapse_instance_dicts() after loading.
     :param max_parents: See ObjManager.__init__(max_parents)
+    :param on_disk: If not None, keep the objects in a
+        meliae.disk.DiskMemObjectCollection rather than in memory, for dumps
+        that are too big to load. Either a directory to keep the files in,
+        or True to use a temporary directory. Call close() on the returned
+        ObjManager (or use it in a with statement) to remove the files.
+        compute_dominators and compute_all_total_sizes still need a few
+        words of memory for every object and reference.
+    :param edge_rules: An EdgeRules of references to remove as soon as the
+        objects are loaded, before the parents are computed.
+    :param maintain_parents: See ObjManager.__init__(maintain_parents)
     """
     cleanup = None
     if isinstance(source, str):
@@ -530,7 +772,7 @@ def load(source, using_json=None, show_prog=True, collapse=True,
         if isinstance(source, file):
             input_size = os.fstat(source.fileno()).st_size
         else:
-            input_size = 0
+            input_size = getattr(source, 'compressed_size', 0)
     elif isinstance(source, (list, tuple)):
         input_size = sum(map(len, source))
     else:
@@ -539,10 +781,13 @@ def load(source, using_json=None, show_prog=True, collapse=True,
         using_json = (simplejson is not None)
     try:
         manager = _load(source, using_json, show_prog, input_size,
-                        max_parents=max_parents)
+                        max_parents=max_parents, on_disk=on_disk,
+                        maintain_parents=maintain_parents)
     finally:
         if cleanup is not None:
             cleanup()
+    if edge_rules is not None:
+        manager.prune_edges(edge_rules)
     if collapse:
         tstart = time.time()
         if not manager.collapse_instance_dicts():
@@ -554,6 +799,423 @@ def load(source, using_json=None, show_prog=True, collapse=True,
     return manager
 
 
+def _open_source(source):
+    """Turn a filename into lines, see load()."""
+    if isinstance(source, str):
+        return files.open_file(source)
+    return source, None
+
+
+def _type_and_size_from_json(line):
+    """Parse (address, type_str, size) out of an arbitrary json line."""
+    if simplejson is None:
+        raise RuntimeError('Failed to parse line: %r' % (line,))
+    line = line.rstrip()
+    if line.endswith(','):
+        line = line[:-1]
+    val = simplejson.loads(line)
+    return val['address'], str(val['type']), val['size']
+
+
+def summarize_file(source, show_prog=False, dedupe=False):
+    """Summarize the types in a dump, without loading it.
+
+    This is the same as load(source).summarize(), but only the type and
+    size of each object is parsed (in C), and nothing is kept per object,
+    so it runs in constant memory, and is fast enough to run on the machine
+    that wrote the dump.
+
+    :param source: A filename (which may be gzipped), or an iterator of
+        lines.
+    :param show_prog: If True, write the time taken to stderr.
+    :param dedupe: If True, count objects dumped more than once only once,
+        as load() does. This keeps the address of every object in an
+        AddressSet, about 8 bytes per object. Only needed for dumps written
+        without scanner.dump_gc_objects(dedupe=True) that haven't been
+        through strip_duplicates.py.
+    :return: An _ObjSummary
+    """
+    tstart = timer()
+    if dedupe:
+        seen = _intset.AddressSet()
+    else:
+        seen = None
+    source, cleanup = _open_source(source)
+    try:
+        type_totals = _loader.summarize_lines(source,
+                                              _type_and_size_from_json, seen)
+    finally:
+        if cleanup is not None:
+            cleanup()
+    summary = _ObjSummary()
+    for totals in type_totals:
+        summary._add_type_totals(*totals)
+    if show_prog:
+        sys.stderr.write('summarized %d objects in %.1fs\n'
+                         % (summary.total_count, timer() - tstart))
+    return summary
+
+
+def diff(old, new, show_prog=False, max_added=20):
+    """Compare two dumps, without loading either of them.
+
+    Both dumps are read once, one after the other, and only the start of
+    each line is parsed (in C). We only remember the addresses of the old
+    dump, in an AddressSet for each type, so an object in the new dump is
+    considered 'added' if there was nothing at the same address with the
+    same type in the old one. Objects dumped more than once are only counted
+    the first time, in either dump, so diff(a, b) and diff(b, a) agree.
+
+    :param old: The earlier dump, a filename or an iterator of lines.
+    :param new: The later dump, a filename or an iterator of lines.
+    :param show_prog: If True, write progress information to stderr.
+    :param max_added: The number of the largest added objects to remember.
+    :return: A _DumpDiff
+    """
+    result = _DumpDiff()
+    # type_str => AddressSet
+    old_objs = {}
+    tstart = timer()
+    source, cleanup = _open_source(old)
+    try:
+        objs = _loader.iter_type_and_size(source, _type_and_size_from_json)
+        for address, type_str, size in objs:
+            addresses = old_objs.get(type_str)
+            if addresses is None:
+                addresses = old_objs[type_str] = _intset.AddressSet()
+            elif address in addresses:
+                continue
+            addresses.add(address)
+            delta = result._get_delta(type_str)
+            delta.old_count += 1
+            delta.old_size += size
+            result.old_count += 1
+            result.old_size += size
+            if show_prog and result.old_count & 0xffff == 0:
+                sys.stderr.write('read %8d old objects in %.1fs\r'
+                                 % (result.old_count, timer() - tstart))
+    finally:
+        if cleanup is not None:
+            cleanup()
+    largest_added = []
+    new_objs = {}
+    source, cleanup = _open_source(new)
+    try:
+        objs = _loader.iter_type_and_size(source, _type_and_size_from_json)
+        for address, type_str, size in objs:
+            addresses = new_objs.get(type_str)
+            if addresses is None:
+                addresses = new_objs[type_str] = _intset.AddressSet()
+            elif address in addresses:
+                continue
+            addresses.add(address)
+            delta = result._get_delta(type_str)
+            delta.new_count += 1
+            delta.new_size += size
+            result.new_count += 1
+            result.new_size += size
+            old_addresses = old_objs.get(type_str)
+            if old_addresses is None or address not in old_addresses:
+                delta.added_count += 1
+                delta.added_size += size
+                if len(largest_added) < max_added:
+                    heapq.heappush(largest_added, (size, address, type_str))
+                elif size > largest_added[0][0]:
+                    heapq.heapreplace(largest_added, (size, address, type_str))
+            if show_prog and result.new_count & 0xffff == 0:
+                sys.stderr.write('read %8d new objects in %.1fs\r'
+                                 % (result.new_count, timer() - tstart))
+    finally:
+        if cleanup is not None:
+            cleanup()
+    largest_added.sort(reverse=True)
+    result.largest_added = largest_added
+    if show_prog:
+        sys.stderr.write('compared %d => %d objects in %.1fs\n'
+                         % (result.old_count, result.new_count,
+                            timer() - tstart))
+    return result
+
+
+def strip_duplicates(source, out, show_prog=False):
+    """Copy a dump, keeping only the first line for each address.
+
+    scanner.dump_gc_objects() doesn't remember what it has written, so it
+    can dump the same object several times. This works a block at a time,
+    with decompression and compression on other threads (see
+    files.DecompressingReader and files.CompressingWriter), the addresses
+    parsed in C, and the seen addresses in an AddressSet.
+
+    :param source: A filename, compressed or not, or a file object.
+    :param out: A filename, compressed according to its extension (eg
+        '.gz'), or a file object.
+    :param show_prog: If True, write progress information to stderr.
+    :return: (lines read, lines written)
+    """
+    cleanups = []
+    try:
+        if isinstance(source, str):
+            source, cleanup = files.open_file(source)
+            if cleanup is None:
+                cleanup = source.close
+            cleanups.append(cleanup)
+        tell_compressed = getattr(source, 'tell_compressed', None)
+        if tell_compressed is not None:
+            input_size = source.compressed_size
+            blocks = source.iter_blocks()
+        else:
+            try:
+                # pipes are files, but 0 isn't useful.
+                input_size = os.fstat(source.fileno()).st_size
+            except (AttributeError, OSError):
+                input_size = 0
+            blocks = iter(lambda: source.read(files._COMPRESSED_BLOCK_SIZE),
+                          '')
+        if isinstance(out, str):
+            if files.format_for_filename(out) is None:
+                out = open(out, 'wb')
+            else:
+                out = files.CompressingWriter(out)
+            cleanups.append(out.close)
+        seen = _intset.AddressSet()
+        input_mb = input_size / 1024. / 1024
+        tstart = timer()
+        bytes_read = lines_in = lines_out = 0
+        for block in files.iter_line_blocks(blocks):
+            bytes_read += len(block)
+            new_block, num_lines, num_kept = _intset.filter_new_lines(seen,
+                                                                      block)
+            out.write(new_block)
+            lines_in += num_lines
+            lines_out += num_kept
+            if show_prog:
+                if tell_compressed is not None:
+                    bytes_read = tell_compressed()
+                sys.stderr.write(
+                    'stripping... line %d, %d out, %5.1f / %5.1f MiB read'
+                    ' in %.1fs\r' % (lines_in, lines_out,
+                                     bytes_read / 1024. / 1024, input_mb,
+                                     timer() - tstart))
+    finally:
+        for cleanup in cleanups:
+            cleanup()
+    if show_prog:
+        sys.stderr.write('stripped %d duplicate lines of %d in %.1fs%s\n'
+                         % (lines_in - lines_out, lines_in, timer() - tstart,
+                            ' ' * 20))
+    return lines_in, lines_out
+
+
+class _LineIndexer(object):
+    """Collect the address and offset of each line, from blocks of a dump."""
+
+    def __init__(self):
+        self.addresses = array.array('L')
+        self.offsets = array.array('L')
+        self._partial = ''
+        # The offset of the start of _partial
+        self._offset = 0
+
+    def add_block(self, block):
+        end = block.rfind('\n') + 1
+        if end == 0:
+            self._partial += block
+            return
+        self._add_lines(self._partial + block[:end])
+        self._partial = block[end:]
+
+    def finish(self):
+        if self._partial:
+            self._add_lines(self._partial)
+            self._partial = ''
+
+    def _add_lines(self, data):
+        for m in _line_address_re.finditer(data):
+            self.addresses.append(int(m.group(1)))
+            self.offsets.append(self._offset + m.start())
+        self._offset += len(data)
+
+
+class DumpIndex(object):
+    """Find objects in a dump by address, without loading all of it.
+
+    This maps every address to the offset of its line in the uncompressed
+    dump. For a gzip dump it also keeps a files.GzipIndex, so a single line
+    can be decompressed from the nearest checkpoint. Objects are parsed as
+    they are asked for, into a MemObjectCollection of just those objects.
+    """
+
+    _magic = 'MLDmpIdx'
+    # dump size, item size of the arrays, number of addresses, has gzip
+    _header = struct.Struct('<8sQBQB')
+
+    def __init__(self, filename, addresses, offsets, gzip_index=None):
+        """Create an index, see build() and open().
+
+        :param addresses: An array of the addresses in the dump, sorted.
+        :param offsets: An array of the offset of each address' line.
+        """
+        self.filename = filename
+        self._addresses = addresses
+        self._offsets = offsets
+        self._gzip_index = gzip_index
+        self._source = None
+        self.objs = _loader.MemObjectCollection()
+
+    @classmethod
+    def build(cls, filename, span=files._INDEX_SPAN):
+        """Read through filename, and index all of its objects.
+
+        :param span: For a gzip dump, the uncompressed bytes between
+            checkpoints, see files.GzipIndex.
+        """
+        indexer = _LineIndexer()
+        gzip_index = None
+        source = open(filename, 'rb')
+        try:
+            format = files.sniff_format(source)
+            if format == 'gzip':
+                # The checkpoints are found in the same pass
+                gzip_index = files.GzipIndex.build(filename, span,
+                                                   indexer.add_block)
+            elif format is not None:
+                raise ValueError('Only uncompressed and gzip dumps can be'
+                                 ' indexed, not %s' % (format,))
+            else:
+                for block in iter(
+                        lambda: source.read(files._COMPRESSED_BLOCK_SIZE), ''):
+                    indexer.add_block(block)
+        finally:
+            source.close()
+        indexer.finish()
+        # Sorting by (address, offset) keeps the first copy of duplicates
+        _loader.sort_by_address(indexer.addresses, indexer.offsets)
+        return cls(filename, indexer.addresses, indexer.offsets, gzip_index)
+
+    @classmethod
+    def open(cls, filename, index_filename=None, span=files._INDEX_SPAN):
+        """Load the index of filename, building and saving it if needed.
+
+        :param index_filename: Where to keep the index, by default next to
+            the dump, as filename + '.idx'. If it can't be written the index
+            is just not saved.
+        """
+        if index_filename is None:
+            index_filename = filename + '.idx'
+        try:
+            source = open(index_filename, 'rb')
+        except IOError:
+            pass
+        else:
+            try:
+                try:
+                    return cls.read_from(filename, source)
+                except (ValueError, struct.error):
+                    # Out of date or corrupt, build it again
+                    pass
+            finally:
+                source.close()
+        index = cls.build(filename, span)
+        try:
+            out = open(index_filename, 'wb')
+        except IOError:
+            return index
+        try:
+            index.write(out)
+        finally:
+            out.close()
+        return index
+
+    def write(self, out):
+        """Write the index to the file object out."""
+        out.write(self._header.pack(self._magic,
+                                    os.path.getsize(self.filename),
+                                    self._addresses.itemsize,
+                                    len(self._addresses),
+                                    self._gzip_index is not None))
+        self._addresses.tofile(out)
+        self._offsets.tofile(out)
+        if self._gzip_index is not None:
+            self._gzip_index.write(out)
+
+    @classmethod
+    def read_from(cls, filename, source):
+        """Read an index for filename from source, as written by write().
+
+        :raises ValueError: If this is not an index, or the dump has changed.
+        """
+        magic, size, itemsize, count, has_gzip = cls._header.unpack(
+            source.read(cls._header.size))
+        if magic != cls._magic:
+            raise ValueError('not a dump index')
+        if size != os.path.getsize(filename):
+            raise ValueError('%s has changed since it was indexed'
+                             % (filename,))
+        addresses = array.array('L')
+        offsets = array.array('L')
+        if itemsize != addresses.itemsize:
+            raise ValueError('index was written with %d byte addresses'
+                             % (itemsize,))
+        try:
+            addresses.fromfile(source, count)
+            offsets.fromfile(source, count)
+        except EOFError:
+            raise ValueError('index is truncated')
+        gzip_index = None
+        if has_gzip:
+            gzip_index = files.GzipIndex.read_from(filename, source)
+        return cls(filename, addresses, offsets, gzip_index)
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def _find(self, address):
+        idx = bisect.bisect_left(self._addresses, address)
+        if idx < len(self._addresses) and self._addresses[idx] == address:
+            return idx
+        return -1
+
+    def __contains__(self, address):
+        return self._find(address) != -1
+
+    def get_line(self, address):
+        """Return the line of the dump for address."""
+        idx = self._find(address)
+        if idx == -1:
+            raise KeyError(address)
+        offset = self._offsets[idx]
+        if self._gzip_index is not None:
+            return self._gzip_index.read_line(offset)
+        if self._source is None:
+            self._source = open(self.filename, 'rb')
+        self._source.seek(offset)
+        return self._source.readline()
+
+    def __getitem__(self, address):
+        """Parse the object at address, see get_line()."""
+        if address in self.objs:
+            return self.objs[address]
+        line = self.get_line(address).rstrip()
+        if line.endswith(','):
+            line = line[:-1]
+        if _object_re.match(line) is None and simplejson is not None:
+            return _from_json(self.objs.add, line)
+        return _from_line(self.objs.add, line)
+
+    def get(self, address, default=None):
+        try:
+            return self[address]
+        except KeyError:
+            return default
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        if self._gzip_index is not None:
+            self._gzip_index.close()
+
+
 def iter_objs(source, using_json=False, show_prog=False, input_size=0,
               objs=None, factory=None):
     """Iterate MemObjects from json.
@@ -562,6 +1224,9 @@ def iter_objs(source, using_json=False, show_prog=False, input_size=0,
     :param using_json: Use simplejson. See load().
     :param show_prog: Show progress.
     :param input_size: The size of the input if known (in bytes) or 0.
+        If source has a tell_compressed() method (see
+        files.DecompressingReader), this is the compressed size, and the
+        progress is reported in compressed bytes.
     :param objs: Either None or a dict containing objects by address. If not
         None, then duplicate objects will not be parsed or output.
     :param factory: Use this to create new instances, if None, use
@@ -584,6 +1249,7 @@ def iter_objs(source, using_json=False, show_prog=False, input_size=0,
         decoder = _from_line
     if factory is None:
         factory = _loader._MemObjectProxy_from_args
+    tell_compressed = getattr(source, 'tell_compressed', None)
     for line_num, line in enumerate(source):
         bytes_read += len(line)
         if line in ("[\n", "]\n"):
@@ -601,27 +1267,83 @@ def iter_objs(source, using_json=False, show_prog=False, input_size=0,
         yield decoder(factory, line, temp_cache=temp_cache)
         if show_prog and (line_num - last > 5000):
             last = line_num
-            mb_read = bytes_read / 1024. / 1024
+            if tell_compressed is not None:
+                mb_read = tell_compressed() / 1024. / 1024
+            else:
+                mb_read = bytes_read / 1024. / 1024
             tdelta = timer() - tstart
+            if input_mb and mb_read:
+                eta = ', %.0fs left' % (tdelta * (input_mb - mb_read)
+                                        / mb_read,)
+            else:
+                eta = ''
             sys.stderr.write(
-                'loading... line %d, %d objs, %5.1f / %5.1f MiB read in %.1fs\r'
-                % (line_num, len(objs), mb_read, input_mb, tdelta))
+                'loading... line %d, %d objs, %5.1f / %5.1f MiB read in %.1fs%s\r'
+                % (line_num, len(objs), mb_read, input_mb, tdelta, eta))
     del temp_cache
     if show_prog:
-        mb_read = bytes_read / 1024. / 1024
+        if tell_compressed is not None:
+            mb_read = tell_compressed() / 1024. / 1024
+        else:
+            mb_read = bytes_read / 1024. / 1024
         tdelta = timer() - tstart
         sys.stderr.write(
             'loaded line %d, %d objs, %5.1f / %5.1f MiB read in %.1fs        \n'
             % (line_num, len(objs), mb_read, input_mb, tdelta))
 
 
-def _load(source, using_json, show_prog, input_size, max_parents=None):
-    objs = _loader.MemObjectCollection()
+def _load(source, using_json, show_prog, input_size, max_parents=None,
+          on_disk=None, maintain_parents=False):
+    if on_disk is None:
+        objs = _loader.MemObjectCollection()
+    else:
+        from meliae import disk
+        if on_disk is True:
+            on_disk = None
+        objs = disk.DiskMemObjectCollection(on_disk)
     for memobj in iter_objs(source, using_json, show_prog, input_size, objs,
                             factory=objs.add):
         # objs.add automatically adds the object as it is created
         pass
-    return ObjManager(objs, show_progress=show_prog, max_parents=max_parents)
+    return ObjManager(objs, show_progress=show_prog, max_parents=max_parents,
+                      maintain_parents=maintain_parents)
+
+
+def _remove_expensive_refs(obj, noref_objs, lru_objs):
+    """Remove the expensive references from a single object.
+
+    :param noref_objs: The addresses of objects that should not be referenced
+    :param lru_objs: The addresses of _LRUNode objects
+    :return: True if obj.children was changed
+    """
+    if obj.type_str == 'function':
+        # Functions have a reference to 'globals' which is not very
+        # helpful for having a clear understanding of what is going on
+        # especially since the function itself is in its own globals
+        # XXX: This is probably not a guaranteed order, but currently
+        #       func_traverse returns:
+        #   func_code, func_globals, func_module, func_defaults,
+        #   func_doc, func_name, func_dict, func_closure
+        # We want to remove the reference to globals and module
+        refs = list(obj.children)
+        obj.children = refs[:1] + refs[3:] + [0]
+        return True
+    elif obj.type_str == '_LRUNode':
+        # We remove the 'sideways' references
+        obj.children = [ref for ref in obj.children
+                             if ref not in lru_objs]
+        return True
+    for ref in obj.children:
+        if ref in noref_objs:
+            break
+    else:
+        # No bad references
+        return False
+    new_ref_list = [ref for ref in obj.children
+                         if ref not in noref_objs]
+    new_ref_list.append(0)
+    obj.children = new_ref_list
+    return True
 
 
 def remove_expensive_references(source, total_objs=0, show_progress=False):
@@ -682,37 +1404,7 @@ def remove_expensive_references(source, total_objs=0, show_progress=False):
             sys.stderr.write('removing %d expensive refs... %8d / %8d   \r'
                              % (num_expensive, idx + total_objs,
                                 total_steps))
-        if obj.type_str == 'function':
-            # Functions have a reference to 'globals' which is not very
-            # helpful for having a clear understanding of what is going on
-            # especially since the function itself is in its own globals
-            # XXX: This is probably not a guaranteed order, but currently
-            #       func_traverse returns:
-            #   func_code, func_globals, func_module, func_defaults,
-            #   func_doc, func_name, func_dict, func_closure
-            # We want to remove the reference to globals and module
-            refs = list(obj.children)
-            obj.children = refs[:1] + refs[3:] + [0]
-            yield (True, obj)
-            continue
-        elif obj.type_str == '_LRUNode':
-            # We remove the 'sideways' references
-            obj.children = [ref for ref in obj.children
-                                 if ref not in lru_objs]
-            yield (True, obj)
-            continue
-        for ref in obj.children:
-            if ref in noref_objs:
-                break
-        else:
-            # No bad references, keep going
-            yield (False, obj)
-            continue
-        new_ref_list = [ref for ref in obj.children
-                             if ref not in noref_objs]
-        new_ref_list.append(0)
-        obj.children = new_ref_list
-        yield (True, obj)
+        yield (_remove_expensive_refs(obj, noref_objs, lru_objs), obj)
     if show_progress:
         sys.stderr.write('removed %d expensive refs from %d objs%s\n'
                          % (num_expensive, total_objs, ' '*20))
@@ -15,6 +15,7 @@
 """Some bits for helping to scan objects looking for referenced memory."""
 
 import gc
+import sys
 import types
 
 from meliae import (
@@ -48,14 +49,9 @@ def dump_all_referenced(outf, obj, is_pending=False):
     else:
         pending = [obj]
     last_offset = len(pending) - 1
-    # TODO: Instead of using an IDSet, we could use a BloomFilter. It would
-    #       mean some objects may not get dumped (blooms say "yes you
-    #       definitely are not present", but only "you might already be
-    #       present", collisions cause false positives.)
-    #       However, you can get by with 8-10bits for a 1% FPR, rather than
-    #       using 32/64-bit pointers + overhead for avoiding hash collisions.
-    #       So on 64-bit we drop from 16bytes/object to 1...
-    seen = _intset.IDSet()
+    # An AddressSet takes 1-2 bytes per object, since addresses are aligned
+    # and clustered, rather than 16 bytes per object for an IDSet.
+    seen = _intset.AddressSet()
     if is_pending:
         seen.add(id(pending))
     while last_offset >= 0:
@@ -76,8 +72,54 @@ def dump_all_referenced(outf, obj, is_pending=False):
                     pending.append(ref)
 
 
-def dump_gc_objects(outf, recurse_depth=1):
+def _unique(objs):
+    """Return objs without the repeated objects, in order."""
+    ids = set()
+    result = []
+    for obj in objs:
+        if id(obj) not in ids:
+            ids.add(id(obj))
+            result.append(obj)
+    return result
+
+
+def _refs_held_by_loop(num_lists):
+    """Count the references to obj held by 'for obj in a_list'.
+
+    obj is an item of num_lists lists (including a_list), and bound to the
+    loop variable. Rather than counting these by hand, a sentinel is put
+    through the same pattern and measured with sys.getrefcount.
+    """
+    sentinel = object()
+    base = sys.getrefcount(sentinel)
+    lists = [[sentinel] for i in xrange(num_lists)]
+    for obj in lists[0]:
+        return sys.getrefcount(sentinel) - base
+
+
+def dump_gc_objects(outf, recurse_depth=1, dedupe=False, bloom_size=None,
+                    refcounts=False, nodump_refcount=None):
     """Dump everything that is available via gc.get_objects().
+
+    Objects that aren't tracked by gc (such as strings and ints) are dumped
+    when they are referenced, so by default they are written once for
+    each object that refers to them, and the dump has to go through
+    strip_duplicates.py.
+
+    :param dedupe: If True, remember what has been written in a
+        _scanner.SeenObjects, and write every object only once.
+    :param bloom_size: With dedupe, use a Bloom filter of this many bytes
+        rather than an exact set. This bounds the memory used, but may
+        leave out a few objects, see SeenObjects.
+    :param refcounts: If True, write the reference count of every object,
+        and whether gc tracks it. The references held by this function are
+        not counted, so the loader can tell which references come from
+        outside the dump, see ObjManager.compute_external_refs. The
+        references of built-in types, and the containers gc no longer
+        tracks, are dumped as well.
+    :param nodump_refcount: Without dedupe, still write objects with more
+        references than this only once. These are usually shared strings,
+        ints and types, which otherwise take much of the dump.
     """
     if isinstance(outf, basestring):
         opened = True
@@ -90,9 +132,11 @@ def dump_gc_objects(outf, recurse_depth=1):
     nodump = [None, True, False]
     # In current versions of python, these are all pre-cached
     nodump.extend(xrange(-5, 256))
-    nodump.extend([chr(c) for c in xrange(256)])
-    nodump.extend([t for t in types.__dict__.itervalues()
-                      if type(t) is types.TypeType])
+    # Generator expressions, as list comprehensions would leave a reference
+    # to their last item in a local, which refcounts would count
+    nodump.extend(chr(c) for c in xrange(256))
+    nodump.extend(t for t in types.__dict__.itervalues()
+                  if type(t) is types.TypeType)
     nodump.extend([set, dict])
     # Some very common interned strings
     nodump.extend(('__doc__', 'self', 'operator', '__init__', 'codecs',
@@ -100,19 +144,33 @@ def dump_gc_objects(outf, recurse_depth=1):
                    'errors', 'keys', 'None', '__module__', 'file', 'name', '',
                    'sys', 'True', 'False'))
     nodump.extend((BaseException, Exception, StandardError, ValueError))
+    # Some types are in types.__dict__ twice, and dict is added again
+    nodump = _unique(nodump)
+    seen = None
+    if dedupe:
+        seen = _scanner.SeenObjects(bloom_size)
+    elif nodump_refcount is not None:
+        seen = _scanner.SeenObjects(bloom_size, min_refcount=nodump_refcount)
+    # While an object is dumped, the loop holds references to it from 'obj'
+    # and from nodump or all_objs. The objects in nodump that gc tracks are
+    # in all_objs as well, so they are in two lists.
+    refs_held = [None, _refs_held_by_loop(1), _refs_held_by_loop(2)]
     for obj in nodump:
-        _scanner.dump_object_info(outf, obj, nodump=None, recurse_depth=0)
+        _scanner.dump_object_info(outf, obj, nodump=None, recurse_depth=0,
+                                  seen=seen, refcounts=refcounts,
+                                  refs_held=refs_held[1 + gc.is_tracked(obj)])
     # Avoid dumping the all_objs list and this function as well. This helps
     # avoid getting a 'reference everything in existence' problem.
     nodump.append(dump_gc_objects)
     # This currently costs us ~16kB during dumping, but means we won't write
-    # out those objects multiple times in the log file.
-    # TODO: we might want to make nodump a variable-size dict, and add anything
-    #       with ob_refcnt > 1000 or so.
+    # out those objects multiple times in the log file. Other widely shared
+    # objects are handled by nodump_refcount.
     nodump = frozenset(nodump)
     for obj in all_objs:
         _scanner.dump_object_info(outf, obj, nodump=nodump,
-                                  recurse_depth=recurse_depth)
+                                  recurse_depth=recurse_depth, seen=seen,
+                                  refcounts=refcounts,
+                                  refs_held=refs_held[1])
     del all_objs[:]
     if opened:
         outf.close()
@@ -123,9 +181,9 @@ def dump_gc_objects(outf, recurse_depth=1):
 def dump_all_objects(outf):
     """Dump everything that is referenced from gc.get_objects()
 
-    This recurses, and tracks dumped objects in an IDSet. Which means it costs
-    memory, which is often about 10% of currently active memory. Otherwise,
-    this usually results in smaller dump files than dump_gc_objects().
+    This recurses, and tracks dumped objects in an AddressSet. Which means it
+    costs memory, though only about 1-2 bytes per object. Otherwise, this
+    usually results in smaller dump files than dump_gc_objects().
 
     This also can be faster, because it doesn't dump the same item multiple
     times.
@@ -154,7 +212,7 @@ def get_recursive_size(obj):
     total_size = 0
     pending = [obj]
     last_item = 0
-    seen = _intset.IDSet()
+    seen = _intset.AddressSet()
     size_of = _scanner.size_of
     while last_item >= 0:
         item = pending[last_item]
@@ -179,7 +237,7 @@ def get_recursive_items(obj):
     all = []
     pending = [obj]
     last_item = 0
-    seen = _intset.IDSet()
+    seen = _intset.AddressSet()
     while last_item >= 0:
         item = pending[last_item]
         last_item -= 1
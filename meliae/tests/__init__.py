@@ -35,6 +35,8 @@ def test_suite():
         'test__intset',
         'test__loader',
         'test__scanner',
+        'test_disk',
+        'test_files',
         'test_loader',
         'test_perf_counter',
         'test_scanner',
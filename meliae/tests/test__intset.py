@@ -14,7 +14,12 @@
 
 """Test the Set of Integers object."""
 
+import array
+import mmap
+import os
+import struct
 import sys
+import tempfile
 
 from meliae import (
     _intset,
@@ -52,6 +57,15 @@ class TestIntSet(tests.TestCase):
         self.assertTrue(-2 in iset)
         self.assertEqual(2, len(iset))
 
+    def test_singletons_iter(self):
+        iset = self._set_type([-1, 0, 5])
+        self.assertEqual([-1, 0, 5], sorted(iset))
+        self.assertEqual([-1, 0, 5], sorted(iset.to_array()))
+        self.assertEqual([-1], list(iset.difference([0, 5])))
+        self.assertEqual([0], list(iset.intersection([0, 7])))
+        iset.discard(-1)
+        self.assertEqual([0, 5], sorted(iset))
+
     def test_add_not_int(self):
         iset = self._set_type()
         self.assertRaises(TypeError, iset.add, 'foo')
@@ -102,12 +116,157 @@ class TestIntSet(tests.TestCase):
         self.assertFalse(6 in iset)
 
     def test_discard(self):
-        # Not supported yet... KnownFailure
-        pass
+        iset = self._set_type([0, 1, 2, 3, 500])
+        iset.discard(2)
+        iset.discard(4)
+        iset.discard(0)
+        self.assertEqual(3, len(iset))
+        self.assertFalse(2 in iset)
+        self.assertFalse(0 in iset)
+        self.assertTrue(1 in iset)
+        self.assertTrue(500 in iset)
+        iset.add(2)
+        self.assertTrue(2 in iset)
+        self.assertEqual(4, len(iset))
+
+    def test_discard_many(self):
+        # The discarded entries must not fill up the table
+        iset = self._set_type()
+        for i in xrange(1, 10000):
+            iset.add(i)
+            iset.discard(i)
+        self.assertEqual(0, len(iset))
+        self.assertEqual(256, len(iset._peek_array()))
+        for i in xrange(1, 100):
+            iset.add(i)
+        self.assertEqual(range(1, 100), sorted(iset))
 
     def test_remove(self):
-        # Not supported yet... KnownFailure
-        pass
+        iset = self._set_type([1, 2])
+        iset.remove(1)
+        self.assertEqual([2], list(iset))
+        self.assertRaises(KeyError, iset.remove, 1)
+
+    def test__iter__(self):
+        self.assertEqual([], list(self._set_type()))
+        values = [0, 1, 2, 3, 200, 10000]
+        iset = self._set_type(values)
+        self.assertEqual(values, sorted(iset))
+        def change_while_iterating():
+            for value in iset:
+                iset.add(value + 1)
+        self.assertRaises(RuntimeError, change_while_iterating)
+
+    def test_to_array(self):
+        iset = self._set_type([0, 5, 3, 1000])
+        result = iset.to_array()
+        self.assertEqual(iset._typecode, result.typecode)
+        self.assertEqual([0, 3, 5, 1000], sorted(result))
+
+    def test_update(self):
+        iset = self._set_type([1])
+        iset.update([2, 3])
+        iset.update(self._set_type([3, 4]))
+        self.assertEqual([1, 2, 3, 4], sorted(iset))
+
+    def test_update_from_buffer(self):
+        iset = self._set_type()
+        iset.update_from_buffer(array.array(iset._typecode, [1, 2, 5, 1]))
+        self.assertEqual([1, 2, 5], sorted(iset))
+        self.assertRaises(ValueError, iset.update_from_buffer, 'abc')
+
+    def test_union(self):
+        iset = self._set_type([0, 1, 2])
+        result = iset.union(self._set_type([2, 3]))
+        self.assertTrue(isinstance(result, self._set_type))
+        self.assertEqual([0, 1, 2, 3], sorted(result))
+        self.assertEqual([0, 1, 2, 4], sorted(iset.union([4])))
+        self.assertEqual([0, 1, 2], sorted(iset))
+
+    def test_intersection(self):
+        iset = self._set_type([0, 1, 2, 300])
+        result = iset.intersection(self._set_type([0, 2, 4, 300, 301]))
+        self.assertTrue(isinstance(result, self._set_type))
+        self.assertEqual([0, 2, 300], sorted(result))
+        self.assertEqual([1], sorted(iset.intersection([1, 5])))
+        self.assertEqual([], list(iset.intersection(self._set_type())))
+
+    def test_difference(self):
+        iset = self._set_type([0, 1, 2, 300])
+        result = iset.difference(self._set_type([0, 2, 4]))
+        self.assertTrue(isinstance(result, self._set_type))
+        self.assertEqual([1, 300], sorted(result))
+        self.assertEqual([0, 1, 2], sorted(iset.difference([300])))
+
+    def test_to_bytes(self):
+        iset = self._set_type([0, 1, 5, 1000])
+        iset.discard(5)
+        result = self._set_type.from_buffer(iset.to_bytes())
+        self.assertEqual([0, 1, 1000], sorted(result))
+        self.assertFalse(5 in result)
+        empty = self._set_type.from_buffer(self._set_type().to_bytes())
+        self.assertEqual([], list(empty))
+        empty.add(3)
+        self.assertEqual([3], list(empty))
+
+    def test_from_buffer_invalid(self):
+        self.assertRaises(ValueError, self._set_type.from_buffer, 'not a set')
+        data = self._set_type([1, 2]).to_bytes()
+        self.assertRaises(ValueError, self._set_type.from_buffer, data[:-1])
+        word = struct.calcsize('l')
+        header_end = 8 + 6 * word
+        def with_header(idx, value):
+            start = 8 + idx * word
+            return data[:start] + struct.pack('l', value) + data[start+word:]
+        # The mask must be a power of 2 less 1
+        table = data[header_end:header_end + 254 * word]
+        self.assertRaises(ValueError, self._set_type.from_buffer,
+            with_header(3, 253)[:header_end] + table)
+        # There must be room for an empty slot
+        self.assertRaises(ValueError, self._set_type.from_buffer,
+                          with_header(2, 256))
+        self.assertRaises(ValueError, self._set_type.from_buffer,
+                          with_header(5, -1))
+        # The table must hold count values, which is checked when copying
+        self.assertRaises(ValueError, self._set_type.from_buffer,
+                          with_header(2, 3))
+
+    def test_from_buffer_in_place(self):
+        data = bytearray(self._set_type(range(0, 3000, 3)).to_bytes())
+        iset = self._set_type.from_buffer(data, copy=False)
+        empty_size = _scanner.size_of(self._set_type())
+        # The table stays in the bytearray
+        self.assertEqual(empty_size, _scanner.size_of(iset))
+        self.assertTrue(2997 in iset)
+        self.assertEqual(range(0, 3000, 3), sorted(iset))
+        # Changing the set copies the table
+        iset.add(1)
+        iset.discard(0)
+        self.assertTrue(_scanner.size_of(iset) > empty_size)
+        self.assertEqual([1] + range(3, 3000, 3), sorted(iset))
+        original = self._set_type.from_buffer(data)
+        self.assertTrue(0 in original)
+        self.assertFalse(1 in original)
+        # The bytearray can't be resized while the set uses it
+        iset = self._set_type.from_buffer(data, copy=False)
+        self.assertRaises(BufferError, data.extend, 'x' * 100000)
+        iset.add(1)
+        data.extend('x')
+
+    def test_from_buffer_mmap(self):
+        fd, path = tempfile.mkstemp(prefix='meliae-')
+        self.addCleanup(os.remove, path)
+        f = os.fdopen(fd, 'wb+')
+        self.addCleanup(f.close)
+        f.write(self._set_type(range(0, 3000, 3)).to_bytes())
+        f.flush()
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        iset = self._set_type.from_buffer(buf, copy=False)
+        # Nothing stops an mmap from being closed, so the table is copied
+        buf.close()
+        self.assertTrue(2997 in iset)
+        self.assertFalse(1 in iset)
+        self.assertEqual(range(0, 3000, 3), sorted(iset))
 
     def assertSizeOf(self, num_words, obj, extra_size=0, has_gc=True):
         expected_size = extra_size + num_words * _scanner._word_size
@@ -129,14 +288,15 @@ class TestIntSet(tests.TestCase):
         # 4: _count
         # 5: _mask
         # 6: _array
-        # 4-byte int _has_singleton
+        # 7: _buffer_owner
+        # 4-byte int _has_singleton, _dummies
         # However, most compliers will align the struct based on the width of
         # the largest entry. So while we could put 2 4-byte ints into the
         # struct, it will waste 4-bytes anyway.
-        self.assertSizeOf(7, iset, has_gc=False)
+        self.assertSizeOf(8, iset, has_gc=False)
         iset.add(12345)
         # Min allocation is 256 entries
-        self.assertSizeOf(7+256, iset, has_gc=False)
+        self.assertSizeOf(8+256, iset, has_gc=False)
 
 
 class TestIDSet(TestIntSet):
@@ -154,8 +314,125 @@ class TestIDSet(TestIntSet):
         self.assertFalse(bigint in iset)
         iset.add(bigint)
         self.assertTrue(bigint in iset)
+        self.assertEqual([bigint], list(iset))
+        self.assertEqual([bigint], list(iset.to_array()))
+        iset.discard(bigint)
+        self.assertFalse(bigint in iset)
+
+    def test_singletons(self):
+        iset = self._set_type([0])
+        self.assertEqual([0], list(iset))
+        iset.discard(0)
+        self.assertEqual(0, len(iset))
+
+    def test_singletons_iter(self):
+        pass
+
+    def test_from_buffer_kind(self):
+        data = _intset.IntSet([1, 2]).to_bytes()
+        self.assertRaises(ValueError, self._set_type.from_buffer, data)
 
     def test_add_singletons(self):
         pass
         # Negative values cannot be checked in IDSet, because we cast them to
         # unsigned long first.
+
+
+class TestAddressSet(TestIDSet):
+
+    _set_type = _intset.AddressSet
+
+    # AddressSet is not serialized
+    def test_to_bytes(self):
+        pass
+
+    def test_from_buffer_invalid(self):
+        pass
+
+    def test_from_buffer_in_place(self):
+        pass
+
+    def test_from_buffer_mmap(self):
+        pass
+
+    def test_from_buffer_kind(self):
+        pass
+
+    def test_discard_many(self):
+        iset = self._set_type()
+        for i in xrange(1, 10000):
+            iset.add(i * 8)
+            iset.discard(i * 8)
+        self.assertEqual(0, len(iset))
+        self.assertEqual([], list(iset))
+
+    def test_aligned_and_unaligned(self):
+        base = 0x7f0000000000
+        values = [base + 8, base + 16, base + 8 * 70000, base + 3, 12]
+        aset = self._set_type(values)
+        self.assertEqual(5, len(aset))
+        for value in values:
+            self.assertTrue(value in aset)
+        self.assertFalse(base in aset)
+        self.assertFalse(base + 24 in aset)
+        self.assertFalse(base + 4 in aset)
+        # The aligned and unaligned values are merged in sorted order
+        self.assertEqual(sorted(values), list(aset))
+        self.assertEqual(sorted(values), list(aset.to_array()))
+
+    def test_sorted_mixed(self):
+        self.assertEqual([3, 5, 8, 16], list(self._set_type([16, 8, 3, 5])))
+        self.assertEqual([3, 5, 8, 16],
+                         list(self._set_type([16, 8, 3, 5]).to_array()))
+        # Including a bitmap container, and unaligned values before, between
+        # and after the aligned ones
+        values = range(0, 80000, 8) + [1, 4, 8001, 79997, 80001, 1 << 40 | 5]
+        aset = self._set_type(reversed(values))
+        self.assertEqual(sorted(values), list(aset))
+        self.assertEqual(sorted(values), list(aset.to_array()))
+        self.assertEqual([], list(self._set_type([])))
+        self.assertEqual([7], list(self._set_type([7]).to_array()))
+
+    def test_dense_container(self):
+        # A container with many values switches to a bitmap, and back
+        aset = self._set_type()
+        for i in xrange(10000):
+            aset.add(i * 8)
+        self.assertEqual(10000, len(aset))
+        self.assertEqual(range(0, 80000, 8), list(aset))
+        self.assertEqual(range(0, 80000, 8), list(aset.to_array()))
+        for i in xrange(0, 10000, 2):
+            aset.discard(i * 8)
+        self.assertEqual(range(8, 80000, 16), list(aset))
+        for i in xrange(1, 10000, 2):
+            aset.discard(i * 8)
+        self.assertEqual([], list(aset))
+
+    def test__sizeof__(self):
+        aset = self._set_type()
+        empty_size = _scanner.size_of(aset)
+        for i in xrange(1000):
+            aset.add(0x7f0000000000 + i * 16)
+        # 1000 values in one container take 2 bytes each
+        self.assertTrue(_scanner.size_of(aset) - empty_size < 4000)
+
+
+class TestFilterNewLines(tests.TestCase):
+
+    def test_filter_new_lines(self):
+        seen = _intset.AddressSet([32])
+        block = ('[\n'
+                 '{"address": 16, "type": "int"}\n'
+                 '{"address": 32, "type": "str"}\n'
+                 '{"address": 17, "type": "int"}\n'
+                 '{"address": 16, "type": "int"}\n'
+                 '{"address": x}\n'
+                 '{"address": 24, "type": "int"}')
+        self.assertEqual(('{"address": 16, "type": "int"}\n'
+                          '{"address": 17, "type": "int"}\n'
+                          '{"address": 24, "type": "int"}', 7, 3),
+                         _intset.filter_new_lines(seen, block))
+        self.assertEqual([16, 17, 24, 32], list(seen))
+        self.assertEqual(('', 1, 0),
+                         _intset.filter_new_lines(seen, '{"address": 16}\n'))
+        self.assertEqual(('', 0, 0), _intset.filter_new_lines(seen, ''))
@@ -14,6 +14,8 @@
 
 """Pyrex extension for tracking loaded objects"""
 
+import array
+
 from meliae import (
     _loader,
     _scanner,
@@ -29,7 +31,7 @@ from meliae import (
 # 3 4-byte int attributes
 # Note that on 64-bit platforms, alignment issues mean we will still
 # round to a multiple-of-8 bytes.
-_memobj_extra_size = 3*4
+_memobj_extra_size = 4*4
 if (_memobj_extra_size % _scanner._word_size) != 0:
     _memobj_extra_size += (_scanner._word_size
                            - (_memobj_extra_size % _scanner._word_size))
@@ -217,10 +219,19 @@ class TestMemObjectCollection(tests.TestCase):
         # 2: refcnt
         # 3: vtable*
         # 4: _table*
-        # 3 4-byte int attributes
+        # 5: _type_index*
+        # 6: _type_lists*
+        # 7: long _num_types
+        # 8: long _alloc_types
+        # 9: long _max_parents
+        # 10: _refcnts*
+        # 11: _dominators*
+        # 12: _type_prev*
+        # 13: _type_next*
+        # 4 4-byte int attributes
         # Note that on 64-bit platforms, alignment issues mean we will still
         # round to a multiple-of-8 bytes.
-        self.assertSizeOf(4+1024, moc, extra_size=_memobj_extra_size,
+        self.assertSizeOf(13+1024, moc, extra_size=_memobj_extra_size,
                           has_gc=False)
 
     def test__sizeof__one_item(self):
@@ -233,10 +244,11 @@ class TestMemObjectCollection(tests.TestCase):
         # 4: *child_list
         # 5: *value
         # 6: *parent_list
-        # 7: ulong total_size
-        # 8: *proxy
+        # 7: long total_parents
+        # 8: ulong total_size
+        # 9: *proxy
         moc.add(0, 'foo', 100)
-        self.assertSizeOf(4+1024+8, moc, extra_size=_memobj_extra_size,
+        self.assertSizeOf(13+1024+9, moc, extra_size=_memobj_extra_size,
                           has_gc=False)
 
     def test__sizeof__with_reflists(self):
@@ -245,7 +257,7 @@ class TestMemObjectCollection(tests.TestCase):
         # ref-list allocates the number of entries + 1
         # Each _memobject also takes up
         moc.add(0, 'foo', 100, children=[1234], parent_list=[3456, 7890])
-        self.assertSizeOf(4+1024+8+2+3, moc, extra_size=_memobj_extra_size,
+        self.assertSizeOf(13+1024+9+2+3, moc, extra_size=_memobj_extra_size,
                           has_gc=False)
 
     def test__sizeof__with_dummy(self):
@@ -253,8 +265,547 @@ class TestMemObjectCollection(tests.TestCase):
         moc.add(0, 'foo', 100, children=[1234], parent_list=[3456, 7890])
         moc.add(1, 'foo', 100, children=[1234], parent_list=[3456, 7890])
         del moc[1]
-        self.assertSizeOf(4+1024+8+2+3, moc, extra_size=_memobj_extra_size,
+        self.assertSizeOf(13+1024+9+2+3, moc, extra_size=_memobj_extra_size,
+                          has_gc=False)
+
+    def test__sizeof__side_arrays(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(0, 'foo', 100, refcnt=2, gc_tracked=True)
+        # The refcnts take a word per slot
+        self.assertSizeOf(13+1024+9+1024, moc, extra_size=_memobj_extra_size,
                           has_gc=False)
+        # Looking up by type adds 2 words per slot, and the first 16 type
+        # lists of 2 words each
+        moc.count_type('foo')
+        self.assertSizeOf(13+1024+9+1024+2048+32, moc,
+                          extra_size=_memobj_extra_size, has_gc=False)
+
+    def test_side_arrays_follow_resize(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'foo', 10, children=[2], refcnt=1, gc_tracked=True)
+        moc.add(2, 'bar', 10, children=[3])
+        moc.add(3, 'foo', 10, refcnt=2, gc_tracked=False)
+        moc.compute_dominators()
+        self.assertEqual([1, 3], sorted(moc.addresses_of_type('foo')))
+        # Growing the table moves everything to new slots
+        for address in xrange(4, 2004):
+            moc.add(address, 'foo', 1, refcnt=address)
+        for address in xrange(4, 1004):
+            del moc[address]
+        self.assertEqual(1002, moc.count_type('foo'))
+        self.assertEqual([1, 3] + range(1004, 2004),
+                         sorted(moc.addresses_of_type('foo')))
+        self.assertEqual([2], moc.addresses_of_type('bar'))
+        self.assertEqual(1, moc[1].refcnt)
+        self.assertTrue(moc[1].gc_tracked)
+        self.assertEqual(2, moc[3].refcnt)
+        self.assertFalse(moc[3].gc_tracked)
+        self.assertEqual(None, moc[2].refcnt)
+        self.assertEqual(1500, moc[1500].refcnt)
+        self.assertEqual(1, moc[2].immediate_dominator)
+        self.assertEqual(2, moc[3].immediate_dominator)
+        self.assertEqual(None, moc[1500].immediate_dominator)
+
+    def test_refcnt_after_delete(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'foo', 10, refcnt=3, gc_tracked=True)
+        mop = moc[1]
+        del moc[1]
+        # The proxy keeps the refcnt, and the slot doesn't leak it to the
+        # next object put there
+        self.assertEqual(3, mop.refcnt)
+        self.assertTrue(mop.gc_tracked)
+        moc.add(1, 'foo', 10)
+        self.assertEqual(None, moc[1].refcnt)
+
+    def test_compute_parents(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'tuple', 20, children=[2, 3])
+        moc.add(2, 'list', 44, children=[2, 3, 3, 999])
+        moc.add(3, 'int', 12)
+        moc.compute_parents()
+        self.assertEqual((), moc[1].parents)
+        self.assertEqual([1, 2], moc[2].parents)
+        # 2 refers to 3 twice, but only shows up once
+        self.assertEqual([1, 2], moc[3].parents)
+        self.assertEqual(2, moc[3].total_parents)
+
+    def test_compute_parents_replaces_existing(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'tuple', 20, children=[2])
+        moc.add(2, 'int', 12, parent_list=[5, 6, 7])
+        moc.add(3, 'int', 12, parent_list=[5])
+        moc.compute_parents()
+        self.assertEqual([1], moc[2].parents)
+        self.assertEqual((), moc[3].parents)
+        self.assertEqual(0, moc[3].total_parents)
+
+    def test_compute_parents_max_parents(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'str', 25)
+        for i in xrange(2, 12):
+            moc.add(i, 'tuple', 20, children=[1, 1])
+        moc.compute_parents(max_parents=3)
+        self.assertEqual(3, moc[1].num_parents)
+        self.assertEqual(10, moc[1].total_parents)
+        moc.compute_parents()
+        self.assertEqual(10, moc[1].num_parents)
+        self.assertEqual(range(2, 12), sorted(moc[1].parents))
+
+    def test_refcnt(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'list', 44, refcnt=3, gc_tracked=True)
+        moc.add(2, 'str', 25, refcnt=0, gc_tracked=False)
+        moc.add(3, 'int', 12)
+        self.assertEqual((3, True), (moc[1].refcnt, moc[1].gc_tracked))
+        self.assertEqual((0, False), (moc[2].refcnt, moc[2].gc_tracked))
+        self.assertEqual((None, None), (moc[3].refcnt, moc[3].gc_tracked))
+        self.assertEqual('{"address": 2, "type": "str", "size": 25,'
+                         ' "refs": [], "refcnt": 0, "gc": false}',
+                         moc[2].to_json())
+
+    def test_compute_external_refs(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'list', 44, children=[3, 3, 4, 999], refcnt=1)
+        moc.add(2, 'tuple', 28, children=[3], refcnt=5)
+        moc.add(3, 'str', 25, refcnt=6)
+        moc.add(4, 'str', 25, refcnt=1)
+        moc.add(5, 'int', 12)
+        # Both of 1's references to 3 count
+        self.assertEqual([(5, moc[2]), (3, moc[3]), (1, moc[1])],
+                         moc.compute_external_refs())
+        self.assertEqual([(5, moc[2])], moc.compute_external_refs(4))
+
+    def assertDominators(self, expected, moc):
+        moc.compute_dominators()
+        actual = dict((obj.address, (obj.immediate_dominator, obj.total_size))
+                      for obj in moc.itervalues())
+        self.assertEqual(expected, actual)
+
+    def test_compute_dominators(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'tuple', 20, children=[2, 3])
+        moc.add(2, 'dict', 100, children=[4, 5])
+        moc.add(3, 'list', 40, children=[3, 4, 999])
+        moc.add(4, 'int', 12)
+        moc.add(5, 'str', 30)
+        moc.add(6, 'module', 50, children=[2])
+        # 2 is reachable from both roots, and 4 from both 2 and 3
+        self.assertDominators({1: (None, 60), 2: (None, 130), 3: (1, 40),
+                               4: (None, 12), 5: (2, 30), 6: (None, 50)}, moc)
+
+    def test_compute_dominators_chain(self):
+        moc = _loader.MemObjectCollection()
+        for i in xrange(1, 2000):
+            moc.add(i, 'node', 1, children=[i + 1])
+        moc.add(2000, 'node', 1)
+        moc.compute_dominators()
+        self.assertEqual(None, moc[1].immediate_dominator)
+        self.assertEqual(2000, moc[1].total_size)
+        self.assertEqual(1500, moc[1501].immediate_dominator)
+        self.assertEqual(500, moc[1501].total_size)
+
+    def test_compute_dominators_unreferenced_cycle(self):
+        moc = _loader.MemObjectCollection()
+        # Nothing refers to this cycle from the outside, so the synthetic
+        # root refers to the first member we find
+        moc.add(1, 'a', 10, children=[2])
+        moc.add(2, 'b', 20, children=[3, 1])
+        moc.add(3, 'c', 30)
+        self.assertDominators({1: (None, 60), 2: (1, 50), 3: (2, 30)}, moc)
+
+    def test_compute_reachable_sizes(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'tuple', 1, children=[2, 3])
+        moc.add(2, 'list', 2, children=[4, 5])
+        moc.add(3, 'list', 4, children=[4])
+        moc.add(4, 'dict', 8, children=[6, 999])
+        moc.add(5, 'str', 16)
+        # 6 and 7 form a cycle
+        moc.add(6, 'a', 32, children=[7])
+        moc.add(7, 'b', 64, children=[6])
+        self.assertEqual(6, moc.compute_reachable_sizes())
+        expected = {}
+        for obj in moc.itervalues():
+            expected[obj.address] = obj.compute_total_size()
+            obj.total_size = 0
+        moc.compute_reachable_sizes()
+        self.assertEqual(expected, dict((obj.address, obj.total_size)
+                                        for obj in moc.itervalues()))
+        self.assertEqual(127, moc[1].total_size)
+        self.assertEqual(96, moc[6].total_size)
+
+    def test_compute_reachable_sizes_approximate(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'root', 10, children=range(100, 200))
+        moc.add(2, 'root', 10, children=range(100, 200))
+        for i in xrange(100, 200):
+            moc.add(i, 'leaf', 100)
+        moc.compute_reachable_sizes(approximate=True, num_registers=256)
+        # Leaves are counted exactly, the shared part is an estimate
+        self.assertEqual(100, moc[100].total_size)
+        self.assertTrue(8000 < moc[1].total_size < 12000,
+                        moc[1].total_size)
+        self.assertRaises(ValueError, moc.compute_reachable_sizes,
+                          approximate=True, num_registers=1)
+
+    def test_compute_reachable_sizes_approximate_reuses_sketches(self):
+        # A binary tree has many sketches alive at once, and trees are
+        # still summed exactly
+        moc = _loader.MemObjectCollection()
+        for i in xrange(1, 2000):
+            children = [c for c in (2 * i, 2 * i + 1) if c < 2000]
+            moc.add(i, 'node', i, children=children)
+        # And all of these are alive until 2000 merges them
+        moc.add(2000, 'wide', 1, children=range(2001, 2300))
+        for i in xrange(2001, 2300):
+            moc.add(i, 'leaf', i)
+        moc.compute_reachable_sizes(approximate=True)
+        approx = dict((obj.address, obj.total_size)
+                      for obj in moc.itervalues())
+        moc.compute_reachable_sizes()
+        self.assertEqual(dict((obj.address, obj.total_size)
+                              for obj in moc.itervalues()), approx)
+
+    def test_largest_total_size(self):
+        moc = _loader.MemObjectCollection()
+        for i in xrange(100):
+            moc.add(i, 'foo', 1, total_size=(i * 37) % 100)
+        self.assertEqual([99, 98, 97],
+            [obj.total_size for obj in moc.largest_total_size(3)])
+        self.assertEqual(100, len(moc.largest_total_size(200)))
+        self.assertEqual([], moc.largest_total_size(0))
+
+    def test_summarize_by_type(self):
+        moc = _loader.MemObjectCollection()
+        self.assertEqual([], moc.summarize_by_type())
+        moc.add(1, 'str', 30)
+        moc.add(2, 'int', 12)
+        moc.add(3, 'str', 40)
+        moc.add(4, 'str', 40)
+        moc.add(5, 'NoneType', 0)
+        self.assertEqual([('NoneType', 1, 0, 0.0, 0, 5),
+                          ('int', 1, 12, 144.0, 12, 2),
+                          ('str', 3, 110, 4100.0, 40, 3),
+                         ], sorted(moc.summarize_by_type()))
+
+    def test_addresses_of_type(self):
+        moc = _loader.MemObjectCollection()
+        self.assertEqual([], moc.addresses_of_type('str'))
+        moc.add(1, 'str', 30)
+        moc.add(2, 'int', 12)
+        moc.add(3, 'str', 40)
+        self.assertEqual([1, 3], sorted(moc.addresses_of_type('str')))
+        self.assertEqual([2], moc.addresses_of_type('int'))
+        self.assertEqual(2, moc.count_type('str'))
+        self.assertEqual(0, moc.count_type('dict'))
+        self.assertEqual(['int', 'str'], sorted(moc.type_strs()))
+
+    def test_addresses_of_type_after_delete(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'str', 30)
+        moc.add(2, 'int', 12)
+        moc.add(3, 'str', 40)
+        moc.add(4, 'str', 40)
+        del moc[3]
+        self.assertEqual([1, 4], sorted(moc.addresses_of_type('str')))
+        del moc[2]
+        self.assertEqual([], moc.addresses_of_type('int'))
+        self.assertEqual(['str'], moc.type_strs())
+        moc.add(2, 'int', 12)
+        self.assertEqual([2], moc.addresses_of_type('int'))
+
+    def test_values_of_type_after_set_type_str(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'instance', 30)
+        moc.add(2, 'instance', 30)
+        moc[1].type_str = 'MyClass'
+        self.assertEqual([2], moc.addresses_of_type('instance'))
+        objs = moc.values_of_type('MyClass')
+        self.assertEqual([1], [o.address for o in objs])
+        self.assertTrue(objs[0] is moc[1])
+        # A proxy that no longer belongs to the collection doesn't change it
+        mop = moc[2]
+        del moc[2]
+        mop.type_str = 'MyClass'
+        self.assertEqual([1], moc.addresses_of_type('MyClass'))
+        self.assertEqual([], moc.addresses_of_type('instance'))
+
+    def test_path_to_root(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'module', 60, children=[2])
+        moc.add(2, 'dict', 140, children=[3, 4])
+        moc.add(3, 'list', 40, children=[5])
+        moc.add(4, 'tuple', 40, children=[5])
+        moc.add(5, 'str', 30)
+        moc.add(6, 'tuple', 40, children=[5])
+        moc.add(7, 'tuple', 40, children=[6])
+        moc.compute_parents()
+        self.assertEqual([[5, 6, 7]], moc.path_to_root(5, k=1))
+        paths = moc.path_to_root(5)
+        self.assertEqual(2, len(paths))
+        self.assertEqual([5, 6, 7], paths[0])
+        self.assertTrue(paths[1] in ([5, 3, 2, 1], [5, 4, 2, 1]))
+        self.assertEqual([[1]], moc.path_to_root(1))
+        self.assertRaises(KeyError, moc.path_to_root, 10)
+
+    def test_path_to_root_skips_types(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'module', 60, children=[2])
+        moc.add(2, 'type', 400, children=[3])
+        moc.add(3, 'str', 30)
+        moc.add(4, 'frame', 400, children=[3])
+        moc.compute_parents()
+        self.assertEqual([], moc.path_to_root(3))
+        self.assertEqual([[3, 4], [3, 2, 1]],
+                         moc.path_to_root(3, skip_types=()))
+
+    def test_remove_expensive_references(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(0, '<ex-reference>', 0)
+        moc.add(1, 'module', 60, children=[2])
+        moc.add(2, 'dict', 140, children=[1, 3, 4])
+        moc.add(3, 'str', 30)
+        moc.add(4, 'type', 400, children=[2])
+        moc.add(5, 'function', 60, children=[6, 2, 1, 7])
+        moc.add(6, 'code', 80)
+        moc.add(7, 'tuple', 28, children=[4])
+        moc.add(8, '_LRUNode', 40, children=[9, 3])
+        moc.add(9, '_LRUNode', 40, children=[8, 3])
+        moc.add(10, 'function', 60, children=[6, 2, 1, 4])
+        self.assertEqual(6, moc.remove_expensive_references())
+        self.assertEqual([2], moc[1].children)
+        self.assertEqual([3, 0], moc[2].children)
+        self.assertEqual([2], moc[4].children)
+        # func_globals and func_module are removed
+        self.assertEqual([6, 7, 0], moc[5].children)
+        self.assertEqual([0], moc[7].children)
+        # Only the sideways references of _LRUNodes are removed
+        self.assertEqual([3], moc[8].children)
+        self.assertEqual([3], moc[9].children)
+        # Like loader.remove_expensive_references, functions keep their
+        # other references to types
+        self.assertEqual([6, 4, 0], moc[10].children)
+
+    def test_prune_edges(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'Registry', 60, children=[2, 3, 4])
+        moc.add(2, 'dict', 140, children=[1, 3, 5])
+        moc.add(3, 'Session', 100, children=[4, 1])
+        moc.add(4, 'Session', 100, children=[3, 5])
+        moc.add(5, 'str', 30)
+        moc.add(6, 'list', 44, children=[1, 5, 1])
+        self.assertEqual(0, moc.prune_edges())
+        self.assertEqual(0, moc.prune_edges(('NotAType',), {'NoType': (0,)},
+                                            ('NoType',)))
+        self.assertEqual(4, moc.prune_edges(into_types=('Registry',),
+                                            slots={'dict': (2, 5)},
+                                            sideways_types=('Session',)))
+        self.assertEqual([2, 3, 4], moc[1].children)
+        # Types with slots or sideways rules keep references into Registry
+        self.assertEqual([1, 3, 0], moc[2].children)
+        # Sideways references are just removed
+        self.assertEqual([1], moc[3].children)
+        self.assertEqual([5], moc[4].children)
+        self.assertEqual([5, 0], moc[6].children)
+
+    def test_collapse_instance_dicts(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'MyClass', 32, children=[2, 3])
+        moc.add(2, 'dict', 140, children=[4, 1])
+        moc.add(3, 'type', 452, children=[])
+        moc.add(4, 'str', 25, children=[])
+        moc.add(5, 'instance', 36, children=[6, 7])
+        moc.add(6, 'classobj', 48, name='OldStyle')
+        moc.add(7, 'dict', 140, children=[4, 8])
+        moc.add(8, 'int', 12)
+        moc.add(9, 'module', 28, children=[10])
+        moc.add(10, 'dict', 140, children=[4, 3])
+        moc.add(11, 'MyClass', 32, children=[4, 3])
+        moc.compute_parents()
+        self.assertEqual(3, moc.collapse_instance_dicts(('type',),
+                                                        update_parents=True))
+        self.assertEqual(8, len(moc))
+        self.assertEqual([4, 1, 3], moc[1].children)
+        self.assertEqual(172, moc[1].size)
+        self.assertEqual('OldStyle', moc[5].type_str)
+        self.assertEqual([4, 8, 6], moc[5].children)
+        self.assertEqual([5], moc.addresses_of_type('OldStyle'))
+        self.assertEqual([4, 3], moc[9].children)
+        self.assertEqual([4, 3], moc[11].children)
+        self.assertEqual([1, 5, 9, 11], sorted(moc[4].parents))
+        self.assertEqual(4, moc[4].total_parents)
+        self.assertEqual([1], moc[1].parents)
+        self.assertEqual([5], moc[8].parents)
+        self.assertEqual([1, 9, 11], sorted(moc[3].parents))
+
+    def test_maintain_parents(self):
+        moc = _loader.MemObjectCollection()
+        self.assertFalse(moc.maintain_parents)
+        moc.add(1, 'tuple', 20, children=[2, 3])
+        moc.add(2, 'list', 44, children=[2, 3, 3])
+        moc.add(3, 'int', 12)
+        moc.add(4, 'int', 12)
+        moc.compute_parents()
+        moc.maintain_parents = True
+        moc[1].children = [3, 4, 4]
+        self.assertEqual([2], moc[2].parents)
+        self.assertEqual([1, 2], sorted(moc[3].parents))
+        self.assertEqual([1], moc[4].parents)
+        moc.add(5, 'tuple', 20, children=[4, 5, 999])
+        self.assertEqual([1, 5], sorted(moc[4].parents))
+        self.assertEqual([5], moc[5].parents)
+        del moc[2]
+        self.assertEqual([1], moc[3].parents)
+        self.assertEqual(1, moc[3].total_parents)
+        moc.prune_edges(into_types=('int',))
+        self.assertEqual([0], moc[1].children)
+        self.assertEqual((), moc[3].parents)
+        self.assertEqual((), moc[4].parents)
+        self.assertEqual(0, moc[4].total_parents)
+        self.assertEqual([5], moc[5].parents)
+
+    def test_maintain_parents_prune_edges(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(0, '<ex-reference>', 0)
+        moc.add(1, 'function', 60, children=[2, 3, 2, 4])
+        moc.add(2, 'code', 80)
+        moc.add(3, 'dict', 140, children=[4])
+        moc.add(4, 'module', 60)
+        moc.add(5, 'list', 44, children=[4, 4, 0])
+        moc.compute_parents()
+        moc.maintain_parents = True
+        self.assertEqual(3, moc.prune_edges(into_types=('module',),
+                                            slots={'function': (2, 3)}))
+        self.assertEqual([2, 3, 0], moc[1].children)
+        # 2 is still referenced by the first slot
+        self.assertEqual([1], moc[2].parents)
+        self.assertEqual([1], moc[3].parents)
+        self.assertEqual([0], moc[3].children)
+        self.assertEqual((), moc[4].parents)
+        self.assertEqual(0, moc[4].total_parents)
+        self.assertEqual([0, 0], moc[5].children)
+        self.assertEqual([1, 3, 5], sorted(moc[0].parents))
+        self.assertEqual(3, moc[0].total_parents)
+        self.assertEqual(0, moc.prune_edges(into_types=('module',),
+                                            slots={'function': (3,)}))
+
+    def test_maintain_parents_max_parents(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'int', 12)
+        for address in range(2, 6):
+            moc.add(address, 'tuple', 20, children=[1])
+        moc.compute_parents(max_parents=2)
+        moc.maintain_parents = True
+        self.assertEqual([2, 3], moc[1].parents)
+        self.assertEqual(4, moc[1].total_parents)
+        moc.add(6, 'tuple', 20, children=[1])
+        self.assertEqual([2, 3], moc[1].parents)
+        self.assertEqual(5, moc[1].total_parents)
+        moc[5].children = []
+        self.assertEqual(4, moc[1].total_parents)
+        del moc[2]
+        self.assertEqual([3], moc[1].parents)
+        self.assertEqual(3, moc[1].total_parents)
+
+    def test_maintain_parents_collapse_shared_dict(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'module', 60, children=[3])
+        moc.add(2, 'module', 60, children=[3])
+        moc.add(3, 'dict', 140, children=[4, 5, 4])
+        moc.add(4, 'str', 30)
+        moc.add(5, 'tuple', 20, children=[4])
+        moc.add(6, 'tuple', 20, children=[5])
+        moc.compute_parents(max_parents=1)
+        moc.maintain_parents = True
+        self.assertEqual(2, moc.collapse_instance_dicts())
+        self.assertEqual([4, 5, 4], moc[1].children)
+        self.assertEqual([4, 5, 4], moc[2].children)
+        self.assertEqual(3, moc[4].total_parents)
+        self.assertEqual(3, moc[5].total_parents)
+
+    def test_find_duplicate_values(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'str', 30, value='foo')
+        moc.add(2, 'str', 30, value='foo')
+        moc.add(3, 'str', 30, value='bar')
+        moc.add(4, 'int', 12, value=10)
+        moc.add(5, 'int', 12, value=10)
+        moc.add(6, 'int', 12, value=10)
+        moc.add(7, 'dict', 140, value='foo')
+        # Only the start of long strings is recorded, so a different size
+        # means a different string
+        moc.add(8, 'str', 500, value='foo')
+        moc.add(9, 'list', 40, children=[1, 2])
+        moc.compute_parents()
+        result = sorted(moc.find_duplicate_values())
+        self.assertEqual(2, len(result))
+        (int_info, str_info) = result
+        self.assertEqual(('int', 10, 12, 3), int_info[:4])
+        self.assertEqual([4, 5, 6], sorted(int_info[4]))
+        self.assertEqual([], int_info[5])
+        self.assertEqual(('str', 'foo', 30, 2), str_info[:4])
+        self.assertEqual([1, 2], sorted(str_info[4]))
+        self.assertEqual([9], str_info[5])
+
+    def test_find_duplicate_values_max_samples(self):
+        moc = _loader.MemObjectCollection()
+        for i in range(1, 11):
+            moc.add(i, 'str', 30, value='foo')
+        (info,) = moc.find_duplicate_values(('str',), max_samples=3)
+        self.assertEqual(10, info[3])
+        self.assertEqual(3, len(info[4]))
+        self.assertEqual([], moc.find_duplicate_values(('unicode',)))
+
+    def make_raw_collection(self):
+        moc = _loader.MemObjectCollection()
+        moc.add(1, 'tuple', 20, children=[2, 3])
+        moc.add(2, 'list', 44, children=[2, 3, 3, 999])
+        moc.add(3, 'str', 30, value='foo')
+        return moc
+
+    def test_iter_raw(self):
+        moc = self.make_raw_collection()
+        self.assertEqual([(1, 'tuple', 20), (2, 'list', 44), (3, 'str', 30)],
+                         sorted(moc.iter_raw()))
+        moc.compute_parents()
+        self.assertEqual([(1, None, 2, 0), (2, None, 4, 2), (3, 'foo', 0, 2)],
+                         sorted(moc.iter_raw(('address', 'value',
+                                              'num_children', 'num_parents'))))
+        self.assertRaises(ValueError, moc.iter_raw, ('foo',))
+
+    def test_iter_raw_batches(self):
+        moc = self.make_raw_collection()
+        batches = list(moc.iter_raw(('address', 'size'), batch_size=2))
+        self.assertEqual(2, len(batches))
+        self.assertEqual([2, 1], [len(b[0]) for b in batches])
+        addresses = []
+        sizes = []
+        for batch_addresses, batch_sizes in batches:
+            self.assertEqual('L', batch_addresses.typecode)
+            addresses.extend(batch_addresses)
+            sizes.extend(batch_sizes)
+        self.assertEqual([(1, 20), (2, 44), (3, 30)],
+                         sorted(zip(addresses, sizes)))
+        self.assertRaises(ValueError, moc.iter_raw, ('type_str',),
+                          batch_size=10)
+
+    def test_iter_raw_changed_size(self):
+        moc = self.make_raw_collection()
+        iterator = moc.iter_raw()
+        iterator.next()
+        moc.add(4, 'int', 12)
+        self.assertRaises(RuntimeError, iterator.next)
+
+    def test_iter_edges(self):
+        moc = self.make_raw_collection()
+        batches = list(moc.iter_edges(batch_size=4))
+        self.assertEqual([4, 2], [len(b[0]) for b in batches])
+        edges = []
+        for parents, children in batches:
+            edges.extend(zip(parents, children))
+        self.assertEqual([(1, 2), (1, 3), (2, 2), (2, 3), (2, 3), (2, 999)],
+                         sorted(edges))
 
     def test_traverse_empty(self):
         # With nothing present, we return no referents
@@ -473,6 +1024,14 @@ class Test_MemObjectProxy(tests.TestCase):
         self.assertEqual(1, mop255.num_parents)
         self.assertEqual([1234567], mop255.parents)
 
+    def test_total_parents(self):
+        mop = self.moc[0]
+        self.assertEqual(0, mop.total_parents)
+        mop.parents = [1, 2, 3]
+        self.assertEqual(3, mop.total_parents)
+        mop.parents = []
+        self.assertEqual(0, mop.total_parents)
+
     def test_p(self):
         mop = self.moc.add(1234567, 'type', 256, children=[0, 255])
         mop0 = self.moc[0]
@@ -586,8 +1145,33 @@ class Test_MemObjectProxy(tests.TestCase):
         # 3: collection*
         # 4: _MemObject*
         # 5: _managed_obj *
+        # 6: long _refcnt
         # No vtable because we have no cdef functions
-        self.assertSizeOf(5, mop, has_gc=True)
+        self.assertSizeOf(6, mop, has_gc=True)
+
+    def test_free_list(self):
+        old_size = _loader.set_proxy_free_list_size(10)
+        self.addCleanup(_loader.set_proxy_free_list_size, old_size)
+        moc = _loader.MemObjectCollection()
+        for i in range(20):
+            moc.add(i, 'int', 12, value=i)
+        proxies = moc.values()
+        del proxies
+        self.assertEqual(10, _loader._proxy_free_list_length())
+        # New proxies reuse the memory, but are otherwise fresh
+        for i in range(20):
+            self.assertEqual(i, moc[i].value)
+            self.assertTrue(moc[i] is moc[i])
+        mop = moc[5]
+        del moc[5]
+        self.assertEqual(5, mop.value)
+        self.assertEqual(_loader.set_proxy_free_list_size(2), 10)
+        self.assertTrue(_loader._proxy_free_list_length() <= 2)
+        _loader.set_proxy_free_list_size(0)
+        self.assertEqual(0, _loader._proxy_free_list_length())
+        del mop
+        self.assertEqual(0, _loader._proxy_free_list_length())
+        self.assertRaises(ValueError, _loader.set_proxy_free_list_size, -1)
 
     def test__sizeof__managed(self):
         mop = self.moc[0]
@@ -600,9 +1184,10 @@ class Test_MemObjectProxy(tests.TestCase):
         # 4: RefList *child_list
         # 5: PyObject *value
         # 6: RefList *parent_list
-        # 7: unsigned long total_size
-        # 8: PyObject *proxy
-        self.assertSizeOf(5+8, mop, has_gc=True)
+        # 7: long total_parents
+        # 8: unsigned long total_size
+        # 9: PyObject *proxy
+        self.assertSizeOf(6+9, mop, has_gc=True)
 
     def test_traverse(self):
         # When a Proxied object is removed from its Collection, it becomes
@@ -700,3 +1285,151 @@ class Test_MemObjectProxyIterRecursiveRefs(tests.TestCase):
         self.assertIterRecursiveRefs([], self.moc[1024], excluding=[1024])
         obj = self.moc.add(1, '1', 1234, children=[1024])
         self.assertIterRecursiveRefs([], obj, excluding=[1])
+
+
+class TestSummarizeLines(tests.TestCase):
+
+    def test_summarize_lines(self):
+        lines = [
+            '[\n',
+            '{"address": 1, "type": "str", "size": 30, "len": 3'
+            ', "value": "abc", "refs": []},\n',
+            '{"address": 2, "type": "int", "size": 12, "value": 1'
+            ', "refs": []},\n',
+            '{"address": 3, "type": "str", "size": 40, "len": 13, "refs": []}'
+            ',\n',
+            '{"address": 4, "type": "str", "size": 40, "refs": []}\n',
+            ']\n',
+            ]
+        self.assertEqual([('int', 1, 12, 144.0, 12, 2),
+                          ('str', 3, 110, 4100.0, 40, 3),
+                         ], sorted(_loader.summarize_lines(lines)))
+
+    def test_fallback(self):
+        lines = ['{"type": "str", "address": 1, "size": 30, "refs": []}\n',
+                 '{"address": 2, "type": "str", "size": 10, "refs": []}\n',
+                ]
+        self.assertRaises(ValueError, _loader.summarize_lines, lines)
+        def fallback(line):
+            return 1, 'str', 30
+        self.assertEqual([('str', 2, 40, 1000.0, 30, 1)],
+                         _loader.summarize_lines(lines, fallback))
+
+    def test_seen(self):
+        lines = ['{"address": 1, "type": "str", "size": 30, "refs": []}\n',
+                 '{"address": 2, "type": "int", "size": 12, "refs": []}\n',
+                 '{"address": 1, "type": "str", "size": 30, "refs": []}\n',
+                ]
+        seen = set([2])
+        self.assertEqual([('str', 1, 30, 900.0, 30, 1)],
+                         _loader.summarize_lines(lines, seen=seen))
+        self.assertEqual(set([1, 2]), seen)
+
+    def test_agrees_with_summarize_by_type(self):
+        # The objects are in a different order in the table than in the
+        # lines, but both pick the largest, with the lowest address on ties
+        objs = [(2052, 'str', 40), (1025, 'NoneType', 0), (4, 'str', 40),
+                (1, 'NoneType', 0), (3, 'str', 12)]
+        lines = ['{"address": %d, "type": "%s", "size": %d, "refs": []}\n'
+                 % obj for obj in objs]
+        moc = _loader.MemObjectCollection()
+        for address, type_str, size in objs:
+            moc.add(address, type_str, size)
+        expected = [('NoneType', 2, 0, 0.0, 0, 1),
+                    ('str', 3, 92, 3344.0, 40, 4)]
+        self.assertEqual(expected, sorted(_loader.summarize_lines(lines)))
+        self.assertEqual(expected, sorted(moc.summarize_by_type()))
+
+
+class TestIterTypeAndSize(tests.TestCase):
+
+    def test_iter_type_and_size(self):
+        lines = [
+            '[\n',
+            '{"address": 1, "type": "str", "size": 30, "refs": []},\n',
+            '{"address": 2, "type": "str", "size": 12, "refs": []},\n',
+            '{"address": 18446744073709551608, "type": "int", "size": 12'
+            ', "refs": []}\n',
+            ']\n',
+            ]
+        objs = list(_loader.iter_type_and_size(lines))
+        self.assertEqual([(1, 'str', 30), (2, 'str', 12),
+                          (18446744073709551608, 'int', 12)], objs)
+        # Consecutive lines of the same type share the type_str
+        self.assertTrue(objs[0][1] is objs[1][1])
+
+    def test_fallback(self):
+        lines = ['{"type": "str", "address": 1, "size": 30, "refs": []}\n']
+        self.assertRaises(ValueError, list,
+                          _loader.iter_type_and_size(lines))
+        def fallback(line):
+            return 1, 'str', 30
+        self.assertEqual([(1, 'str', 30)],
+                         list(_loader.iter_type_and_size(lines, fallback)))
+
+
+class TestGraph(tests.TestCase):
+
+    def make_graph(self):
+        # Slot 0 -> 1, 2; 1 -> 3; 2 -> 3; slot 4 is empty; 5 <-> 6
+        starts = array.array('l', [0, 2, 3, 4, 4, 4, 5, 6])
+        succ = array.array('l', [1, 2, 3, 3, 6, 5])
+        sizes = array.array('l', [1, 2, 4, 8, -1, 16, 32])
+        return starts, succ, sizes
+
+    def test_graph_dominators(self):
+        idom, retained = _loader.graph_dominators(*self.make_graph())
+        self.assertEqual([-1, 0, 0, 0, -1, -1, 5], list(idom))
+        self.assertEqual([15, 2, 4, 8, 0, 48, 32], list(retained))
+
+    def test_graph_reachable_sizes(self):
+        starts, succ, sizes = self.make_graph()
+        num_components, reach = _loader.graph_reachable_sizes(starts, succ,
+                                                              sizes)
+        self.assertEqual(5, num_components)
+        self.assertEqual([15, 10, 12, 8, 0, 48, 48], list(reach))
+        hashes = array.array('l', [hash(i) for i in range(7)])
+        num_components, reach = _loader.graph_reachable_sizes(starts, succ,
+            sizes, hashes, approximate=True, num_registers=16)
+        self.assertEqual(5, num_components)
+        self.assertRaises(ValueError, _loader.graph_reachable_sizes,
+                          starts, succ, sizes, approximate=True)
+        self.assertEqual((0, array.array('L')), _loader.graph_reachable_sizes(
+            array.array('l', [0]), array.array('l'), array.array('l')))
+
+    def test_invalid(self):
+        starts, succ, sizes = self.make_graph()
+        # starts of the wrong length, or not ending at len(succ)
+        self.assertRaises(ValueError, _loader.graph_dominators,
+                          starts[:-1], succ, sizes)
+        self.assertRaises(ValueError, _loader.graph_dominators,
+                          starts, succ[:-1], sizes)
+        # A reference out of range, or to an empty slot
+        self.assertRaises(ValueError, _loader.graph_dominators,
+                          starts, array.array('l', [1, 2, 3, 3, 6, 7]), sizes)
+        self.assertRaises(ValueError, _loader.graph_dominators,
+                          starts, array.array('l', [1, 2, 3, 4, 6, 5]), sizes)
+        # An empty slot with references
+        self.assertRaises(ValueError, _loader.graph_dominators, starts, succ,
+                          array.array('l', [1, 2, 4, -1, -1, 16, 32]))
+        self.assertRaises(ValueError, _loader.graph_dominators,
+                          starts, succ, array.array('i', sizes))
+
+
+class TestSortByAddress(tests.TestCase):
+
+    def test_sort_by_address(self):
+        addresses = array.array('L', [5, 3, 9, 3, 5, 1])
+        offsets = array.array('L', [0, 10, 20, 30, 40, 50])
+        self.assertEqual(4, _loader.sort_by_address(addresses, offsets))
+        self.assertEqual([1, 3, 5, 9], list(addresses))
+        # The first offset of repeated addresses is kept
+        self.assertEqual([50, 10, 0, 20], list(offsets))
+        empty = array.array('L')
+        self.assertEqual(0, _loader.sort_by_address(empty, array.array('L')))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, _loader.sort_by_address,
+                          array.array('L', [1, 2]), array.array('L', [1]))
+        self.assertRaises(TypeError, _loader.sort_by_address,
+                          array.array('L', [1]), array.array('B', [1] * 8))
@@ -553,6 +553,125 @@ class TestDumpInfo(tests.TestCase):
         self.assertDumpInfo(fm)
 
 
+class TestSeenObjects(tests.TestCase):
+
+    def dump(self, obj, seen):
+        as_list = []
+        _scanner.dump_object_info(as_list.append, obj, seen=seen)
+        return ''.join(as_list)
+
+    def test_dump_once(self):
+        s = 'a unique string'
+        t1 = (s,)
+        t2 = (s, t1)
+        seen = _scanner.SeenObjects()
+        self.assertFalse(seen.is_bloom)
+        self.assertEqual(py_dump_object_info(t1), self.dump(t1, seen))
+        self.assertTrue(s in seen)
+        self.assertTrue(t1 in seen)
+        self.assertFalse(t2 in seen)
+        # s has already been written
+        self.assertEqual(py_dump_object_info(t2).split('\n')[0] + '\n',
+                         self.dump(t2, seen))
+        self.assertEqual('', self.dump(t1, seen))
+        self.assertEqual(3, len(seen))
+
+    def test_add_many(self):
+        seen = _scanner.SeenObjects()
+        objs = [object() for i in xrange(5000)]
+        for obj in objs:
+            self.assertTrue(seen.add(obj))
+        for obj in objs:
+            self.assertFalse(seen.add(obj))
+        self.assertEqual(5000, len(seen))
+        self.assertFalse(object() in seen)
+        self.assertTrue(_scanner.size_of(seen) > 5000 * _scanner._word_size)
+
+    def test_bloom(self):
+        seen = _scanner.SeenObjects(bloom_size=1024)
+        self.assertTrue(seen.is_bloom)
+        self.assertTrue(_scanner.size_of(seen) >= 1024)
+        objs = [object() for i in xrange(500)]
+        for obj in objs:
+            seen.add(obj)
+        for obj in objs:
+            self.assertTrue(obj in seen)
+            self.assertFalse(seen.add(obj))
+        # 16 bits per object, with 4 hashes, few false positives
+        false_positives = len([obj for obj in [object() for i in xrange(500)]
+                               if obj in seen])
+        self.assertTrue(false_positives < 20)
+        self.assertRaises(ValueError, _scanner.SeenObjects, 0)
+
+    def test_holds_references(self):
+        s = 'a unique %s' % ('string',)
+        l = [s]
+        num_refs = sys.getrefcount(s)
+        seen = _scanner.SeenObjects()
+        as_list = []
+        _scanner.dump_object_info(as_list.append, l, seen=seen,
+                                  refcounts=True)
+        # Objects that were dumped can't be freed, and have their address
+        # taken by another one
+        self.assertEqual(num_refs + 1, sys.getrefcount(s))
+        # The reference held by seen isn't in the refcnt
+        line = ''.join(as_list).splitlines()[1]
+        self.assertTrue(line.endswith(', "refcnt": %d, "gc": false}'
+                                      % (num_refs - 1,)), line)
+        del seen
+        self.assertEqual(num_refs, sys.getrefcount(s))
+
+    def test_min_refcount(self):
+        s = 'a widely %s string' % ('shared',)
+        refs = [s] * 10
+        t1 = (s,)
+        seen = _scanner.SeenObjects(min_refcount=5)
+        self.assertEqual(5, seen.min_refcount)
+        self.assertEqual(py_dump_object_info(t1), self.dump(t1, seen))
+        self.assertTrue(s in seen)
+        self.assertFalse(t1 in seen)
+        # t1 has few references, so it is dumped again, but s is not
+        self.assertEqual(py_dump_object_info(t1).split('\n')[0] + '\n',
+                         self.dump(t1, seen))
+
+
+class TestDumpRefcounts(tests.TestCase):
+
+    # These call dump_object_info directly, as a helper method would hold
+    # more references to the object being dumped.
+
+    def test_refcnt(self):
+        s = 'a unique %s' % ('string',)
+        l = [s, s]
+        as_list = []
+        _scanner.dump_object_info(as_list.append, l, refcounts=True)
+        lines = ''.join(as_list).splitlines()
+        self.assertEqual(2, len(lines))
+        # Only the reference from 'l' is counted
+        self.assertTrue(lines[0].endswith(', "refcnt": 1, "gc": true}'),
+                        lines[0])
+        self.assertTrue(lines[1].endswith(', "refcnt": %d, "gc": false}'
+                                          % (sys.getrefcount(s) - 1,)),
+                        lines[1])
+        as_list = []
+        _scanner.dump_object_info(as_list.append, l, refcounts=True,
+                                  refs_held=1)
+        line = ''.join(as_list).splitlines()[0]
+        self.assertTrue(line.endswith(', "refcnt": 0, "gc": true}'), line)
+
+    def test_untracked(self):
+        t = tuple([1, 2])
+        as_list = []
+        _scanner.dump_object_info(as_list.append, t, recurse_depth=0,
+                                  refcounts=True)
+        self.assertTrue(as_list[-1].endswith('"gc": true}\n'), as_list)
+        # Tuples of atomic objects are untracked by the next collection
+        gc.collect()
+        _scanner.dump_object_info(as_list.append, t, recurse_depth=0,
+                                  refcounts=True)
+        self.assertTrue(as_list[-1].endswith('"gc": false}\n'), as_list)
+
+
 class TestGetReferents(tests.TestCase):
 
     def test_list_referents(self):
@@ -0,0 +1,430 @@
+# Copyright (C) 2009, 2010 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the collection that keeps objects on disk."""
+
+import gc
+import os
+
+from meliae import (
+    _loader,
+    disk,
+    loader,
+    tests,
+    )
+from meliae.tests import test_loader
+
+
+class TestDiskMemObjectCollection(tests.TestCase):
+
+    def make_collection(self, **kwargs):
+        coll = disk.DiskMemObjectCollection(**kwargs)
+        self.addCleanup(coll.close)
+        return coll
+
+    def test_add_and_get(self):
+        coll = self.make_collection()
+        self.assertEqual(0, len(coll))
+        proxy = coll.add(1234, 'str', 25, value='a str')
+        self.assertEqual(1, len(coll))
+        self.assertTrue(1234 in coll)
+        self.assertFalse(1235 in coll)
+        self.assertTrue(proxy is coll[1234])
+        self.assertEqual('str', proxy.type_str)
+        self.assertEqual(25, proxy.size)
+        self.assertEqual('a str', proxy.value)
+        self.assertEqual([], proxy.children)
+        self.assertRaises(KeyError, coll.__getitem__, 1235)
+        self.assertEqual(None, coll.get(1235))
+        coll.add(1235, 'module', 60, name='mymod', children=[1234])
+        self.assertEqual('mymod', coll[1235].value)
+        self.assertEqual([1234], coll[1235].children)
+        self.assertTrue(coll[1235][0] is proxy)
+
+    def test_set_fields(self):
+        coll = self.make_collection()
+        proxy = coll.add(1, 'instance', 20, children=[2, 3])
+        proxy.type_str = 'MyClass'
+        proxy.size = 40
+        proxy.children = [4, 5, 6]
+        proxy.total_size = 1000
+        self.assertEqual('MyClass', coll[1].type_str)
+        self.assertEqual(40, coll[1].size)
+        self.assertEqual([4, 5, 6], coll[1].children)
+        self.assertEqual(3, len(coll[1]))
+        self.assertEqual(1000, coll[1].total_size)
+        self.assertEqual(['MyClass'], coll.type_strs())
+
+    def test_grow(self):
+        coll = self.make_collection(initial_size=16)
+        for i in xrange(1000):
+            coll.add(i * 16, 'int', 12, value=i)
+        self.assertEqual(1000, len(coll))
+        for i in xrange(1000):
+            self.assertEqual(i, coll[i * 16].value)
+        self.assertEqual(range(0, 16000, 16), sorted(coll.keys()))
+
+    def test_delete(self):
+        coll = self.make_collection()
+        coll.add(1, 'str', 25, value='foo', children=[2])
+        coll.add(2, 'int', 12, value=10)
+        proxy = coll[1]
+        del coll[1]
+        self.assertFalse(1 in coll)
+        self.assertEqual(1, len(coll))
+        # The proxy keeps its data
+        self.assertEqual('foo', proxy.value)
+        self.assertEqual([2], proxy.children)
+        self.assertEqual([], coll.addresses_of_type('str'))
+        coll.add(1, 'tuple', 20)
+        self.assertEqual('tuple', coll[1].type_str)
+
+    def test_compute_parents(self):
+        coll = self.make_collection(run_size=2)
+        coll.add(1, 'tuple', 20, children=[2, 3])
+        coll.add(2, 'list', 44, children=[2, 3, 3, 999])
+        coll.add(3, 'int', 12)
+        coll.add(4, 'int', 12, parent_list=[5, 6])
+        coll.compute_parents()
+        self.assertEqual([], coll[1].parents)
+        self.assertEqual([1, 2], coll[2].parents)
+        self.assertEqual([1, 2], coll[3].parents)
+        self.assertEqual([], coll[4].parents)
+        coll.compute_parents(max_parents=1)
+        self.assertEqual([1], coll[3].parents)
+        self.assertEqual(2, coll[3].total_parents)
+
+    def test_compute_external_refs(self):
+        coll = self.make_collection()
+        coll.add(1, 'list', 44, children=[3, 3, 4, 999], refcnt=1,
+                 gc_tracked=True)
+        coll.add(2, 'tuple', 28, children=[3], refcnt=5, gc_tracked=True)
+        coll.add(3, 'str', 25, refcnt=6, gc_tracked=False)
+        coll.add(4, 'str', 25, refcnt=1, gc_tracked=False)
+        coll.add(5, 'int', 12)
+        self.assertEqual((5, True), (coll[2].refcnt, coll[2].gc_tracked))
+        self.assertEqual((6, False), (coll[3].refcnt, coll[3].gc_tracked))
+        self.assertEqual((None, None), (coll[5].refcnt, coll[5].gc_tracked))
+        self.assertEqual([(5, coll[2]), (3, coll[3]), (1, coll[1])],
+                         coll.compute_external_refs())
+        self.assertEqual([(5, coll[2])], coll.compute_external_refs(4))
+
+    def test_summarize_by_type(self):
+        coll = self.make_collection()
+        coll.add(1, 'str', 30)
+        coll.add(2, 'int', 12)
+        coll.add(3, 'str', 40)
+        coll.add(4, 'str', 40)
+        coll.add(0, 'int', 12)
+        self.assertEqual([('int', 2, 24, 288.0, 12, 0),
+                          ('str', 3, 110, 4100.0, 40, 3),
+                         ], sorted(coll.summarize_by_type()))
+
+    def test_iter_raw(self):
+        coll = self.make_collection()
+        coll.add(1, 'tuple', 20, children=[2, 3])
+        coll.add(2, 'list', 44, children=[2, 3, 3, 999])
+        coll.add(3, 'str', 30, value='foo')
+        self.assertEqual([(1, 'tuple', 20), (2, 'list', 44), (3, 'str', 30)],
+                         sorted(coll.iter_raw()))
+        batches = list(coll.iter_raw(('address', 'size'), batch_size=2))
+        self.assertEqual([2, 1], [len(b[0]) for b in batches])
+        edges = []
+        for parents, children in coll.iter_edges(batch_size=4):
+            edges.extend(zip(parents, children))
+        self.assertEqual([(1, 2), (1, 3), (2, 2), (2, 3), (2, 3), (2, 999)],
+                         sorted(edges))
+
+    def test_prune_edges(self):
+        coll = self.make_collection()
+        coll.add(1, 'Registry', 60, children=[2, 3, 4])
+        coll.add(2, 'dict', 140, children=[1, 3, 5])
+        coll.add(3, 'Session', 100, children=[4, 1])
+        coll.add(4, 'Session', 100, children=[3, 5])
+        coll.add(5, 'str', 30)
+        coll.add(6, 'list', 44, children=[1, 5, 1])
+        self.assertEqual(4, coll.prune_edges(into_types=('Registry',),
+                                             slots={'dict': (2, 5)},
+                                             sideways_types=('Session',)))
+        self.assertEqual([2, 3, 4], coll[1].children)
+        self.assertEqual([1, 3, 0], coll[2].children)
+        self.assertEqual([1], coll[3].children)
+        self.assertEqual([5], coll[4].children)
+        self.assertEqual([5, 0], coll[6].children)
+
+    def test_collapse_instance_dicts(self):
+        coll = self.make_collection()
+        coll.add(1, 'instance', 36, children=[2, 3])
+        coll.add(2, 'classobj', 48, name='OldStyle')
+        coll.add(3, 'dict', 140, children=[4, 5])
+        coll.add(4, 'str', 25)
+        coll.add(5, 'int', 12)
+        coll.add(6, 'tuple', 28, children=[5])
+        coll.compute_parents()
+        self.assertEqual(1, coll.collapse_instance_dicts(update_parents=True))
+        self.assertFalse(3 in coll)
+        self.assertEqual('OldStyle', coll[1].type_str)
+        self.assertEqual([4, 5, 2], coll[1].children)
+        self.assertEqual(176, coll[1].size)
+        self.assertEqual([1], coll[4].parents)
+        self.assertEqual([1, 6], sorted(coll[5].parents))
+
+    def test_close_removes_files(self):
+        coll = disk.DiskMemObjectCollection()
+        path = coll._path
+        self.assertTrue(os.path.isdir(path))
+        coll.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_garbage_collected_removes_files(self):
+        coll = disk.DiskMemObjectCollection()
+        path = coll._path
+        coll.add(1, 'str', 25, value='foo')
+        # Even when part of a cycle
+        coll.cycle = coll
+        del coll
+        gc.collect()
+        self.assertFalse(os.path.exists(path))
+
+    def test_compact(self):
+        coll = self.make_collection()
+        coll.add(1, 'list', 44, children=[2, 3], value='list value')
+        coll.add(2, 'str', 25, value='two')
+        coll.add(3, 'int', 12, value=3)
+        for i in xrange(10):
+            coll[1].children = range(100)
+            coll[1].value = 'x' * 1000
+        coll[1].children = [2, 3]
+        coll[1].value = 'list value'
+        coll.compute_parents()
+        refs_size = os.path.getsize(os.path.join(coll._path, 'refs'))
+        values_size = os.path.getsize(os.path.join(coll._path, 'values'))
+        coll.compact()
+        self.assertTrue(os.path.getsize(os.path.join(coll._path, 'refs'))
+                        < refs_size)
+        self.assertTrue(os.path.getsize(os.path.join(coll._path, 'values'))
+                        < values_size)
+        self.assertEqual([2, 3], coll[1].children)
+        self.assertEqual('list value', coll[1].value)
+        self.assertEqual('two', coll[2].value)
+        self.assertEqual(3, coll[3].value)
+        self.assertEqual([1], coll[3].parents)
+
+    def add_graph(self, coll):
+        coll.add(1, 'tuple', 20, children=[2, 3])
+        coll.add(2, 'dict', 100, children=[4, 5])
+        coll.add(3, 'list', 40, children=[3, 4, 999])
+        coll.add(4, 'int', 12)
+        coll.add(5, 'str', 30)
+        coll.add(6, 'module', 50, children=[2])
+        # 7 and 8 form a cycle
+        coll.add(7, 'a', 32, children=[8, 1])
+        coll.add(8, 'b', 64, children=[7])
+        coll.add(9, 'tuple', 28, children=[7])
+
+    def test_compute_dominators(self):
+        coll = self.make_collection(initial_size=16)
+        self.add_graph(coll)
+        coll.compute_dominators()
+        self.assertEqual({1: (7, 60), 2: (None, 130), 3: (1, 40),
+                          4: (None, 12), 5: (2, 30), 6: (None, 50),
+                          7: (9, 156), 8: (7, 64), 9: (None, 184)},
+                         dict((obj.address, (obj.immediate_dominator,
+                                             obj.total_size))
+                              for obj in coll.itervalues()))
+        proxy = coll[3]
+        del coll[3]
+        self.assertEqual(None, proxy.immediate_dominator)
+        self.assertEqual(7, coll[1].immediate_dominator)
+
+    def test_compute_reachable_sizes(self):
+        coll = self.make_collection(initial_size=16)
+        moc = _loader.MemObjectCollection()
+        self.add_graph(coll)
+        self.add_graph(moc)
+        self.assertEqual(moc.compute_reachable_sizes(),
+                         coll.compute_reachable_sizes())
+        expected = dict((obj.address, obj.total_size)
+                        for obj in moc.itervalues())
+        self.assertEqual(expected, dict((obj.address, obj.total_size)
+                                        for obj in coll.itervalues()))
+        self.assertEqual(326, coll[9].total_size)
+        # The estimates use the same hashes as the objects in memory
+        moc.compute_reachable_sizes(approximate=True, num_registers=16)
+        coll.compute_reachable_sizes(approximate=True, num_registers=16)
+        expected = dict((obj.address, obj.total_size)
+                        for obj in moc.itervalues())
+        self.assertEqual(expected, dict((obj.address, obj.total_size)
+                                        for obj in coll.itervalues()))
+        self.assertRaises(ValueError, coll.compute_reachable_sizes,
+                          approximate=True, num_registers=1)
+
+    def test_find_duplicate_values(self):
+        coll = self.make_collection()
+        coll.add(1, 'str', 30, value='foo')
+        coll.add(2, 'str', 30, value='foo')
+        coll.add(3, 'str', 30, value='bar')
+        coll.add(4, 'int', 12, value=10)
+        coll.add(5, 'int', 12, value=10)
+        coll.add(6, 'int', 12, value=10)
+        coll.add(7, 'dict', 140, value='foo')
+        coll.add(8, 'str', 500, value='foo')
+        coll.add(9, 'list', 40, children=[1, 2])
+        coll.compute_parents()
+        result = sorted(coll.find_duplicate_values())
+        self.assertEqual(2, len(result))
+        (int_info, str_info) = result
+        self.assertEqual(('int', 10, 12, 3), int_info[:4])
+        self.assertEqual([4, 5, 6], sorted(int_info[4]))
+        self.assertEqual([], int_info[5])
+        self.assertEqual(('str', 'foo', 30, 2), str_info[:4])
+        self.assertEqual([1, 2], sorted(str_info[4]))
+        self.assertEqual([9], str_info[5])
+        (info,) = coll.find_duplicate_values(('int',), max_samples=2)
+        self.assertEqual(3, info[3])
+        self.assertEqual(2, len(info[4]))
+        self.assertEqual([], coll.find_duplicate_values(('unicode',)))
+
+    def test_path_to_root(self):
+        coll = self.make_collection()
+        coll.add(1, 'module', 60, children=[2])
+        coll.add(2, 'dict', 140, children=[3, 4])
+        coll.add(3, 'list', 40, children=[5])
+        coll.add(4, 'tuple', 40, children=[5])
+        coll.add(5, 'str', 30)
+        coll.add(6, 'tuple', 40, children=[5])
+        coll.add(7, 'tuple', 40, children=[6])
+        coll.add(8, 'frame', 400, children=[6])
+        coll.compute_parents()
+        self.assertEqual([[5, 6, 7]], coll.path_to_root(5, k=1))
+        paths = coll.path_to_root(5)
+        self.assertEqual(2, len(paths))
+        self.assertEqual([5, 6, 7], paths[0])
+        self.assertTrue(paths[1] in ([5, 3, 2, 1], [5, 4, 2, 1]))
+        self.assertEqual([[1]], coll.path_to_root(1))
+        self.assertEqual([[6, 8], [6, 7]],
+                         sorted(coll.path_to_root(6, skip_types=()),
+                                reverse=True))
+        self.assertRaises(KeyError, coll.path_to_root, 10)
+
+
+class TestLoadOnDisk(tests.TestCase):
+
+    def load(self, **kwargs):
+        manager = loader.load(test_loader._example_dump, show_prog=False,
+                              on_disk=True, **kwargs)
+        self.addCleanup(manager.objs.close)
+        return manager
+
+    def test_close(self):
+        manager = loader.load(test_loader._example_dump, show_prog=False,
+                              on_disk=True)
+        path = manager.objs._path
+        # As used by a with statement
+        self.assertTrue(manager.__enter__() is manager)
+        self.assertEqual(7, len(manager.objs))
+        manager.__exit__(None, None, None)
+        self.assertFalse(os.path.exists(path))
+        manager.close()
+
+    def test_load(self):
+        manager = self.load()
+        self.assertTrue(isinstance(manager.objs,
+                                   disk.DiskMemObjectCollection))
+        # The module's __dict__ has been collapsed
+        self.assertEqual(7, len(manager.objs))
+        self.assertEqual([3, 7, 8], sorted(manager[4].parents))
+        self.assertEqual([4, 5], sorted(o.address
+                                        for o in manager.get_all('int')))
+
+    def test_summarize(self):
+        manager = self.load(collapse=False)
+        summary = manager.summarize()
+        self.assertEqual(8, summary.total_count)
+        self.assertEqual(321, summary.total_size)
+        summary = manager.summarize(manager[7])
+        self.assertEqual(44, summary.total_size)
+
+    def test_analyses_agree_with_memory(self):
+        manager = self.load()
+        in_memory = loader.load(test_loader._example_dump, show_prog=False)
+        for m in (manager, in_memory):
+            m.compute_dominators()
+        self.assertEqual(
+            sorted((o.address, o.immediate_dominator, o.total_size)
+                   for o in in_memory.objs.itervalues()),
+            sorted((o.address, o.immediate_dominator, o.total_size)
+                   for o in manager.objs.itervalues()))
+        for m in (manager, in_memory):
+            m.compute_all_total_sizes()
+        self.assertEqual(
+            sorted((o.address, o.total_size)
+                   for o in in_memory.objs.itervalues()),
+            sorted((o.address, o.total_size)
+                   for o in manager.objs.itervalues()))
+        self.assertEqual(sorted(in_memory.objs.find_duplicate_values()),
+                         sorted(manager.objs.find_duplicate_values()))
+        self.assertEqual(in_memory.objs.path_to_root(5),
+                         manager.objs.path_to_root(5))
+
+    def test_remove_expensive_references_paths_agree(self):
+        lines = [
+            '{"address": 1, "type": "function", "size": 60, "name": "f"'
+            ', "refs": [2, 3, 4, 5]}',
+            '{"address": 2, "type": "code", "size": 80, "refs": []}',
+            '{"address": 3, "type": "dict", "size": 140, "len": 1'
+            ', "refs": [6, 4]}',
+            '{"address": 4, "type": "module", "size": 60, "name": "m"'
+            ', "refs": [3]}',
+            '{"address": 5, "type": "type", "size": 400, "name": "T"'
+            ', "refs": [3, 4]}',
+            '{"address": 6, "type": "str", "size": 30, "len": 1'
+            ', "value": "x", "refs": []}',
+            '{"address": 7, "type": "_LRUNode", "size": 40'
+            ', "refs": [8, 6, 5]}',
+            '{"address": 8, "type": "_LRUNode", "size": 40'
+            ', "refs": [7, 6]}',
+            '{"address": 9, "type": "list", "size": 44, "len": 3'
+            ', "refs": [5, 6, 4]}',
+            ]
+        streamed = {}
+        for changed, obj in loader.remove_expensive_references(
+                lambda: loader.iter_objs(lines)):
+            streamed[obj.address] = list(obj.children)
+        self.assertEqual([2, 5, 0], streamed[1])
+        in_memory = loader.load(lines, show_prog=False, collapse=False)
+        in_memory.remove_expensive_references()
+        on_disk = loader.load(lines, show_prog=False, collapse=False,
+                              on_disk=True)
+        self.addCleanup(on_disk.close)
+        on_disk.remove_expensive_references()
+        for address, children in streamed.iteritems():
+            self.assertEqual(children, list(in_memory[address].children))
+            self.assertEqual(children, list(on_disk[address].children))
+
+    def test_remove_expensive_references(self):
+        lines = list(test_loader._example_dump)
+        lines.append('{"address": 9, "type": "tuple", "size": 20, "len": 1'
+                     ', "refs": [8]}')
+        manager = loader.load(lines, show_prog=False, on_disk=True)
+        self.addCleanup(manager.objs.close)
+        manager.remove_expensive_references()
+        self.assertTrue(0 in manager.objs)
+        # The reference to the module is replaced by the null object
+        self.assertEqual([0], manager[9].children)
+        in_memory = loader.load(lines, show_prog=False)
+        in_memory.remove_expensive_references()
+        for obj in in_memory.objs.itervalues():
+            self.assertEqual(list(obj.children),
+                             manager[obj.address].children)
@@ -0,0 +1,279 @@
+# Copyright (C) 2011 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Test reading dump files."""
+
+import bz2
+import gzip
+import os
+import random
+import tempfile
+import zlib
+
+from meliae import (
+    files,
+    tests,
+    )
+
+
+_lines = ['{"address": %d, "type": "int", "size": 12, "value": %d}\n'
+          % (i, i) for i in xrange(1000)]
+
+
+class TestOpenFile(tests.TestCase):
+
+    def write_file(self, content):
+        fd, name = tempfile.mkstemp(prefix='meliae-')
+        self.addCleanup(os.remove, name)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        return name
+
+    def gzip_compress(self, content):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(content) + compressor.flush()
+
+    def read_lines(self, name):
+        source, cleanup = files.open_file(name)
+        try:
+            return list(source)
+        finally:
+            if cleanup is not None:
+                cleanup()
+
+    def test_plain(self):
+        name = self.write_file(''.join(_lines))
+        self.assertEqual(_lines, self.read_lines(name))
+
+    def test_gzip(self):
+        name = self.write_file('')
+        content = gzip.GzipFile(name, 'wb')
+        content.writelines(_lines)
+        content.close()
+        source = open(name, 'rb')
+        self.assertEqual('gzip', files.sniff_format(source))
+        source.close()
+        self.assertEqual(_lines, self.read_lines(name))
+
+    def test_gzip_concatenated_and_padded(self):
+        content = ''.join(_lines)
+        name = self.write_file(self.gzip_compress(content[:5000])
+                               + self.gzip_compress(content[5000:])
+                               + '\x00' * 10)
+        self.assertEqual(_lines, self.read_lines(name))
+
+    def test_bz2(self):
+        content = ''.join(_lines)
+        name = self.write_file(bz2.compress(content[:100])
+                               + bz2.compress(content[100:]))
+        self.assertEqual(_lines, self.read_lines(name))
+
+    def test_xz(self):
+        if files.lzma is None:
+            return
+        name = self.write_file(files.lzma.compress(''.join(_lines)))
+        self.assertEqual(_lines, self.read_lines(name))
+
+    def test_small_blocks(self):
+        # Lines and streams are split between blocks
+        content = ''.join(_lines) + 'no trailing newline'
+        compressed = self.gzip_compress(content[:3000])
+        name = self.write_file(compressed + self.gzip_compress(content[3000:]))
+        reader = files.DecompressingReader(name, block_size=len(compressed))
+        try:
+            self.assertEqual('gzip', reader.format)
+            self.assertEqual(os.path.getsize(name), reader.compressed_size)
+            self.assertEqual(_lines + ['no trailing newline'], list(reader))
+            self.assertEqual(reader.compressed_size, reader.tell_compressed())
+        finally:
+            reader.close()
+
+    def test_padding_across_blocks(self):
+        content = ''.join(_lines)
+        compressed = self.gzip_compress(content)
+        name = self.write_file(compressed + '\x00' * 1000)
+        for block_size in (len(compressed), len(compressed) - 1, 300):
+            reader = files.DecompressingReader(name, block_size=block_size)
+            try:
+                self.assertEqual(_lines, list(reader))
+            finally:
+                reader.close()
+
+    def test_truncated(self):
+        content = ''.join(_lines)
+        compressed = self.gzip_compress(content)
+        name = self.write_file(compressed[:-10])
+        self.assertRaises(EOFError, self.read_lines, name)
+        name = self.write_file(compressed + compressed[:len(compressed) / 2])
+        self.assertRaises(EOFError, self.read_lines, name)
+        name = self.write_file(bz2.compress(content)[:-10])
+        self.assertRaises(EOFError, self.read_lines, name)
+
+    def test_corrupt(self):
+        compressed = self.gzip_compress(''.join(_lines))
+        name = self.write_file(compressed[:10] + '\xff' * 20 + compressed[30:])
+        self.assertRaises(zlib.error, self.read_lines, name)
+
+    def test_close_early(self):
+        name = self.write_file(self.gzip_compress(''.join(_lines) * 100))
+        reader = files.DecompressingReader(name, block_size=100)
+        self.assertEqual(_lines[0], iter(reader).next())
+        reader.close()
+        self.assertFalse(reader._thread.isAlive())
+
+
+class TestIterLineBlocks(tests.TestCase):
+
+    def test_iter_line_blocks(self):
+        self.assertEqual(['a\n', 'b\n', 'cd\ne\n', 'f'],
+                         list(files.iter_line_blocks(['a\nb', '\nc', 'd\ne\n',
+                                                      'f'])))
+        self.assertEqual(['abc\n'],
+                         list(files.iter_line_blocks(['a', 'b', 'c\n'])))
+        self.assertEqual([], list(files.iter_line_blocks([])))
+
+
+class TestCompressingWriter(tests.TestCase):
+
+    def check_round_trip(self, suffix, format):
+        fd, name = tempfile.mkstemp(prefix='meliae-', suffix=suffix)
+        os.close(fd)
+        self.addCleanup(os.remove, name)
+        self.assertEqual(format, files.format_for_filename(name))
+        writer = files.CompressingWriter(name)
+        for line in _lines:
+            writer.write(line)
+        writer.close()
+        source = open(name, 'rb')
+        try:
+            self.assertEqual(format, files.sniff_format(source))
+        finally:
+            source.close()
+        reader = files.DecompressingReader(name)
+        try:
+            self.assertEqual(_lines, list(reader))
+        finally:
+            reader.close()
+
+    def test_gzip(self):
+        self.check_round_trip('.gz', 'gzip')
+
+    def test_bz2(self):
+        self.check_round_trip('.bz2', 'bz2')
+
+    def test_xz(self):
+        if files.lzma is None:
+            return
+        self.check_round_trip('.xz', 'xz')
+
+    def test_format_for_filename(self):
+        self.assertEqual(None, files.format_for_filename('dump.json'))
+        self.assertRaises(ValueError, files.CompressingWriter, 'dump.json')
+
+
+class TestGzipIndex(tests.TestCase):
+
+    def make_gzip(self, *parts):
+        fd, name = tempfile.mkstemp(prefix='meliae-')
+        self.addCleanup(os.remove, name)
+        f = os.fdopen(fd, 'wb')
+        try:
+            for part in parts:
+                compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                              16 + zlib.MAX_WBITS)
+                f.write(compressor.compress(part) + compressor.flush())
+        finally:
+            f.close()
+        return name
+
+    def make_content(self, size):
+        r = random.Random(42)
+        return ''.join(['%016x' % r.getrandbits(64)
+                        for i in xrange(size // 16)])
+
+    def build(self, name, span):
+        index = files.GzipIndex.build(name, span)
+        self.addCleanup(index.close)
+        return index
+
+    def test_read(self):
+        content = self.make_content(300000)
+        index = self.build(self.make_gzip(content), span=50000)
+        self.assertEqual(len(content), index.uncompressed_size)
+        self.assertTrue(len(index) > 3)
+        for offset, length in [(0, 10), (100000, 5000), (299990, 100),
+                               (45000, 200000), (300000, 10)]:
+            self.assertEqual(content[offset:offset + length],
+                             index.read(offset, length))
+
+    def test_on_data(self):
+        parts = [self.make_content(100000), self.make_content(70000)]
+        data = []
+        index = files.GzipIndex.build(self.make_gzip(*parts), 20000,
+                                      data.append)
+        self.addCleanup(index.close)
+        self.assertEqual(''.join(parts), ''.join(data))
+        self.assertTrue(len(data) > 1)
+
+    def test_read_concatenated(self):
+        parts = [self.make_content(100000), self.make_content(70000),
+                 self.make_content(50000)]
+        content = ''.join(parts)
+        index = self.build(self.make_gzip(*parts), span=20000)
+        self.assertEqual(len(content), index.uncompressed_size)
+        # Read across the ends of the members
+        self.assertEqual(content[90000:190000], index.read(90000, 100000))
+        self.assertEqual(content[160000:], index.read(160000, 100000))
+
+    def test_read_line(self):
+        content = ''.join(_lines)
+        index = self.build(self.make_gzip(content), span=10000)
+        offset = content.index(_lines[500])
+        self.assertEqual(_lines[500], index.read_line(offset))
+        self.assertEqual(_lines[500], index.read_line(offset, guess=5))
+
+    def test_write_and_read(self):
+        content = self.make_content(200000)
+        name = self.make_gzip(content)
+        index = self.build(name, span=30000)
+        fd, index_name = tempfile.mkstemp(prefix='meliae-')
+        self.addCleanup(os.remove, index_name)
+        out = os.fdopen(fd, 'wb')
+        index.write(out)
+        out.close()
+        source = open(index_name, 'rb')
+        try:
+            loaded = files.GzipIndex.read_from(name, source)
+        finally:
+            source.close()
+        self.addCleanup(loaded.close)
+        self.assertEqual(len(index), len(loaded))
+        self.assertEqual(content[123456:130000], loaded.read(123456, 6544))
+        source = open(index_name, 'rb')
+        try:
+            self.assertRaises(ValueError, files.GzipIndex.read_from,
+                              index_name, source)
+        finally:
+            source.close()
+
+    def test_not_gzip(self):
+        fd, name = tempfile.mkstemp(prefix='meliae-')
+        self.addCleanup(os.remove, name)
+        os.write(fd, 'not compressed\n')
+        os.close(fd)
+        self.assertRaises(ValueError, files.GzipIndex.build, name)
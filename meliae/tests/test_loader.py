@@ -53,6 +53,17 @@ _example_dump = [
 # you subclass object you get a lot of references, and type instances also
 # reference other stuff that tends to chain to stuff like 'sys', which ends up
 # referencing everything.
+# Written with refcounts=True. 2 holds a reference to 3 that isn't in the dump
+_refcnt_dump = [
+'{"address": 1, "type": "list", "size": 44, "len": 2, "refs": [3, 3]'
+    ', "refcnt": 1, "gc": true}',
+'{"address": 2, "type": "MyType", "size": 32, "refs": [], "refcnt": 1'
+    ', "gc": true}',
+'{"address": 3, "type": "str", "size": 25, "len": 1, "value": "a"'
+    ', "refs": [], "refcnt": 3, "gc": false}',
+'{"address": 4, "type": "int", "size": 12, "value": 1, "refs": []}',
+]
+
 _instance_dump = [
 '{"address": 1, "type": "MyClass", "size": 32, "refs": [2, 3]}',
 '{"address": 3, "type": "type", "size": 452, "name": "MyClass", "refs": []}',
@@ -150,6 +161,21 @@ class TestLoad(tests.TestCase):
         obj = objs[4567]
         self.assertEqual("Test \\'whoami\\'\\u000a\\\"Your name\\\"", obj.value)
 
+    def test_load_refcnt(self):
+        using = [False]
+        if loader.simplejson is not None:
+            using.append(True)
+        for using_json in using:
+            objs = loader.load(_refcnt_dump, using_json=using_json,
+                               show_prog=False).objs
+            self.assertEqual([3, 3], objs[1].children)
+            self.assertEqual((1, True), (objs[1].refcnt, objs[1].gc_tracked))
+            self.assertEqual((3, False),
+                             (objs[3].refcnt, objs[3].gc_tracked))
+            self.assertEqual('a', objs[3].value)
+            self.assertEqual((None, None),
+                             (objs[4].refcnt, objs[4].gc_tracked))
+
     def test_load_example(self):
         objs = loader.load(_example_dump, show_prog=False)
 
@@ -179,6 +205,84 @@ class TestLoad(tests.TestCase):
             f.close()
             os.remove(name)
 
+    def check_dump_index(self, name):
+        index = loader.DumpIndex.open(name)
+        self.addCleanup(os.remove, name + '.idx')
+        self.addCleanup(index.close)
+        self.assertEqual(8, len(index))
+        self.assertTrue(7 in index)
+        self.assertFalse(9 in index)
+        self.assertEqual(_example_dump[5], index.get_line(7).rstrip(',\n'))
+        obj = index[7]
+        self.assertEqual('tuple', obj.type_str)
+        self.assertEqual([4, 5], obj.children)
+        self.assertTrue(obj is index[7])
+        self.assertRaises(KeyError, index.__getitem__, 9)
+        self.assertEqual(None, index.get(9))
+        # The second time, the saved index is used
+        loaded = loader.DumpIndex.open(name)
+        self.addCleanup(loaded.close)
+        self.assertEqual('a str', loaded[6].value)
+        return index, loaded
+
+    def test_dump_index(self):
+        fd, name = tempfile.mkstemp(prefix='meliae-')
+        self.addCleanup(os.remove, name)
+        f = os.fdopen(fd, 'wb')
+        f.write('[\n%s\n]\n' % (',\n'.join(_example_dump),))
+        f.close()
+        index, loaded = self.check_dump_index(name)
+        self.assertEqual(None, loaded._gzip_index)
+
+    def test_dump_index_compressed(self):
+        fd, name = tempfile.mkstemp(prefix='meliae-')
+        self.addCleanup(os.remove, name)
+        f = os.fdopen(fd, 'wb')
+        content = gzip.GzipFile(mode='wb', compresslevel=6, fileobj=f)
+        for line in _example_dump:
+            content.write(line + '\n')
+        content.close()
+        f.close()
+        index, loaded = self.check_dump_index(name)
+        self.assertNotEqual(None, loaded._gzip_index)
+
+    def test_dump_index_large(self):
+        # Enough lines to span several blocks, with repeated objects
+        lines = ['{"address": %d, "type": "str", "size": 30, "len": 1'
+                 ', "value": "%s", "refs": []}' % (address, address % 10)
+                 for address in range(50000, 0, -1) + range(100, 200)]
+        fd, name = tempfile.mkstemp(prefix='meliae-')
+        self.addCleanup(os.remove, name)
+        f = os.fdopen(fd, 'wb')
+        content = gzip.GzipFile(mode='wb', compresslevel=6, fileobj=f)
+        content.write('[\n%s\n]\n' % (',\n'.join(lines),))
+        content.close()
+        f.close()
+        index = loader.DumpIndex.build(name, span=100000)
+        self.addCleanup(index.close)
+        self.assertEqual(50000, len(index))
+        self.assertTrue(len(index._gzip_index) > 5)
+        # The first copy of each object is found
+        self.assertEqual(lines[50000 - 150], index.get_line(150).rstrip(',\n'))
+        self.assertEqual(lines[0], index.get_line(50000).rstrip(',\n'))
+        self.assertEqual(lines[-1 - 100], index.get_line(1).rstrip(',\n'))
+
+    def test_strip_duplicates(self):
+        fd, name = tempfile.mkstemp(prefix='meliae-', suffix='.gz')
+        self.addCleanup(os.remove, name)
+        f = os.fdopen(fd, 'wb')
+        content = gzip.GzipFile(mode='wb', compresslevel=6, fileobj=f)
+        for line in _example_dump + _example_dump[2:5]:
+            content.write(line + '\n')
+        content.close()
+        f.close()
+        out_name = name[:-3] + '-stripped.gz'
+        self.addCleanup(os.remove, out_name)
+        self.assertEqual((11, 8), loader.strip_duplicates(name, out_name))
+        stripped = gzip.GzipFile(out_name).read()
+        self.assertEqual(''.join([line + '\n' for line in _example_dump]),
+                         stripped)
+
     def test_get_all(self):
         om = loader.load(_example_dump, show_prog=False)
         the_ints = om.get_all('int')
@@ -192,6 +296,139 @@ class TestLoad(tests.TestCase):
         self.assertEqual('int', an_int.type_str)
 
 
+class TestDiff(tests.TestCase):
+
+    def test_diff_same(self):
+        result = loader.diff(_example_dump, _example_dump)
+        self.assertEqual(8, result.old_count)
+        self.assertEqual(8, result.new_count)
+        self.assertEqual(321, result.new_size)
+        self.assertEqual([], result.top_growers())
+        self.assertEqual([], result.largest_added)
+        for delta in result.type_deltas.itervalues():
+            self.assertEqual(0, delta.count_delta)
+            self.assertEqual(0, delta.added_count)
+
+    def test_diff(self):
+        new_dump = list(_example_dump)
+        # The str goes away, and its address gets reused by a dict
+        del new_dump[6]
+        new_dump.append('{"address": 6, "type": "dict", "size": 140'
+                        ', "len": 0, "refs": []}')
+        new_dump.append('{"address": 9, "type": "str", "size": 30'
+                        ', "len": 6, "value": "a str2", "refs": []}')
+        new_dump.append('{"address": 10, "type": "str", "size": 25'
+                        ', "len": 1, "value": "a", "refs": []}')
+        result = loader.diff(_example_dump, new_dump, max_added=2)
+        self.assertEqual(8, result.old_count)
+        self.assertEqual(10, result.new_count)
+        self.assertEqual(321 - 29 + 140 + 30 + 25, result.new_size)
+        self.assertEqual(['dict', 'str'],
+                         [d.type_str for d in result.top_growers()])
+        str_delta = result.type_deltas['str']
+        self.assertEqual(1, str_delta.count_delta)
+        self.assertEqual(26, str_delta.size_delta)
+        self.assertEqual(2, str_delta.added_count)
+        self.assertEqual(55, str_delta.added_size)
+        dict_delta = result.type_deltas['dict']
+        self.assertEqual(1, dict_delta.added_count)
+        self.assertEqual([(140, 6, 'dict'), (30, 9, 'str')],
+                         result.largest_added)
+
+    def test_diff_duplicates(self):
+        dup_dump = _example_dump + _example_dump[:3]
+        forward = loader.diff(_example_dump, dup_dump)
+        backward = loader.diff(dup_dump, _example_dump)
+        self.assertEqual((8, 8), (forward.old_count, forward.new_count))
+        self.assertEqual((8, 8), (backward.old_count, backward.new_count))
+        self.assertEqual(forward.new_size, backward.old_size)
+        self.assertEqual([], forward.top_growers())
+        self.assertEqual([], backward.top_growers())
+
+    def test_diff_address_and_type(self):
+        old_dump = ['{"address": 1, "type": "str", "size": 30, "refs": []}',
+                    '{"address": 2, "type": "int", "size": 12, "refs": []}',
+                   ]
+        # The same addresses with other types are new objects
+        new_dump = ['{"address": 1, "type": "int", "size": 12, "refs": []}',
+                    '{"address": 2, "type": "str", "size": 30, "refs": []}',
+                    '{"address": 2, "type": "int", "size": 12, "refs": []}',
+                   ]
+        result = loader.diff(old_dump, new_dump)
+        self.assertEqual(1, result.type_deltas['int'].added_count)
+        self.assertEqual(1, result.type_deltas['str'].added_count)
+        self.assertEqual([(30, 2, 'str'), (12, 1, 'int')],
+                         result.largest_added)
+
+    def test_diff_files(self):
+        old_name = self.write_dump(_example_dump)
+        new_name = self.write_dump(_example_dump[:-1])
+        result = loader.diff(old_name, new_name)
+        self.assertEqual(-1, result.type_deltas['module'].count_delta)
+        self.assertEqual(-60, result.new_size - result.old_size)
+
+    def write_dump(self, lines):
+        fd, name = tempfile.mkstemp(prefix='meliae-')
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write('[\n%s\n]\n' % (',\n'.join(lines),))
+        finally:
+            f.close()
+        self.addCleanup(os.remove, name)
+        return name
+
+
+class TestSummarizeFile(tests.TestCase):
+
+    def assertSummaryMatchesLoad(self, summary):
+        manager = loader.load(_example_dump, show_prog=False, collapse=False)
+        expected = manager.summarize()
+        self.assertEqual(expected.total_count, summary.total_count)
+        self.assertEqual(expected.total_size, summary.total_size)
+        for type_str, type_summary in expected.type_summaries.iteritems():
+            other = summary.type_summaries[type_str]
+            self.assertEqual((type_summary.count, type_summary.total_size,
+                              type_summary.sq_sum, type_summary.max_size),
+                             (other.count, other.total_size, other.sq_sum,
+                              other.max_size))
+
+    def test_summarize_lines(self):
+        summary = loader.summarize_file(_example_dump)
+        self.assertSummaryMatchesLoad(summary)
+
+    def test_summarize_duplicates(self):
+        # load() keeps the first line for each address, and so do we
+        lines = _example_dump + [_example_dump[2], _example_dump[0]]
+        summary = loader.summarize_file(lines, dedupe=True)
+        self.assertSummaryMatchesLoad(summary)
+        # Otherwise the dump is trusted not to repeat objects
+        summary = loader.summarize_file(lines)
+        self.assertEqual(10, summary.total_count)
+        self.assertEqual(3, summary.type_summaries['int'].count)
+
+    def test_summarize_compressed(self):
+        fd, name = tempfile.mkstemp(prefix='meliae-')
+        f = os.fdopen(fd, 'wb')
+        try:
+            content = gzip.GzipFile(mode='wb', compresslevel=6, fileobj=f)
+            content.write('[\n%s\n]\n' % (',\n'.join(_example_dump),))
+            content.close()
+            f.close()
+            summary = loader.summarize_file(name)
+        finally:
+            f.close()
+            os.remove(name)
+        self.assertSummaryMatchesLoad(summary)
+
+    def test_summarize_other_order(self):
+        if loader.simplejson is None:
+            return
+        summary = loader.summarize_file(
+            ['{"type": "str", "size": 30, "address": 1, "refs": []}'])
+        self.assertEqual(1, summary.total_count)
+        self.assertEqual(30, summary.type_summaries['str'].total_size)
+
+
 class TestRemoveExpensiveReferences(tests.TestCase):
 
     def test_remove_expensive_references(self):
@@ -297,6 +534,8 @@ class TestObjManager(tests.TestCase):
         # By default, we only track 100 parents
         manager = loader.load(content, show_prog=False)
         self.assertEqual(100, manager[2].num_parents)
+        # We still know how many parents there really are
+        self.assertEqual(200, manager[2].total_parents)
         manager = loader.load(content, show_prog=False, max_parents=0)
         self.assertEqual(0, manager[2].num_parents)
         manager = loader.load(content, show_prog=False, max_parents=-1)
@@ -304,6 +543,12 @@ class TestObjManager(tests.TestCase):
         manager = loader.load(content, show_prog=False, max_parents=10)
         self.assertEqual(10, manager[2].num_parents)
 
+    def test_compute_external_refs(self):
+        manager = loader.load(_refcnt_dump, show_prog=False)
+        self.assertEqual([(1, manager[3]), (1, manager[2]), (1, manager[1])],
+                         manager.compute_external_refs())
+        self.assertEqual([], manager.compute_external_refs(2))
+
     def test_compute_total_size(self):
         manager = loader.load(_example_dump, show_prog=False)
         objs = manager.objs
@@ -321,6 +566,38 @@ class TestObjManager(tests.TestCase):
         manager.compute_total_size(obj)
         self.assertEqual(16, obj.total_size)
 
+    def test_compute_dominators(self):
+        manager = loader.load(_example_dump, show_prog=False, collapse=False)
+        manager.compute_dominators()
+        objs = manager.objs
+        # The dict is shared between the outer tuple and the module, so
+        # neither of them keeps it alive on its own
+        self.assertEqual(None, objs[2].immediate_dominator)
+        self.assertEqual(124+29+20, objs[2].total_size)
+        self.assertEqual(20+44, objs[1].total_size)
+        self.assertEqual(60, objs[8].total_size)
+        self.assertEqual(1, objs[3].immediate_dominator)
+        self.assertEqual(2, objs[7].immediate_dominator)
+        self.assertEqual(None, objs[4].immediate_dominator)
+
+    def test_path_to_root(self):
+        manager = loader.load(_example_dump, show_prog=False, collapse=False)
+        manager.compute_parents()
+        paths = [[obj.address for obj in path]
+                 for path in manager.path_to_root(4)]
+        # There are 2 roots, the module and the outer tuple, both 2 steps
+        # away
+        self.assertEqual([1, 8], sorted([path[-1] for path in paths]))
+        self.assertEqual([3, 3], [len(path) for path in paths])
+        self.assertEqual([4, 4], [path[0] for path in paths])
+
+    def test_compute_all_total_sizes(self):
+        manager = loader.load(_example_dump, show_prog=False, collapse=False)
+        top = manager.compute_all_total_sizes(top=2)
+        self.assertEqual([1, 8], [obj.address for obj in top])
+        self.assertEqual(257, manager[8].total_size)
+        self.assertEqual(29, manager[6].total_size)
+
     def test_remove_expensive_references(self):
         lines = list(_example_dump)
         lines.pop(-1) # Remove the old module
@@ -344,6 +621,45 @@ class TestObjManager(tests.TestCase):
         self.assertEqual('<ex-reference>', null_obj.type_str)
         self.assertEqual([11, 0], mymod_dict.children)
 
+    def assertParentsUpToDate(self, manager):
+        parents = dict((obj.address, (sorted(obj.parents), obj.total_parents))
+                       for obj in manager.objs.itervalues())
+        manager.objs.compute_parents()
+        for obj in manager.objs.itervalues():
+            self.assertEqual((sorted(obj.parents), obj.total_parents),
+                             parents[obj.address])
+
+    def test_remove_expensive_references_maintains_parents(self):
+        manager = loader.load(_instance_dump, show_prog=False,
+                              maintain_parents=True)
+        self.assertTrue(manager.objs.maintain_parents)
+        manager.remove_expensive_references()
+        self.assertParentsUpToDate(manager)
+
+    def test_remove_expensive_references_recomputes_parents(self):
+        manager = loader.load(_instance_dump, show_prog=False)
+        # Maintaining the parents is opt in
+        self.assertFalse(manager.objs.maintain_parents)
+        manager.remove_expensive_references()
+        self.assertFalse(manager.objs.maintain_parents)
+        self.assertParentsUpToDate(manager)
+
+    def test_prune_edges(self):
+        lines = list(_example_dump)
+        lines.append('{"address": 9, "type": "Registry", "size": 40'
+                     ', "refs": [1, 2]}')
+        lines.append('{"address": 10, "type": "tuple", "size": 20'
+                     ', "refs": [9, 5]}')
+        rules = loader.EdgeRules().drop_into('Registry')
+        manager = loader.load(lines, show_prog=False, edge_rules=rules)
+        self.assertEqual([5, 0], manager[10].children)
+        self.assertEqual(0, manager[9].num_parents)
+        self.assertTrue(10 in manager[5].parents)
+        rules = loader.expensive_reference_rules().drop_slots('tuple', 0)
+        self.assertEqual(set([1, 2]), rules.slots['function'])
+        manager.prune_edges(rules)
+        self.assertEqual([0, 0], manager[10].children)
+
     def test_collapse_instance_dicts(self):
         manager = loader.load(_instance_dump, show_prog=False, collapse=False)
         # This should collapse all of the references from the instance's dict
@@ -392,6 +708,21 @@ class TestObjManager(tests.TestCase):
         self.assertEqual([4, 5, 6, 7, 2], instance.children)
         self.assertEqual('OldStyle', instance.type_str)
 
+    def test_collapse_instance_dicts_updates_parents(self):
+        for dump in (_instance_dump, _old_instance_dump):
+            manager = loader.load(dump, show_prog=False, collapse=False)
+            manager.compute_parents()
+            manager.collapse_instance_dicts()
+            parents = dict((obj.address, sorted(obj.parents))
+                           for obj in manager.objs.itervalues())
+            total_parents = dict((obj.address, obj.total_parents)
+                                 for obj in manager.objs.itervalues())
+            manager.compute_parents()
+            for obj in manager.objs.itervalues():
+                self.assertEqual(sorted(obj.parents), parents[obj.address])
+                self.assertEqual(obj.total_parents,
+                                 total_parents[obj.address])
+
     def test_expand_refs_as_dict(self):
         # TODO: This test fails if simplejson is not installed, because the
         #       regex extractor does not cast to integers (they stay as
@@ -425,6 +756,38 @@ class TestObjManager(tests.TestCase):
                          sorted(summary.type_summaries.keys()))
         self.assertEqual(257, summary.total_size)
 
+    def test_summarize_all(self):
+        manager = loader.load(_example_dump, show_prog=False, collapse=False)
+        summary = manager.summarize()
+        self.assertEqual(8, summary.total_count)
+        self.assertEqual(321, summary.total_size)
+        self.assertEqual(['dict', 'int', 'list', 'module', 'str', 'tuple'],
+                         sorted(summary.type_summaries.keys()))
+        tuples = summary.type_summaries['tuple']
+        self.assertEqual(2, tuples.count)
+        self.assertEqual(40, tuples.total_size)
+        self.assertEqual(800, tuples.sq_sum)
+        self.assertEqual(20, tuples.max_size)
+        self.assertTrue(tuples.max_address in (1, 7))
+        summary.by_size()
+        self.assertEqual('dict', summary.summaries[0].type_str)
+
+    def test_find_duplicate_values(self):
+        lines = list(_example_dump)
+        lines.append('{"address": 9, "type": "str", "size": 29, "len": 5'
+                     ', "value": "a str", "refs": []}')
+        lines.append('{"address": 10, "type": "str", "size": 29, "len": 5'
+                     ', "value": "a str", "refs": []}')
+        manager = loader.load(lines, show_prog=False, collapse=False)
+        manager.compute_parents()
+        (dup,) = manager.find_duplicate_values()
+        self.assertEqual('str', dup.type_str)
+        self.assertEqual('a str', dup.value)
+        self.assertEqual(3, dup.count)
+        self.assertEqual(58, dup.wasted_size)
+        self.assertEqual([6, 9, 10], sorted(dup.addresses))
+        self.assertEqual([2], dup.holders)
+
     def test_summarize_excluding(self):
         manager = loader.load(_example_dump, show_prog=False)
         summary = manager.summarize(manager[8], excluding=[4, 5])
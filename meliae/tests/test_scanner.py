@@ -14,6 +14,7 @@
 
 """The core routines for scanning python references and dumping memory info."""
 
+import sys
 import tempfile
 
 from meliae import (
@@ -83,6 +84,84 @@ class TestDumpAllReferenced(tests.TestCase):
         self.assertDumpAllReferenced([a, b, c, l], c)
 
 
+class TestDumpGCObjects(tests.TestCase):
+
+    def dump_addresses(self, **kwargs):
+        t = tempfile.TemporaryFile(prefix='meliae-')
+        t_file = getattr(t, 'file', t)
+        scanner.dump_gc_objects(t_file, **kwargs)
+        t.seek(0)
+        return [int(line.split(',', 1)[0][len('{"address": '):])
+                for line in t]
+
+    def test_dedupe(self):
+        shared = 'a string referenced %s' % ('twice',)
+        objs = [[shared], [shared]]
+        addresses = self.dump_addresses(dedupe=True)
+        self.assertEqual(len(set(addresses)), len(addresses))
+        self.assertTrue(id(shared) in addresses)
+        self.assertTrue(id(objs[0]) in addresses)
+        addresses = self.dump_addresses(dedupe=True, bloom_size=1 << 20)
+        self.assertEqual(len(set(addresses)), len(addresses))
+
+    def test_nodump_refcount(self):
+        shared = 'a string referenced %s' % ('often',)
+        objs = [[shared] for i in xrange(10)]
+        addresses = self.dump_addresses()
+        self.assertTrue(addresses.count(id(shared)) >= 10)
+        addresses = self.dump_addresses(nodump_refcount=5)
+        self.assertEqual(1, addresses.count(id(shared)))
+
+    def test_refcounts(self):
+        obj = ['a list referenced by %s' % ('obj',)]
+        t = tempfile.TemporaryFile(prefix='meliae-')
+        t_file = getattr(t, 'file', t)
+        scanner.dump_gc_objects(t_file, refcounts=True)
+        t.seek(0)
+        prefix = '{"address": %d,' % (id(obj),)
+        lines = [line for line in t if line.startswith(prefix)]
+        self.assertEqual(1, len(lines))
+        self.assertTrue(lines[0].endswith(', "refcnt": 1, "gc": true}\n'),
+                        lines[0])
+
+    def test_refcounts_exact(self):
+        obj = ['a list referenced by', 'obj']
+        holders = ([obj], (obj,), {1: obj})
+        # obj, the holders, and nothing else
+        num_refs = sys.getrefcount(obj) - 1
+        self.assertEqual(4, num_refs)
+        t = tempfile.TemporaryFile(prefix='meliae-')
+        t_file = getattr(t, 'file', t)
+        scanner.dump_gc_objects(t_file, refcounts=True)
+        t.seek(0)
+        prefix = '{"address": %d,' % (id(obj),)
+        lines = [line for line in t if line.startswith(prefix)]
+        self.assertEqual(1, len(lines))
+        self.assertTrue(lines[0].endswith(', "refcnt": %d, "gc": true}\n'
+                                          % (num_refs,)), lines[0])
+
+    def test_refs_held_by_loop(self):
+        self.assertEqual(2, scanner._refs_held_by_loop(1))
+        self.assertEqual(3, scanner._refs_held_by_loop(2))
+
+    def test_refcounts_static_types(self):
+        t = tempfile.TemporaryFile(prefix='meliae-')
+        t_file = getattr(t, 'file', t)
+        scanner.dump_gc_objects(t_file, refcounts=True)
+        num_refs = sys.getrefcount(dict) - 1
+        t.seek(0)
+        prefix = '{"address": %d,' % (id(dict),)
+        lines = [line for line in t if line.startswith(prefix)]
+        self.assertEqual(1, len(lines))
+        # Built-in types list their references, so their __dict__ and
+        # __mro__ aren't taken as referenced from outside the dump
+        self.assertTrue(', %d,' % (id(dict.__mro__),) in lines[0], lines[0])
+        # dict is in nodump three times, but only dumped once, with just
+        # the references from outside dump_gc_objects
+        self.assertTrue(lines[0].endswith(', "refcnt": %d, "gc": false}\n'
+                                          % (num_refs,)), lines[0])
+
+
 class TestGetRecursiveSize(tests.TestCase):
 
     def assertRecursiveSize(self, n_objects, total_size, obj):
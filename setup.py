@@ -75,6 +75,9 @@ The name is simply a fun word (means Ash-wood Nymph).
                          ["meliae/_loader.pyx"]))
     ext.append(Extension("meliae._intset",
                          ["meliae/_intset.pyx"]))
+    ext.append(Extension("meliae._zran",
+                         ["meliae/_zran.pyx"],
+                         libraries=["z"]))
 
     setup(**kwargs)
 